@@ -0,0 +1,186 @@
+import os
+import socket
+import logging
+import ipaddress
+import threading
+from dataclasses import dataclass, field
+from typing import Iterable, NamedTuple, Optional, Tuple
+
+from _exceptions import *
+
+
+ACCESS_ALLOW, ACCESS_DENY = "allow", "deny"
+
+
+class _PrefixNode:
+    __slots__ = ("prefix", "length", "children", "value")
+
+    def __init__(self, prefix: int, length: int, value: Optional[str] = None) -> None:
+        self.prefix = prefix        ## the first `length` bits of the network address
+        self.length = length
+        self.children = [None, None]
+        self.value = value
+
+
+class PrefixTree:
+    """Path compressed binary (PATRICIA) trie of the network prefixes of one
+    address family
+
+    A lookup follows a single path from the root, and so compares at most
+    `bits` (32 or 128) bits whatever the number of prefixes in the tree"""
+    __slots__ = ("bits", "_root", "_size")
+
+    def __init__(self, bits: int) -> None:
+        self.bits = bits
+        self._root = _PrefixNode(0, 0)
+        self._size = 0
+
+
+    def __len__(self) -> int:
+        return self._size
+
+
+    def insert(self, network: int, length: int, value: str) -> None:
+        """Sets the value of the prefix `network`/`length` (replacing the value of a duplicate prefix)"""
+        prefix = network >> (self.bits - length)
+        node = self._root
+        while True:
+            if node.length == length:
+                self._size += node.value is None
+                node.value = value
+                return None
+            bit = (prefix >> (length - node.length - 1)) & 1
+            child = node.children[bit]
+            if child is None:
+                node.children[bit] = _PrefixNode(prefix, length, value)
+                self._size += 1
+                return None
+
+            ## The bits the new prefix shares with the child (past the ones they share with `node`)
+            commonLength = min(child.length, length)
+            difference = (child.prefix >> (child.length - commonLength)) ^ (prefix >> (length - commonLength))
+            commonLength -= difference.bit_length()
+            if commonLength == child.length:
+                node = child
+                continue
+
+            ## NOTE: The child is split where the prefixes diverge (or where the new prefix ends)
+            split = _PrefixNode(prefix >> (length - commonLength), commonLength)
+            childBit = (child.prefix >> (child.length - commonLength - 1)) & 1
+            split.children[childBit] = child
+            node.children[bit] = split
+            if commonLength == length:
+                split.value = value
+            else:
+                split.children[1 - childBit] = _PrefixNode(prefix, length, value)
+            self._size += 1
+            return None
+
+
+    def lookup(self, address: int) -> Optional[str]:
+        """Returns the value of the longest prefix that contains the address (or None)"""
+        bits, match = self.bits, None
+        node = self._root
+        while node is not None:
+            if (address >> (bits - node.length)) != node.prefix:
+                break
+            if node.value is not None:
+                match = node.value
+            if node.length == bits:
+                break
+            node = node.children[(address >> (bits - node.length - 1)) & 1]
+        return match
+
+
+
+class _AccessTrees(NamedTuple):
+    ## NOTE: Swapped as a whole on reload, so a concurrent lookup only ever sees one version of the list
+    ipv4: PrefixTree
+    ipv6: PrefixTree
+    fileId: Optional[Tuple[int, int, int]]
+
+
+@dataclass
+class AccessList:
+    """Allow/deny rules of client networks, where the longest (most specific)
+    matching prefix decides, and clients that no rule matches are allowed
+
+    The rules are loaded from `path` - one "allow <cidr>" or "deny <cidr>"
+    per line (a bare "<cidr>" is denied, so a plain blocklist can be used as
+    is), with "#" comments. reload() builds the new trees before swapping
+    them in, so it can be run off the event loop"""
+    path: Optional[str] = None
+    RELOAD_CHECK_INTERVAL: float = 1.0
+
+    _trees: _AccessTrees = field(init=False, repr=False, default=None)
+    _reloadLock: threading.Lock = field(init=False, repr=False, default_factory=threading.Lock)
+
+    def __post_init__(self) -> None:
+        self._trees = _AccessTrees(PrefixTree(32), PrefixTree(128), None)
+        if self.path is not None:
+            self.reload()
+
+
+    @classmethod
+    def fromRules(cls, rules: Iterable[Tuple[str, str]]) -> "AccessList":
+        """Returns an access list of (action, cidr) rules (that isn't backed by a file)"""
+        accessList = cls()
+        accessList._trees = accessList._buildTrees(rules, None)
+        return accessList
+
+
+    def __len__(self) -> int:
+        return len(self._trees.ipv4) + len(self._trees.ipv6)
+
+
+    def allows(self, host: str) -> bool:
+        trees = self._trees
+        try:
+            if ":" in host:
+                action = trees.ipv6.lookup(int.from_bytes(socket.inet_pton(socket.AF_INET6, host), "big"))
+            else:
+                action = trees.ipv4.lookup(int.from_bytes(socket.inet_pton(socket.AF_INET, host), "big"))
+        except OSError:
+            return True ## e.g. not an IP address (the list only has IP rules)
+        return action != ACCESS_DENY
+
+
+    def reload(self) -> bool:
+        """Loads the rules file again if it has been replaced (returns whether it was)"""
+        with self._reloadLock:
+            stat = os.stat(self.path)
+            fileId = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+            if self._trees.fileId == fileId:
+                return False
+            with open(self.path, "r") as rulesFile:
+                trees = self._buildTrees(self._parseRules(rulesFile), fileId)
+            self._trees = trees
+            logging.info(f"Access list {self.path} loaded ({len(self)} prefixes)")
+            return True
+
+
+    def _buildTrees(self, rules: Iterable[Tuple[str, str]], fileId: Optional[Tuple[int, int, int]]) -> _AccessTrees:
+        trees = _AccessTrees(PrefixTree(32), PrefixTree(128), fileId)
+        for action, cidr in rules:
+            if action not in (ACCESS_ALLOW, ACCESS_DENY):
+                raise InvalidAccessListError(self.path, f"unknown action {action!r} (must be allow or deny)")
+            try:
+                network = ipaddress.ip_network(cidr, strict=False)
+            except ValueError as e:
+                raise InvalidAccessListError(self.path, str(e))
+            tree = trees.ipv4 if network.version == 4 else trees.ipv6
+            tree.insert(int(network.network_address), network.prefixlen, action)
+        return trees
+
+
+    def _parseRules(self, lines: Iterable[str]) -> Iterable[Tuple[str, str]]:
+        for line in lines:
+            words = line.split("#", 1)[0].split()
+            if not words:
+                continue
+            if len(words) == 1:
+                yield ACCESS_DENY, words[0]
+            elif len(words) == 2:
+                yield words[0].lower(), words[1]
+            else:
+                raise InvalidAccessListError(self.path, f"invalid rule {line.strip()!r}")
@@ -0,0 +1,108 @@
+import time
+import ipaddress
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+from _exceptions import *
+
+
+@dataclass
+class TokenBucketTable:
+    """Token buckets of at most `maxEntries` keys, that are evicted least
+    recently used first
+
+    A key's bucket holds up to `burst` tokens, and is refilled at `rate`
+    tokens per second. An evicted key starts again with a full bucket, so
+    the table bounds the memory (not the rate) when there are more keys"""
+    rate: float
+    burst: float
+    maxEntries: int = 65536
+
+    ## NOTE: key -> [tokens, time of the last refill] (a list, so it's updated in place)
+    _buckets: "OrderedDict[str, List[float]]" = field(init=False, repr=False, default_factory=OrderedDict)
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+
+    def bucket(self, key: str, now: float) -> List[float]:
+        """Returns the key's bucket, refilled up to `now`"""
+        buckets = self._buckets
+        bucket = buckets.get(key)
+        if bucket is None:
+            if len(buckets) >= self.maxEntries:
+                buckets.popitem(last=False)
+            bucket = buckets[key] = [self.burst, now]
+            return bucket
+        buckets.move_to_end(key)
+        bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        return bucket
+
+
+
+@dataclass
+class AdmissionControl:
+    """Rate limits new connections per client IP (and optionally per client
+    network), before the proxy connects to a backend or creates a tunnel
+
+    - A client IP may open `burst` connections at once, and `rate` per second after that
+    - With `prefixRate`, the clients in the same network (IPv4 /`prefixLength`,
+      IPv6 /`prefixLength6`) also share a bucket of `prefixBurst` connections"""
+    rate: float
+    burst: int
+    prefixRate: Optional[float] = None
+    prefixBurst: Optional[int] = None
+    prefixLength: int = 24
+    prefixLength6: int = 64
+    maxEntries: int = 65536
+
+    _hosts: TokenBucketTable = field(init=False, repr=False)
+    _prefixes: Optional[TokenBucketTable] = field(init=False, repr=False, default=None)
+
+    def __post_init__(self) -> None:
+        self._validateArgs()
+        self._hosts = TokenBucketTable(self.rate, self.burst, self.maxEntries)
+        if self.prefixRate is not None:
+            prefixBurst = self.burst if self.prefixBurst is None else self.prefixBurst
+            self._prefixes = TokenBucketTable(self.prefixRate, prefixBurst, self.maxEntries)
+
+
+    def _validateArgs(self) -> None:
+        for name in ("rate", "burst", "prefixRate", "prefixBurst", "maxEntries"):
+            value = getattr(self, name)
+            if value is None and name.startswith("prefix"):
+                continue
+            if not (isinstance(value, (int, float)) and value > 0):
+                raise InvalidAdmissionControlError(self, f"{name} must be a positive number")
+        if not (isinstance(self.prefixLength, int) and 0 <= self.prefixLength <= 32):
+            raise InvalidAdmissionControlError(self, "prefixLength must be an int from 0 to 32")
+        if not (isinstance(self.prefixLength6, int) and 0 <= self.prefixLength6 <= 128):
+            raise InvalidAdmissionControlError(self, "prefixLength6 must be an int from 0 to 128")
+
+
+    def admits(self, clientHost: str, now: Optional[float] = None) -> bool:
+        """Takes a token for a new connection of the client (False if it has to be dropped)"""
+        now = time.monotonic() if now is None else now
+        hostBucket = self._hosts.bucket(clientHost, now)
+        if hostBucket[0] < 1:
+            return False
+        if self._prefixes is not None:
+            ## NOTE: A token is only taken once both buckets have one (so a dropped connection costs nothing)
+            prefixBucket = self._prefixes.bucket(self._prefixKey(clientHost), now)
+            if prefixBucket[0] < 1:
+                return False
+            prefixBucket[0] -= 1
+        hostBucket[0] -= 1
+        return True
+
+
+    def trackedClients(self) -> int:
+        return len(self._hosts)
+
+
+    def _prefixKey(self, clientHost: str) -> str:
+        address = ipaddress.ip_address(clientHost)
+        prefixLength = self.prefixLength if address.version == 4 else self.prefixLength6
+        return str(ipaddress.ip_network((address, prefixLength), strict=False))
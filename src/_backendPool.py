@@ -0,0 +1,384 @@
+import bisect
+import hashlib
+import heapq
+import ipaddress
+import logging
+import socket
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Callable, Deque, List, Optional, Set, Tuple
+
+from _exceptions import *
+
+
+## Circuit breaker states of a backend
+BREAKER_CLOSED, BREAKER_OPEN, BREAKER_HALF_OPEN = "closed", "open", "half-open"
+
+
+@dataclass(eq=False)
+class Backend:
+    """A server that tunnels can be proxied to"""
+    host: str
+    port: int
+    weight: int = 1
+    ## NOTE: Kept up to date by ProxyConnections as the backend's tunnels are created and closed
+    activeTunnels: int = field(init=False, default=0)
+    ## NOTE: New tunnels are only picked for a backend whose circuit is closed (see BackendPool)
+    state: str = field(init=False, default=BREAKER_CLOSED)
+    _index: int = field(init=False, repr=False, default=0)     ## position in its pool
+    _failures: Deque[float] = field(init=False, repr=False, default_factory=deque)   ## times of the recent failures
+    _openedAt: float = field(init=False, repr=False, default=0.0)
+
+    @property
+    def address(self) -> Tuple[str, int]:
+        return self.host, self.port
+
+
+@dataclass
+class BackendPool:
+    """The backends of a proxy, and the strategy that picks the backend of
+    each new tunnel
+
+    - "round-robin":     backends in turn (a backend with weight w gets w turns per cycle)
+    - "least-active":    the backend with the fewest live tunnels per unit of weight
+    - "consistent-hash": the backend that the client IP hashes to, so a client keeps
+                         its backend (and only ~1/n of clients move when a backend is added)
+
+    Each backend has a circuit breaker - `failureThreshold` failures (failed
+    connects, or connections reset by the backend) within `failureWindow`
+    seconds open it, and the backend isn't picked again until `openSeconds`
+    later, when a single tunnel is let through as a trial (half-open). The
+    trial connect closes the circuit again, or reopens it"""
+    backends: List[Backend]
+    strategy: str = "round-robin"
+    failureThreshold: int = 3
+    failureWindow: float = 10.0
+    openSeconds: float = 5.0
+    ## NOTE: None waits for the OS connect timeout
+    connectTimeout: Optional[float] = None
+    STRATEGIES = ("round-robin", "least-active", "consistent-hash")
+    ## NOTE: Points per unit of weight on the hash ring (more points spread the clients more evenly)
+    VIRTUAL_NODES: int = 64
+
+    _schedule: List[int] = field(init=False, repr=False, default_factory=list)
+    _turn: int = field(init=False, repr=False, default=0)
+    _heap: List[int] = field(init=False, repr=False, default_factory=list)
+    _heapPositions: List[int] = field(init=False, repr=False, default_factory=list)
+    _ringHashes: List[int] = field(init=False, repr=False, default_factory=list)
+    _ringBackends: List[int] = field(init=False, repr=False, default_factory=list)
+    _closedCount: int = field(init=False, repr=False, default=0)
+    ## NOTE: (openedAt, backend) in the order the circuits were opened (so the next trial is always at the front)
+    _openBackends: Deque[Tuple[float, Backend]] = field(init=False, repr=False, default_factory=deque)
+
+    def __post_init__(self) -> None:
+        self._validateArgs()
+        self._closedCount = len(self.backends)
+        ## NOTE: Every strategy's structure is built up front, so that a pick doesn't scan the backends
+        for index, backend in enumerate(self.backends):
+            backend._index = index
+        self._schedule = self._buildSchedule()
+        self._heap = list(range(len(self.backends)))
+        self._heapPositions = list(range(len(self.backends)))
+        self._ringHashes, self._ringBackends = self._buildRing()
+
+
+    @classmethod
+    def single(cls, host: str, port: int) -> "BackendPool":
+        return cls([Backend(host, port)])
+
+
+    def _validateArgs(self) -> None:
+        if not self.backends:
+            raise InvalidBackendPoolError(self, "there must be at least one backend")
+        if self.strategy not in self.STRATEGIES:
+            raise InvalidBackendPoolError(self, f"unknown strategy {self.strategy!r} (must be one of {self.STRATEGIES})")
+        for backend in self.backends:
+            ## Raises an exception if not a valid ip_address
+            ipaddress.ip_address(backend.host)
+            if not (isinstance(backend.port, int) and 0 < backend.port):
+                raise InvalidProxyPortError(backend.port)
+            if not (isinstance(backend.weight, int) and backend.weight > 0):
+                raise InvalidBackendPoolError(self, f"the weight of {backend.address} must be a positive int")
+        if not (isinstance(self.failureThreshold, int) and self.failureThreshold > 0):
+            raise InvalidBackendPoolError(self, "failureThreshold must be a positive int")
+        for name in ("failureWindow", "openSeconds", "connectTimeout"):
+            value = getattr(self, name)
+            if not (value is None and name == "connectTimeout") and not (isinstance(value, (int, float)) and value > 0):
+                raise InvalidBackendPoolError(self, f"{name} must be a positive number")
+
+
+    def __len__(self) -> int:
+        return len(self.backends)
+
+
+    def pick(self, clientHost: Optional[str] = None, now: Optional[float] = None,
+                exclude: Optional[Set[Backend]] = None) -> Optional[Backend]:
+        """Returns the backend for a new tunnel of the client (or None if
+        every backend's circuit is open, or is in `exclude` - e.g. the
+        backends that a failed connect was already retried on)"""
+        if self._openBackends:
+            trial = self._pickTrial(time.monotonic() if now is None else now)
+            if trial is not None and not (exclude and trial in exclude):
+                return trial
+        if not self._closedCount:
+            return None
+        if len(self.backends) == 1:
+            backend = self.backends[0]
+            return None if exclude and backend in exclude else backend
+        if self.strategy == "round-robin":
+            return self._pickRoundRobin(exclude)
+        elif self.strategy == "least-active":
+            return self._pickLeastActive(exclude)
+        return self._pickConsistentHash(clientHost, exclude)
+
+
+    def acquire(self, backend: Backend) -> None:
+        """Counts a new live tunnel of the backend"""
+        backend.activeTunnels += 1
+        if self.strategy == "least-active":
+            self._siftDown(self._heapPositions[backend._index])
+
+
+    def release(self, backend: Backend) -> None:
+        """Counts a closed tunnel of the backend"""
+        backend.activeTunnels -= 1
+        if self.strategy == "least-active":
+            self._siftUp(self._heapPositions[backend._index])
+
+
+    def recordSuccess(self, backend: Backend) -> None:
+        """Records a successful connect (or probe) to the backend"""
+        if backend.state == BREAKER_CLOSED:
+            return None
+        logging.info(f"Backend {backend.host}:{backend.port} recovered - its circuit is closed")
+        backend.state = BREAKER_CLOSED
+        backend._failures.clear()
+        self._closedCount += 1
+        self._reheap(backend)
+
+
+    def recordFailure(self, backend: Backend, now: Optional[float] = None) -> None:
+        """Records a failed connect (or probe) to the backend, or a
+        connection that the backend reset"""
+        now = time.monotonic() if now is None else now
+        if backend.state == BREAKER_HALF_OPEN:
+            return self._trip(backend, now)
+        if backend.state == BREAKER_OPEN:
+            ## e.g. a tunnel that was opened before the circuit was
+            return None
+        failures = backend._failures
+        failures.append(now)
+        while failures[0] <= now - self.failureWindow:
+            failures.popleft()
+        if len(failures) >= self.failureThreshold:
+            self._trip(backend, now)
+
+
+    ################## Circuit Breaking ######################
+    def _trip(self, backend: Backend, now: float) -> None:
+        logging.warning(f"WARNING: Backend {backend.host}:{backend.port} is failing - its circuit is open for {self.openSeconds}s")
+        if backend.state == BREAKER_CLOSED:
+            self._closedCount -= 1
+        backend.state, backend._openedAt = BREAKER_OPEN, now
+        backend._failures.clear()
+        self._openBackends.append((now, backend))
+        self._reheap(backend)
+
+
+    def _pickTrial(self, now: float) -> Optional[Backend]:
+        ## NOTE: Entries of circuits that have since been closed (or reopened) are stale, and are dropped
+        openBackends = self._openBackends
+        while openBackends:
+            openedAt, backend = openBackends[0]
+            if backend.state == BREAKER_CLOSED or backend._openedAt != openedAt:
+                openBackends.popleft()
+            elif now - openedAt < self.openSeconds:
+                return None
+            else:
+                ## NOTE: A trial whose outcome is never recorded is retried after another openSeconds
+                openBackends.popleft()
+                backend.state, backend._openedAt = BREAKER_HALF_OPEN, now
+                openBackends.append((now, backend))
+                return backend
+        return None
+
+
+    def _reheap(self, backend: Backend) -> None:
+        if self.strategy == "least-active":
+            self._siftUp(self._heapPositions[backend._index])
+            self._siftDown(self._heapPositions[backend._index])
+
+
+    ################## Round Robin ######################
+    def _buildSchedule(self) -> List[int]:
+        ## NOTE: Smooth weighted round-robin - a heavier backend's turns are spread over the cycle (not bunched)
+        weights = [backend.weight for backend in self.backends]
+        current, total = [0] * len(weights), sum(weights)
+        schedule = []
+        for _ in range(total):
+            for index, weight in enumerate(weights):
+                current[index] += weight
+            index = max(range(len(weights)), key=current.__getitem__)
+            current[index] -= total
+            schedule.append(index)
+        return schedule
+
+
+    def _pickRoundRobin(self, exclude: Optional[Set[Backend]] = None) -> Optional[Backend]:
+        ## NOTE: Backends whose circuit isn't closed (or that are excluded) lose their turns
+        schedule = self._schedule
+        for _ in range(len(schedule)):
+            backend = self.backends[schedule[self._turn]]
+            self._turn = (self._turn + 1) % len(schedule)
+            if backend.state == BREAKER_CLOSED and not (exclude and backend in exclude):
+                return backend
+        return None
+
+
+    ################## Least Active ######################
+    ## NOTE: The backends are kept in a heap ordered by tunnels per unit of weight, so a pick is the top of
+    ## the heap, and as a count only changes by one, its backend moves by a few swaps (O(log backends))
+    def _load(self, index: int) -> Tuple[bool, float, int]:
+        ## NOTE: Backends whose circuit isn't closed sink below every closed backend
+        backend = self.backends[index]
+        return backend.state != BREAKER_CLOSED, backend.activeTunnels / backend.weight, index
+
+
+    def _swap(self, i: int, j: int) -> None:
+        heap, positions = self._heap, self._heapPositions
+        heap[i], heap[j] = heap[j], heap[i]
+        positions[heap[i]], positions[heap[j]] = i, j
+
+
+    def _pickLeastActive(self, exclude: Optional[Set[Backend]] = None) -> Optional[Backend]:
+        heap = self._heap
+        if not exclude:
+            return self.backends[heap[0]]
+        ## NOTE: The excluded backends are skipped with a best-first walk down the heap, so only the children
+        ## of excluded backends are visited (O(excluded * log backends))
+        candidates = [(self._load(heap[0]), 0)]
+        while candidates:
+            (notClosed, _, index), position = heapq.heappop(candidates)
+            if notClosed:
+                return None
+            backend = self.backends[index]
+            if backend not in exclude:
+                return backend
+            for child in (2 * position + 1, 2 * position + 2):
+                if child < len(heap):
+                    heapq.heappush(candidates, (self._load(heap[child]), child))
+        return None
+
+
+    def _siftUp(self, position: int) -> None:
+        while position > 0:
+            parent = (position - 1) // 2
+            if self._load(self._heap[parent]) <= self._load(self._heap[position]):
+                return None
+            self._swap(parent, position)
+            position = parent
+
+
+    def _siftDown(self, position: int) -> None:
+        heap = self._heap
+        while True:
+            smallest = position
+            for child in (2 * position + 1, 2 * position + 2):
+                if child < len(heap) and self._load(heap[child]) < self._load(heap[smallest]):
+                    smallest = child
+            if smallest == position:
+                return None
+            self._swap(position, smallest)
+            position = smallest
+
+
+    ################## Consistent Hashing ######################
+    @staticmethod
+    def _hash(key: str) -> int:
+        ## NOTE: A stable hash (the builtin hash() of a str differs between processes)
+        return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+    def _buildRing(self) -> Tuple[List[int], List[int]]:
+        points = sorted((self._hash(f"{backend.host}:{backend.port}#{node}"), index)
+                            for index, backend in enumerate(self.backends)
+                            for node in range(self.VIRTUAL_NODES * backend.weight))
+        return [point for point, _ in points], [index for _, index in points]
+
+
+    def _pickConsistentHash(self, clientHost: Optional[str], exclude: Optional[Set[Backend]] = None) -> Optional[Backend]:
+        if clientHost is None:
+            return self._pickRoundRobin(exclude)
+        position = bisect.bisect(self._ringHashes, self._hash(clientHost))
+        ## NOTE: A client of a backend whose circuit isn't closed (or that is excluded) moves to the next backend
+        ## on the ring
+        ringBackends = self._ringBackends
+        for offset in range(len(ringBackends)):
+            backend = self.backends[ringBackends[(position + offset) % len(ringBackends)]]
+            if backend.state == BREAKER_CLOSED and not (exclude and backend in exclude):
+                return backend
+        return None
+
+
+
+@dataclass
+class BackendProber:
+    """Connects to every backend of the pool each `interval` seconds, from a
+    background thread (so a probe never blocks the event loop)
+
+    The results are only queued by the thread - they are recorded in the
+    pool by the event loop (see applyResults()), as the pool isn't locked"""
+    backendPool: BackendPool
+    interval: float = 5.0
+    timeout: float = 1.0
+    ## NOTE: Called by the thread after each round of probes (e.g. to wake up the event loop)
+    onResults: Optional[Callable[[], None]] = None
+    _results: Deque[Tuple[Backend, bool]] = field(init=False, repr=False, default_factory=deque)
+    _stopped: threading.Event = field(init=False, repr=False, default_factory=threading.Event)
+    _thread: Optional[threading.Thread] = field(init=False, repr=False, default=None)
+
+    def __post_init__(self) -> None:
+        for name in ("interval", "timeout"):
+            value = getattr(self, name)
+            if not (isinstance(value, (int, float)) and value > 0):
+                raise InvalidBackendPoolError(self.backendPool, f"the probe {name} must be a positive number")
+
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="BackendProber", daemon=True)
+            self._thread.start()
+
+
+    def close(self) -> None:
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+    def applyResults(self) -> None:
+        while self._results:
+            backend, healthy = self._results.popleft()
+            if healthy:
+                self.backendPool.recordSuccess(backend)
+            else:
+                self.backendPool.recordFailure(backend)
+
+
+    def probe(self, backend: Backend) -> bool:
+        try:
+            socket.create_connection(backend.address, timeout=self.timeout).close()
+        except OSError:
+            return False
+        return True
+
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            for backend in self.backendPool.backends:
+                self._results.append((backend, self.probe(backend)))
+            if self.onResults is not None:
+                self.onResults()
@@ -0,0 +1,170 @@
+import os
+import math
+import mmap
+import time
+import struct
+import hashlib
+import threading
+from dataclasses import dataclass, field
+from typing import Iterable, NamedTuple, Optional, Tuple
+
+from _exceptions import *
+
+
+## NOTE: The index file holds no plaintext credentials - only a keyed hash of each "username\0password" pair
+## Layout: | header | bloom filter bits | sorted array of DIGEST_SIZE records |
+INDEX_MAGIC = b"BAITIDX1"
+INDEX_VERSION = 1
+INDEX_HEADER = struct.Struct("<8sIQQI")    ## magic, version, record count, bloom bits, bloom hashes
+DIGEST_SIZE = 16
+
+
+def credentialDigest(username: str, password: str, key: bytes = b"") -> bytes:
+    return hashlib.blake2b(username.encode("utf-8", "surrogateescape") + b"\0" + password.encode("utf-8", "surrogateescape"),
+                            digest_size=DIGEST_SIZE, key=key).digest()
+
+
+def _bloomBitIndexes(digest: bytes, bloomBits: int, bloomHashes: int) -> Iterable[int]:
+    ## NOTE: Double hashing (h1 + i*h2) derives every bloom hash from the one digest
+    h1 = int.from_bytes(digest[:8], "little")
+    h2 = int.from_bytes(digest[8:], "little") | 1
+    return ((h1 + i * h2) % bloomBits for i in range(bloomHashes))
+
+
+class _IndexState(NamedTuple):
+    ## NOTE: Swapped as a whole on reload, so a concurrent lookup only ever sees one version of the index
+    mapping: mmap.mmap
+    recordCount: int
+    bloomBits: int
+    bloomHashes: int
+    bloomOffset: int
+    recordsOffset: int
+    fileId: Tuple[int, int, int]    ## (inode, size, mtime) of the file that was mapped
+
+
+@dataclass
+class BaitCredentialIndex:
+    """Read-only index of bait credentials that is memory mapped from disk
+
+    A Bloom filter answers most (negative) lookups, and the remaining ones
+    are confirmed with a binary search over the sorted digests. The file is
+    mapped (instead of read), so every process that opens the index shares
+    the page cache instead of holding its own copy.
+
+    The file is rebuilt out of place (see build()) and picked up by
+    reload() / reloadIfChanged() without a restart"""
+    path: str
+    key: bytes = field(default=b"", repr=False)
+    RELOAD_CHECK_INTERVAL: float = 1.0
+
+    _state: Optional[_IndexState] = field(init=False, repr=False, default=None)
+    _lastReloadCheck: float = field(init=False, repr=False, default=0.0)
+    _reloadLock: threading.Lock = field(init=False, repr=False, default_factory=threading.Lock)
+
+    def __post_init__(self) -> None:
+        self.reload()
+
+
+    @classmethod
+    def build(cls, path: str, credentials: Iterable[Tuple[str, str]], key: bytes = b"",
+                falsePositiveRate: float = 0.01) -> "BaitCredentialIndex":
+        """Writes the index for the (username, password) pairs, replacing any
+        existing index at `path` atomically, and returns it opened"""
+        if not (0 < falsePositiveRate < 1):
+            raise InvalidBloomFilterRateError(falsePositiveRate)
+
+        digests = sorted({credentialDigest(username, password, key) for username, password in credentials})
+        bloomBits, bloomHashes = cls._bloomParameters(len(digests), falsePositiveRate)
+        bloom = bytearray((bloomBits + 7) // 8)
+        for digest in digests:
+            for bit in _bloomBitIndexes(digest, bloomBits, bloomHashes):
+                bloom[bit >> 3] |= 1 << (bit & 7)
+
+        ## NOTE: Readers keep the old mapping until they reload, as the new index is swapped in with a rename
+        temporaryPath = f"{path}.{os.getpid()}.tmp"
+        with open(temporaryPath, "wb") as f:
+            f.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, len(digests), bloomBits, bloomHashes))
+            f.write(bloom)
+            f.write(b"".join(digests))
+        os.replace(temporaryPath, path)
+        return cls(path, key)
+
+
+    @staticmethod
+    def _bloomParameters(count: int, falsePositiveRate: float) -> Tuple[int, int]:
+        count = max(count, 1)
+        bloomBits = max(64, math.ceil(-count * math.log(falsePositiveRate) / (math.log(2) ** 2)))
+        bloomHashes = max(1, round(bloomBits / count * math.log(2)))
+        return bloomBits, bloomHashes
+
+
+    def __len__(self) -> int:
+        return self._state.recordCount
+
+
+    def contains(self, username: str, password: str) -> bool:
+        state = self._state
+        digest = credentialDigest(username, password, self.key)
+
+        ## Fast negatives (no record is touched)
+        mapping, bloomOffset = state.mapping, state.bloomOffset
+        for bit in _bloomBitIndexes(digest, state.bloomBits, state.bloomHashes):
+            if not mapping[bloomOffset + (bit >> 3)] & (1 << (bit & 7)):
+                return False
+
+        ## Confirm with a binary search over the sorted records
+        low, high = 0, state.recordCount
+        recordsOffset = state.recordsOffset
+        while low < high:
+            middle = (low + high) // 2
+            start = recordsOffset + middle * DIGEST_SIZE
+            record = mapping[start:start + DIGEST_SIZE]
+            if record < digest:
+                low = middle + 1
+            elif record > digest:
+                high = middle
+            else:
+                return True
+        return False
+
+
+    def reload(self) -> bool:
+        """Maps the index file again if it has been replaced (returns whether it was)"""
+        with self._reloadLock:
+            stat = os.stat(self.path)
+            fileId = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+            if self._state is not None and self._state.fileId == fileId:
+                return False
+            ## NOTE: The previous mapping isn't closed, as a lookup may still hold it (it's closed once unreferenced)
+            self._state = self._mapIndex(fileId)
+            return True
+
+
+    def isReloadDue(self) -> bool:
+        """Whether reloadIfChanged() would check the file (this doesn't touch the file itself)"""
+        return time.monotonic() - self._lastReloadCheck >= self.RELOAD_CHECK_INTERVAL
+
+
+    def reloadIfChanged(self) -> bool:
+        """reload(), but at most once every RELOAD_CHECK_INTERVAL seconds (so it can be called per lookup)"""
+        if not self.isReloadDue():
+            return False
+        self._lastReloadCheck = time.monotonic()
+        return self.reload()
+
+
+    def _mapIndex(self, fileId: Tuple[int, int, int]) -> _IndexState:
+        with open(self.path, "rb") as f:
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(mapping) < INDEX_HEADER.size:
+            raise InvalidCredentialIndexError(self.path, "the file is smaller than the header")
+        magic, version, recordCount, bloomBits, bloomHashes = INDEX_HEADER.unpack_from(mapping, 0)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            raise InvalidCredentialIndexError(self.path, f"unknown format {magic!r} (version {version})")
+
+        bloomOffset = INDEX_HEADER.size
+        recordsOffset = bloomOffset + (bloomBits + 7) // 8
+        if len(mapping) != recordsOffset + recordCount * DIGEST_SIZE:
+            raise InvalidCredentialIndexError(self.path, "the file size doesn't match the header")
+        return _IndexState(mapping, recordCount, bloomBits, bloomHashes, bloomOffset, recordsOffset, fileId)
@@ -8,6 +8,120 @@ class BufferOverflowError(BufferError):
         super().__init__(self.msg)
 
 
+class InvalidMemoryBudgetError(ValueError):
+    def __init__(self, memoryBudget: "MemoryBudget") -> None:
+        self.msg = f"Invalid MemoryBudget limits (0 <= resumeLimit <= softLimit <= hardLimit is required) - {memoryBudget}"
+        super().__init__(self.msg)
+
+
+class InvalidHookModeError(Exception):
+    def __init__(self, streamInterceptor: "StreamInterceptor") -> None:
+        self.msg = f"Invalid HOOK_MODE for {streamInterceptor} - {streamInterceptor.HOOK_MODE!r} (expected 'inline' or 'async')"
+        super().__init__(self.msg)
+
+
+class InvalidHookWorkersError(ValueError):
+    def __init__(self, hookWorkers: int) -> None:
+        self.msg = f"hookWorkers must be a positive integer (or None to run hooks inline) - {hookWorkers!r}"
+        super().__init__(self.msg)
+
+
+class MissingAsyncHookRunnerError(Exception):
+    def __init__(self, buffer: "Buffer") -> None:
+        self.msg = "A request hook returned an awaitable, but no AsyncHookRunner was set on the Buffer (see Buffer.setHook())"
+        super().__init__(self.msg)
+
+
+class InvalidBloomFilterRateError(ValueError):
+    def __init__(self, falsePositiveRate: float) -> None:
+        self.msg = f"The bloom filter false positive rate must be between 0 and 1 (exclusive) - {falsePositiveRate}"
+        super().__init__(self.msg)
+
+
+class InvalidCredentialIndexError(Exception):
+    def __init__(self, path: str, reason: str) -> None:
+        self.msg = f"Invalid bait credential index @ {path} - {reason}"
+        super().__init__(self.msg)
+
+
+class RequestRewriteUnavailableError(Exception):
+    def __init__(self, buffer: "Buffer") -> None:
+        self.msg = "A request can only be rewritten by a hook running inline, before any of the request has been forwarded (see Buffer.replaceRequest())"
+        super().__init__(self.msg)
+
+
+class InvalidEditRangeError(ValueError):
+    def __init__(self, start: int, end: int, length: int) -> None:
+        self.msg = f"Invalid edit range [{start}:{end}] - it must be within the request (length={length}) and not overlap its other edits"
+        super().__init__(self.msg)
+
+
+class DataChannelUnavailableError(Exception):
+    def __init__(self, proxyTunnel: "ProxyTunnel") -> None:
+        self.msg = "Cannot open a data channel for a ProxyTunnel that isn't managed by ProxyConnections"
+        super().__init__(self.msg)
+
+
+class InvalidSlidingWindowError(ValueError):
+    def __init__(self, sketch: "SlidingWindowSketch") -> None:
+        self.msg = f"The window, buckets, width and depth of a SlidingWindowSketch must be positive - {sketch!r}"
+        super().__init__(self.msg)
+
+
+class InvalidThrottleThresholdError(ValueError):
+    def __init__(self, throttleThreshold: object) -> None:
+        self.msg = f"throttleThreshold must be a positive int - {throttleThreshold!r}"
+        super().__init__(self.msg)
+
+
+class InvalidBackendPoolError(ValueError):
+    def __init__(self, backendPool: "BackendPool", reason: str) -> None:
+        self.msg = f"Invalid BackendPool - {reason}"
+        super().__init__(self.msg)
+
+
+class InvalidSessionCaptureError(ValueError):
+    def __init__(self, sessionCapture: "SessionCapture", reason: str) -> None:
+        self.msg = f"Invalid SessionCapture - {reason}"
+        super().__init__(self.msg)
+
+
+class InvalidCaptureFileError(ValueError):
+    def __init__(self, path: str, reason: str) -> None:
+        self.msg = f"Invalid capture file {path!r} - {reason}"
+        super().__init__(self.msg)
+
+
+class BackendUnavailableError(ConnectionError):
+    def __init__(self, backendPool: "BackendPool") -> None:
+        self.msg = "No backend is available - the circuit of every backend in the pool is open"
+        super().__init__(self.msg)
+
+
+class InvalidAdmissionControlError(ValueError):
+    def __init__(self, admissionControl: "AdmissionControl", reason: str) -> None:
+        self.msg = f"Invalid AdmissionControl - {reason}"
+        super().__init__(self.msg)
+
+
+class InvalidAccessListError(ValueError):
+    def __init__(self, path: Optional[str], reason: str) -> None:
+        self.msg = f"Invalid access list {path!r} - {reason}"
+        super().__init__(self.msg)
+
+
+class UnknownSocketProfileError(ValueError):
+    def __init__(self, name: str) -> None:
+        self.msg = f"Unknown socket profile {name!r} (see SOCKET_PROFILES)"
+        super().__init__(self.msg)
+
+
+class InvalidInterceptorPipelineError(ValueError):
+    def __init__(self, pipeline: type, reason: str) -> None:
+        self.msg = f"Invalid interceptor pipeline {pipeline.__name__} - {reason}"
+        super().__init__(self.msg)
+
+
 class AlreadyRegisteredSocketError(Exception):
     def __init__(self, proxyConnections: "ProxyConnections", socket: "socket.socket", socketName: Optional[str] = None):
         self.msg = "Socket (name=%s) already registered in ProxyConnections instance.\n", socketName
@@ -46,12 +160,25 @@ class AbstractStreamInterceptorError(Exception):
         super().__init__(self.msg)
 
 
+class UnreloadableStreamInterceptorError(Exception):
+    def __init__(self, streamInterceptor: "streamInterceptor") -> None:
+        self.msg = f"Cannot reload StreamInterceptor {streamInterceptor.__qualname__} - \
+        it must be a module level class in an imported module (or pass the new class explicitly)"
+        super().__init__(self.msg)
+
+
 class InvalidProxyPortError(Exception):
     def __init__(self, PROXY_PORT: object):
         self.msg = f"Invalid PROXY_PORT arg for ProxyConnections instance: %s", PROXY_PORT
         super().__init__(self.msg)
 
 
+class EdgeTriggeredSelectorUnavailableError(Exception):
+    def __init__(self) -> None:
+        self.msg = "An edge-triggered selector requires select.epoll() - it is not available on this platform"
+        super().__init__(self.msg)
+
+
 class IncorrectDelimitersTypeError(TypeError):
     def __init__(self, REQUEST_DELIMITERS):
         self.msg = f"Incorrect type for Buffer().REQUEST_DELIMITERS - {type(REQUEST_DELIMITERS)}"
@@ -87,3 +214,4 @@ class PeakFromEmptyQueueError(IndexError):
     def __init__(self):
         self.msg = "Cannot peak a request from empty buffer._requests deque"
         super().__init__(self.msg)
+
@@ -0,0 +1,161 @@
+import re
+from typing import Optional, Tuple, Union
+
+
+## NOTE: Everything here works on the bytes the Buffer hands out - there's no decoding or regex per message
+BytesLike = Union[bytes, bytearray, memoryview]
+
+SPACE, HYPHEN, CR, LF, ZERO = 0x20, 0x2D, 0x0D, 0x0A, 0x30
+
+## Command verbs (RFC 959, RFC 2228, RFC 2428, RFC 3659)
+FTP_VERBS = (
+    b"USER", b"PASS", b"ACCT", b"CWD", b"CDUP", b"SMNT", b"REIN", b"QUIT",
+    b"PORT", b"PASV", b"TYPE", b"STRU", b"MODE", b"RETR", b"STOR", b"STOU",
+    b"APPE", b"ALLO", b"REST", b"RNFR", b"RNTO", b"ABOR", b"DELE", b"RMD",
+    b"MKD", b"PWD", b"LIST", b"NLST", b"SITE", b"SYST", b"STAT", b"HELP",
+    b"NOOP", b"AUTH", b"ADAT", b"PROT", b"PBSZ", b"CCC", b"MIC", b"CONF",
+    b"ENC", b"EPRT", b"EPSV", b"FEAT", b"OPTS", b"MDTM", b"SIZE", b"MLST",
+    b"MLSD",
+)
+
+## The first 4 bytes (uppercased) of a command select its verb
+## NOTE: Three letter verbs are followed by either their argument or the end of the line
+_VERB_LOOKUP = {}
+for _verb in FTP_VERBS:
+    if len(_verb) == 4:
+        _VERB_LOOKUP[_verb] = _verb
+    else:
+        for _terminator in (b" ", b"\r", b"\n"):
+            _VERB_LOOKUP[_verb + _terminator] = _verb
+del _verb, _terminator
+
+
+def _skipSpaces(message: BytesLike) -> int:
+    ## NOTE: We're softer than RFC 959 and accept leading whitespace (the loop doesn't run for well formed messages)
+    if not message or message[0] != SPACE:
+        return 0
+    start = 0
+    while start < len(message) and message[start] == SPACE:
+        start += 1
+    return start
+
+
+def commandVerb(message: BytesLike) -> Optional[bytes]:
+    """Returns the (uppercase) verb of an FTP command, or None if it isn't a known verb"""
+    start = _skipSpaces(message)
+    verb = _VERB_LOOKUP.get(bytes(message[start:start + 4]).upper())
+    if verb is None and len(message) - start == 3:
+        ## A three letter verb without a line terminator
+        verb = _VERB_LOOKUP.get(bytes(message[start:start + 3]).upper() + b" ")
+    elif verb is not None and len(message) > start + 4 and len(verb) == 4 and message[start + 4] not in (SPACE, CR, LF):
+        ## e.g. "USERS" isn't a USER command
+        return None
+    return verb
+
+
+def commandArgument(message: BytesLike) -> bytes:
+    """Returns the argument of an FTP command (without the verb and line terminator)"""
+    verb = commandVerb(message)
+    if verb is None:
+        return b""
+    return bytes(message[_skipSpaces(message) + len(verb):]).strip(b" \r\n")
+
+
+def replyCode(message: BytesLike) -> Optional[int]:
+    """Returns the three digit code of an FTP reply (xyz - 1 <= x <= 5, 0 <= y <= 5), or None if there isn't one"""
+    if len(message) < 3:
+        return None
+    x, y, z = message[0] - ZERO, message[1] - ZERO, message[2] - ZERO
+    if not (1 <= x <= 5 and 0 <= y <= 5 and 0 <= z <= 9):
+        return None
+    ## NOTE: The code must be followed by a space (last line), a hyphen (first line of a multi-line reply) or the line end
+    if len(message) > 3 and message[3] not in (SPACE, HYPHEN, CR, LF):
+        return None
+    return x * 100 + y * 10 + z
+
+
+## NOTE: The data channel commands/replies are rare, so (unlike the per message parsing above) they use regexes
+_HOST_PORT_REGEX = re.compile(rb"(\d{1,3}),(\d{1,3}),(\d{1,3}),(\d{1,3}),(\d{1,3}),(\d{1,3})")
+_EXTENDED_PORT_REGEX = re.compile(rb"\((.)\1\1(\d{1,5})\1\)")
+_EXTENDED_ADDRESS_REGEX = re.compile(rb"([!-~])([12])\1([0-9A-Fa-f:.]+)\1(\d{1,5})\1")
+
+
+def parseHostPort(message: BytesLike) -> Optional[Tuple[str, int, Tuple[int, int]]]:
+    """Returns the (host, port, span) of the "h1,h2,h3,h4,p1,p2" argument of
+    a PORT command or a 227 (PASV) reply"""
+    match = _HOST_PORT_REGEX.search(message)
+    if match is None:
+        return None
+    numbers = [int(number) for number in match.groups()]
+    if max(numbers) > 255:
+        return None
+    return ".".join(str(number) for number in numbers[:4]), numbers[4] * 256 + numbers[5], match.span()
+
+
+def formatHostPort(host: str, port: int) -> bytes:
+    return (host.replace(".", ",") + f",{port >> 8},{port & 0xFF}").encode("ascii")
+
+
+def parseExtendedPort(message: BytesLike) -> Optional[Tuple[int, Tuple[int, int]]]:
+    """Returns the (port, span) of the "(|||port|)" of a 229 (EPSV) reply (RFC 2428)"""
+    match = _EXTENDED_PORT_REGEX.search(message)
+    if match is None:
+        return None
+    return int(match.group(2)), match.span(2)
+
+
+def parseExtendedAddress(message: BytesLike) -> Optional[Tuple[str, int, Tuple[int, int]]]:
+    """Returns the (host, port, span) of the "|af|host|port|" argument of an
+    EPRT command (RFC 2428)"""
+    match = _EXTENDED_ADDRESS_REGEX.search(message)
+    if match is None:
+        return None
+    port = int(match.group(4))
+    if port > 65535:
+        return None
+    return match.group(3).decode("ascii"), port, match.span()
+
+
+def formatExtendedAddress(host: str, port: int) -> bytes:
+    return f"|{2 if ':' in host else 1}|{host}|{port}|".encode("ascii")
+
+
+def isMultilineReplyStart(message: BytesLike) -> bool:
+    return len(message) > 3 and message[3] == HYPHEN and replyCode(message) is not None
+
+
+class FTPReplyFramer:
+    """Joins the lines of multi-line FTP replies (RFC 959 page 35)
+
+    A multi-line reply starts with "xyz-" and ends with the first line that
+    starts with the same "xyz " - every line between them is part of the
+    reply (even if it starts with some other code)"""
+    __slots__ = ("_code", "_lines")
+
+    def __init__(self) -> None:
+        self._code: Optional[int] = None
+        self._lines = []
+
+
+    def feed(self, line: BytesLike) -> Optional[Tuple[int, bytes]]:
+        """Takes one (CRLF delimited) line, and returns (code, reply) once a reply is complete"""
+        if self._code is None:
+            code = replyCode(line)
+            if code is None:
+                return None
+            if len(line) > 3 and line[3] == HYPHEN:
+                self._code = code
+                self._lines.append(bytes(line))
+                return None
+            return code, bytes(line)
+
+        self._lines.append(bytes(line))
+        if len(line) > 3 and line[3] == SPACE and replyCode(line) == self._code:
+            code, reply = self._code, b"".join(self._lines)
+            self._code, self._lines = None, []
+            return code, reply
+        return None
+
+
+    def inReply(self) -> bool:
+        return self._code is not None
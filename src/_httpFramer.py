@@ -0,0 +1,293 @@
+import logging
+from collections import deque
+from typing import Deque, List, Optional, Tuple, Union
+
+from _proxyDS import MessageFramer
+
+
+## NOTE: Only message heads are buffered and parsed - bodies are counted through (never scanned or copied)
+BytesLike = Union[bytes, bytearray]
+
+CR, LF = 0x0D, 0x0A
+HEAD_TERMINATOR = b"\r\n\r\n"
+HEX_DIGITS = b"0123456789abcdefABCDEF"
+
+## Framer states (RFC 7230 section 3.3.3)
+FRAME_HEAD, FRAME_BODY, FRAME_CHUNK_SIZE, FRAME_CHUNK_DATA, FRAME_CHUNK_END, FRAME_TRAILERS, FRAME_RELAY = range(7)
+
+
+class HTTPMessageHead(bytes):
+    """The raw head (start line and header fields) of an HTTP/1.x message,
+    parsed once by the framer
+
+    It is the bytes that are hooked (so it can be forwarded or rewritten as
+    is), with the parsed start line and fields as attributes"""
+
+    def __new__(cls, head: BytesLike) -> "HTTPMessageHead":
+        self = super().__new__(cls, head)
+        lines = self.split(b"\r\n")
+        self.startLine = lines[0]
+        ## NOTE: A request line is "method target version", and a status line is "version status reason"
+        self.isRequest = not self.startLine.startswith(b"HTTP/")
+        parts = self.startLine.split(b" ", 2)
+        self.method, self.target, self.version, self.status, self.reason = None, None, None, None, None
+        if self.isRequest and len(parts) == 3 and parts[2].startswith(b"HTTP/"):
+            self.method, self.target, self.version = parts
+        elif not self.isRequest and len(parts) >= 2 and parts[1].isdigit():
+            self.version, self.status = parts[0], int(parts[1])
+            self.reason = parts[2] if len(parts) == 3 else b""
+
+        self.fields: List[Tuple[bytes, bytes]] = []
+        self.isValid = self.version is not None
+        for line in lines[1:]:
+            if not line:
+                continue
+            name, separator, value = line.partition(b":")
+            ## NOTE: Obsolete line folding and whitespace before the colon are rejected (RFC 7230 section 3.2.4)
+            if not separator or not name or name != name.strip(b" \t"):
+                self.isValid = False
+                continue
+            self.fields.append((name, value.strip(b" \t")))
+        return self
+
+
+    def header(self, name: bytes) -> Optional[bytes]:
+        """Returns the value of the (case-insensitive) field, joining repeated fields with commas"""
+        name = name.lower()
+        values = [value for fieldName, value in self.fields if fieldName.lower() == name]
+        return b", ".join(values) if values else None
+
+
+    def headers(self, name: bytes) -> List[bytes]:
+        name = name.lower()
+        return [value for fieldName, value in self.fields if fieldName.lower() == name]
+
+
+
+class HTTPMessageFramer(MessageFramer):
+    """Incremental framer of one direction of an HTTP/1.x connection
+
+    A message head is delimited by an empty line, and its body by either
+    Content-Length or the chunked transfer coding (RFC 7230 section 3.3.3).
+    Heads are passed to the hook, while bodies (and chunk size lines) are
+    only counted, so a body costs the same per chunk whatever its size.
+
+    The response framer of a connection is given the request framer, as a
+    response body depends on its request's method (e.g. HEAD or CONNECT).
+    A stream that can't be framed is relayed (uninspected) from then on"""
+    __slots__ = ("isRequest", "requestFramer", "_state", "_remaining", "_head", "_line", "_methods")
+    MAX_HEAD_SIZE = 64 * 1024
+    MAX_LINE_SIZE = 8 * 1024
+
+    def __init__(self, isRequest: bool, requestFramer: Optional["HTTPMessageFramer"] = None) -> None:
+        self.isRequest = isRequest
+        self.requestFramer = requestFramer
+        ## NOTE: The methods of the requests that haven't been answered yet (in order, as HTTP/1.1 is pipelined)
+        self._methods: Deque[bytes] = deque()
+        self.reset()
+
+
+    @classmethod
+    def forConnection(cls) -> Tuple["HTTPMessageFramer", "HTTPMessageFramer"]:
+        """Returns the (clientToServer, serverToClient) framers of a connection"""
+        requestFramer = cls(isRequest=True)
+        return requestFramer, cls(isRequest=False, requestFramer=requestFramer)
+
+
+    def reset(self) -> None:
+        self._state = FRAME_HEAD
+        self._remaining = 0     ## body (or chunk) bytes still to be relayed
+        self._head = bytearray()
+        self._line = bytearray()
+        self._methods.clear()
+
+
+    def pendingBytes(self) -> int:
+        return len(self._head) + len(self._line)
+
+
+    def isRelaying(self) -> bool:
+        return self._state == FRAME_RELAY
+
+
+    def relayRest(self) -> None:
+        """Relays the rest of the stream (e.g. once the connection has been upgraded to another protocol)"""
+        self._state = FRAME_RELAY
+
+
+    def feed(self, chunk: BytesLike) -> List[Union[HTTPMessageHead, int]]:
+        frames = []
+        position, end = 0, len(chunk)
+        while position < end:
+            state = self._state
+            if state == FRAME_BODY or state == FRAME_CHUNK_DATA:
+                size = min(self._remaining, end - position)
+                self._relay(frames, size)
+                position += size
+                self._remaining -= size
+                if not self._remaining:
+                    if state == FRAME_BODY:
+                        self._state = FRAME_HEAD
+                    else:
+                        self._state = FRAME_CHUNK_END
+            elif state == FRAME_HEAD:
+                position = self._feedHead(chunk, position, frames)
+            elif state == FRAME_RELAY:
+                self._relay(frames, end - position)
+                position = end
+            else:
+                position = self._feedChunkLine(chunk, position, frames)
+        return frames
+
+
+    @staticmethod
+    def _relay(frames: List[Union[HTTPMessageHead, int]], size: int) -> None:
+        if frames and type(frames[-1]) is int:
+            frames[-1] += size
+        elif size:
+            frames.append(size)
+
+
+    def _abandon(self, frames: List[Union[HTTPMessageHead, int]], reason: str) -> None:
+        logging.warning(f"WARNING: The HTTP stream can't be framed, so the rest of it is relayed - {reason}")
+        ## NOTE: The held bytes of the partial head/line are relayed with the rest of the stream
+        self._relay(frames, self.pendingBytes())
+        self._head, self._line = bytearray(), bytearray()
+        self._state = FRAME_RELAY
+
+
+    ################## Message Heads ######################
+    def _feedHead(self, chunk: BytesLike, position: int, frames: List[Union[HTTPMessageHead, int]]) -> int:
+        head = self._head
+        if not head:
+            ## NOTE: Empty lines before a message are ignored (RFC 7230 section 3.5)
+            start = position
+            while position < len(chunk) and chunk[position] in (CR, LF):
+                position += 1
+            self._relay(frames, position - start)
+            if position == len(chunk):
+                return position
+            end = self._findHeadEnd(chunk, position)
+        else:
+            ## The terminator can span the previous chunk
+            overlap = bytes(head[-3:])
+            end = (overlap + bytes(chunk[position:position + 3])).find(HEAD_TERMINATOR)
+            if end != -1:
+                end += position - len(overlap) + len(HEAD_TERMINATOR)
+            else:
+                end = self._findHeadEnd(chunk, position)
+
+        if end == -1:
+            if len(head) + len(chunk) - position > self.MAX_HEAD_SIZE:
+                self._abandon(frames, f"the message head is over {self.MAX_HEAD_SIZE} bytes")
+                self._relay(frames, len(chunk) - position)
+                return len(chunk)
+            head += chunk[position:]
+            return len(chunk)
+
+        head += chunk[position:end]
+        self._head = bytearray()
+        self._startMessage(HTTPMessageHead(head), frames)
+        return end
+
+
+    @staticmethod
+    def _findHeadEnd(chunk: BytesLike, position: int) -> int:
+        ## Returns the offset after the terminator (or -1)
+        end = chunk.find(HEAD_TERMINATOR, position)
+        return end if end == -1 else end + len(HEAD_TERMINATOR)
+
+
+    def _startMessage(self, head: HTTPMessageHead, frames: List[Union[HTTPMessageHead, int]]) -> None:
+        if not head.isValid or head.isRequest != self.isRequest:
+            self._relay(frames, len(head))
+            return self._abandon(frames, f"invalid message head {head.startLine[:64]!r}")
+
+        frames.append(head)
+        if self.isRequest:
+            self._methods.append(head.method.upper())
+            if head.method.upper() == b"CONNECT":
+                ## NOTE: The client's data after a CONNECT is for the tunnel it asked for
+                return self.relayRest()
+        elif not self._hasResponseBody(head):
+            return None
+
+        transferEncoding = head.header(b"transfer-encoding")
+        if transferEncoding is not None:
+            ## NOTE: Transfer-Encoding overrides Content-Length, and chunked must be the final coding
+            if transferEncoding.rsplit(b",", 1)[-1].strip(b" \t").lower() == b"chunked":
+                self._state = FRAME_CHUNK_SIZE
+            elif self.isRequest:
+                self._abandon(frames, f"the request body length is unknown (Transfer-Encoding: {transferEncoding!r})")
+            else:
+                ## A response without a chunked coding ends when the connection is closed
+                self.relayRest()
+            return None
+
+        contentLengths = {value.strip(b" \t") for value in b",".join(head.headers(b"content-length")).split(b",")} - {b""}
+        if not contentLengths:
+            if not self.isRequest:
+                self.relayRest()
+            return None
+        if len(contentLengths) != 1 or not next(iter(contentLengths)).isdigit():
+            return self._abandon(frames, f"invalid Content-Length {sorted(contentLengths)!r}")
+        self._remaining = int(next(iter(contentLengths)))
+        if self._remaining:
+            self._state = FRAME_BODY
+
+
+    def _hasResponseBody(self, head: HTTPMessageHead) -> bool:
+        status = head.status
+        ## NOTE: Interim (1xx) responses come before the final response to the same request
+        if 100 <= status < 200 and status != 101:
+            return False
+        requestFramer = self.requestFramer
+        method = None
+        if requestFramer is not None and requestFramer._methods:
+            method = requestFramer._methods.popleft()
+
+        if status == 101 or (method == b"CONNECT" and 200 <= status < 300):
+            ## The connection is no longer HTTP (in either direction)
+            self.relayRest()
+            if requestFramer is not None:
+                requestFramer.relayRest()
+            return False
+        return not (method == b"HEAD" or status in (204, 304))
+
+
+    ################## Chunked Bodies ######################
+    def _feedChunkLine(self, chunk: BytesLike, position: int, frames: List[Union[HTTPMessageHead, int]]) -> int:
+        ## NOTE: Only the chunk size lines and trailers are read - the chunk data is counted through
+        end = chunk.find(b"\n", position)
+        if end == -1:
+            if len(self._line) + len(chunk) - position > self.MAX_LINE_SIZE:
+                self._abandon(frames, f"a chunk line is over {self.MAX_LINE_SIZE} bytes")
+                self._relay(frames, len(chunk) - position)
+                return len(chunk)
+            self._line += chunk[position:]
+            return len(chunk)
+
+        end += 1
+        line = bytes(self._line + chunk[position:end]) if self._line else bytes(chunk[position:end])
+        self._line = bytearray()
+        self._relay(frames, len(line))
+        line = line.rstrip(b"\r\n")
+
+        state = self._state
+        if state == FRAME_CHUNK_SIZE:
+            ## NOTE: Chunk extensions (after ";") are ignored
+            size = line.split(b";", 1)[0].strip(b" \t")
+            if not size or size.strip(HEX_DIGITS):
+                self._abandon(frames, f"invalid chunk size {size[:16]!r}")
+                return end
+            self._remaining = int(size, 16)
+            self._state = FRAME_CHUNK_DATA if self._remaining else FRAME_TRAILERS
+        elif state == FRAME_CHUNK_END:
+            if line:
+                self._abandon(frames, "the chunk data is longer than its size")
+                return end
+            self._state = FRAME_CHUNK_SIZE
+        elif not line:
+            ## The empty line after the trailer fields ends the message
+            self._state = FRAME_HEAD
+        return end
@@ -0,0 +1,174 @@
+import inspect
+import logging
+import functools
+from collections import deque
+from typing import Awaitable, Callable, List, Optional, Sequence, Tuple
+
+from _proxyDS import Buffer, MessageFramer, StreamInterceptor
+from _exceptions import *
+
+
+Hook = Callable[[Buffer, bytearray], Optional[Awaitable]]
+
+
+def _noHook(buffer: Buffer, message: bytearray) -> None:
+    return None
+
+
+class _StageChain:
+    """Calls the hooks of a direction's stages, in order, for each message
+
+    A stage's awaitable defers the later stages of its message, and of every
+    message after it (so each stage sees the messages in order). The
+    awaitable resolves to the chain's next step, which the buffer then calls
+    on the event loop thread (see Buffer.setHook())"""
+    __slots__ = ("hooks", "_messages")
+
+    def __init__(self, hooks: Sequence[Hook]) -> None:
+        self.hooks = hooks
+        ## NOTE: A token per message whose stages haven't all been called yet (the first one's are being called)
+        self._messages: deque = deque()
+
+    def __call__(self, buffer: Buffer, message: bytearray) -> Optional[Awaitable]:
+        token = object()
+        self._messages.append(token)
+        return self._resume(token, 0, buffer, message)
+
+    def _resume(self, token: object, start: int, buffer: Buffer, message: bytearray) -> Optional[Awaitable]:
+        if self._messages[0] is not token:
+            ## An earlier message's stages are still deferred, so this one waits behind them
+            return _awaitStage(None, functools.partial(self._resume, token, start))
+        try:
+            for index in range(start, len(self.hooks)):
+                result = self.hooks[index](buffer, message)
+                if inspect.isawaitable(result):
+                    return _awaitStage(result, functools.partial(self._resume, token, index + 1),
+                                        functools.partial(self._resume, token, len(self.hooks)))
+        except BaseException:
+            self._messages.popleft()
+            raise
+        self._messages.popleft()
+        return None
+
+
+async def _awaitStage(pending: Optional[Awaitable], resume: Hook, skip: Optional[Hook] = None) -> Hook:
+    ## NOTE: Only the awaiting is done on the AsyncHookRunner - the chain resumes on the event loop thread
+    if pending is None:
+        return resume
+    try:
+        await pending
+    except Exception as e:
+        ## The message's later stages are skipped (but the messages behind it still go through)
+        logging.error(f"Request hook failed: {e!r}")
+        return skip
+    return resume
+
+
+def _overridesHook(stage: StreamInterceptor, name: str) -> bool:
+    return getattr(stage, name) is not getattr(StreamInterceptor, name)
+
+
+
+class InterceptorPipeline(StreamInterceptor):
+    """Chains the STAGES interceptors of a subclass, in order, per direction
+
+    The stages share the tunnel's buffers, so a message is parsed (or framed)
+    once and then passed to the hook of each stage. The pipeline is resolved
+    when the subclass is defined:
+    - transparent stages (see isTransparent()) are dropped, as are stages
+      from a direction whose hook they don't override (a direction with a
+      single stage calls its hook directly)
+    - the stages must split the stream the same way (the same
+      REQUEST_DELIMITERS and createFramers()), and ask for at most one
+      SOCKET_PROFILE
+    - the hooks are inline if any stage's are, and requests are held back
+      for rewriting if any stage rewrites them
+    Each stage sees a message as it was received - the edits of the earlier
+    stages are only applied when the message is sent (so they can't overlap).
+    A stage that returns an awaitable defers the later stages, and the later
+    messages of its direction, which are then called on the event loop thread"""
+    STAGES: Tuple[StreamInterceptor, ...] = ()
+
+    _stages: Tuple[StreamInterceptor, ...] = ()
+    _clientToServerStages: Tuple[int, ...] = ()
+    _serverToClientStages: Tuple[int, ...] = ()
+    _proxyTunnel = None
+
+    def __init_subclass__(cls, **kwargs) -> None:
+        super().__init_subclass__(**kwargs)
+        stages = []
+        for stage in cls.STAGES:
+            if not (isinstance(stage, type) and issubclass(stage, StreamInterceptor)) or stage is StreamInterceptor:
+                raise InvalidInterceptorPipelineError(cls, f"{stage!r} is not a StreamInterceptor subclass")
+            ## NOTE: A nested pipeline is flattened, so its stages share the same pass
+            stages.extend(stage.STAGES if issubclass(stage, InterceptorPipeline) else (stage,))
+        if not stages:
+            raise InvalidInterceptorPipelineError(cls, "STAGES is empty")
+        cls.STAGES = tuple(stages)
+
+        ## NOTE: Only a pipeline of transparent stages is itself transparent (it then keeps their settings)
+        activeStages = [stage for stage in stages if not stage.isTransparent()]
+        profiles = {stage.SOCKET_PROFILE for stage in activeStages or stages if stage.SOCKET_PROFILE is not None}
+        if len(profiles) > 1:
+            raise InvalidInterceptorPipelineError(cls, f"the stages ask for different socket profiles {sorted(profiles)}")
+        cls.SOCKET_PROFILE = profiles.pop() if profiles else None
+        cls._stages = tuple(activeStages)
+        cls.PASS_THROUGH = not activeStages
+        if not activeStages:
+            return None
+        cls.REQUEST_DELIMITERS = activeStages[0].REQUEST_DELIMITERS
+
+        for stage in activeStages[1:]:
+            if list(stage.REQUEST_DELIMITERS) != list(cls.REQUEST_DELIMITERS):
+                raise InvalidInterceptorPipelineError(cls, f"{stage.__name__} has different REQUEST_DELIMITERS")
+            if stage.createFramers is not activeStages[0].createFramers:
+                raise InvalidInterceptorPipelineError(cls, f"{stage.__name__} has a different createFramers()")
+        cls.HOOK_MODE = "inline" if any(stage.HOOK_MODE == "inline" for stage in activeStages) else "async"
+        cls.REWRITES_REQUESTS = any(stage.REWRITES_REQUESTS for stage in activeStages)
+        cls._clientToServerStages = tuple(index for index, stage in enumerate(activeStages)
+                                            if _overridesHook(stage, "clientToServerHook"))
+        cls._serverToClientStages = tuple(index for index, stage in enumerate(activeStages)
+                                            if _overridesHook(stage, "serverToClientHook"))
+
+
+    def __init__(self) -> None:
+        self.stages: List[StreamInterceptor] = [stage() for stage in self._stages]
+        ## NOTE: The fused hooks shadow the class' hooks, so the tunnel binds them like any interceptor's
+        self.clientToServerHook = self._fuseHooks("clientToServerHook", self._clientToServerStages)
+        self.serverToClientHook = self._fuseHooks("serverToClientHook", self._serverToClientStages)
+
+
+    def _fuseHooks(self, name: str, stageIndexes: Tuple[int, ...]) -> Hook:
+        hooks = tuple(getattr(self.stages[index], name) for index in stageIndexes)
+        if not hooks:
+            return _noHook
+        if len(hooks) == 1:
+            return hooks[0]
+        return _StageChain(hooks)
+
+
+    @property
+    def proxyTunnel(self):
+        return self._proxyTunnel
+
+    @proxyTunnel.setter
+    def proxyTunnel(self, proxyTunnel) -> None:
+        ## NOTE: The stages may use the tunnel themselves (e.g. to open data channels)
+        self._proxyTunnel = proxyTunnel
+        for stage in self.stages:
+            stage.proxyTunnel = proxyTunnel
+
+
+    @classmethod
+    def isTransparent(cls) -> bool:
+        ## NOTE: The pipeline's hooks are only fused per instance, so the stages' hooks are checked instead
+        return not (cls._clientToServerStages or cls._serverToClientStages)
+
+
+    @classmethod
+    def acceptsClient(cls, host: str) -> bool:
+        return all(stage.acceptsClient(host) for stage in cls.STAGES)
+
+
+    def createFramers(self) -> Optional[Tuple[MessageFramer, MessageFramer]]:
+        return self.stages[0].createFramers() if self.stages else None
@@ -0,0 +1,167 @@
+import time
+import heapq
+import logging
+import threading
+from array import array
+from dataclasses import dataclass, field
+from typing import Dict, Hashable, List, Optional, Tuple
+
+from _exceptions import *
+
+
+@dataclass
+class SlidingWindowSketch:
+    """Count-min sketch of the events of the last `window` seconds
+
+    The window is a ring of `buckets` sketches (one per window/buckets
+    seconds), so expired events are dropped a bucket at a time. The memory
+    is fixed (width * depth counters per bucket) however many keys are
+    counted, and counts can only be overestimated (by hash collisions)"""
+    window: float = 600.0
+    buckets: int = 10
+    width: int = 4096
+    depth: int = 4
+
+    _ring: List[array] = field(init=False, repr=False)
+    _totals: array = field(init=False, repr=False)    ## sum of the live buckets (so an estimate is `depth` lookups)
+    _epoch: int = field(init=False, repr=False, default=0)
+
+    def __post_init__(self) -> None:
+        if not (self.window > 0 and self.buckets > 0 and self.width > 0 and self.depth > 0):
+            raise InvalidSlidingWindowError(self)
+        self._bucketSeconds = self.window / self.buckets
+        self._ring = [array("I", bytes(4 * self.width * self.depth)) for _ in range(self.buckets)]
+        self._totals = array("I", bytes(4 * self.width * self.depth))
+        self._epoch = int(time.monotonic() // self._bucketSeconds)
+
+
+    def _cells(self, key: Hashable) -> List[int]:
+        ## NOTE: Double hashing (h1 + i*h2) derives every row's cell from two hashes of the key
+        h1, h2 = hash(key), hash((key, self.depth)) | 1
+        width = self.width
+        return [row * width + (h1 + row * h2) % width for row in range(self.depth)]
+
+
+    def _advance(self, now: float) -> array:
+        ## Drops the buckets that have left the window, and returns the current one
+        epoch = int(now // self._bucketSeconds)
+        if epoch != self._epoch:
+            for expired in range(max(self._epoch + 1, epoch - self.buckets + 1), epoch + 1):
+                bucket, totals = self._ring[expired % self.buckets], self._totals
+                for cell, count in enumerate(bucket):
+                    if count:
+                        totals[cell] -= count
+                        bucket[cell] = 0
+            self._epoch = epoch
+        return self._ring[epoch % self.buckets]
+
+
+    def add(self, key: Hashable, count: int = 1, now: Optional[float] = None) -> int:
+        """Counts `count` events for the key, and returns its new estimate"""
+        bucket = self._advance(time.monotonic() if now is None else now)
+        totals = self._totals
+        estimate = None
+        for cell in self._cells(key):
+            bucket[cell] += count
+            totals[cell] += count
+            estimate = totals[cell] if estimate is None else min(estimate, totals[cell])
+        return estimate
+
+
+    def estimate(self, key: Hashable, now: Optional[float] = None) -> int:
+        self._advance(time.monotonic() if now is None else now)
+        totals = self._totals
+        return min(totals[cell] for cell in self._cells(key))
+
+
+
+## NOTE: Attempts are counted under three keys, so both a client trying many usernames (password
+## spraying) and many clients trying one username (a distributed attack) stand out
+def _attemptKeys(host: str, username: Optional[str]) -> Tuple[Tuple[Optional[str], Optional[str]], ...]:
+    if username is None:
+        return ((host, None),)
+    return ((host, None), (host, username), (None, username))
+
+
+@dataclass
+class LoginAttemptTracker:
+    """Process-wide counts of the login attempts of every client (shared
+    by the interceptors of all tunnels)
+
+    Failures and successes are kept in sliding-window sketches keyed by
+    client IP, by (client IP, username) and by username, so the memory
+    doesn't grow with the number of clients. A client is throttled once it
+    has `throttleThreshold` failures within the window"""
+    window: float = 600.0
+    buckets: int = 10
+    throttleThreshold: int = 20
+    maxOffenders: int = 64
+    sketchWidth: int = 4096
+    sketchDepth: int = 4
+
+    _failures: SlidingWindowSketch = field(init=False, repr=False)
+    _successes: SlidingWindowSketch = field(init=False, repr=False)
+    ## NOTE: The sketch can't list its keys, so the keys with the most failures are kept alongside it
+    _offenders: Dict[Tuple[Optional[str], Optional[str]], int] = field(init=False, repr=False, default_factory=dict)
+    _lock: threading.Lock = field(init=False, repr=False, default_factory=threading.Lock)
+
+    def __post_init__(self) -> None:
+        if not (isinstance(self.throttleThreshold, int) and self.throttleThreshold > 0):
+            raise InvalidThrottleThresholdError(self.throttleThreshold)
+        self._failures = SlidingWindowSketch(self.window, self.buckets, self.sketchWidth, self.sketchDepth)
+        self._successes = SlidingWindowSketch(self.window, self.buckets, self.sketchWidth, self.sketchDepth)
+
+
+    def recordFailure(self, host: str, username: Optional[str] = None, now: Optional[float] = None) -> None:
+        with self._lock:
+            for key in _attemptKeys(host, username):
+                self._trackOffender(key, self._failures.add(key, now=now))
+
+
+    def recordSuccess(self, host: str, username: Optional[str] = None, now: Optional[float] = None) -> None:
+        with self._lock:
+            failures = self._failures.estimate((host, username), now=now)
+            for key in _attemptKeys(host, username):
+                self._successes.add(key, now=now)
+        ## NOTE: A login that follows a burst of failures is likely a guessed password
+        if failures >= self.throttleThreshold:
+            logging.critical(f"CRITICAL: A client logged in after {failures} failed attempts - Host: <{host}>, Username: <{username}>")
+
+
+    def failures(self, host: Optional[str] = None, username: Optional[str] = None, now: Optional[float] = None) -> int:
+        """Returns the failures (within the window) of the client, of the
+        username, or of the username from the client"""
+        with self._lock:
+            return self._failures.estimate((host, username), now=now)
+
+
+    def successes(self, host: Optional[str] = None, username: Optional[str] = None, now: Optional[float] = None) -> int:
+        with self._lock:
+            return self._successes.estimate((host, username), now=now)
+
+
+    def isThrottled(self, host: str, now: Optional[float] = None) -> bool:
+        return self.failures(host, now=now) >= self.throttleThreshold
+
+
+    def topOffenders(self, count: int = 10, now: Optional[float] = None) -> List[Tuple[Tuple[Optional[str], Optional[str]], int]]:
+        """Returns up to `count` ((host, username), failures) pairs with the
+        most failures within the window (host or username is None for the
+        per username / per client counts)"""
+        with self._lock:
+            ## NOTE: The failures are estimated again, as older ones may have left the window
+            current = [(key, self._failures.estimate(key, now=now)) for key in self._offenders]
+            self._offenders = {key: failures for key, failures in current if failures}
+            return heapq.nlargest(count, self._offenders.items(), key=lambda offender: offender[1])
+
+
+    def _trackOffender(self, key: Tuple[Optional[str], Optional[str]], failures: int) -> None:
+        offenders = self._offenders
+        if key in offenders or len(offenders) < self.maxOffenders:
+            offenders[key] = failures
+            return None
+        ## Replaces the offender with the fewest failures (if the key has more)
+        weakest = min(offenders, key=offenders.get)
+        if offenders[weakest] < failures:
+            del offenders[weakest]
+            offenders[key] = failures
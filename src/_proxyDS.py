@@ -1,8 +1,14 @@
 import re
+import bisect
+import asyncio
+import inspect
+import logging
 import functools
+import threading
 from collections import deque
+from concurrent.futures import Executor, Future
 from dataclasses import dataclass, field
-from typing import Callable, Iterable, List, NamedTuple, Sequence, Tuple
+from typing import Awaitable, Callable, Iterable, List, NamedTuple, Optional, Sequence, Tuple, Union
 
 from _exceptions import *
 proxyHandlerDescriptor = NamedTuple("ProxyHandlerData", [("PROXY_HOST", str), ("PROXY_PORT", int), ("StreamInterceptor", object)])
@@ -12,6 +18,42 @@ proxyHandlerDescriptor = NamedTuple("ProxyHandlerData", [("PROXY_HOST", str), ("
 ## NOTE: We will subclass this for the Stream Interceptor
 ## NOTE: This should be performed on a per protocol basis!!!
 class StreamInterceptor:
+    ## NOTE: When the server offloads hooks to a thread pool, this selects whether forwarding waits for them
+    ## - "inline": a request (and any data after it) is only forwarded once its hook has finished
+    ## - "async":  the hook only observes the request, so forwarding doesn't wait for it
+    HOOK_MODE: str = "inline"
+    HOOK_MODES = ("inline", "async")
+    ## NOTE: A pass-through interceptor's tunnel forwards the stream as is (no delimiter parsing, no hooks)
+    PASS_THROUGH: bool = False
+    ## NOTE: Set if the hooks rewrite requests (see Buffer.replaceRequest()) - undelimited data is then held
+    ## back, as a request can only be rewritten if none of it has been forwarded yet
+    REWRITES_REQUESTS: bool = False
+    ## NOTE: The name of the socket options applied to both sockets of a tunnel (see SOCKET_PROFILES) - None
+    ## keeps the OS defaults
+    SOCKET_PROFILE: Optional[str] = None
+    ## NOTE: Set to the ProxyTunnel that owns the instance (None if it isn't used in a tunnel)
+    proxyTunnel = None
+    ## NOTE: Class attributes that are configured at runtime (rather than in the module), which a reload of
+    ## the interceptor's module would otherwise reset - they're carried over to the reloaded class
+    RUNTIME_ATTRIBUTES: Tuple[str, ...] = ()
+
+    ## NOTE: Consulted by the server before a new client connection is tunneled (e.g. to throttle brute-force clients)
+    @classmethod
+    def acceptsClient(cls, host: str) -> bool:
+        return True
+
+    ## NOTE: A transparent interceptor's tunnels are relayed with RelayBuffers (no parsing, framing or hooks) - it
+    ## is either PASS_THROUGH, or doesn't override either hook (e.g. it only filters clients, or counts tunnels)
+    @classmethod
+    def isTransparent(cls) -> bool:
+        return cls.PASS_THROUGH or (cls.clientToServerHook is StreamInterceptor.clientToServerHook
+                                        and cls.serverToClientHook is StreamInterceptor.serverToClientHook)
+
+    ## NOTE: Returns the (clientToServer, serverToClient) framers of a new tunnel, which then replace the
+    ## delimiter parsing of its buffers (e.g. for HTTP, where only the message heads are delimited)
+    def createFramers(self) -> Optional[Tuple["MessageFramer", "MessageFramer"]]:
+        return None
+
     ## NOTE: This needs to rewrite any requests to the real server
     @staticmethod
     def clientToServerHook(buffer: "Buffer", requestChunk: bytes) -> None:
@@ -23,6 +65,152 @@ class StreamInterceptor:
         raise NotImplementedError
 
 
+class PassThroughInterceptor(StreamInterceptor):
+    """Interceptor for tunnels that only relay bulk data (e.g. FTP data connections)"""
+    REQUEST_DELIMITERS = [b"\r\n"]
+    PASS_THROUGH = True
+    SOCKET_PROFILE = "bulk"
+
+    @staticmethod
+    def clientToServerHook(buffer: "Buffer", requestChunk: bytes) -> None:
+        return None
+
+    @staticmethod
+    def serverToClientHook(buffer: "Buffer", responseChunk: bytes) -> None:
+        return None
+
+
+class MessageFramer:
+    """Splits one direction of a stream into the messages that are passed to
+    the hook, and the bytes that are only relayed (e.g. message bodies)"""
+    __slots__ = ()
+
+    def feed(self, chunk: bytes) -> List[Union[bytes, int]]:
+        """Returns the frames of the chunk in stream order - a message (bytes)
+        is hooked, and a count (int) of bytes is relayed without a hook"""
+        raise NotImplementedError
+
+    def pendingBytes(self) -> int:
+        """Returns the bytes of a partial message held by the framer"""
+        return 0
+
+    def reset(self) -> None:
+        return None
+
+
+@dataclass
+class MemoryBudget:
+    """Global count of the bytes held by every Buffer (data, request queue
+    and the delimiter lookback) that is shared across all tunnels
+
+    - Above `softLimit` the server stops reading into the largest buffers
+      until usage drops back to `resumeLimit`
+    - Above `hardLimit` new connections are refused"""
+    softLimit: int
+    hardLimit: int
+    resumeLimit: Optional[int] = None
+    usage: int = field(init=False, default=0)
+
+    def __post_init__(self) -> None:
+        if self.resumeLimit is None:
+            self.resumeLimit = (self.softLimit * 3) // 4
+        if not (0 <= self.resumeLimit <= self.softLimit <= self.hardLimit):
+            raise InvalidMemoryBudgetError(self)
+
+    def allocate(self, size: int) -> None:
+        """Adds (or releases, if negative) `size` bytes to the global usage"""
+        self.usage += size
+
+    def isOverSoftLimit(self) -> bool:
+        return self.usage > self.softLimit
+
+    def isOverHardLimit(self) -> bool:
+        return self.usage > self.hardLimit
+
+    def isUnderResumeLimit(self) -> bool:
+        return self.usage <= self.resumeLimit
+
+
+@dataclass
+class SerialHookQueue:
+    """Runs hooks on a shared executor one at a time, in the order they
+    were submitted
+
+    Each tunnel has its own queue, so requests of a tunnel are hooked in
+    order (and an interceptor instance is never run concurrently), while
+    hooks of different tunnels run in parallel on the executor"""
+    executor: Executor
+    _queue: deque = field(init=False, repr=False, default_factory=deque)
+    _lock: threading.Lock = field(init=False, repr=False, default_factory=threading.Lock)
+    _running: bool = field(init=False, default=False)
+
+    def submit(self, hook: Callable, *args) -> Future:
+        future = Future()
+        with self._lock:
+            self._queue.append((future, hook, args))
+            if self._running:
+                return future
+            self._running = True
+        self.executor.submit(self._run)
+        return future
+
+    def _run(self) -> None:
+        while True:
+            with self._lock:
+                if not self._queue:
+                    self._running = False
+                    return None
+                future, hook, args = self._queue.popleft()
+
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(hook(*args))
+            except BaseException as e:
+                future.set_exception(e)
+
+
+@dataclass
+class AsyncHookRunner:
+    """Awaits the awaitables returned by interceptor hooks on an asyncio
+    event loop that runs in a background thread (started on first use)
+
+    The proxy's event loop never blocks on them - the buffer instead holds
+    back the awaited request until the returned future is done"""
+    _loop: Optional[asyncio.AbstractEventLoop] = field(init=False, repr=False, default=None)
+    _thread: Optional[threading.Thread] = field(init=False, repr=False, default=None)
+    _lock: threading.Lock = field(init=False, repr=False, default_factory=threading.Lock)
+
+    def submit(self, awaitable: Awaitable, previous: Optional[Future] = None) -> Future:
+        """Schedules the awaitable (after `previous` has finished, so that the
+        awaited hooks of a direction complete in order)"""
+        return asyncio.run_coroutine_threadsafe(self._awaitInOrder(awaitable, previous), self._startLoop())
+
+    def close(self) -> None:
+        with self._lock:
+            if self._loop is None:
+                return None
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop.close()
+            self._loop, self._thread = None, None
+
+    def _startLoop(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=self._loop.run_forever, name="AsyncHookRunner", daemon=True)
+                self._thread.start()
+            return self._loop
+
+    @staticmethod
+    async def _awaitInOrder(awaitable: Awaitable, previous: Optional[Future]) -> object:
+        if previous is not None and not previous.done():
+            ## NOTE: The previous hook's failure is reported by its own future
+            await asyncio.wait([asyncio.wrap_future(previous)])
+        return await awaitable
+
+
 ## The Buffer needs to be rewritten
 ## - It needs to be **aware** of the higher-level layer 7 requests
 
@@ -47,6 +235,28 @@ class Buffer:
     _prevEndBuffer: bytearray = field(init=False, default_factory=bytearray)
     _requests: deque = field(init=False, default_factory=deque)
     _MAX_BUFFER_SIZE: int = 1024 * 128 ## 128Kb
+    memoryBudget: Optional[MemoryBudget] = field(default=None, compare=False, repr=False)
+    parseRequests: bool = field(default=True, compare=False)
+    holdUndelimited: bool = field(default=False, compare=False)
+    ## NOTE: If set, the framer splits the stream instead of the REQUEST_DELIMITERS
+    framer: Optional[MessageFramer] = field(default=None, compare=False, repr=False)
+    _memoryUsage: int = field(init=False, default=0, compare=False)
+    ## NOTE: Offloaded hooks are tracked with absolute stream offsets (as _data is popped from the left)
+    _hookQueue: Optional[SerialHookQueue] = field(init=False, default=None, compare=False, repr=False)
+    _asyncHookRunner: Optional[AsyncHookRunner] = field(init=False, default=None, compare=False, repr=False)
+    _lastAwaitedHook: Optional[Future] = field(init=False, default=None, compare=False, repr=False)
+    _waitForHook: bool = field(init=False, default=True, compare=False, repr=False)
+    _onHookComplete: Optional[Callable[[], None]] = field(init=False, default=None, compare=False, repr=False)
+    _pendingHooks: deque = field(init=False, default_factory=deque, compare=False, repr=False)
+    ## NOTE: The (offset, request, future) of each awaited hook, until its result is checked for a continuation
+    _awaitedHooks: deque = field(init=False, default_factory=deque, compare=False, repr=False)
+    _poppedOffset: int = field(init=False, default=0, compare=False, repr=False)
+    _dispatchedOffset: int = field(init=False, default=0, compare=False, repr=False)
+    _hookedRequest: Optional[Tuple[int, int]] = field(init=False, default=None, compare=False, repr=False)
+    ## NOTE: Edits are kept as sorted [start, end, replacement] patches (at absolute offsets of the received
+    ## stream), and only applied when the data is sent - so an edit never moves the rest of _data
+    _patches: List[list] = field(init=False, default_factory=list, compare=False, repr=False)
+    _patchSent: int = field(init=False, default=0, compare=False, repr=False)   ## bytes sent of the first patch
 
     def __post_init__(self):
         # ## NOTE: We'll likely change the structure later
@@ -75,39 +285,362 @@ class Buffer:
         return None
     
     ############### Bytes Operations #######################
+    ## NOTE: Bytes are counted in the edited stream (i.e. with the patches applied) by read(), pop(),
+    ## gather() and sendable() - without patches, this is `buffer()._data` itself
     def read(self, bytes: int = 0) -> bytes:
         """This reads bytes from the intercepted data stream
         `buffer()._data` (without popping)"""
+        if self._patches:
+            return b"".join(self.gather(bytes))
         if bytes < 0:
             return self._data
         return self._data[:bytes]
 
 
+    def gather(self, bytes: int = 0) -> List[bytes]:
+        """Returns the next bytes of the edited stream as a list of segments
+        (slices of `buffer()._data` and the patched in data), so that they
+        can be sent with a single gather write (without being joined)"""
+        data, cursor = self._data, self._poppedOffset
+        if bytes < 0:
+            bytes = self._editedLength(len(data))
+        segments = []
+        for index, (start, end, replacement) in enumerate(self._patches):
+            if start > cursor:
+                size = min(bytes, start - cursor)
+                segments.append(data[cursor - self._poppedOffset:cursor - self._poppedOffset + size])
+                bytes -= size
+                cursor += size
+            if bytes <= 0:
+                return segments
+            ## NOTE: The first patch may have been partially sent
+            skip = self._patchSent if index == 0 else 0
+            segment = replacement[skip:skip + bytes]
+            if segment:
+                segments.append(segment)
+            bytes -= len(segment)
+            cursor = end
+            if bytes <= 0:
+                return segments
+        segment = data[cursor - self._poppedOffset:cursor - self._poppedOffset + bytes]
+        if segment or not segments:
+            segments.append(segment)
+        return segments
+
+
     def pop(self, bytes: int = 0) -> bytes:
         """This pops bytes from the intercepted data stream
         buffer `buffer()._data` (from the left)"""
-        if bytes < 0:
-            bytes = len(self._data)
-        ret = self.read(bytes)
-        del self._data[:bytes]
+        if self._patches:
+            ret = self.read(bytes)
+            self._consumeEdited(len(ret))
+        else:
+            if bytes < 0:
+                bytes = len(self._data)
+            ret = self.read(bytes)
+            del self._data[:bytes]
+            self._poppedOffset += len(ret)
+        if self.memoryBudget is not None:
+            self._updateMemoryUsage()
         return ret
 
 
+    def _consumeEdited(self, bytes: int) -> None:
+        ## Translates the sent bytes of the edited stream into received bytes (and drops the sent patches)
+        patches, cursor = self._patches, self._poppedOffset
+        while bytes > 0:
+            if patches and patches[0][0] == cursor:
+                _, end, replacement = patches[0]
+                size = min(bytes, len(replacement) - self._patchSent)
+                self._patchSent += size
+                bytes -= size
+                if self._patchSent == len(replacement):
+                    del patches[0]
+                    self._patchSent = 0
+                    cursor = end
+            else:
+                size = min(bytes, patches[0][0] - cursor) if patches else bytes
+                cursor += size
+                bytes -= size
+        ## NOTE: Deletions (empty replacements) are dropped as soon as they're reached
+        while patches and patches[0][0] == cursor and not patches[0][2]:
+            cursor = patches.pop(0)[1]
+        del self._data[:cursor - self._poppedOffset]
+        self._poppedOffset = cursor
+
+
+    def _editedLength(self, bytes: int) -> int:
+        ## Returns the length of the first `bytes` of `buffer()._data` once edited
+        ## NOTE: An insertion at the end is sent with them (e.g. one at the end of the last hooked request)
+        end = self._poppedOffset + bytes
+        for start, patchEnd, replacement in self._patches:
+            if start > end or (start == end and patchEnd > start):
+                break
+            if patchEnd > end:
+                ## NOTE: A patch is only sent once all of it can be (so the data is cut at its start)
+                return bytes - (end - start)
+            bytes += len(replacement) - (patchEnd - start)
+        return bytes - self._patchSent
+
+
     def write(self, chunk: bytearray) -> None:
         """Writes the received chunk to a intercepted data
         stream buffer - `buffer()._data`"""
         self._data += chunk
-        self._execRequestParsing(chunk)
-
-
-    def setHook(self, hook: Callable[["Buffer", bytearray], None]) -> None:
+        ## NOTE: Pass-through buffers are never parsed into requests (the stream is only relayed)
+        if self.parseRequests and self.framer is not None:
+            self._execFraming(chunk)
+        elif self.parseRequests:
+            self._execRequestParsing(chunk)
+        elif self._requests or self._prevEndBuffer or (self.framer is not None and self.framer.pendingBytes()):
+            self._discardParsingState()
+        if self.memoryBudget is not None:
+            self._updateMemoryUsage()
+
+
+    def stopInspection(self) -> None:
+        """Stops parsing the stream into requests (e.g. once an interceptor
+        has nothing more to learn from it), so the rest is only relayed
+
+        Hooks that are already running still hold back their requests. This
+        is safe to call from a hook (inline or offloaded)"""
+        ## NOTE: Only flags are set here - the partially parsed request is discarded by the next write()
+        self.parseRequests = False
+        self.holdUndelimited = False
+
+
+    def discardUndelimited(self) -> None:
+        """Drops the data that is held back because it isn't part of a
+        delimited request yet (e.g. once the stream has ended, as the request
+        can't be completed anymore)"""
+        if self.holdUndelimited:
+            del self._data[self._dispatchedOffset - self._poppedOffset:]
+        self._discardParsingState()
+
+
+    def _discardParsingState(self) -> None:
+        self._requests.clear()
+        self._prevEndBuffer = bytearray()
+        if self.framer is not None:
+            self.framer.reset()
+        if self.memoryBudget is not None:
+            self._updateMemoryUsage()
+
+
+    ############### Memory Accounting #######################
+    def memoryUsage(self) -> int:
+        """Returns the bytes held by the buffer (stream data, unsent edits,
+        queued requests and the delimiter lookback `buffer()._prevEndBuffer`)"""
+        ## NOTE: Delimited requests are passed to the hook straight away, so the queue is usually <= 1 item
+        usage = len(self._data) + len(self._prevEndBuffer) + sum(len(request) for request, _ in self._requests)
+        usage += sum(len(replacement) for _, _, replacement in self._patches)
+        if self.framer is not None:
+            usage += self.framer.pendingBytes()
+        return usage
+
+
+    def releaseMemory(self) -> None:
+        """Returns the accounted bytes to the memory budget (e.g. once the tunnel is closed)"""
+        if self.memoryBudget is not None:
+            self.memoryBudget.allocate(-self._memoryUsage)
+        self._memoryUsage = 0
+
+
+    def _updateMemoryUsage(self) -> None:
+        usage = self.memoryUsage()
+        self.memoryBudget.allocate(usage - self._memoryUsage)
+        self._memoryUsage = usage
+
+
+    def sendable(self) -> int:
+        """Returns the number of bytes at the start of `buffer()._data` that
+        can be forwarded (i.e. that aren't held back by a running hook)"""
+        if self._awaitedHooks:
+            self._resumeAwaitedHooks()
+        pendingHooks = self._pendingHooks
+        while pendingHooks and pendingHooks[0][1].done() and not self._awaitsResume(pendingHooks[0][1]):
+            pendingHooks.popleft()
+        ## NOTE: With holdUndelimited, only requests that have been passed to the hook are forwarded
+        sendable = self._dispatchedOffset - self._poppedOffset if self.holdUndelimited else len(self._data)
+        if pendingHooks:
+            sendable = min(max(pendingHooks[0][0] - self._poppedOffset, 0), sendable)
+        if not self._patches:
+            return sendable
+        ## NOTE: A deletion at the start is dropped here, as there's nothing to send for it
+        ## (_consumeEdited() also drops the deletions that directly follow it, so the actual advance is subtracted)
+        while self._patches and self._patches[0][0] == self._poppedOffset and not self._patches[0][2] \
+                and self._patches[0][1] - self._poppedOffset <= sendable:
+            poppedOffset = self._poppedOffset
+            self._consumeEdited(0)
+            sendable = max(sendable - (self._poppedOffset - poppedOffset), 0)
+        return self._editedLength(sendable)
+
+
+    def waitForHooks(self, timeout: Optional[float] = None) -> None:
+        """Blocks until the awaited hooks of the requests passed so far (and
+        the hooks they continue with) have finished (the last one's exception
+        is raised). This must be called from the thread that writes the buffer"""
+        awaitedHook = self._lastAwaitedHook
+        while awaitedHook is not None:
+            awaitedHook.result(timeout)
+            self._resumeAwaitedHooks()
+            awaitedHook = self._lastAwaitedHook if self._awaitedHooks else None
+
+
+    def canReplaceRequest(self) -> bool:
+        return (self._hookedRequest is not None and self._hookQueue is None
+                    and self._hookedRequest[0] >= self._poppedOffset)
+
+
+    def replaceRange(self, start: int, end: int, replacement: bytes) -> None:
+        """Replaces the bytes [start:end] of the request that is being passed
+        to the hook (offsets are within the request, as it was received)
+
+        The edit is recorded as a patch that is applied when the request is
+        sent, so the rest of `buffer()._data` is neither moved nor copied.
+        Edits of a request can't overlap. This can only be called from a
+        hook that runs inline (i.e. not on a hook executor) of a buffer that
+        holds undelimited data"""
+        if not self.canReplaceRequest():
+            raise RequestRewriteUnavailableError(self)
+        offset, length = self._hookedRequest
+        if not (0 <= start <= end <= length):
+            raise InvalidEditRangeError(start, end, length)
+        start, end = offset + start, offset + end
+        patches = self._patches
+        index = bisect.bisect_right(patches, [start, end], key=lambda patch: patch[:2])
+        for neighbour in patches[max(index - 1, 0):index + 1]:
+            if neighbour[0] < end and start < neighbour[1]:
+                raise InvalidEditRangeError(start - offset, end - offset, length)
+        patches.insert(index, [start, end, bytes(replacement)])
+        if self.memoryBudget is not None:
+            self._updateMemoryUsage()
+
+
+    def insertAt(self, offset: int, data: bytes) -> None:
+        """Inserts data at the offset of the request that is being passed to the hook"""
+        self.replaceRange(offset, offset, data)
+
+
+    def deleteRange(self, start: int, end: int) -> None:
+        """Deletes the bytes [start:end] of the request that is being passed to the hook"""
+        self.replaceRange(start, end, b"")
+
+
+    def replaceRequest(self, replacement: bytes) -> None:
+        """Replaces the request that is being passed to the hook in the
+        intercepted data stream `buffer()._data` (see replaceRange())"""
+        if not self.canReplaceRequest():
+            raise RequestRewriteUnavailableError(self)
+        self.replaceRange(0, self._hookedRequest[1], replacement)
+
+
+    def setHook(self, hook: Callable[["Buffer", bytearray], None], hookQueue: Optional[SerialHookQueue] = None,
+                    waitForHook: bool = True, onHookComplete: Optional[Callable[[], None]] = None,
+                    asyncHookRunner: Optional[AsyncHookRunner] = None) -> None:
         """This binds a request hook which is executed whenever
         a request is completely parsed from the request queue 
-        `buffer()._requests`"""
-        ## TODO: Find a better way to bind the hook function to this self obj instance
-        # self._requestHook = functools.partial(hook, self)
-        # self._requestHook = hook
-        
+        `buffer()._requests`
+
+        - If a `hookQueue` is provided, the hook runs on its executor instead
+        - If the hook returns an awaitable (e.g. it is an `async def`), it is
+          awaited by the `asyncHookRunner`. If the awaitable resolves to
+          another hook, that hook is then called for the same request (inline,
+          by the next sendable(), so it can still rewrite a held request)
+        With `waitForHook`, the request is held back from sendable() until its
+        hook has finished, and `onHookComplete` is then called (from the
+        executor / runner thread)"""
+        self._boundHook = functools.partial(hook, self)
+        self._hookQueue = hookQueue
+        self._asyncHookRunner = asyncHookRunner
+        self._waitForHook = waitForHook
+        self._onHookComplete = onHookComplete
+        if hookQueue is None:
+            self._requestHook = self._callRequestHook
+        else:
+            self._requestHook = self._submitRequestHook
+
+
+    def _callRequestHook(self, request: bytearray) -> None:
+        requestOffset = self._dispatchedOffset
+        self._dispatchedOffset += len(request)
+        self._callHook(self._boundHook, requestOffset, request)
+
+
+    def _callHook(self, hook: Callable[[bytearray], object], requestOffset: int, request: bytearray) -> None:
+        self._hookedRequest = (requestOffset, len(request))
+        try:
+            result = hook(request)
+        finally:
+            self._hookedRequest = None
+        if inspect.isawaitable(result):
+            ## NOTE: Only this direction's forwarding is suspended while the hook is awaited
+            self._validateAsyncHookRunner(result)
+            self._lastAwaitedHook = self._asyncHookRunner.submit(result, self._lastAwaitedHook)
+            self._awaitedHooks.append((requestOffset, request, self._lastAwaitedHook))
+            self._trackRequestHook(requestOffset, self._lastAwaitedHook)
+
+
+    def _resumeAwaitedHooks(self) -> None:
+        ## NOTE: The awaited hooks finish in order, so their continuations are called in the order of the requests
+        awaitedHooks = self._awaitedHooks
+        while awaitedHooks and awaitedHooks[0][2].done():
+            requestOffset, request, future = awaitedHooks.popleft()
+            if future.cancelled() or future.exception() is not None or not callable(future.result()):
+                continue
+            self._callHook(functools.partial(future.result(), self), requestOffset, request)
+
+
+    def _awaitsResume(self, future: Future) -> bool:
+        ## NOTE: A hook that finished after the continuations were resumed holds its request until the next call
+        return bool(self._awaitedHooks) and any(awaitedHook is future for _, _, awaitedHook in self._awaitedHooks)
+
+
+    def _submitRequestHook(self, request: bytearray) -> None:
+        requestOffset = self._dispatchedOffset
+        self._dispatchedOffset += len(request)
+        self._trackRequestHook(requestOffset, self._hookQueue.submit(self._runOffloadedHook, request))
+
+
+    def _runOffloadedHook(self, request: bytearray) -> object:
+        ## NOTE: The executor thread waits on an awaitable result, so the tunnel's next hook runs after it
+        ## (as does the hook that the awaitable resolves to, if any)
+        result = self._boundHook(request)
+        while inspect.isawaitable(result):
+            self._validateAsyncHookRunner(result)
+            result = self._asyncHookRunner.submit(result).result()
+            if callable(result):
+                result = result(self, request)
+        return result
+
+
+    def _validateAsyncHookRunner(self, awaitable: Awaitable) -> None:
+        if self._asyncHookRunner is None:
+            if inspect.iscoroutine(awaitable):
+                awaitable.close() ## avoids the "never awaited" warning
+            raise MissingAsyncHookRunnerError(self)
+
+
+    def _trackRequestHook(self, requestOffset: int, future: Future) -> None:
+        if self._waitForHook:
+            ## NOTE: A continuation's hook is for an earlier request than the hooks that were called since
+            pendingHooks = self._pendingHooks
+            if pendingHooks and pendingHooks[-1][0] > requestOffset:
+                bisect.insort_right(pendingHooks, (requestOffset, future), key=lambda pendingHook: pendingHook[0])
+            else:
+                pendingHooks.append((requestOffset, future))
+        future.add_done_callback(self._completeRequestHook)
+
+
+    def _completeRequestHook(self, future: Future) -> None:
+        failed = not future.cancelled() and future.exception() is not None
+        if failed:
+            logging.error(f"Request hook failed: {future.exception()!r}")
+        ## NOTE: A hook that resolves to a continuation needs the loop to call it, even if its request isn't held
+        resumable = not (future.cancelled() or failed) and callable(future.result())
+        if (self._waitForHook or resumable) and self._onHookComplete is not None:
+            self._onHookComplete()
+
 
     ############## Request Queue Operations ########################
     def pushToQueue(self, data: bytearray, delimited: bool) -> None:
@@ -196,12 +729,16 @@ class Buffer:
 
         ## At this point we must have SOMETHING in the queue
         ## All elements below the top have been delimited, so we can pass it to the requestHook
-        while len(self._requests) - 1:
+        ## NOTE: A hook can stop the inspection, so the remaining requests are then only relayed
+        while len(self._requests) > 1 and self.parseRequests:
             ## we pop the request from queue
             request, _ = self._requests.popleft()
             ## we execute the request hook
             self._requestHook(request)
 
+        if not self.parseRequests:
+            return self._discardParsingState()
+
         ## The top element isn't guaranteed to be finished
         ## --> Therefore we need to determine if it has been delimited
         _, isDelimited = self.peakFromQueue()
@@ -214,7 +751,95 @@ class Buffer:
         return None
 
 
+    def _execFraming(self, chunk: bytearray) -> None:
+        """Passes the messages that the framer finds in the chunk to the
+        request hook (the relayed bytes are only counted)"""
+        for frame in self.framer.feed(chunk):
+            ## NOTE: A hook can stop the inspection, so the remaining frames are then only relayed
+            if not self.parseRequests:
+                return self._discardParsingState()
+            if type(frame) is int:
+                self._dispatchedOffset += frame
+            else:
+                self._requestHook(frame)
+        if not self.parseRequests:
+            return self._discardParsingState()
+        return None
+
+
     ##################### Request Hook ###################
     def _requestHook(self, request: bytearray) -> None:
         ## Method that should be overriden / set depending on protocol
         ...
+
+
+
+class RelayBuffer:
+    """The buffer of one direction of a transparent tunnel (see
+    StreamInterceptor.isTransparent()) - the stream is only relayed, so
+    there are no delimiters, framing, hooks or edits to account for"""
+    __slots__ = ("_data", "memoryBudget", "_memoryUsage")
+    parseRequests = False
+
+    def __init__(self, memoryBudget: Optional[MemoryBudget] = None) -> None:
+        self._data = bytearray()
+        self.memoryBudget = memoryBudget
+        self._memoryUsage = 0
+
+
+    def write(self, chunk: bytes) -> None:
+        self._data += chunk
+        if self.memoryBudget is not None:
+            self._updateMemoryUsage()
+
+
+    def read(self, bytes: int = 0) -> bytes:
+        if bytes < 0:
+            return self._data
+        return self._data[:bytes]
+
+
+    def gather(self, bytes: int = 0) -> List[bytes]:
+        return [self.read(bytes)]
+
+
+    def pop(self, bytes: int = 0) -> bytes:
+        if bytes < 0:
+            bytes = len(self._data)
+        ret = self._data[:bytes]
+        del self._data[:bytes]
+        if self.memoryBudget is not None:
+            self._updateMemoryUsage()
+        return ret
+
+
+    def sendable(self) -> int:
+        return len(self._data)
+
+
+    def stopInspection(self) -> None:
+        return None
+
+
+    def discardUndelimited(self) -> None:
+        return None
+
+
+    def waitForHooks(self, timeout: Optional[float] = None) -> None:
+        return None
+
+
+    def memoryUsage(self) -> int:
+        return len(self._data)
+
+
+    def releaseMemory(self) -> None:
+        if self.memoryBudget is not None:
+            self.memoryBudget.allocate(-self._memoryUsage)
+        self._memoryUsage = 0
+
+
+    def _updateMemoryUsage(self) -> None:
+        usage = len(self._data)
+        self.memoryBudget.allocate(usage - self._memoryUsage)
+        self._memoryUsage = usage
@@ -0,0 +1,347 @@
+import os
+import mmap
+import time
+import glob
+import struct
+import logging
+import itertools
+from array import array
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional
+
+from _exceptions import *
+
+
+## NOTE: Records are copied straight into a memory mapped segment, so capturing a chunk costs no syscall
+## (the pages are written back to disk by the kernel, off the event loop)
+## Segment layout: | header | records ... | (zeroed, until the segment is closed and truncated)
+## Index layout:   | header | (tunnel id, record count, record offsets ...) per tunnel |
+SEGMENT_MAGIC = b"SICAPSG1"
+INDEX_MAGIC = b"SICAPIX1"
+SEGMENT_HEADER = struct.Struct("<8sdd")      ## magic, wall clock time, monotonic time (at creation)
+RECORD_HEADER = struct.Struct("<QBdI")       ## tunnel id, direction, monotonic time, payload length
+INDEX_HEADER = struct.Struct("<8sI")         ## magic, tunnel count
+INDEX_ENTRY = struct.Struct("<QI")           ## tunnel id, record count
+
+DIRECTIONS = ("clientToServer", "serverToClient")
+
+
+class CaptureRecord(NamedTuple):
+    tunnelId: int
+    direction: str
+    timestamp: float    ## time.monotonic() when the chunk was read
+    payload: bytes
+
+
+@dataclass
+class _Segment:
+    number: int
+    file: object
+    mapping: mmap.mmap
+    size: int
+    offset: int = SEGMENT_HEADER.size
+    ## NOTE: The offsets of each tunnel's records (written to the index file when the segment is closed)
+    index: Dict[int, array] = field(default_factory=dict)
+
+
+@dataclass
+class SessionCapture:
+    """Appends every chunk read by the proxy's tunnels to memory mapped,
+    append-only segment files in `directory`
+
+    A segment is rotated once it's `segmentSize` bytes, and is then written
+    an index of the records of each tunnel (see CaptureReader). The capture
+    is only ever appended to by the event loop - the segments are created
+    ahead of time, renamed into place and closed (with their index) by a
+    background writer, and records wait in memory while the next segment
+    isn't ready yet"""
+    directory: str
+    segmentSize: int = 64 * 1024 * 1024
+    PREFIX = "capture"
+
+    _segment: Optional[_Segment] = field(init=False, repr=False, default=None)
+    ## NOTE: The writer runs its tasks in order, so a segment is always closed before the next one is
+    _writer: Optional[ThreadPoolExecutor] = field(init=False, repr=False, default=None)
+    _nextSegment: Optional[Future] = field(init=False, repr=False, default=None)
+    ## NOTE: The (tunnel id, direction, time, payload) of the records that are waiting for the next segment
+    _backlog: deque = field(init=False, repr=False, default_factory=deque)
+    _tunnelIds: Iterator[int] = field(init=False, repr=False, default_factory=lambda: itertools.count(1))
+    _segmentNumbers: Iterator[int] = field(init=False, repr=False, default=None)
+
+    def __post_init__(self) -> None:
+        if not (isinstance(self.segmentSize, int) and self.segmentSize > SEGMENT_HEADER.size + RECORD_HEADER.size):
+            raise InvalidSessionCaptureError(self, f"segmentSize must be an int over {SEGMENT_HEADER.size + RECORD_HEADER.size}")
+        os.makedirs(self.directory, exist_ok=True)
+        ## NOTE: A new capture never overwrites the segments of a previous one in the same directory
+        existing = [segmentNumber(path) for path in segmentPaths(self.directory, self.PREFIX)]
+        self._segmentNumbers = itertools.count(max(existing, default=0) + 1)
+        ## NOTE: Even the first segment is created by the writer, so that the event loop never waits on the disk
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="SessionCapture")
+        self._nextSegment = self._submit(self._createSegment, next(self._segmentNumbers), self.segmentSize)
+
+
+    def newTunnelId(self) -> int:
+        return next(self._tunnelIds)
+
+
+    def append(self, tunnelId: int, direction: int, payload: bytes) -> None:
+        """Appends a chunk read from the `direction` (an index of DIRECTIONS) of the tunnel"""
+        recordSize = RECORD_HEADER.size + len(payload)
+        segment = self._segment
+        if segment is None or self._backlog or segment.offset + recordSize > segment.size:
+            self._backlog.append((tunnelId, direction, time.monotonic(), payload))
+            return self._drainBacklog()
+        self._writeRecord(segment, tunnelId, direction, time.monotonic(), payload)
+
+
+    def _writeRecord(self, segment: _Segment, tunnelId: int, direction: int, timestamp: float, payload: bytes) -> None:
+        recordSize = RECORD_HEADER.size + len(payload)
+        offset = segment.offset
+        RECORD_HEADER.pack_into(segment.mapping, offset, tunnelId, direction, timestamp, len(payload))
+        segment.mapping[offset + RECORD_HEADER.size:offset + recordSize] = payload
+        segment.offset = offset + recordSize
+
+        offsets = segment.index.get(tunnelId)
+        if offsets is None:
+            offsets = segment.index[tunnelId] = array("Q")
+        offsets.append(offset)
+
+
+    def close(self) -> None:
+        """Writes the records that are waiting for a segment, closes the
+        current segment, and waits for the writer to finish"""
+        if self._writer is None:
+            return None
+        while self._backlog and self._nextSegment is not None:
+            wait([self._nextSegment])
+            try:
+                self._drainBacklog()
+            except OSError as e:
+                logging.error(f"Session capture dropped {len(self._backlog)} records: {e!r}")
+                self._backlog.clear()
+        if self._segment is not None:
+            self._submit(self._closeSegment, self._segment)
+            self._segment = None
+        if self._nextSegment is not None:
+            self._submit(self._discardSegment, self._nextSegment)
+            self._nextSegment = None
+        self._writer.shutdown(wait=True)
+        self._writer = None
+
+
+    def _drainBacklog(self) -> None:
+        ## NOTE: The records are written in order, so they stay in the backlog until the writer has the next segment ready
+        ## (they're written by a later append(), or by close())
+        backlog = self._backlog
+        while backlog:
+            tunnelId, direction, timestamp, payload = backlog[0]
+            recordSize = RECORD_HEADER.size + len(payload)
+            segment = self._segment
+            if segment is None or segment.offset + recordSize > segment.size:
+                segment = self._rotate(recordSize)
+                if segment is None:
+                    return None
+            backlog.popleft()
+            self._writeRecord(segment, tunnelId, direction, timestamp, payload)
+
+
+    def _rotate(self, recordSize: int) -> Optional[_Segment]:
+        ## Returns the next segment, or None if the writer hasn't created it yet
+        if self._segment is not None:
+            self._submit(self._closeSegment, self._segment)
+            self._segment = None
+        if self._nextSegment is None:
+            self._nextSegment = self._submit(self._createSegment, next(self._segmentNumbers), self.segmentSize)
+        if not self._nextSegment.done():
+            return None
+        ## NOTE: A segment that failed to be created raises here, and is replaced by the next rotation
+        pending, self._nextSegment = self._nextSegment, None
+        segment = pending.result()
+        if segment.offset + recordSize > segment.size:
+            ## A record that is larger than a segment gets a segment of its own (grown by the writer, as it's rare)
+            self._nextSegment = self._submit(self._growSegment, segment, segment.offset + recordSize)
+            return None
+
+        SEGMENT_HEADER.pack_into(segment.mapping, 0, SEGMENT_MAGIC, time.time(), time.monotonic())
+        self._submit(self._publishSegment, segment)
+        self._segment = segment
+        self._nextSegment = self._submit(self._createSegment, next(self._segmentNumbers), self.segmentSize)
+        return segment
+
+
+    def _submit(self, function, *args) -> Future:
+        future = self._writer.submit(function, *args)
+        future.add_done_callback(_logWriterFailure)
+        return future
+
+
+    def _createSegment(self, number: int, size: int) -> _Segment:
+        ## NOTE: The file is extended without being written (sparse), so only the pages that are used take up disk
+        file = open(segmentPath(self.directory, self.PREFIX, number) + ".tmp", "w+b")
+        file.truncate(size)
+        return _Segment(number, file, mmap.mmap(file.fileno(), size), size)
+
+
+    @staticmethod
+    def _growSegment(segment: _Segment, size: int) -> _Segment:
+        segment.mapping.close()
+        segment.size = size
+        segment.file.truncate(size)
+        segment.mapping = mmap.mmap(segment.file.fileno(), size)
+        return segment
+
+
+    def _publishSegment(self, segment: _Segment) -> None:
+        ## NOTE: The segment is only renamed into place once it's used, so readers never see a preallocated one
+        ## (its records are already written through the mapping, which isn't affected by the rename)
+        os.replace(segment.file.name, segmentPath(self.directory, self.PREFIX, segment.number))
+
+
+    @staticmethod
+    def _discardSegment(pending: Future) -> None:
+        ## Called by the writer, so the segment has already been created (unless that failed)
+        if pending.exception() is not None:
+            return None
+        segment = pending.result()
+        segment.mapping.close()
+        segment.file.close()
+        os.remove(segment.file.name)
+
+
+    def _closeSegment(self, segment: _Segment) -> None:
+        ## The unused (zeroed) end of the segment is truncated
+        segment.mapping.close()
+        segment.file.truncate(segment.offset)
+        segment.file.close()
+
+        entries = [INDEX_HEADER.pack(INDEX_MAGIC, len(segment.index))]
+        for tunnelId, offsets in segment.index.items():
+            entries.append(INDEX_ENTRY.pack(tunnelId, len(offsets)))
+            entries.append(offsets.tobytes())
+        ## NOTE: The index is written out of place, so a reader never sees a partial index
+        path = indexPath(self.directory, self.PREFIX, segment.number)
+        with open(path + ".tmp", "wb") as indexFile:
+            indexFile.write(b"".join(entries))
+        os.replace(path + ".tmp", path)
+
+
+
+def _logWriterFailure(future: Future) -> None:
+    if not future.cancelled() and future.exception() is not None:
+        logging.error(f"Session capture writer failed: {future.exception()!r}")
+
+
+
+@dataclass
+class CaptureReader:
+    """Reads the records of the segments in a capture directory (in the
+    order they were captured)
+
+    The records of a single tunnel are found with the index of each closed
+    segment, while a segment that is still being written (or wasn't closed)
+    is scanned"""
+    directory: str
+    PREFIX = "capture"
+
+    def segments(self) -> List[str]:
+        return segmentPaths(self.directory, self.PREFIX)
+
+
+    def records(self, tunnelId: Optional[int] = None) -> Iterator[CaptureRecord]:
+        for path in self.segments():
+            yield from self._readSegment(path, tunnelId)
+
+
+    def sessions(self, tunnelIds: Optional[Iterable[int]] = None) -> Dict[int, List[CaptureRecord]]:
+        """Returns the records of each tunnel (or only of `tunnelIds`), keyed
+        by tunnel id in ascending order - each segment is only read once"""
+        selected = None if tunnelIds is None else set(tunnelIds)
+        sessions = {}
+        for path in self.segments():
+            for record in self._readSegment(path):
+                if selected is None or record.tunnelId in selected:
+                    records = sessions.get(record.tunnelId)
+                    if records is None:
+                        records = sessions[record.tunnelId] = []
+                    records.append(record)
+        return {tunnelId: sessions[tunnelId] for tunnelId in sorted(sessions)}
+
+
+    def tunnelIds(self) -> List[int]:
+        tunnelIds = set()
+        for path in self.segments():
+            index = self._readIndex(path)
+            if index is None:
+                tunnelIds.update(record.tunnelId for record in self._readSegment(path))
+            else:
+                tunnelIds.update(index)
+        return sorted(tunnelIds)
+
+
+    def _readSegment(self, path: str, tunnelId: Optional[int] = None) -> Iterator[CaptureRecord]:
+        with open(path, "rb") as file:
+            data = file.read()
+        if len(data) < SEGMENT_HEADER.size or SEGMENT_HEADER.unpack_from(data)[0] != SEGMENT_MAGIC:
+            raise InvalidCaptureFileError(path, "not a capture segment")
+
+        index = self._readIndex(path) if tunnelId is not None else None
+        if index is not None:
+            offsets = index.get(tunnelId, ())
+        else:
+            offsets = self._scanOffsets(data)
+        for offset in offsets:
+            recordTunnelId, direction, timestamp, length = RECORD_HEADER.unpack_from(data, offset)
+            if tunnelId is None or recordTunnelId == tunnelId:
+                start = offset + RECORD_HEADER.size
+                yield CaptureRecord(recordTunnelId, DIRECTIONS[direction], timestamp, data[start:start + length])
+
+
+    @staticmethod
+    def _scanOffsets(data: bytes) -> Iterator[int]:
+        ## NOTE: Tunnel ids start at 1, so a zeroed record header is the (not yet written) end of the segment
+        offset = SEGMENT_HEADER.size
+        while offset + RECORD_HEADER.size <= len(data):
+            recordTunnelId, _, _, length = RECORD_HEADER.unpack_from(data, offset)
+            if recordTunnelId == 0 or offset + RECORD_HEADER.size + length > len(data):
+                return None
+            yield offset
+            offset += RECORD_HEADER.size + length
+
+
+    def _readIndex(self, path: str) -> Optional[Dict[int, array]]:
+        try:
+            with open(path[:-len(".seg")] + ".idx", "rb") as indexFile:
+                data = indexFile.read()
+        except FileNotFoundError:
+            return None
+        magic, tunnelCount = INDEX_HEADER.unpack_from(data)
+        if magic != INDEX_MAGIC:
+            raise InvalidCaptureFileError(path, "the segment's index is corrupt")
+        index, position = {}, INDEX_HEADER.size
+        for _ in range(tunnelCount):
+            tunnelId, recordCount = INDEX_ENTRY.unpack_from(data, position)
+            position += INDEX_ENTRY.size
+            offsets = array("Q")
+            offsets.frombytes(data[position:position + 8 * recordCount])
+            index[tunnelId] = offsets
+            position += 8 * recordCount
+        return index
+
+
+
+def segmentPath(directory: str, prefix: str, number: int) -> str:
+    return os.path.join(directory, f"{prefix}-{number:06d}.seg")
+
+
+def indexPath(directory: str, prefix: str, number: int) -> str:
+    return os.path.join(directory, f"{prefix}-{number:06d}.idx")
+
+
+def segmentNumber(path: str) -> int:
+    return int(os.path.basename(path).rsplit("-", 1)[1].split(".", 1)[0])
+
+
+def segmentPaths(directory: str, prefix: str) -> List[str]:
+    return sorted(glob.glob(os.path.join(glob.escape(directory), f"{prefix}-*.seg")), key=segmentNumber)
@@ -0,0 +1,80 @@
+import socket
+import logging
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+from _exceptions import *
+
+
+## NOTE: These options are Linux specific, so they're skipped where the platform doesn't have them
+TCP_QUICKACK = getattr(socket, "TCP_QUICKACK", None)
+TCP_KEEPIDLE = getattr(socket, "TCP_KEEPIDLE", None)
+TCP_KEEPINTVL = getattr(socket, "TCP_KEEPINTVL", None)
+TCP_KEEPCNT = getattr(socket, "TCP_KEEPCNT", None)
+
+
+@dataclass(frozen=True)
+class SocketProfile:
+    """Socket options for both sockets of a tunnel (see the SOCKET_PROFILE of
+    a StreamInterceptor)
+
+    - noDelay:       disables Nagle's algorithm, so small messages are sent straight away
+    - quickAck:      acknowledges received data straight away, instead of delaying the ACK
+                     (Linux clears it, so it's set again after every read)
+    - sendBuffer/receiveBuffer: the initial SO_SNDBUF/SO_RCVBUF sizes (None keeps the OS default)
+    - autotuneLimit: the size up to which the buffers are doubled while the tunnel keeps
+                     moving data (every AUTOTUNE_FACTOR buffers' worth of data read), for
+                     platforms that don't size the buffers themselves - it stops early once
+                     the kernel caps the size (net.core.rmem_max / wmem_max on Linux)
+    - keepAlive:     probes idle connections, so dead peers are detected"""
+    noDelay: bool = False
+    quickAck: bool = False
+    sendBuffer: Optional[int] = None
+    receiveBuffer: Optional[int] = None
+    autotuneLimit: Optional[int] = None
+    keepAlive: bool = False
+    keepAliveIdle: int = 60
+    keepAliveInterval: int = 10
+    keepAliveCount: int = 5
+    AUTOTUNE_FACTOR = 8
+
+    def apply(self, sock: socket.socket) -> None:
+        try:
+            if self.noDelay:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if self.quickAck and TCP_QUICKACK is not None:
+                sock.setsockopt(socket.IPPROTO_TCP, TCP_QUICKACK, 1)
+            if self.sendBuffer is not None:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.sendBuffer)
+            if self.receiveBuffer is not None:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.receiveBuffer)
+            if self.keepAlive:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+                for option, value in ((TCP_KEEPIDLE, self.keepAliveIdle), (TCP_KEEPINTVL, self.keepAliveInterval),
+                                        (TCP_KEEPCNT, self.keepAliveCount)):
+                    if option is not None:
+                        sock.setsockopt(socket.IPPROTO_TCP, option, value)
+        except OSError as e:
+            ## NOTE: The options only tune the connection, so a socket that refuses one is still tunneled
+            logging.warning(f"WARNING: Failed to apply the socket profile {self} - {e}")
+
+
+SOCKET_PROFILES: Dict[str, SocketProfile] = {
+    ## e.g. FTP control connections (short commands and replies, where latency matters)
+    "interactive": SocketProfile(noDelay=True, quickAck=True, keepAlive=True),
+    ## e.g. FTP data connections (large transfers, where throughput matters)
+    ## NOTE: The buffer sizes are left to the kernel - on Linux, setting SO_SNDBUF/SO_RCVBUF turns off its
+    ## automatic sizing (which grows the buffers up to tcp_rmem/tcp_wmem, with the connection's bandwidth-delay
+    ## product), and the sizes that can be set are capped at rmem_max/wmem_max (only ~208KB by default). Fixed
+    ## sizes (and autotuneLimit) only pay off where the kernel doesn't size the buffers itself
+    "bulk": SocketProfile(),
+}
+
+
+def getSocketProfile(name: Optional[str]) -> Optional[SocketProfile]:
+    if name is None:
+        return None
+    profile = SOCKET_PROFILES.get(name)
+    if profile is None:
+        raise UnknownSocketProfileError(name)
+    return profile
@@ -1,47 +1,98 @@
-import re
+import asyncio
 import logging
 import collections
-from typing import Optional, Tuple
+import ipaddress
+from typing import Awaitable, Optional, Tuple
 
-from _proxyDS import ProxyInterceptor, Buffer
+from _proxyDS import StreamInterceptor, Buffer
+from _credentialIndex import BaitCredentialIndex
+from _loginTracker import LoginAttemptTracker
+from _ftpParser import FTPReplyFramer, commandVerb, commandArgument, replyCode, parseHostPort, formatHostPort, parseExtendedPort, \
+                        parseExtendedAddress, formatExtendedAddress
 
 
-class FTPProxyInterceptor(ProxyInterceptor):
+## Login sequence states (RFC 959 page 58)
+LOGIN_IDLE, LOGIN_AWAIT_PASS, LOGIN_AWAIT_ACCT = 0, 1, 2
+VERB_USER, VERB_PASS, VERB_ACCT, VERB_PORT, VERB_EPRT = b"USER", b"PASS", b"ACCT", b"PORT", b"EPRT"
+REPLY_PASV, REPLY_EPSV = 227, 229
+
+
+class FTPLoginSession:
+    """Login state of one FTP control connection"""
+    ## NOTE: Slots keep the per-connection record small (there can be a large number of idle control connections)
+    __slots__ = ("state", "username", "password", "USERmessages", "PASSmessages", "requests", "responses", "replyFramer", "failures")
+
     def __init__(self) -> None:
-        super().__init__()
+        self.requests = collections.deque()
+        self.responses = collections.deque()
+        self.replyFramer = FTPReplyFramer()
+        self.failures = 0       ## failed login sequences of the connection
+        self.reset()
+
+    def reset(self) -> None:
+        self.state = LOGIN_IDLE
+        self.username, self.password = None, None
+        self.USERmessages, self.PASSmessages = None, None
+
+
+class FTPProxyInterceptor(StreamInterceptor):
+    REQUEST_DELIMITERS = [b"\r\n"]
+    ## NOTE: Shared by every tunnel (the index is memory mapped, so it isn't copied per tunnel or process)
+    BAIT_CREDENTIAL_INDEX: Optional[BaitCredentialIndex] = None
+    ## NOTE: Shared by every tunnel, so that failed logins are counted across connections
+    LOGIN_ATTEMPT_TRACKER: Optional[LoginAttemptTracker] = None
+    RUNTIME_ATTRIBUTES = ("BAIT_CREDENTIAL_INDEX", "LOGIN_ATTEMPT_TRACKER")
+    ## NOTE: PASV/EPSV replies and PORT/EPRT commands are rewritten to point at proxy-owned data channels
+    ## (a subclass can unset this, so that the tunnel doesn't need to be inspected once logged in)
+    REWRITES_REQUESTS = True
+    ## NOTE: The control connection carries short commands and replies, so it's tuned for latency
+    SOCKET_PROFILE = "interactive"
+    ## NOTE: The tunnel is no longer inspected after this many failed logins (FTP servers usually disconnect by then)
+    MAX_LOGIN_FAILURES = 3
 
-        ## Here are the requests
-        self._requestQueue = collections.deque()
-        self._responseQueue = collections.deque()
+    def __init__(self) -> None:
+        super().__init__()
 
-        ## Here's the generator that holds the state
-        self._loginStateGenerator = self._updateLoginState()
+        ## Here's the record that holds the login state (and the unpaired requests/responses)
+        self._session = FTPLoginSession()
+        self._clientHost: Optional[str] = None
 
 
+    @classmethod
+    def acceptsClient(cls, host: str) -> bool:
+        ## Clients with too many failed logins (within the tracker's window) are refused
+        tracker = cls.LOGIN_ATTEMPT_TRACKER
+        return tracker is None or not tracker.isThrottled(host)
 
-    ## NOTE: These methods assume that the there is at least one delimited reqeust in buffer
-    ## NOTE: These methods assume that the correct buffer has been passed as an argument
-    def clientToServerRequestHook(self, buffer: Buffer) -> None:
-        ## we retrieve a request from the buffer
-        request, delimited = buffer.popFromQueue()
-        if not delimited:
-            raise ValueError("Cannot perform request hook on a request that isn't delimited (i.e. not complete)")
 
-        self.ftpMessageHook(request=request)
 
+    ## NOTE: The buffer passes every delimited (i.e. complete) request to these hooks
+    ## NOTE: If an awaitable is returned (e.g. the login success hook), the buffer holds back the
+    ## message (and anything after it in that direction) until it has been awaited
+    ## NOTE: Messages stay as bytes - they are only decoded for logging once a login step completes
+    def clientToServerHook(self, buffer: Buffer, request: bytearray) -> Optional[Awaitable]:
+        if self.REWRITES_REQUESTS and self.proxyTunnel is not None:
+            verb = commandVerb(request)
+            if verb == VERB_PORT or verb == VERB_EPRT:
+                self._proxyActiveDataChannel(buffer, verb, request)
+        return self.ftpMessageHook(request=request)
 
 
-    def serverToClientRequestHook(self,  buffer: Buffer) -> None:
-      ## we retrieve a request from the buffer
-        response, delimited = buffer.popFromQueue()
-        if not delimited:
-            raise ValueError("Cannot perform request hook on a request that isn't delimited (i.e. not complete)")
 
-        self.ftpMessageHook(response=response)
+    def serverToClientHook(self, buffer: Buffer, response: bytearray) -> Optional[Awaitable]:
+        ## The lines of a multi-line reply are joined before the reply is paired with its request
+        reply = self._session.replyFramer.feed(response)
+        if reply is None:
+            return None
+        code, reply = reply
+        ## NOTE: Only single line replies can be rewritten (the earlier lines have already been forwarded)
+        if code in (REPLY_PASV, REPLY_EPSV) and self.REWRITES_REQUESTS and self.proxyTunnel is not None and len(reply) == len(response):
+            self._proxyPassiveDataChannel(buffer, code, reply)
+        return self.ftpMessageHook(response=reply)
 
 
 
-    def ftpMessageHook(self, request: Optional[str] = None, response: Optional[str] = None) -> None:
+    def ftpMessageHook(self, request: Optional[bytes] = None, response: Optional[bytes] = None) -> Optional[Awaitable]:
         ## FTP is intended to have an alternating communication
         ## -- We cannot control the adversary
         ## -- But we control our FTP server,
@@ -66,141 +117,234 @@ class FTPProxyInterceptor(ProxyInterceptor):
         self._validateHookArgs(request, response)
 
         ## We add the request or response to their corresponding queues
+        session = self._session
         if request:
-            self._requestQueue.append(request)
+            session.requests.append(request)
+        elif session.requests:
+            session.responses.append(response)
         else:
-            self._responseQueue.append(response)
+            ## NOTE: A reply without an outstanding request (e.g. the 220 greeting) is dropped, as pairing it
+            ## would shift every later reply onto the wrong request
+            return None
 
         ## We then check if there exists a request with a corresponding response
-        if min(len(self._requestQueue), len(self._responseQueue)) > 0:
-            ## execute a generator (that maintains the state of the login mechanism)
-            next(self._loginStateGenerator)
+        if session.requests and session.responses:
+            ## NOTE: An awaitable is returned when the login must be checked asynchronously
+            return self._advanceLoginState(session, session.requests.popleft(), session.responses.popleft())
 
         return None
 
-    def _validateHookArgs(self, request: Optional[str] = None, response: Optional[str] = None) -> None:
+    def _validateHookArgs(self, request: Optional[bytes] = None, response: Optional[bytes] = None) -> None:
         if not (bool(request) ^ bool(response)):
             raise Exception(f"Cannot only pass a request OR response, not both - request={request}, response={response}")
         
 
-    def _updateLoginState(self) -> None:
-        ## Now we perform the logic
-        ## We continuously track logins until the ftp connection is shut down
+    def _advanceLoginState(self, session: FTPLoginSession, request: bytes, response: bytes) -> Optional[Awaitable]:
         ## We refer to Page 58 of the FTP RFC 959 for the Login Sequence
+        ## NOTE: Pairs without a transition (e.g. a NOOP between USER and PASS) leave the state unchanged
+        code = replyCode(response)
+        if code is None:
+            return None
+        verb = commandVerb(request)
+        transition = FTP_LOGIN_TRANSITIONS.get((session.state, verb, code // 100))
+        if transition is None:
+            return None
+
+        nextState, action = transition
+        result = action(self, session, verb, request, response)
+        if nextState == LOGIN_IDLE:
+            session.reset()
+        else:
+            session.state = nextState
+        return result
+
+
+    ################## Login Transition Actions ######################
+    ## NOTE: Every action has the signature (self, session, verb, request, response)
+    def _recordUSER(self, session: FTPLoginSession, verb: bytes, request: bytes, response: bytes) -> None:
+        session.username = self._getArgument(request)
+        session.USERmessages = self._decodeMessages(request, response)
+
+
+    def _recordPASS(self, session: FTPLoginSession, verb: bytes, request: bytes, response: bytes) -> None:
+        session.password = self._getArgument(request)
+        session.PASSmessages = self._decodeMessages(request, response)
+
+
+    def _loginUSERSuccess(self, session: FTPLoginSession, verb: bytes, request: bytes, response: bytes) -> None:
+        ## NOTE: You should not be able to login with just USER command
+        self._createFTPLoginSuccessMessage("USER", self._getArgument(request))
+        self._recordLoginAttempt(self._getArgument(request), success=True)
+        self._completeLoginInspection(session, success=True)
+        logging.critical("CRITICAL: A user was able to login only by using a 'USER' command. \
+                            This means they didn't require a password which should NOT happen")
+
+
+    def _loginPASSSuccess(self, session: FTPLoginSession, verb: bytes, request: bytes, response: bytes) -> Awaitable:
+        password = self._getArgument(request)
+        self._createFTPLoginSuccessMessage("PASS", session.username, password)
+        self._recordLoginAttempt(session.username, success=True)
+        self._completeLoginInspection(session, success=True)
+        ## NOTE: The login reply is held back (only in this tunnel) while the credentials are checked
+        return self._executeFTPLoginSuccessHook(username=session.username, password=password)
+
+
+    def _loginACCTSuccess(self, session: FTPLoginSession, verb: bytes, request: bytes, response: bytes) -> None:
+        self._createFTPLoginSuccessMessage("ACCT", session.username, session.password, self._getArgument(request))
+        self._recordLoginAttempt(session.username, success=True)
+        self._completeLoginInspection(session, success=True)
+        logging.critical("CRITICAL: A user was able to login using 'ACCT' - The FTP server should NOT be configured for this")
+
+
+    def _loginError(self, session: FTPLoginSession, verb: bytes, request: bytes, response: bytes) -> None:
+        self._createFTPLoginErrorMessage("ERROR", verb.decode("ascii"), *self._getLoginMessages(session, verb, request, response))
+
 
-        ## NOTE: The sequence must be adhered to according to the specification
-        ## -- Otherwise the 503 reply code wouldn't exist for PASS and ACCT which have
-        ## commands that preceed it
-
-        ## NOTE: There is no need for an else statement for each request below
-
-
-        while True:
-            ## Define variables
-            username, USERrequest, USERresponse = None, None, None
-            password, PASSrequest, PASSresponse = None, None, None
-            account, ACCTrequest, ACCTresponse = None, None, None
-
-
-
-            ## 1. First Request (USER)
-            request = self._requestQueue.pop()
-            response = self._responseQueue.pop()
-
-            ## NOTE: The reason why the first step is different from step 2 and 3 is that we need to wait for the USER command
-            ## to trigger a command sequence. This is why we check every request to see if it is a USER request which will trigger
-            ## the login command sequence
-            if self._isUSERRequest(request):
-                responseCode = self._getResponseCode(response)
-                if 100 <= responseCode <= 199:
-                    ## Error
-                    self._createFTPLoginErrorMessage("ERROR", "USER", (USERrequest, USERresponse))
-                    yield
-                    continue
-                elif 200 <= responseCode <= 299:
-                    ## Success
-                    ## NOTE: You should not be able to login with just USER command
-                    username = self._getUsername(request)
-                    self._createFTPLoginSuccessMessage(username)
-                    logging.critical("CRITICAL: A user was able to login only by using a 'USER' command. \
-                                     This means they didn't require a password which should NOT happen")
-                    yield
-                    continue
-                elif 400 <= responseCode <= 599:
-                    ## Failure
-                    self._createFTPLoginErrorMessage("FAILURE", "USER", (USERrequest, USERresponse))
-                    yield
-                    continue
-
-                ## otherwise we got 3yz reply (intermediary positive reply), so we continue with the command sequence
-                yield
-
-            ## otherwise, we didn't get a USER request, so we ignore it, and go back to the top of the while loop
-            else:
-                yield
-                continue
-
-
-
-            ## 2. Second Request (PASS)
-            request = self._requestQueue.pop()
-            response = self._responseQueue.pop()
-
-            responseCode = self._getResponseCode(response)
-            if 100 <= responseCode <= 199:
-                ## Error
-                self._createFTPLoginErrorMessage("ERROR", "PASS", (USERrequest, USERresponse), (PASSrequest, PASSresponse))
-                yield
-                continue
-            elif 200 <= responseCode <= 299:
-                ## Success
-                password = self._getPassword(request)
-                self._createFTPLoginSuccessMessage(username, password)
-                self._executeFTPLoginSuccessHook(username=username, password=password)
-                yield
-                continue
-            elif 400 <= responseCode <= 599:
-                ## Failure
-                self._createFTPLoginErrorMessage("FAILURE", "PASS", (USERrequest, USERresponse), (PASSrequest, PASSresponse))
-                yield
-                continue
-
-            ## otherwise we got 3yz reply, so we continue
-            yield
-
-
-
-            ## 3. Third Request (ACCT)
-            request = self._requestQueue.pop()
-            response = self._responseQueue.pop()
-
-            responseCode = self._getResponseCode(response)
-            if 100 <= responseCode <= 199 or 300 <= responseCode <= 399:
-                ## Error
-                self._createFTPLoginErrorMessage("ERROR", "ACCT", (USERrequest, USERresponse), (PASSrequest, PASSresponse), (ACCTrequest, ACCTresponse))
-                yield
-                continue
-            elif 200 <= responseCode <= 299:
-                ## Success
-                account = self._getAccount(request)
-                self._createFTPLoginSuccessMessage(username, password, account)
-                logging.critical("CRITICAL: A user was able to login using 'ACCT' - The FTP server should NOT be configured for this")
-                yield
-                continue
-            elif 400 <= responseCode <= 599:
-                ## Failure
-                self._createFTPLoginErrorMessage("FAILURE", "ACCT", (USERrequest, USERresponse), (PASSrequest, PASSresponse), (ACCTrequest, ACCTresponse))
-                yield
-                continue
-                ## There is no else case unless 6xx returned
-
-            ## otherwise we got 3yz reply, so we continue
-            yield
-
-
-    def _executeFTPLoginSuccessHook(self, username: str, password: str) -> None:
+    def _loginFailure(self, session: FTPLoginSession, verb: bytes, request: bytes, response: bytes) -> None:
+        self._createFTPLoginErrorMessage("FAILURE", verb.decode("ascii"), *self._getLoginMessages(session, verb, request, response))
+        self._recordLoginAttempt(self._getArgument(request) if verb == VERB_USER else session.username, success=False)
+        self._completeLoginInspection(session, success=False)
+
+
+    def _completeLoginInspection(self, session: FTPLoginSession, success: bool) -> None:
+        ## Once the login sequence is over, there's nothing more to learn from the control connection
+        if not success:
+            session.failures += 1
+            if session.failures < self.MAX_LOGIN_FAILURES:
+                return None
+        ## NOTE: Unless the data channels are proxied (their PASV/EPSV/PORT messages must still be rewritten, even
+        ## after the last failed login), or one of them is still waiting for its connection
+        if self.REWRITES_REQUESTS or self.proxyTunnel is None or self.proxyTunnel.hasOpenDataChannels():
+            return None
+        self.proxyTunnel.stopInspection()
+
+
+    def _recordLoginAttempt(self, username: Optional[str], success: bool) -> None:
+        tracker = self.LOGIN_ATTEMPT_TRACKER
+        if tracker is None or self._getClientHost() is None:
+            return None
+        if success:
+            tracker.recordSuccess(self._clientHost, username)
+        else:
+            tracker.recordFailure(self._clientHost, username)
+
+
+    def _getClientHost(self) -> Optional[str]:
+        if self._clientHost is None and self.proxyTunnel is not None:
+            try:
+                self._clientHost = self.proxyTunnel.clientToProxySocket.getpeername()[0]
+            except OSError:
+                return None ## the client has already disconnected
+        return self._clientHost
+
+
+    def _getLoginMessages(self, session: FTPLoginSession, verb: bytes, request: bytes, response: bytes) -> Tuple[Tuple[str, str], ...]:
+        ## The messages of the previous steps of the command sequence are logged with the current one
+        messages = self._decodeMessages(request, response)
+        if verb == VERB_USER:
+            return (messages,)
+        elif verb == VERB_PASS:
+            return (session.USERmessages, messages)
+        return (session.USERmessages, session.PASSmessages, messages)
+
+
+    def _decodeMessages(self, request: bytes, response: bytes) -> Tuple[str, str]:
+        return request.decode("latin-1"), response.decode("latin-1")
+
+
+    ################## Data Channels ######################
+    ## NOTE: Data connections are relayed by pass-through tunnels, that are opened on demand by
+    ## proxy-owned listeners (see ProxyTunnel.openDataChannel()) and closed with the transfer
+    def _proxyPassiveDataChannel(self, buffer: Buffer, code: int, reply: bytes) -> None:
+        serverHost = self.proxyTunnel.proxyToServerSocket.getpeername()[0]
+        if code == REPLY_PASV:
+            hostPort = parseHostPort(reply)
+            if hostPort is None:
+                return None
+            host, port, (start, end) = hostPort
+            ## NOTE: Servers bound to every interface may advertise an address we can't connect to
+            if host == "0.0.0.0":
+                host = serverHost
+        else:
+            ## NOTE: An EPSV data connection is made to the host of the control connection (RFC 2428)
+            extendedPort = parseExtendedPort(reply)
+            if extendedPort is None:
+                return None
+            port, (start, end) = extendedPort
+            host = serverHost
+
+        proxyAddress = self._openDataChannel(buffer, (host, port), "client")
+        if proxyAddress is None:
+            return None
+        replacement = formatHostPort(*proxyAddress) if code == REPLY_PASV else str(proxyAddress[1]).encode("ascii")
+        buffer.replaceRequest(reply[:start] + replacement + reply[end:])
+
+
+    def _proxyActiveDataChannel(self, buffer: Buffer, verb: bytes, request: bytearray) -> None:
+        hostPort = parseHostPort(request) if verb == VERB_PORT else parseExtendedAddress(request)
+        if hostPort is None:
+            return None
+        host, port, (start, end) = hostPort
+
+        ## NOTE: The proxy connects to the address itself, so an address other than the client's would let the
+        ## client reach any host the proxy can (an FTP bounce) - its argument is dropped, so the server refuses it
+        if not self._isClientHost(host):
+            logging.error(f"ERROR: Refused an FTP {verb.decode('ascii')} to {host}:{port} - it isn't the client's address ({self._clientHost})")
+            if buffer.canReplaceRequest():
+                buffer.replaceRequest(verb + b"\r\n")
+            return None
+
+        proxyAddress = self._openDataChannel(buffer, (host, port), "server")
+        if proxyAddress is None:
+            return None
+        replacement = formatHostPort(*proxyAddress) if verb == VERB_PORT else formatExtendedAddress(*proxyAddress)
+        buffer.replaceRequest(request[:start] + replacement + request[end:])
+
+
+    def _isClientHost(self, host: str) -> bool:
+        clientHost = self._getClientHost()
+        if clientHost is None:
+            return False
+        try:
+            address, clientAddress = ipaddress.ip_address(host), ipaddress.ip_address(clientHost)
+        except ValueError:
+            return False
+        ## NOTE: A dual-stack listener reports IPv4 clients as IPv4-mapped IPv6 addresses
+        if getattr(clientAddress, "ipv4_mapped", None) is not None:
+            clientAddress = clientAddress.ipv4_mapped
+        return address == clientAddress
+
+
+    def _openDataChannel(self, buffer: Buffer, targetAddress: Tuple[str, int], acceptFrom: str) -> Optional[Tuple[str, int]]:
+        ## NOTE: The message can only be rewritten by a hook that runs inline on the event loop
+        if not buffer.canReplaceRequest():
+            logging.error(f"ERROR: Cannot proxy the FTP data channel to {targetAddress} - the message can't be rewritten")
+            return None
+        try:
+            return self.proxyTunnel.openDataChannel(targetAddress, acceptFrom)
+        except OSError as e:
+            logging.error(f"ERROR: Failed to open an FTP data channel to {targetAddress} - {e}")
+            return None
+
+
+    async def _executeFTPLoginSuccessHook(self, username: str, password: str) -> bool:
         """This will async communicate with the _database class component to check whether the creds are a bait trap"""
-        raise NotImplementedError()
+        isBait = await self.isBaitCredential(username, password)
+        if isBait:
+            logging.critical(f"CRITICAL: A user logged in with bait credentials - Username: <{username}>")
+        return isBait
+
+
+    async def isBaitCredential(self, username: str, password: str) -> bool:
+        """Looks up whether the credentials are bait credentials in BAIT_CREDENTIAL_INDEX"""
+        index = self.BAIT_CREDENTIAL_INDEX
+        if index is None:
+            return False
+        ## NOTE: A rebuilt index is picked up here (the check against the file is rate limited by the index), and
+        ## the check stats (and may map) the file, so it runs on the executor instead of blocking the runner's loop
+        if index.isReloadDue():
+            await asyncio.get_running_loop().run_in_executor(None, index.reloadIfChanged)
+        return index.contains(username, password)
 
 
     def _createFTPLoginSuccessMessage(self, requestVerb: str,
@@ -214,13 +358,13 @@ class FTPProxyInterceptor(ProxyInterceptor):
         assert requestVerb in ("USER", "PASS", "ACCT")
 
         ## Create success message
-        successMsg = "SUCCESS @ftp.cmds.%s - ", requestVerb
+        successMsg = f"SUCCESS @ftp.cmds.{requestVerb} - "
         if username:
-            successMsg += "Username: <%s>, ", username
+            successMsg += f"Username: <{username}>, "
         if password:
-            successMsg += "Password: <%s>, ", password
+            successMsg += f"Password: <{password}>, "
         if account:
-            successMsg += "Account: <%s>", account
+            successMsg += f"Account: <{account}>"
 
         ## Log the success message
         logging.info(successMsg)
@@ -238,13 +382,13 @@ class FTPProxyInterceptor(ProxyInterceptor):
         assert requestVerb in ("USER", "PASS", "ACCT")
 
         ## Create error message
-        errorMsg = "%s @ftp.cmds.%s - \t", errorType, requestVerb
+        errorMsg = f"{errorType} @ftp.cmds.{requestVerb} - \t"
         if USERmessages:
-            errorMsg += "1) USER-request: <%s>, USER-response: <%s>, \t", USERmessages[0], USERmessages[1]
+            errorMsg += f"1) USER-request: <{USERmessages[0]}>, USER-response: <{USERmessages[1]}>, \t"
         if PASSmessages:
-            errorMsg += "2) PASS-request: <%s>, PASS-response: <%s>, \t", PASSmessages[0], PASSmessages[1]
+            errorMsg += f"2) PASS-request: <{PASSmessages[0]}>, PASS-response: <{PASSmessages[1]}>, \t"
         if ACCTmessages:
-            errorMsg += "2) ACCT-request: <%s>, ACCT-response: <%s>, \t", ACCTmessages[0], ACCTmessages[1]
+            errorMsg += f"3) ACCT-request: <{ACCTmessages[0]}>, ACCT-response: <{ACCTmessages[1]}>, \t"
 
         ## Log the error message
         if errorType == "FAILURE":
@@ -254,60 +398,37 @@ class FTPProxyInterceptor(ProxyInterceptor):
 
 
 
-    def _isUSERRequest(self, request: str) -> bool:
-        ## NOTE: We don't need to check if this is a valid request as we'll only process the request arguments if
-        ## the reply code is a positive one
-        ## NOTE: We are being softer than RFC 959 on the standards by stripping whitespace (in case there are FTP
-        ## implementations that have the same behavior)
-
-        ## NOTE: the regex checks if the strings starts with zero or more spaces and then has a USER string succeedeing it
-        if re.search('^\s*USER', request):
-            return True
-        return False
-
-
-    ## TODO: Rewrite these three methods to use regex searches
-    ## NOTE: These methods will only be executed assuming that the request received a positive 3xx response
+    ## NOTE: This method will only be executed assuming that the request received a positive reply
     ## --> This means input validation on the request isn't neccessary
-    def _getUsername(self, request: str) -> str:
-        ## The User request should be delimited with either \r\n or \r at the END of the request, so we strip that on the end (i.e. right of str)
-        ## NOTE: Although the RFC 959 defines the commands on 1985, we don't have to adhere to its strictness and can
-        ## be lenient in order to interpret requests that would otherwise be incorrect against the standard.
-        ## e.g. in the below, the "space" should not be between the last param and the CRLF delimeter
-        request = request.strip(" \r\n")
-        entities = [entity.strip(" ") for entity in request.split(" ")]
-
-        if len(entities) != 2:
-            raise Exception(f"Cannot have a USER command that doesn't have two entities - {request}")
-        return entities[1]
-
-    def _getPassword(self, request: str) -> str:
-        request = request.strip(" \r\n")
-        entities = [entity.strip(" ") for entity in request.split(" ")]
-
-        if len(entities) != 2:
-            raise Exception(f"Cannot have a PASS command that doesn't have two entities - {request}")
-        return entities[1]
-
-    def _getAccount(self, request: str) -> str:
-        request = request.strip(" \r\n")
-        entities = [entity.strip(" ") for entity in request.split(" ")]
-
-        if len(entities) != 2:
-            raise Exception(f"Cannot have a ACCT command that doesn't have two entities - {request}")
-        return entities[1]
-
-
-    def _getResponseCode(self, request: str) -> Optional[int]:
-        ## All reply codes have a length of 3
-        ## Reply code xyz
-        ## 1 <= x <= 5
-        ## 0 <= y <= 5
-        ## 0 <= z <= 9 ## not specified on FRC and servers may provide custom replies so we take up the whole range 0-9
-        ret = re.search('^\s*([1-5][0-5][0-9])', request)
-        if ret is None:
-            return None
-        return int(ret.groups(0))
+    def _getArgument(self, request: bytes) -> str:
+        return commandArgument(request).decode("latin-1")
+
+
+
+## (state, verb, reply class) -> (next state, action)
+## NOTE: A USER command (re)starts the command sequence from any state
+FTP_LOGIN_TRANSITIONS = {}
+for _state in (LOGIN_IDLE, LOGIN_AWAIT_PASS, LOGIN_AWAIT_ACCT):
+    FTP_LOGIN_TRANSITIONS.update({
+        (_state, VERB_USER, 1): (LOGIN_IDLE, FTPProxyInterceptor._loginError),
+        (_state, VERB_USER, 2): (LOGIN_IDLE, FTPProxyInterceptor._loginUSERSuccess),
+        (_state, VERB_USER, 3): (LOGIN_AWAIT_PASS, FTPProxyInterceptor._recordUSER),
+        (_state, VERB_USER, 4): (LOGIN_IDLE, FTPProxyInterceptor._loginFailure),
+        (_state, VERB_USER, 5): (LOGIN_IDLE, FTPProxyInterceptor._loginFailure),
+    })
+FTP_LOGIN_TRANSITIONS.update({
+    (LOGIN_AWAIT_PASS, VERB_PASS, 1): (LOGIN_IDLE, FTPProxyInterceptor._loginError),
+    (LOGIN_AWAIT_PASS, VERB_PASS, 2): (LOGIN_IDLE, FTPProxyInterceptor._loginPASSSuccess),
+    (LOGIN_AWAIT_PASS, VERB_PASS, 3): (LOGIN_AWAIT_ACCT, FTPProxyInterceptor._recordPASS),
+    (LOGIN_AWAIT_PASS, VERB_PASS, 4): (LOGIN_IDLE, FTPProxyInterceptor._loginFailure),
+    (LOGIN_AWAIT_PASS, VERB_PASS, 5): (LOGIN_IDLE, FTPProxyInterceptor._loginFailure),
+    (LOGIN_AWAIT_ACCT, VERB_ACCT, 1): (LOGIN_IDLE, FTPProxyInterceptor._loginError),
+    (LOGIN_AWAIT_ACCT, VERB_ACCT, 2): (LOGIN_IDLE, FTPProxyInterceptor._loginACCTSuccess),
+    (LOGIN_AWAIT_ACCT, VERB_ACCT, 3): (LOGIN_IDLE, FTPProxyInterceptor._loginError),
+    (LOGIN_AWAIT_ACCT, VERB_ACCT, 4): (LOGIN_IDLE, FTPProxyInterceptor._loginFailure),
+    (LOGIN_AWAIT_ACCT, VERB_ACCT, 5): (LOGIN_IDLE, FTPProxyInterceptor._loginFailure),
+})
+del _state
 
 
 
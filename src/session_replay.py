@@ -0,0 +1,159 @@
+import os
+import sys
+import time
+import argparse
+import importlib
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Iterable, List, Optional, Tuple
+
+from tcp_proxyserver import ProxyTunnel
+from _proxyDS import AsyncHookRunner, Buffer, StreamInterceptor
+from _sessionCapture import CaptureReader, CaptureRecord
+
+
+## NOTE: A replay drives the same Buffers and hooks as a live tunnel, without sockets or an event loop,
+## so its timings are only the cost of parsing, framing and the interceptor's hooks
+
+
+class ReplaySocket:
+    """Stands in for a socket of a replayed tunnel (interceptors only ever
+    read its address)"""
+    def __init__(self, address: Tuple[str, int]) -> None:
+        self.address = address
+
+    def getpeername(self) -> Tuple[str, int]:
+        return self.address
+
+    def getsockname(self) -> Tuple[str, int]:
+        return self.address
+
+
+class ReplayTunnel(ProxyTunnel):
+    """A ProxyTunnel whose chunks are fed from a capture instead of read
+    from its sockets"""
+
+    def openDataChannel(self, targetAddress: Tuple[str, int], acceptFrom: str = "client") -> Tuple[str, int]:
+        ## NOTE: Data channels aren't replayed, so the messages are rewritten to the address they already have
+        return targetAddress
+
+
+    def feed(self, direction: str, payload: bytes) -> int:
+        """Writes a captured chunk into the buffer of its direction, and
+        returns the bytes that would then have been sent on"""
+        endpoint = self.clientEndpoint if direction == "clientToServer" else self.serverEndpoint
+        buffer = endpoint.readBuffer
+        buffer.write(payload)
+        ## NOTE: The awaited hooks are waited for, so the chunk is sent on as it would be once they're done
+        buffer.waitForHooks()
+        return self._drain(buffer)
+
+
+    @staticmethod
+    def _drain(buffer: Buffer) -> int:
+        ## Consumes the sendable bytes, as the peer endpoint's write would (including applying the edits)
+        sendable = buffer.sendable()
+        if sendable:
+            buffer.gather(sendable)
+            buffer.pop(sendable)
+        return sendable
+
+
+
+@dataclass
+class ReplayStats:
+    sessions: int = 0
+    chunks: int = 0
+    bytesIn: int = 0
+    bytesOut: int = 0
+    seconds: float = 0.0     ## total time spent replaying (summed over the sessions, even if replayed in parallel)
+
+    def __add__(self, other: "ReplayStats") -> "ReplayStats":
+        return ReplayStats(self.sessions + other.sessions, self.chunks + other.chunks, self.bytesIn + other.bytesIn,
+                            self.bytesOut + other.bytesOut, self.seconds + other.seconds)
+
+    @property
+    def throughput(self) -> float:
+        """Bytes replayed per second"""
+        return self.bytesIn / self.seconds if self.seconds else 0.0
+
+
+
+def replaySession(records: Iterable[CaptureRecord], streamInterceptor: StreamInterceptor) -> ReplayStats:
+    """Replays the records of a single tunnel through a new instance of the
+    interceptor, with the chunks split as they were captured
+
+    The hooks run inline (as there's no executor), and the awaitables they
+    return are awaited (on the tunnel's own AsyncHookRunner) before the next
+    chunk is fed. The exceptions they raise are propagated"""
+    ## NOTE: The records are read before the replay is timed
+    records = [(record.direction, record.payload) for record in records]
+    asyncHookRunner = AsyncHookRunner()
+    tunnel = ReplayTunnel(ReplaySocket(("127.0.0.1", 0)), ReplaySocket(("127.0.0.1", 0)), streamInterceptor,
+                            asyncHookRunner=asyncHookRunner)
+
+    bytesOut = 0
+    try:
+        start = time.perf_counter()
+        for direction, payload in records:
+            bytesOut += tunnel.feed(direction, payload)
+        seconds = time.perf_counter() - start
+    finally:
+        asyncHookRunner.close()
+
+    tunnel.releaseMemory()
+    return ReplayStats(1, len(records), sum(len(payload) for _, payload in records), bytesOut, seconds)
+
+
+def replayCapture(directory: str, streamInterceptor: StreamInterceptor, workers: Optional[int] = None,
+                    tunnelIds: Optional[List[int]] = None) -> ReplayStats:
+    """Replays every tunnel of a capture (or only `tunnelIds`), each through
+    its own interceptor instance
+
+    With `workers`, the tunnels are replayed in parallel by a process pool
+    (the interceptor must then be a module level class, so it can be pickled)"""
+    ## NOTE: The capture is read once, and its records are dispatched by tunnel (rather than every tunnel
+    ## reading every segment again)
+    sessions = CaptureReader(directory).sessions(tunnelIds)
+    if tunnelIds is None:
+        tunnelIds = list(sessions)
+    jobs = [(sessions.get(tunnelId, []), streamInterceptor) for tunnelId in tunnelIds]
+
+    stats = ReplayStats()
+    if workers is None:
+        for job in jobs:
+            stats += _replayCapturedTunnel(job)
+        return stats
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for sessionStats in executor.map(_replayCapturedTunnel, jobs, chunksize=max(1, len(jobs) // (4 * workers))):
+            stats += sessionStats
+    return stats
+
+
+def _replayCapturedTunnel(job: Tuple[List[CaptureRecord], StreamInterceptor]) -> ReplayStats:
+    records, streamInterceptor = job
+    return replaySession(records, streamInterceptor)
+
+
+def _importStreamInterceptor(path: str) -> StreamInterceptor:
+    ## e.g. "tcp_proxyinterceptors:HTTPProxyInterceptor"
+    moduleName, _, className = path.partition(":")
+    return getattr(importlib.import_module(moduleName), className)
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replays captured sessions through a StreamInterceptor (without sockets)")
+    parser.add_argument("directory", help="the directory of a SessionCapture")
+    parser.add_argument("interceptor", help="the interceptor class, as module:Class")
+    parser.add_argument("--workers", type=int, default=None, help="replay the sessions in parallel with a process pool")
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.getcwd())
+    stats = replayCapture(args.directory, _importStreamInterceptor(args.interceptor), args.workers)
+    print(f"Replayed {stats.sessions} sessions ({stats.chunks} chunks, {stats.bytesIn} bytes in, {stats.bytesOut} bytes out) "
+            f"in {stats.seconds:.3f}s - {stats.throughput / 1e6:.1f} MB/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,32 @@
-from _proxyDS import ProxyInterceptor, Buffer
+from typing import Optional, Tuple
+
+from _proxyDS import StreamInterceptor, Buffer
+from _httpFramer import HTTPMessageFramer, HTTPMessageHead
 
 
 ## NOTE: This is not intended to work robustly - this is just a code that is meant to show an example
-class HTTPProxyInterceptor(ProxyInterceptor):
-    def clientToServerHook(self, requestChunk: bytes, buffer: "Buffer") -> None:
-        buffer._data = buffer._data.replace(b"0.0.0.0:8080", b"127.0.0.1:80")
+class HTTPProxyInterceptor(StreamInterceptor):
+    ## NOTE: Unused - the buffers are split by the HTTP framers (only the message heads are hooked)
+    REQUEST_DELIMITERS = [b"\r\n\r\n"]
+    ## NOTE: Partial heads are held back, so that the address in a head can be rewritten
+    REWRITES_REQUESTS = True
+    PROXY_ADDRESS = b"0.0.0.0:8080"
+    SERVER_ADDRESS = b"127.0.0.1:80"
+
+    def createFramers(self) -> Optional[Tuple[HTTPMessageFramer, HTTPMessageFramer]]:
+        return HTTPMessageFramer.forConnection()
+
+    ## NOTE: The bodies stream through the buffers without being hooked (or rewritten)
+    def clientToServerHook(self, buffer: Buffer, head: HTTPMessageHead) -> None:
+        self._rewriteHead(buffer, head, self.PROXY_ADDRESS, self.SERVER_ADDRESS)
 
-    def serverToClientHook(self, requestChunk: bytes, buffer: "Buffer") -> bytes:
-        buffer._data = buffer._data.replace(b"127.0.0.1:80", b"0.0.0.0:8080")
+    def serverToClientHook(self, buffer: Buffer, head: HTTPMessageHead) -> None:
+        self._rewriteHead(buffer, head, self.SERVER_ADDRESS, self.PROXY_ADDRESS)
 
+    @staticmethod
+    def _rewriteHead(buffer: Buffer, head: HTTPMessageHead, old: bytes, new: bytes) -> None:
+        ## NOTE: Only the address bytes are patched (the head isn't rebuilt)
+        start = head.find(old)
+        while start != -1 and buffer.canReplaceRequest():
+            buffer.replaceRange(start, start + len(old), new)
+            start = head.find(old, start + len(old))
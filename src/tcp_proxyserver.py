@@ -1,18 +1,30 @@
 
 from abc import ABCMeta
+from collections import deque
 import os
+import sys
 import time
+import importlib
+import functools
 import threading
 import ipaddress
+import errno
+import select
 import selectors
 import socket
 import signal
 import logging
+from concurrent.futures import Executor, ThreadPoolExecutor
 from datetime import datetime
 from dataclasses import dataclass, field
-from typing import Dict, Optional, Tuple
-
-from _proxyDS import Buffer, proxyHandlerDescriptor, StreamInterceptor
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from _accessList import AccessList
+from _admissionControl import AdmissionControl
+from _backendPool import Backend, BackendPool, BackendProber
+from _sessionCapture import SessionCapture
+from _socketOptions import SocketProfile, TCP_QUICKACK, getSocketProfile
+from _proxyDS import AsyncHookRunner, Buffer, MemoryBudget, PassThroughInterceptor, RelayBuffer, SerialHookQueue, proxyHandlerDescriptor, StreamInterceptor
 from _exceptions import *
 ## TODO: Replace default exceptions with custom exceptions
 ## TODO: Implement Context management for TCPProxyServer
@@ -23,6 +35,12 @@ from _exceptions import *
 
 
 
+## NOTE: Pass-through tunnels (e.g. data channels, or once inspection is complete) only relay bulk data, so they use larger chunks
+BULK_CHUNK_SIZE = 64 * 1024
+## NOTE: The socket buffer size that autotuning starts from, when a profile doesn't set one
+DEFAULT_SOCKET_BUFFER = 64 * 1024
+
+
 ## BUG: Call to write() calls read() and calls to read() call write()
 ## --> Results in infinite recursive loop
 @dataclass(unsafe_hash=True)
@@ -31,16 +49,61 @@ class ProxyTunnel:
     proxyToServerSocket: socket.socket
     streamInterceptor: StreamInterceptor
     CHUNK_SIZE: int = field(default=1024, hash=None)
+    memoryBudget: Optional[MemoryBudget] = field(default=None, compare=False, repr=False)
+    hookExecutor: Optional[Executor] = field(default=None, compare=False, repr=False)
+    onHookComplete: Optional[Callable[["TunnelEndpoint"], None]] = field(default=None, compare=False, repr=False)
+    asyncHookRunner: Optional[AsyncHookRunner] = field(default=None, compare=False, repr=False)
+    proxyConnections: Optional["ProxyConnections"] = field(default=None, compare=False, repr=False)
+    backend: Optional[Backend] = field(default=None, compare=False, repr=False)
+    capture: Optional[SessionCapture] = field(default=None, compare=False, repr=False)
 
     def __post_init__(self):
         ## Initialize streamInterceptor
         self.streamInterceptor = self.streamInterceptor()
+        self.streamInterceptor.proxyTunnel = self
+        self.transparent = self.streamInterceptor.isTransparent()
         ## Setup Bidirectional Buffers
-        self.serverToClientBuffer = Buffer(self.streamInterceptor.REQUEST_DELIMITERS)
-        self.clientToServerBuffer = Buffer(self.streamInterceptor.REQUEST_DELIMITERS)
+        if self.transparent:
+            ## NOTE: Nothing is hooked, so the stream is only relayed (without delimiters or framers)
+            self.serverToClientBuffer = RelayBuffer(self.memoryBudget)
+            self.clientToServerBuffer = RelayBuffer(self.memoryBudget)
+        else:
+            bufferOptions = {"memoryBudget": self.memoryBudget, "parseRequests": not self.streamInterceptor.PASS_THROUGH,
+                                "holdUndelimited": self.streamInterceptor.REWRITES_REQUESTS}
+            clientToServerFramer, serverToClientFramer = self.streamInterceptor.createFramers() or (None, None)
+            self.serverToClientBuffer = Buffer(self.streamInterceptor.REQUEST_DELIMITERS, framer=serverToClientFramer, **bufferOptions)
+            self.clientToServerBuffer = Buffer(self.streamInterceptor.REQUEST_DELIMITERS, framer=clientToServerFramer, **bufferOptions)
+        ## Setup the endpoints (registered as the selector key data of each socket)
+        self.clientEndpoint = TunnelEndpoint(self, self.clientToProxySocket, "clientToServer",
+                                                self.clientToServerBuffer, self.serverToClientBuffer, self.CHUNK_SIZE)
+        self.serverEndpoint = TunnelEndpoint(self, self.proxyToServerSocket, "serverToClient",
+                                                self.serverToClientBuffer, self.clientToServerBuffer, self.CHUNK_SIZE)
+        self.clientEndpoint.peer = self.serverEndpoint
+        self.serverEndpoint.peer = self.clientEndpoint
+        ## NOTE: The chunks are captured as they are read (before any interceptor sees them)
+        if self.capture is not None:
+            self.captureId = self.capture.newTunnelId()
+            self.clientEndpoint.capture = functools.partial(self.capture.append, self.captureId, 0)
+            self.serverEndpoint.capture = functools.partial(self.capture.append, self.captureId, 1)
         ## Set hooks on Bidirectional Buffers
-        self.clientToServerBuffer.setHook(self.streamInterceptor.clientToServerHook)
-        self.serverToClientBuffer.setHook(self.streamInterceptor.serverToClientHook)
+        self.hookQueue = None
+        if not self.transparent:
+            self._setHooks()
+
+
+    def _setHooks(self) -> None:
+        ## NOTE: Both directions share a queue, so the interceptor sees the tunnel's requests in order
+        self.hookQueue = SerialHookQueue(self.hookExecutor) if self.hookExecutor is not None else None
+        waitForHook = self.streamInterceptor.HOOK_MODE == "inline"
+        onClientHookComplete = onServerHookComplete = None
+        if self.onHookComplete is not None:
+            ## NOTE: A held request is written by the endpoint on the other side of the tunnel
+            onClientHookComplete = functools.partial(self.onHookComplete, self.serverEndpoint)
+            onServerHookComplete = functools.partial(self.onHookComplete, self.clientEndpoint)
+        self.clientToServerBuffer.setHook(self.streamInterceptor.clientToServerHook, self.hookQueue, waitForHook,
+                                            onClientHookComplete, self.asyncHookRunner)
+        self.serverToClientBuffer.setHook(self.streamInterceptor.serverToClientHook, self.hookQueue, waitForHook,
+                                            onServerHookComplete, self.asyncHookRunner)
 
 
     def readFrom(self, source: socket.socket) -> Optional[int]:
@@ -69,7 +132,7 @@ class ProxyTunnel:
 
         ## Read from the buffer and send it to destination socket
         buffer = self._selectBufferForWrite(destination)
-        data = buffer.read(self.CHUNK_SIZE)
+        data = buffer.read(min(self.CHUNK_SIZE, buffer.sendable()))
         
         ## We try to send data via the destination socket
         try:
@@ -80,6 +143,89 @@ class ProxyTunnel:
             return None
             
 
+    def readAllFrom(self, source: socket.socket) -> Optional[int]:
+        """Reads from the source socket until it would block (required when
+        the socket is polled with an edge-triggered selector)"""
+        try:
+            return _drainSocket(source, self._selectBufferForRead(source), self.CHUNK_SIZE)
+        except socket.error:
+            return None
+
+
+    def writeAllTo(self, destination: socket.socket) -> Optional[int]:
+        """Writes the buffered data to the destination socket until either the
+        buffer is empty or the socket would block"""
+        try:
+            return _flushBuffer(destination, self._selectBufferForWrite(destination), self.CHUNK_SIZE)
+        except socket.error:
+            return None
+
+
+    def openDataChannel(self, targetAddress: Tuple[str, int], acceptFrom: str = "client") -> Tuple[str, int]:
+        """Opens a proxy-owned listener that relays a single connection
+        (e.g. an FTP data connection) to `targetAddress`, and returns the
+        address that the `acceptFrom` side ("client" or "server") of this
+        tunnel should connect to instead"""
+        if self.proxyConnections is None:
+            raise DataChannelUnavailableError(self)
+        return self.proxyConnections.openDataChannel(self, targetAddress, acceptFrom).address
+
+
+    def hasOpenDataChannels(self) -> bool:
+        """Whether a data channel opened by this tunnel is still waiting for its connection"""
+        return self.proxyConnections is not None and bool(self.proxyConnections.dataChannels(self))
+
+
+    def stopInspection(self, direction: Optional[str] = None) -> None:
+        """Switches a direction ("clientToServer" or "serverToClient"), or
+        both, to raw forwarding - the stream is no longer parsed or hooked,
+        and is relayed in BULK_CHUNK_SIZE chunks"""
+        if direction not in (None, "clientToServer", "serverToClient"):
+            raise ValueError(f"Invalid direction (must be 'clientToServer', 'serverToClient' or None) - {direction}")
+        for endpoint in (self.clientEndpoint, self.serverEndpoint):
+            if direction is None or endpoint.direction == direction:
+                ## NOTE: The endpoint reads the direction's data, and its peer writes it
+                endpoint.readBuffer.stopInspection()
+                endpoint.CHUNK_SIZE = endpoint.peer.CHUNK_SIZE = max(endpoint.CHUNK_SIZE, BULK_CHUNK_SIZE)
+
+
+    def applySocketProfile(self, profile: SocketProfile) -> None:
+        for endpoint in (self.clientEndpoint, self.serverEndpoint):
+            profile.apply(endpoint.sock)
+            endpoint.quickAck = profile.quickAck and TCP_QUICKACK is not None
+            if profile.autotuneLimit is not None:
+                endpoint.startAutotuning(profile.receiveBuffer or DEFAULT_SOCKET_BUFFER, profile.autotuneLimit,
+                                            profile.AUTOTUNE_FACTOR)
+
+
+    def getEndpoint(self, sock: socket.socket) -> "TunnelEndpoint":
+        if self.clientToProxySocket == sock:
+            return self.clientEndpoint
+        elif self.proxyToServerSocket == sock:
+            return self.serverEndpoint
+        else:
+            raise UnassociatedTunnelSocket(self, sock)
+
+
+    def memoryUsage(self) -> Dict[str, int]:
+        """Returns the bytes held by each direction of the tunnel (plus the
+        interceptor state, if the interceptor reports it)"""
+        usage = {
+            "clientToServer": self.clientToServerBuffer.memoryUsage(),
+            "serverToClient": self.serverToClientBuffer.memoryUsage(),
+        }
+        interceptorUsage = getattr(self.streamInterceptor, "memoryUsage", None)
+        if interceptorUsage is not None:
+            usage["interceptor"] = interceptorUsage()
+        usage["total"] = sum(usage.values())
+        return usage
+
+
+    def releaseMemory(self) -> None:
+        self.clientToServerBuffer.releaseMemory()
+        self.serverToClientBuffer.releaseMemory()
+
+
     def _selectBufferForWrite(self, source: socket.socket) -> Buffer:
         ## For WRITE, we read from the opposite Buffer and perform source.sendall()
         if self.clientToProxySocket == source:
@@ -100,17 +246,216 @@ class ProxyTunnel:
             raise UnassociatedTunnelSocket(self, socket)
 
 
+def _drainSocket(source: socket.socket, buffer: Buffer, chunkSize: int,
+                    capture: Optional[Callable[[bytes], None]] = None) -> Optional[int]:
+    ## Reads until the source would block (None if the socket was closed, and raises any other socket error)
+    bytesRead = 0
+    while True:
+        try:
+            data = source.recv(chunkSize)
+        except BlockingIOError:
+            return bytesRead
+        if not data:
+            return None
+        if capture is not None:
+            capture(data)
+        buffer.write(data)
+        bytesRead += len(data)
+
+
+def _sendBuffer(destination: socket.socket, buffer: Buffer, size: int) -> int:
+    ## NOTE: An edited stream is sent with a gather write, so its patches are never joined into the data
+    segments = buffer.gather(size)
+    if len(segments) == 1:
+        return destination.send(segments[0])
+    return destination.sendmsg(segments)
+
+
+def _flushBuffer(destination: socket.socket, buffer: Buffer, chunkSize: int) -> Optional[int]:
+    ## Sends until the buffer is empty or the destination would block (raises if the socket was closed)
+    bytesSent = 0
+    while (sendable := buffer.sendable()):
+        try:
+            sent = _sendBuffer(destination, buffer, min(chunkSize, sendable))
+        except BlockingIOError:
+            return bytesSent
+        buffer.pop(sent)
+        bytesSent += sent
+    return bytesSent
+
+
+@dataclass(eq=False)
+class TunnelEndpoint:
+    """One socket of a ProxyTunnel, with the buffers it reads into and
+    writes from already bound
+
+    An endpoint is registered as the selector key data of its socket, so
+    an event goes straight to the right buffers (without a lookup in
+    ProxyConnections or a socket comparison in the ProxyTunnel)"""
+    tunnel: ProxyTunnel
+    sock: socket.socket
+    direction: str          ## direction of the data read from `sock` (e.g. "clientToServer")
+    readBuffer: Buffer      ## filled by reading `sock`
+    writeBuffer: Buffer     ## drained by writing to `sock`
+    CHUNK_SIZE: int = field(default=1024)
+    peer: Optional["TunnelEndpoint"] = field(default=None, repr=False)
+    eof: bool = field(default=False, repr=False)     ## set once `sock` is closed (while the read data is still forwarded)
+    eofForwarded: bool = field(default=False, repr=False)    ## set once a client's EOF has been passed on (the peer's write side is shut down)
+    reset: bool = field(default=False, repr=False)   ## set if `sock` was reset by its peer (RST)
+    capture: Optional[Callable[[bytes], None]] = field(default=None, repr=False)     ## records each chunk read from `sock`
+    quickAck: bool = field(default=False, repr=False)
+    ## NOTE: Set by startAutotuning() - `sock`'s receive buffer (and its peer's send buffer) is doubled every
+    ## `_autotuneFactor` buffers' worth of data read, until it reaches `_autotuneLimit`
+    _autotuneLimit: Optional[int] = field(default=None, repr=False)
+    _autotuneFactor: int = field(default=0, repr=False)
+    _bufferSize: int = field(default=0, repr=False)
+    _effectiveBufferSize: int = field(default=0, repr=False)  ## SO_RCVBUF as reported by the kernel
+    _autotuneCountdown: int = field(default=0, repr=False)
+
+    def readFrom(self) -> Optional[int]:
+        try:
+            data = self.sock.recv(self.CHUNK_SIZE)
+        except socket.error as e:
+            return self._closedBy(e)
+        if not data:
+            return None
+        if self.capture is not None:
+            self.capture(data)
+        self.readBuffer.write(data)
+        if self.quickAck or self._autotuneLimit is not None:
+            self._tune(len(data))
+        return len(data)
+
+
+    def writeTo(self) -> Optional[int]:
+        ## NOTE: Nothing is sent while the buffer is empty (the socket's write side may have been shut down)
+        size = min(self.CHUNK_SIZE, self.writeBuffer.sendable())
+        if size == 0:
+            return 0
+        try:
+            bytesSent = _sendBuffer(self.sock, self.writeBuffer, size)
+        except socket.error as e:
+            return self._closedBy(e)
+        self.writeBuffer.pop(bytesSent)
+        return bytesSent
+
+
+    def readAll(self) -> Optional[int]:
+        try:
+            bytesRead = _drainSocket(self.sock, self.readBuffer, self.CHUNK_SIZE, self.capture)
+        except socket.error as e:
+            return self._closedBy(e)
+        if bytesRead and (self.quickAck or self._autotuneLimit is not None):
+            self._tune(bytesRead)
+        return bytesRead
+
+
+    def writeAll(self) -> Optional[int]:
+        try:
+            return _flushBuffer(self.sock, self.writeBuffer, self.CHUNK_SIZE)
+        except socket.error as e:
+            return self._closedBy(e)
+
+
+    def startAutotuning(self, bufferSize: int, limit: int, factor: int) -> None:
+        self._bufferSize, self._autotuneLimit, self._autotuneFactor = bufferSize, limit, factor
+        self._autotuneCountdown = bufferSize * factor
+        try:
+            self._effectiveBufferSize = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+        except OSError:
+            self._autotuneLimit = None
+
+
+    def _tune(self, bytesRead: int) -> None:
+        try:
+            if self.quickAck:
+                ## NOTE: Linux leaves quick ACK mode on its own, so it's set again after each read
+                self.sock.setsockopt(socket.IPPROTO_TCP, TCP_QUICKACK, 1)
+            if self._autotuneLimit is None:
+                return None
+            self._autotuneCountdown -= bytesRead
+            if self._autotuneCountdown > 0:
+                return None
+            self._bufferSize = min(self._autotuneLimit, self._bufferSize * 2)
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self._bufferSize)
+            self.peer.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self._bufferSize)
+            effectiveBufferSize = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+        except OSError:
+            return None ## the socket is closed (the tunnel is closed by the event loop)
+        ## NOTE: The kernel silently caps the size (e.g. at rmem_max), so the tuning stops once a doubling doesn't take
+        if self._bufferSize >= self._autotuneLimit or effectiveBufferSize <= self._effectiveBufferSize:
+            self._autotuneLimit = None
+        self._effectiveBufferSize = effectiveBufferSize
+        self._autotuneCountdown = self._bufferSize * self._autotuneFactor
+
+
+    def _closedBy(self, error: OSError) -> None:
+        ## NOTE: A reset is told apart from a clean close, as resets count against the backend's circuit breaker
+        if isinstance(error, (ConnectionResetError, BrokenPipeError)):
+            self.reset = True
+        return None
+
+
+@dataclass(eq=False)
+class DataChannelListener:
+    """Proxy-owned listening socket for a single data connection of a
+    tunnel (e.g. an FTP data connection)
+
+    It is closed once it has accepted its connection, once it expires, or
+    once its control tunnel is closed"""
+    sock: socket.socket
+    controlTunnel: ProxyTunnel
+    targetAddress: Tuple[str, int]
+    acceptFrom: str         ## side of the control tunnel that connects to the listener ("client" or "server")
+    expiresAt: float
+
+    @property
+    def address(self) -> Tuple[str, int]:
+        return self.sock.getsockname()[:2]
+
+
+@dataclass(eq=False)
+class PendingDataChannel:
+    """Data connection accepted by a DataChannelListener, whose (non-blocking)
+    connect to the target address is still in progress
+
+    Its tunnel is created once the connect completes (see
+    ProxyConnections.completeDataChannel()), and it's closed if the connect
+    doesn't complete before it expires"""
+    acceptedSocket: socket.socket
+    targetSocket: socket.socket
+    acceptFrom: str
+    nonBlocking: bool       ## whether the tunnel's sockets stay non-blocking (i.e. for an edge-triggered loop)
+    expiresAt: float
+
+
 @dataclass
 class ProxyConnections:
     PROXY_HOST: str
     PROXY_PORT: int
     streamInterceptor: StreamInterceptor
     selector: selectors.BaseSelector
+    memoryBudget: Optional[MemoryBudget] = field(default=None)
+    hookExecutor: Optional[Executor] = field(default=None)
+    onHookComplete: Optional[Callable[[TunnelEndpoint], None]] = field(default=None)
+    asyncHookRunner: Optional[AsyncHookRunner] = field(default=None)
+    BULK_CHUNK_SIZE: int = field(default=BULK_CHUNK_SIZE)
+    DATA_CHANNEL_TIMEOUT: float = field(default=30.0)
+    ## NOTE: The connect to a data channel's target runs on the event loop (without blocking it), until this expires
+    DATA_CHANNEL_CONNECT_TIMEOUT: float = field(default=5.0)
+    ## NOTE: Without a pool, every tunnel is proxied to PROXY_HOST:PROXY_PORT
+    backendPool: Optional[BackendPool] = field(default=None)
+    ## NOTE: Without a capture, the traffic isn't recorded
+    capture: Optional[SessionCapture] = field(default=None)
 
     _sock: Dict[socket.socket, ProxyTunnel] = field(init=False, default_factory=dict)
+    _listeners: Dict[socket.socket, DataChannelListener] = field(init=False, default_factory=dict)
+    _pendingDataChannels: Dict[socket.socket, PendingDataChannel] = field(init=False, default_factory=dict)
 
     def __post_init__(self) -> None:
         self._validateArgs()
+        if self.backendPool is None:
+            self.backendPool = BackendPool.single(self.PROXY_HOST, self.PROXY_PORT)
 
     def _validateArgs(self) -> None:
         ## Validate host
@@ -122,22 +467,39 @@ class ProxyConnections:
             raise InvalidProxyPortError(self.PROXY_PORT)
 
         ## Validate interceptor
-        if (StreamInterceptor not in self.streamInterceptor.__mro__):
-            raise AbsentStreamInterceptorParentError(self.streamInterceptor)
-        elif (StreamInterceptor == self.streamInterceptor.__mro__[0]):
-            raise AbstractStreamInterceptorError(self.streamInterceptor)
+        self._validateStreamInterceptor(self.streamInterceptor)
+
+    def _validateStreamInterceptor(self, streamInterceptor: StreamInterceptor) -> None:
+        if (StreamInterceptor not in streamInterceptor.__mro__):
+            raise AbsentStreamInterceptorParentError(streamInterceptor)
+        elif (StreamInterceptor == streamInterceptor.__mro__[0]):
+            raise AbstractStreamInterceptorError(streamInterceptor)
+        elif streamInterceptor.HOOK_MODE not in StreamInterceptor.HOOK_MODES:
+            raise InvalidHookModeError(streamInterceptor)
+        ## Raises an exception if the profile is unknown
+        getSocketProfile(streamInterceptor.SOCKET_PROFILE)
 
         ## TODO: We'll be moving to ABC Meta class for StreamInterceptor abstract classes
         ## --> Therefore the validation process and the corresponding pytest tests will likely change
 
+    def setStreamInterceptor(self, streamInterceptor: StreamInterceptor) -> None:
+        """Swaps the interceptor class used for new tunnels. Existing tunnels
+        hold their own interceptor instance, so they finish on the old version"""
+        self._validateStreamInterceptor(streamInterceptor)
+        self.streamInterceptor = streamInterceptor
+
     def __len__(self) -> int:
         return len(self._sock)
 
     def get(self, sock: socket.socket) -> ProxyTunnel:
         return self._sock.get(sock)
 
+    def tunnels(self) -> Set[ProxyTunnel]:
+        return {tunnel for tunnel in self._sock.values()}
+
     ## TODO: We need to add methods for rewriting
-    def createTunnel(self, clientToProxySocket: socket.socket, proxyToServerSocket: socket.socket) -> ProxyTunnel:
+    def createTunnel(self, clientToProxySocket: socket.socket, proxyToServerSocket: socket.socket,
+                        streamInterceptor: Optional[StreamInterceptor] = None, backend: Optional[Backend] = None) -> ProxyTunnel:
         ## Check if the sockets are registered with a pre-existing tunnel
         if self._sock.get(clientToProxySocket):
             raise AlreadyRegisteredSocketError("clientToProxySocket", clientToProxySocket, self)
@@ -145,14 +507,27 @@ class ProxyConnections:
             raise AlreadyRegisteredSocketError("proxyToServerSocket", proxyToServerSocket, self)
 
         ## We then create a new proxyTunnel
-        proxyTunnel = ProxyTunnel(clientToProxySocket, proxyToServerSocket, self.streamInterceptor)
+        ## NOTE: Tunnels use the current interceptor, unless one is passed (e.g. for data channels)
+        streamInterceptor = self.streamInterceptor if streamInterceptor is None else streamInterceptor
+        chunkSize = {"CHUNK_SIZE": self.BULK_CHUNK_SIZE} if streamInterceptor.isTransparent() else {}
+        proxyTunnel = ProxyTunnel(clientToProxySocket, proxyToServerSocket, streamInterceptor, **chunkSize,
+                                    memoryBudget=self.memoryBudget, hookExecutor=self.hookExecutor,
+                                    onHookComplete=self.onHookComplete, asyncHookRunner=self.asyncHookRunner,
+                                    proxyConnections=self, backend=backend, capture=self.capture)
+        socketProfile = getSocketProfile(streamInterceptor.SOCKET_PROFILE)
+        if socketProfile is not None:
+            proxyTunnel.applySocketProfile(socketProfile)
         self._sock[clientToProxySocket] = proxyTunnel
         self._sock[proxyToServerSocket] = proxyTunnel
 
         ## We then register the associated sockets (so that they can be polled)
-        self.selector.register(clientToProxySocket, selectors.EVENT_READ | selectors.EVENT_WRITE, data="connection")
-        self.selector.register(proxyToServerSocket, selectors.EVENT_READ | selectors.EVENT_WRITE, data="connection")
-        
+        ## NOTE: Each socket's endpoint is stored as the key data, so that events can be serviced without a lookup
+        self.selector.register(clientToProxySocket, selectors.EVENT_READ | selectors.EVENT_WRITE, data=proxyTunnel.clientEndpoint)
+        self.selector.register(proxyToServerSocket, selectors.EVENT_READ | selectors.EVENT_WRITE, data=proxyTunnel.serverEndpoint)
+
+        ## NOTE: The live tunnels of each backend are counted here, so the pool never has to count them
+        if backend is not None:
+            self.backendPool.acquire(backend)
         return proxyTunnel
 
 
@@ -173,25 +548,191 @@ class ProxyConnections:
             proxyTunnel.proxyToServerSocket.close()
         self.selector.unregister(proxyTunnel.proxyToServerSocket)
         del self._sock[proxyTunnel.proxyToServerSocket]
+
+        ## Return the buffered bytes to the memory budget
+        proxyTunnel.releaseMemory()
+        if proxyTunnel.backend is not None:
+            self.backendPool.release(proxyTunnel.backend)
+            if proxyTunnel.serverEndpoint.reset:
+                self.backendPool.recordFailure(proxyTunnel.backend)
+
+        ## Data channels that haven't been connected yet are closed with their control tunnel
+        ## NOTE: Connected data channels are separate tunnels, so a running transfer isn't cut off
+        for listener in self.dataChannels(proxyTunnel):
+            self.closeDataChannel(listener)
                 
 
     def closeAllTunnels(self) -> None:
-        proxyTunnels = {tunnel for tunnel in self._sock.values()}
-        for tunnel in proxyTunnels:
+        for tunnel in self.tunnels():
             self.closeTunnel(tunnel)
+        for listener in list(self._listeners.values()):
+            self.closeDataChannel(listener)
+        for pending in list(self._pendingDataChannels.values()):
+            self.closePendingDataChannel(pending)
+
+
+    def openDataChannel(self, controlTunnel: ProxyTunnel, targetAddress: Tuple[str, int], acceptFrom: str) -> DataChannelListener:
+        ## NOTE: The listener is bound to the address that `acceptFrom` already reaches the proxy on
+        if acceptFrom == "client":
+            bindHost = controlTunnel.clientToProxySocket.getsockname()[0]
+        elif acceptFrom == "server":
+            bindHost = controlTunnel.proxyToServerSocket.getsockname()[0]
+        else:
+            raise ValueError(f"Invalid acceptFrom for a data channel (must be 'client' or 'server') - {acceptFrom}")
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            sock.bind((bindHost, 0))
+            sock.listen(1)
+            sock.setblocking(False)
+        except socket.error as e:
+            sock.close()
+            raise e
+
+        listener = DataChannelListener(sock, controlTunnel, targetAddress, acceptFrom, time.monotonic() + self.DATA_CHANNEL_TIMEOUT)
+        self._listeners[sock] = listener
+        self.selector.register(sock, selectors.EVENT_READ, data=listener)
+        return listener
+
+
+    def connectDataChannel(self, listener: DataChannelListener, acceptedSocket: socket.socket, nonBlocking: bool = False) -> PendingDataChannel:
+        """Starts connecting the connection accepted by the listener to its
+        target address (the listener is closed) - the connection is relayed
+        through a pass-through tunnel once the connect completes"""
+        self.closeDataChannel(listener)
+        host, port = listener.targetAddress
+        targetSocket = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET, socket.SOCK_STREAM)
+        ## NOTE: The connect doesn't block the event loop - the socket is polled until it's writable
+        targetSocket.setblocking(False)
+        result = targetSocket.connect_ex((host, port))
+        if result not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            targetSocket.close()
+            acceptedSocket.close()
+            raise OSError(result, os.strerror(result))
+
+        pending = PendingDataChannel(acceptedSocket, targetSocket, listener.acceptFrom, nonBlocking,
+                                        time.monotonic() + self.DATA_CHANNEL_CONNECT_TIMEOUT)
+        self._pendingDataChannels[targetSocket] = pending
+        self.selector.register(targetSocket, selectors.EVENT_WRITE, data=pending)
+        return pending
+
+
+    def completeDataChannel(self, pending: PendingDataChannel) -> ProxyTunnel:
+        """Relays a data connection whose connect has completed through a
+        pass-through tunnel (raises a socket.error if the connect failed)"""
+        self._pendingDataChannels.pop(pending.targetSocket, None)
+        self.selector.unregister(pending.targetSocket)
+        result = pending.targetSocket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if result != 0:
+            pending.targetSocket.close()
+            pending.acceptedSocket.close()
+            raise OSError(result, os.strerror(result))
+
+        acceptedSocket, targetSocket = pending.acceptedSocket, pending.targetSocket
+        acceptedSocket.setblocking(not pending.nonBlocking)
+        targetSocket.setblocking(not pending.nonBlocking)
+
+        ## NOTE: The tunnel keeps the orientation of its control tunnel
+        if pending.acceptFrom == "client":
+            return self.createTunnel(acceptedSocket, targetSocket, PassThroughInterceptor)
+        return self.createTunnel(targetSocket, acceptedSocket, PassThroughInterceptor)
+
+
+    def closePendingDataChannel(self, pending: PendingDataChannel) -> None:
+        if self._pendingDataChannels.pop(pending.targetSocket, None) is None:
+            return None
+        self.selector.unregister(pending.targetSocket)
+        pending.targetSocket.close()
+        pending.acceptedSocket.close()
 
 
-    def setupProxyToServerSocket(self) -> socket.socket:
+    def dataChannels(self, controlTunnel: ProxyTunnel) -> List[DataChannelListener]:
+        """Returns the listeners of the tunnel's data channels that haven't been connected yet"""
+        if not self._listeners:
+            return []
+        return [listener for listener in self._listeners.values() if listener.controlTunnel is controlTunnel]
+
+
+    def closeDataChannel(self, listener: DataChannelListener) -> None:
+        if self._listeners.pop(listener.sock, None) is None:
+            return None
+        self.selector.unregister(listener.sock)
+        listener.sock.close()
+
+
+    def nextDataChannelExpiry(self) -> Optional[float]:
+        if not self._listeners and not self._pendingDataChannels:
+            return None
+        return min(channel.expiresAt for channels in (self._listeners, self._pendingDataChannels) for channel in channels.values())
+
+
+    def closeExpiredDataChannels(self) -> None:
+        if not self._listeners and not self._pendingDataChannels:
+            return None
+        now = time.monotonic()
+        for listener in [listener for listener in self._listeners.values() if listener.expiresAt <= now]:
+            self.closeDataChannel(listener)
+        for pending in [pending for pending in self._pendingDataChannels.values() if pending.expiresAt <= now]:
+            self.closePendingDataChannel(pending)
+
+
+    def pickBackend(self, clientHost: Optional[str] = None) -> Optional[Backend]:
+        return self.backendPool.pick(clientHost)
+
+
+    def setupProxyToServerSocket(self, backend: Optional[Backend] = None) -> socket.socket:
+        backend = backend or self.backendPool.pick()
+        if backend is None:
+            raise BackendUnavailableError(self.backendPool)
+        host, port = backend.address
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         try:
-            s.connect((self.PROXY_HOST, self.PROXY_PORT))
+            s.settimeout(self.backendPool.connectTimeout)
+            s.connect((host, port))
+            s.settimeout(None)
         except socket.error as e:
-            print(f"Failed to setup proxy to server connection @ {self.PROXY_HOST}:{self.PROXY_PORT}: {e}")
+            print(f"Failed to setup proxy to server connection @ {host}:{port}: {e}")
+            s.close()
+            self.backendPool.recordFailure(backend)
             raise e
 
+        self.backendPool.recordSuccess(backend)
         return s
 
 
+    def connectBackend(self, clientHost: Optional[str] = None) -> Tuple[socket.socket, Backend]:
+        """Connects to a backend for a new tunnel of the client - a failed
+        connect is retried on another backend the pool picks (raises a
+        socket.error once no backend is left to try)"""
+        error = BackendUnavailableError(self.backendPool)
+        ## NOTE: The backends that failed are excluded, as least-active and consistent-hash would pick them again
+        tried = set()
+        for _ in range(len(self.backendPool)):
+            backend = self.backendPool.pick(clientHost, exclude=tried)
+            if backend is None:
+                break
+            try:
+                return self.setupProxyToServerSocket(backend), backend
+            except socket.error as e:
+                tried.add(backend)
+                error = e
+        raise error
+
+
+
+if hasattr(select, "epoll"):
+    class EdgeTriggeredSelector(selectors.EpollSelector):
+        """Epoll selector that registers every file object with EPOLLET
+
+        Readiness is only reported when it changes, instead of on every
+        select() for as long as a socket stays readable/writable. Sockets
+        must be non-blocking and be read/written until EAGAIN"""
+        _EVENT_READ = select.EPOLLIN | select.EPOLLET
+        _EVENT_WRITE = select.EPOLLOUT | select.EPOLLET
+else:
+    EdgeTriggeredSelector = None
+
+
 
 ## BUG: It seems that the eventLoop may not be handling requests when the selector is polled
 ## --> The events are retrieved, and then immediately polled again
@@ -209,11 +750,32 @@ class TCPProxyServer:
     PROXY_PORT: int
     streamInterceptor: StreamInterceptor
     addressReuse: bool = field(default=False)
+    edgeTriggered: bool = field(default=False)
+    memoryBudget: Optional[MemoryBudget] = field(default=None)
+    hookWorkers: Optional[int] = field(default=None)
+    backendPool: Optional[BackendPool] = field(default=None)
+    ## NOTE: None disables the active health checks (backends are still checked by their connects and resets)
+    healthCheckInterval: Optional[float] = field(default=None)
+    capture: Optional[SessionCapture] = field(default=None)
+    admissionControl: Optional[AdmissionControl] = field(default=None)
+    accessList: Optional[AccessList] = field(default=None)
+    ## NOTE: How often the loop checks whether the memory budget allows paused sockets to resume
+    PAUSED_POLL_INTERVAL: float = field(default=0.1)
 
     serverSocket: socket.socket = field(init=False, repr=False)
     selector: selectors.BaseSelector = field(init=False, repr=False, default_factory=selectors.DefaultSelector)
     proxyConnections: ProxyConnections = field(init=False, repr=True)
     _exitFlag: bool = field(init=False, default=False)
+    _reloadFlag: bool = field(init=False, default=False)
+    _pausedSockets: Set[socket.socket] = field(init=False, repr=False, default_factory=set)
+    _pausedBytes: int = field(init=False, repr=False, default=0)
+    _hookExecutor: Optional[ThreadPoolExecutor] = field(init=False, repr=False, default=None)
+    _asyncHookRunner: AsyncHookRunner = field(init=False, repr=False, default_factory=AsyncHookRunner)
+    _completedHooks: deque = field(init=False, repr=False, default_factory=deque)
+    _backendProber: Optional[BackendProber] = field(init=False, repr=False, default=None)
+    ## NOTE: Other threads (and signal handlers) write to the wakeup socket, so the loop can block in select()
+    _wakeupReader: socket.socket = field(init=False, repr=False, default=None)
+    _wakeupWriter: socket.socket = field(init=False, repr=False, default=None)
     _terminated: threading.Event = field(init=False, default_factory=threading.Event)
 
     def __post_init__(self):
@@ -228,9 +790,35 @@ class TCPProxyServer:
 
 
     def _setupDataStructures(self):
-        self.selector = selectors.DefaultSelector()
-        self.proxyConnections = ProxyConnections(self.PROXY_HOST, self.PROXY_PORT, self.streamInterceptor, self.selector)
+        self.selector = self._createSelector()
+        self._hookExecutor = self._createHookExecutor()
+        ## NOTE: Level-triggered loops keep polling EVENT_WRITE, so held data is flushed without a notification
+        onHookComplete = self._hookCompleted if self.edgeTriggered else None
+        self.proxyConnections = ProxyConnections(self.PROXY_HOST, self.PROXY_PORT, self.streamInterceptor, self.selector,
+                                                    self.memoryBudget, self._hookExecutor, onHookComplete, self._asyncHookRunner,
+                                                    backendPool=self.backendPool, capture=self.capture)
+        if self.healthCheckInterval is not None:
+            self._backendProber = BackendProber(self.proxyConnections.backendPool, self.healthCheckInterval,
+                                                onResults=self._wakeup)
         self._setupServerSocket()
+        self._setupWakeupSocket()
+
+
+    def _createHookExecutor(self) -> Optional[ThreadPoolExecutor]:
+        ## NOTE: Without a pool, the interceptor hooks run inline on the event loop thread
+        if self.hookWorkers is None:
+            return None
+        if not (isinstance(self.hookWorkers, int) and self.hookWorkers > 0):
+            raise InvalidHookWorkersError(self.hookWorkers)
+        return ThreadPoolExecutor(max_workers=self.hookWorkers, thread_name_prefix="StreamInterceptorHook")
+
+
+    def _createSelector(self) -> selectors.BaseSelector:
+        if not self.edgeTriggered:
+            return selectors.DefaultSelector()
+        if EdgeTriggeredSelector is None:
+            raise EdgeTriggeredSelectorUnavailableError()
+        return EdgeTriggeredSelector()
 
 
     def _setupSignalHandlers(self):
@@ -240,31 +828,105 @@ class TCPProxyServer:
         try:
             signal.signal(signal.SIGINT, self._sigHandler)
         except AttributeError: pass ## Avoid errors caused by OS differences
+        try:
+            signal.signal(signal.SIGHUP, self._sigReloadHandler)
+        except AttributeError: pass ## Avoid errors caused by OS differences
 
 
     def run(self) -> None:
+        if self._backendProber is not None:
+            self._backendProber.start()
         return self._executeEventLoop()
 
 
     def _executeEventLoop(self) -> None:
         self._logDebugMessage("Server", "Server-Running", "Success")
+        ## NOTE: An edge-triggered selector reports each readiness change once, so sockets are drained
+        if self.edgeTriggered:
+            acceptConnection, serviceConnection = self._acceptAllConnections, self._serviceConnectionEdgeTriggered
+        else:
+            acceptConnection, serviceConnection = self._acceptConnection, self._serviceConnection
+
         while self._exitFlag is False:
-            ## TODO: Modify the timeout??
-            events = self.selector.select(timeout=0.1)
+            ## NOTE: Reloads requested by a signal are performed here (between event batches)
+            if self._reloadFlag:
+                self._handleReloadRequest()
+
+            events = self.selector.select(timeout=self._selectTimeout())
             for selectorKey, bitmask in events:
                 if selectorKey.data == "ServerSocket":
                     # print("TCPProxyServer - Accepting new connection")
-                    self._acceptConnection()
+                    acceptConnection()
+                elif selectorKey.data == "Wakeup":
+                    self._drainWakeupSocket()
+                elif isinstance(selectorKey.data, DataChannelListener):
+                    self._acceptDataChannel(selectorKey.data)
+                elif isinstance(selectorKey.data, PendingDataChannel):
+                    self._completeDataChannel(selectorKey.data)
                 else:
                     # print(f"TCPProxyServer - Servicing connection: {selectorKey}")
-                    self._serviceConnection(selectorKey, bitmask)
+                    serviceConnection(selectorKey, bitmask)
+
+            if self._completedHooks:
+                self._flushCompletedHooks()
+
+            if self.memoryBudget is not None:
+                self._enforceMemoryBudget()
+
+            if self._backendProber is not None:
+                self._backendProber.applyResults()
+
+            self.proxyConnections.closeExpiredDataChannels()
 
         self._close()
 
+
+    def _selectTimeout(self) -> Optional[float]:
+        ## NOTE: The loop only wakes up for a timer (or an event) - an idle loop blocks until it's woken up
+        if self._pausedSockets:
+            ## Paused sockets are resumed once the buffers drain (which the other events may not report)
+            return self.PAUSED_POLL_INTERVAL
+        expiresAt = self.proxyConnections.nextDataChannelExpiry()
+        if expiresAt is None:
+            return None
+        return max(0.0, expiresAt - time.monotonic())
+
+
+    def _wakeup(self) -> None:
+        ## NOTE: A full socket already has a pending wakeup, and a closed one has no loop left to wake up
+        try:
+            self._wakeupWriter.send(b"\0")
+        except OSError:
+            pass
+
+
+    def _drainWakeupSocket(self) -> None:
+        try:
+            while self._wakeupReader.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+
+    def _hookCompleted(self, endpoint: TunnelEndpoint) -> None:
+        ## Called by the executor threads (the completion is flushed by the loop, once it's woken up)
+        self._completedHooks.append(endpoint)
+        self._wakeup()
+
+
     def _close(self):
         try:
+            if self._hookExecutor is not None:
+                self._hookExecutor.shutdown(wait=False, cancel_futures=True)
+            self._asyncHookRunner.close()
+            if self._backendProber is not None:
+                self._backendProber.close()
             self.proxyConnections.closeAllTunnels()
+            if self.capture is not None:
+                self.capture.close()
             self.serverSocket.close()
+            self._wakeupReader.close()
+            self._wakeupWriter.close()
             self._logDebugMessage("Server", "Server-Termination", "Success")
         except (KeyboardInterrupt, Exception) as e:
             self._logDebugMessage("Server", "Server-Termination" "Warning")
@@ -299,57 +961,326 @@ class TCPProxyServer:
         self.selector.register(self.serverSocket, selectors.EVENT_READ, data="ServerSocket")
 
 
+    def _setupWakeupSocket(self) -> None:
+        self._wakeupReader, self._wakeupWriter = socket.socketpair()
+        self._wakeupReader.setblocking(False)
+        self._wakeupWriter.setblocking(False)
+        self.selector.register(self._wakeupReader, selectors.EVENT_READ, data="Wakeup")
+
+
     def _acceptConnection(self) -> None:
         clientToProxySocket, (hostname, port) = self.serverSocket.accept()
+
+        if self.accessList is not None and not self.accessList.allows(hostname):
+            clientToProxySocket.close()
+            logging.info(f"{datetime.now()}\t{hostname}\t{port}\tRejected\tAccess-Denied\tFailure")
+            return None
+
+        ## NOTE: Clients over their connection rate are dropped first, before any other work is done for them
+        if self.admissionControl is not None and not self.admissionControl.admits(hostname):
+            clientToProxySocket.close()
+            logging.info(f"{datetime.now()}\t{hostname}\t{port}\tRejected\tRate-Limited\tFailure")
+            return None
+
+        if not self.streamInterceptor.acceptsClient(hostname):
+            clientToProxySocket.close()
+            logging.info(f"{datetime.now()}\t{hostname}\t{port}\tRejected\tClient-Throttled\tFailure")
+            return None
+
+        ## NOTE: Past the hard limit, connections are refused before any backend connection or buffer is created
+        if self.memoryBudget is not None and self.memoryBudget.isOverHardLimit():
+            clientToProxySocket.close()
+            logging.info(f"{datetime.now()}\t{hostname}\t{port}\tRejected\tMemory-Budget-Exceeded\tFailure")
+            return None
+
+        ## NOTE: Backends whose circuit is open aren't dialled, so the client fails fast if none are left
         try:
-            proxyToServerSocket = self.proxyConnections.setupProxyToServerSocket()
+            proxyToServerSocket, backend = self.proxyConnections.connectBackend(hostname)
+        except BackendUnavailableError:
+            clientToProxySocket.close()
+            logging.info(f"{datetime.now()}\t{hostname}\t{port}\tRejected\tBackend-Unavailable\tFailure")
+            return None
         except socket.error as e:
             clientToProxySocket.close()
             ## socket hasn't been registered yet, so no need to unregister
             logging.info(f"{datetime.now()}\t{hostname}\t{port}\tRejected\tConnection-Rejected\tFailure")
             return None
 
-        self.proxyConnections.createTunnel(clientToProxySocket, proxyToServerSocket)
+        if self.edgeTriggered:
+            clientToProxySocket.setblocking(False)
+            proxyToServerSocket.setblocking(False)
+
+        self.proxyConnections.createTunnel(clientToProxySocket, proxyToServerSocket, backend=backend)
         logging.info(f"{datetime.now()}\t{hostname}\t{port}\tUndefined\tConnection-Accepted\tSuccess")
-        
+
+
+    def _acceptDataChannel(self, listener: DataChannelListener) -> None:
+        try:
+            acceptedSocket, (hostname, port) = listener.sock.accept()
+        except BlockingIOError:
+            return None
+
+        try:
+            self.proxyConnections.connectDataChannel(listener, acceptedSocket, nonBlocking=self.edgeTriggered)
+        except socket.error as e:
+            logging.info(f"{datetime.now()}\t{hostname}\t{port}\tRejected\tData-Channel-Rejected\tFailure")
+            return None
+
+
+    def _completeDataChannel(self, pending: PendingDataChannel) -> None:
+        try:
+            hostname, port = pending.acceptedSocket.getpeername()[:2]
+        except OSError:
+            hostname, port = None, None
+        try:
+            self.proxyConnections.completeDataChannel(pending)
+        except socket.error as e:
+            logging.info(f"{datetime.now()}\t{hostname}\t{port}\tRejected\tData-Channel-Rejected\tFailure")
+            return None
+        logging.info(f"{datetime.now()}\t{hostname}\t{port}\tUndefined\tData-Channel-Accepted\tSuccess")
+
+
+    def _acceptAllConnections(self) -> None:
+        ## NOTE: The listening socket only reports an edge once, so we accept until the backlog is empty
+        while True:
+            try:
+                self._acceptConnection()
+            except BlockingIOError:
+                return None
+
 
     def _serviceConnection(self, selectorKey: selectors.SelectorKey, bitmask: int) -> None:
-        sock = selectorKey.fileobj
+        endpoint = selectorKey.data
 
         ## NOTE: It's possible the the other socket of the tunnel closed the tunnel
-        proxyTunnel = self.proxyConnections.get(sock)
-        if proxyTunnel is None:
+        ## (the socket is then closed, but its event can still be in the current batch)
+        if endpoint.sock.fileno() == -1:
             return None
 
         ## In order to transfer from one socket, to another, we need to create buffers between them
-        if bitmask & selectors.EVENT_READ:
+        if bitmask & selectors.EVENT_READ and not endpoint.eof:
             ## Read data from socket into buffer
-            out = proxyTunnel.readFrom(sock)
+            out = endpoint.readFrom()
             ## If socket is closed, close tunnel
             if out is None:
-                return self.proxyConnections.closeTunnel(proxyTunnel)
+                return self._closeTunnelOnEOF(endpoint)
 
         if bitmask & selectors.EVENT_WRITE:
             ## Writes data from buffer into socket (if any)
-            out = proxyTunnel.writeTo(sock)
+            out = endpoint.writeTo()
             ## If socket is closed, close tunnel
             if out is None:
-                return self.proxyConnections.closeTunnel(proxyTunnel)
+                return self.proxyConnections.closeTunnel(endpoint.tunnel)
+            if endpoint.peer.eof:
+                return self._forwardEOF(endpoint.peer)
             
 
+    def _serviceConnectionEdgeTriggered(self, selectorKey: selectors.SelectorKey, bitmask: int) -> None:
+        endpoint = selectorKey.data
+
+        ## NOTE: It's possible the the other socket of the tunnel closed the tunnel
+        if endpoint.sock.fileno() == -1:
+            return None
+
+        if bitmask & selectors.EVENT_READ and not endpoint.eof:
+            ## Drain the socket into the buffer
+            if endpoint.readAll() is None:
+                return self._closeTunnelOnEOF(endpoint)
+            ## NOTE: The peer's EVENT_WRITE edge may have already been reported (while its buffer was
+            ## empty), so we forward the new data straight away instead of waiting for another edge
+            if endpoint.peer.writeAll() is None:
+                return self.proxyConnections.closeTunnel(endpoint.tunnel)
+
+        if bitmask & selectors.EVENT_WRITE:
+            ## Flush the buffered data (if any) until the socket would block
+            if endpoint.writeAll() is None:
+                return self.proxyConnections.closeTunnel(endpoint.tunnel)
+            if endpoint.peer.eof:
+                return self._forwardEOF(endpoint.peer)
+
+
+    def _closeTunnelOnEOF(self, endpoint: TunnelEndpoint) -> None:
+        ## NOTE: The data read before the EOF is still forwarded (e.g. the end of an FTP data transfer), but a
+        ## partial request that is held back can't be completed anymore, so it's dropped
+        endpoint.eof = True
+        self._setReadInterest(endpoint.sock, False)
+        endpoint.readBuffer.discardUndelimited()
+        ## NOTE: The peer's EVENT_WRITE edge may have already been reported, so an edge-triggered peer is flushed
+        ## here (a level-triggered peer is flushed by its next EVENT_WRITE, as its socket may be blocking)
+        if self.edgeTriggered and endpoint.peer.writeAll() is None:
+            return self.proxyConnections.closeTunnel(endpoint.tunnel)
+        return self._forwardEOF(endpoint)
+
+
+    def _forwardEOF(self, endpoint: TunnelEndpoint) -> None:
+        ## NOTE: Once the data read before the EOF has been forwarded, a server's EOF closes the tunnel, while a
+        ## client's EOF is passed on as a half-close - so the server can still reply (e.g. to the last request),
+        ## and the tunnel is closed once the server is done as well
+        if endpoint.readBuffer._data:
+            return None
+        if endpoint is endpoint.tunnel.serverEndpoint:
+            return self.proxyConnections.closeTunnel(endpoint.tunnel)
+        if not endpoint.eofForwarded:
+            endpoint.eofForwarded = True
+            try:
+                endpoint.peer.sock.shutdown(socket.SHUT_WR)
+            except OSError:
+                return self.proxyConnections.closeTunnel(endpoint.tunnel)
+
+
+    def _flushCompletedHooks(self) -> None:
+        ## NOTE: An offloaded (or awaited) hook releasing held data doesn't produce an edge, so the data is flushed here
+        ## (the completions are appended by the executor threads, and only ever popped by the loop)
+        while self._completedHooks:
+            endpoint = self._completedHooks.popleft()
+            if endpoint.sock.fileno() == -1:
+                continue
+            if endpoint.writeAll() is None:
+                self.proxyConnections.closeTunnel(endpoint.tunnel)
+            elif endpoint.peer.eof:
+                self._forwardEOF(endpoint.peer)
+
+
+    def _enforceMemoryBudget(self) -> None:
+        ## Resume reading once the buffers have drained below the resume limit
+        if self._pausedSockets and self.memoryBudget.isUnderResumeLimit():
+            for sock in self._pausedSockets:
+                self._setReadInterest(sock, True)
+            self._pausedSockets.clear()
+            self._pausedBytes = 0
+            return None
+
+        ## Past the soft limit, we stop reading into the largest buffers first
+        ## NOTE: Buffers that are already paused are accounted for, so this only rescans when usage keeps growing
+        excess = self.memoryBudget.usage - self.memoryBudget.softLimit
+        if excess <= 0 or self._pausedBytes >= excess:
+            return None
+
+        candidates = []
+        for tunnel in self.proxyConnections.tunnels():
+            ## NOTE: A buffer is filled by reading its source socket
+            candidates.append((tunnel.clientToServerBuffer._memoryUsage, tunnel.clientToProxySocket))
+            candidates.append((tunnel.serverToClientBuffer._memoryUsage, tunnel.proxyToServerSocket))
+        candidates.sort(key=lambda candidate: candidate[0], reverse=True)
+
+        for usage, sock in candidates:
+            if self._pausedBytes >= excess or usage == 0:
+                break
+            if sock in self._pausedSockets:
+                continue
+            self._setReadInterest(sock, False)
+            self._pausedSockets.add(sock)
+            self._pausedBytes += usage
+
+
+    def _setReadInterest(self, sock: socket.socket, enabled: bool) -> None:
+        ## NOTE: The tunnel may have been closed while its socket was paused
+        if sock.fileno() == -1:
+            return None
+        selectorKey = self.selector.get_key(sock)
+        if enabled:
+            events = selectorKey.events | selectors.EVENT_READ
+        else:
+            events = selectorKey.events & ~selectors.EVENT_READ
+        self.selector.modify(sock, events, selectorKey.data)
+
+
+    def memoryReport(self) -> Dict[str, object]:
+        """Returns the memory held by each tunnel (keyed by client address),
+        along with the global usage and limits of the memory budget"""
+        tunnels = {}
+        for tunnel in self.proxyConnections.tunnels():
+            try:
+                tunnels[tunnel.clientToProxySocket.getpeername()] = tunnel.memoryUsage()
+            except OSError:
+                continue ## the client has already disconnected
+
+        report = {"tunnels": tunnels, "total": sum(usage["total"] for usage in tunnels.values())}
+        if self.memoryBudget is not None:
+            report["budgetUsage"] = self.memoryBudget.usage
+            report["softLimit"] = self.memoryBudget.softLimit
+            report["hardLimit"] = self.memoryBudget.hardLimit
+            report["pausedSockets"] = len(self._pausedSockets)
+        return report
+
+
     def _logDebugMessage(self, user: str = "Server", eventType: str = "Default", description: str = "Default",) -> None:
         logging.debug(f"{datetime.now()}\t{self.HOST}\t{self.PORT}\t{user}\t{eventType}\t{description}")
         
 
+    def reloadStreamInterceptor(self, streamInterceptor: Optional[StreamInterceptor] = None) -> StreamInterceptor:
+        """Applies a new version of the interceptor to new tunnels without
+        dropping the live ones (which keep running on the old version).
+        If no class is passed, the module of the current interceptor is
+        re-imported and the class with the same name is used"""
+        if streamInterceptor is None:
+            streamInterceptor = self._reimportStreamInterceptor(self.streamInterceptor)
+
+        ## Raises an exception (and keeps the current interceptor) if the new class is invalid
+        self.proxyConnections.setStreamInterceptor(streamInterceptor)
+        self.streamInterceptor = streamInterceptor
+        self._logDebugMessage("Server", "Interceptor-Reload", f"Success ({streamInterceptor.__module__}.{streamInterceptor.__qualname__})")
+        return streamInterceptor
+
+
+    def _reimportStreamInterceptor(self, streamInterceptor: StreamInterceptor) -> StreamInterceptor:
+        ## NOTE: Classes defined inside functions cannot be looked up again after a reload
+        module = sys.modules.get(streamInterceptor.__module__)
+        if module is None or "<locals>" in streamInterceptor.__qualname__:
+            raise UnreloadableStreamInterceptorError(streamInterceptor)
+
+        module = importlib.reload(module)
+        reloadedInterceptor = module
+        for name in streamInterceptor.__qualname__.split("."):
+            reloadedInterceptor = getattr(reloadedInterceptor, name, None)
+        if reloadedInterceptor is None:
+            raise UnreloadableStreamInterceptorError(streamInterceptor)
+        for name in getattr(reloadedInterceptor, "RUNTIME_ATTRIBUTES", ()):
+            if getattr(reloadedInterceptor, name, None) is None:
+                setattr(reloadedInterceptor, name, getattr(streamInterceptor, name, None))
+        return reloadedInterceptor
+
+
+    def _handleReloadRequest(self) -> None:
+        self._reloadFlag = False
+        try:
+            self.reloadStreamInterceptor()
+        except Exception as e:
+            ## A broken interceptor version must not take down the live tunnels
+            self._logDebugMessage("Server", "Interceptor-Reload", f"Failure ({e})")
+        ## NOTE: A large access list takes a while to build, so it's built off the event loop (and swapped in once built)
+        if self.accessList is not None and self.accessList.path is not None:
+            threading.Thread(target=self._reloadAccessList, name="AccessListReload", daemon=True).start()
+
+
+    def _reloadAccessList(self) -> None:
+        try:
+            self.accessList.reload()
+        except Exception as e:
+            ## The current rules are kept
+            self._logDebugMessage("Server", "AccessList-Reload", f"Failure ({e})")
+
+
     def close(self, blocking: bool = True) -> None:
+        """Asks the event loop to exit, and waits until it has closed the server if `blocking`"""
         self._exitFlag = True
-        self._terminated.wait()
+        self._wakeup()
+        if blocking:
+            self._terminated.wait()
 
     
 
    ## Required parameters by signal handler
     def _sigHandler(self, signum, frame) -> None:
-        self.close()
+        ## NOTE: The handler runs on the loop's own thread (the one that would have to set _terminated), so it only
+        ## asks the loop to exit
+        self._exitFlag = True
+        self._wakeup()
+
+    def _sigReloadHandler(self, signum, frame) -> None:
+        ## NOTE: The reload is deferred to the event loop, as the signal can interrupt it at any point
+        self._reloadFlag = True
+        self._wakeup()
 
 
 
@@ -357,7 +1288,8 @@ class TCPProxyServer:
 def main():
     HOST, PORT = "0.0.0.0", 8080
     PROXY_HOST, PROXY_PORT = "127.0.0.1", 80
-    streamInterceptor = StreamInterceptor
+    ## NOTE: A plain proxy - its tunnels are transparent (see StreamInterceptor.isTransparent())
+    streamInterceptor = PassThroughInterceptor
     TPS = TCPProxyServer(HOST, PORT, PROXY_HOST, PROXY_PORT, streamInterceptor)
     TPS.run()
 
@@ -2,11 +2,16 @@ import collections
 import os
 import sys
 import functools
+import random
+import time
 import pytest
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 sys.path.insert(0, os.path.join("..", "src"))
 sys.path.insert(0, "src")
-from _proxyDS import Buffer
+from _proxyDS import AsyncHookRunner, Buffer, MemoryBudget, SerialHookQueue
 from _exceptions import *
 ## Buffer Initiatialization
 
@@ -788,4 +793,505 @@ class Test_Buffer_HookSetting:
         assert isRan == True
 
 
- 
\ No newline at end of file
+ 
+
+
+
+class Test_Buffer_MemoryAccounting:
+    def test_memoryBudget_defaultResumeLimit(self):
+        budget = MemoryBudget(1000, 2000)
+        assert budget.resumeLimit == 750
+        assert budget.usage == 0
+
+    @pytest.mark.parametrize("limits", [(1000, 500), (1000, 2000, 1001), (1000, 2000, -1)])
+    def test_memoryBudget_invalidLimits(self, limits):
+        with pytest.raises(InvalidMemoryBudgetError) as excInfo:
+            MemoryBudget(*limits)
+        assert "Invalid MemoryBudget" in str(excInfo.value)
+
+    def test_memoryBudget_thresholds(self):
+        budget = MemoryBudget(100, 200, 50)
+        budget.allocate(150)
+        assert budget.isOverSoftLimit() and not budget.isOverHardLimit() and not budget.isUnderResumeLimit()
+        budget.allocate(100)
+        assert budget.isOverHardLimit()
+        budget.allocate(-200)
+        assert budget.usage == 50
+        assert budget.isUnderResumeLimit() and not budget.isOverSoftLimit()
+
+    def test_write_noBudget(self):
+        b = Buffer([b"\r\n"])
+        b.write(b"incomplete")
+        assert b._memoryUsage == 0
+        ## stream data + undelimited queued request + delimiter lookback
+        assert b.memoryUsage() == len(b"incomplete") * 2 + len(b._prevEndBuffer)
+
+    def test_write_accountedInBudget(self):
+        budget = MemoryBudget(1000, 2000)
+        b1, b2 = Buffer([b"\r\n"], memoryBudget=budget), Buffer([b"\r\n"], memoryBudget=budget)
+        b1.write(b"incomplete")
+        b2.write(b"abc")
+        assert b1._memoryUsage == b1.memoryUsage()
+        assert b2._memoryUsage == b2.memoryUsage()
+        assert budget.usage == b1.memoryUsage() + b2.memoryUsage()
+
+    def test_pop_returnsBytesToBudget(self):
+        budget = MemoryBudget(1000, 2000)
+        b = Buffer([b"\r\n"], memoryBudget=budget)
+        b.write(b"request\r\nincomplete")
+        usage = budget.usage
+        b.pop(len(b"request\r\n"))
+        assert budget.usage == usage - len(b"request\r\n")
+        assert budget.usage == b.memoryUsage()
+
+    def test_releaseMemory(self):
+        budget = MemoryBudget(1000, 2000)
+        b1, b2 = Buffer([b"\r\n"], memoryBudget=budget), Buffer([b"\r\n"], memoryBudget=budget)
+        b1.write(b"incomplete")
+        b2.write(b"abc")
+        b1.releaseMemory()
+        assert budget.usage == b2.memoryUsage()
+        assert b1._memoryUsage == 0
+        b2.releaseMemory()
+        assert budget.usage == 0
+
+
+
+@pytest.fixture()
+def createHookExecutor():
+    executor = ThreadPoolExecutor(max_workers=4)
+    yield executor
+    executor.shutdown(wait=True)
+
+
+class Test_Buffer_HookOffloading:
+    def test_serialHookQueue_ordering(self, createHookExecutor):
+        hookQueue = SerialHookQueue(createHookExecutor)
+        calls = []
+        def hook(index):
+            time.sleep(0.001 * (index % 3)) ## uneven hook durations shouldn't reorder the calls
+            calls.append(index)
+            return index
+
+        futures = [hookQueue.submit(hook, index) for index in range(50)]
+        assert [future.result(timeout=5) for future in futures] == list(range(50))
+        assert calls == list(range(50))
+
+    def test_serialHookQueue_exception(self, createHookExecutor):
+        hookQueue = SerialHookQueue(createHookExecutor)
+        def hook():
+            raise KeyError("hookFailure")
+
+        failed, succeeded = hookQueue.submit(hook), hookQueue.submit(lambda: "done")
+        with pytest.raises(KeyError):
+            failed.result(timeout=5)
+        assert succeeded.result(timeout=5) == "done" ## the queue keeps running after a failed hook
+
+    def test_inlineMode_holdsRequestUntilHooked(self, createHookExecutor):
+        b = Buffer([b"\r\n"])
+        release, completed, hooked = threading.Event(), threading.Event(), []
+        def hook(buffer, request):
+            release.wait(5)
+            hooked.append(bytes(request))
+
+        b.setHook(hook, SerialHookQueue(createHookExecutor), waitForHook=True, onHookComplete=completed.set)
+        b.write(b"partial")
+        assert b.sendable() == len(b"partial")
+
+        ## the completed request (and any data after it) is held until its hook returns
+        b.write(b"Request\r\nnext")
+        assert b.sendable() == 0
+        release.set()
+        assert completed.wait(5)
+        assert hooked == [b"partialRequest\r\n"]
+        assert b.sendable() == len(b"partialRequest\r\nnext")
+
+    def test_inlineMode_heldOffsetAfterPop(self, createHookExecutor):
+        b = Buffer([b"\r\n"])
+        release = threading.Event()
+        b.setHook(lambda buffer, request: release.wait(5), SerialHookQueue(createHookExecutor), waitForHook=True)
+
+        b.write(b"first")
+        b.pop(len(b"first"))
+        b.write(b"\r\nsecond\r\n")
+        assert b.sendable() == 0 ## "first" was forwarded, but its request is still being hooked
+        release.set()
+        createHookExecutor.shutdown(wait=True)
+        assert b.sendable() == len(b"\r\nsecond\r\n")
+
+    def test_asyncMode_doesNotHold(self, createHookExecutor):
+        b = Buffer([b"\r\n"])
+        release, hooked = threading.Event(), []
+        def hook(buffer, request):
+            release.wait(5)
+            hooked.append(bytes(request))
+
+        b.setHook(hook, SerialHookQueue(createHookExecutor), waitForHook=False)
+        b.write(b"request\r\n")
+        assert b.sendable() == len(b"request\r\n")
+        release.set()
+        createHookExecutor.shutdown(wait=True)
+        assert hooked == [b"request\r\n"]
+
+
+
+@pytest.fixture()
+def createAsyncHookRunner():
+    runner = AsyncHookRunner()
+    yield runner
+    runner.close()
+
+
+class Test_Buffer_AwaitableHooks:
+    def test_awaitableHook_holdsRequestUntilAwaited(self, createAsyncHookRunner):
+        b = Buffer([b"\r\n"])
+        release, completed, hooked = threading.Event(), threading.Event(), []
+        async def hook(buffer, request):
+            await asyncio.get_running_loop().run_in_executor(None, release.wait, 5)
+            hooked.append(bytes(request))
+
+        b.setHook(hook, onHookComplete=completed.set, asyncHookRunner=createAsyncHookRunner)
+        b.write(b"request\r\nnext")
+        assert b.sendable() == 0
+        release.set()
+        assert completed.wait(5)
+        assert hooked == [b"request\r\n"]
+        assert b.sendable() == len(b"request\r\nnext")
+
+    def test_awaitableHook_ordering(self, createAsyncHookRunner):
+        b = Buffer([b"\r\n"])
+        hooked = []
+        async def hook(buffer, request):
+            await asyncio.sleep(0.01 if request.startswith(b"first") else 0)
+            hooked.append(bytes(request))
+
+        b.setHook(hook, asyncHookRunner=createAsyncHookRunner)
+        b.write(b"first\r\nsecond\r\n")
+        b.waitForHooks(timeout=5)
+        assert hooked == [b"first\r\n", b"second\r\n"]
+        assert b.sendable() == len(b"first\r\nsecond\r\n")
+
+    def test_waitForHooks_raises(self, createAsyncHookRunner):
+        b = Buffer([b"\r\n"])
+        async def hook(buffer, request):
+            raise ValueError(bytes(request))
+
+        b.waitForHooks() ## nothing to wait for
+        b.setHook(hook, asyncHookRunner=createAsyncHookRunner)
+        b.write(b"request\r\n")
+        with pytest.raises(ValueError):
+            b.waitForHooks(timeout=5)
+
+    def test_awaitableHook_continuation(self, createAsyncHookRunner):
+        b = Buffer([b"\r\n"], holdUndelimited=True)
+        resumedBy = []
+        def resume(buffer, request):
+            resumedBy.append(threading.current_thread())
+            buffer.replaceRequest(bytes(request).upper())
+        async def hook(buffer, request):
+            return resume if request.startswith(b"first") else None
+
+        b.setHook(hook, asyncHookRunner=createAsyncHookRunner)
+        b.write(b"first\r\nsecond\r\n")
+        ## The continuation is called by sendable() (on the thread that drives the buffer), before the request is sent
+        b._lastAwaitedHook.result(timeout=5)
+        assert resumedBy == []
+        sendable = b.sendable()
+        assert resumedBy == [threading.current_thread()]
+        assert b"".join(b.gather(sendable)) == b"FIRST\r\nsecond\r\n"
+
+    def test_awaitableHook_continuationNotSkipped(self, createAsyncHookRunner, monkeypatch):
+        b = Buffer([b"\r\n"], holdUndelimited=True)
+        async def hook(buffer, request):
+            return lambda buffer, request: buffer.replaceRequest(b"resumed\r\n")
+
+        b.setHook(hook, asyncHookRunner=createAsyncHookRunner)
+        b.write(b"request\r\n")
+        b._lastAwaitedHook.result(timeout=5)
+        ## The hook finished just after the continuations were checked, so the request is still held
+        with monkeypatch.context() as patch:
+            patch.setattr(b, "_resumeAwaitedHooks", lambda: None)
+            assert b.sendable() == 0
+        sendable = b.sendable()
+        assert b"".join(b.gather(sendable)) == b"resumed\r\n"
+
+    def test_awaitableHook_continuationAwaited(self, createAsyncHookRunner):
+        b = Buffer([b"\r\n"])
+        hooked = []
+        async def resumed():
+            hooked.append("resumed")
+        async def hook(buffer, request):
+            hooked.append(bytes(request))
+            return lambda buffer, request: resumed()
+
+        b.setHook(hook, asyncHookRunner=createAsyncHookRunner)
+        b.write(b"request\r\nnext")
+        b.waitForHooks(timeout=5)
+        ## The second request is only held by the continuation's awaitable
+        assert hooked == [b"request\r\n", "resumed"]
+        assert b.sendable() == len(b"request\r\nnext")
+
+    def test_awaitableHook_offloadedContinuation(self, createHookExecutor, createAsyncHookRunner):
+        b = Buffer([b"\r\n"])
+        async def hook(buffer, request):
+            return lambda buffer, request: bytes(request).upper()
+
+        b.setHook(hook, SerialHookQueue(createHookExecutor), asyncHookRunner=createAsyncHookRunner)
+        b.write(b"request\r\n")
+        _, future = b._pendingHooks[0]
+        assert future.result(timeout=5) == b"REQUEST\r\n"
+
+    def test_synchronousHook_notHeld(self, createAsyncHookRunner):
+        b = Buffer([b"\r\n"])
+        b.setHook(lambda buffer, request: None, asyncHookRunner=createAsyncHookRunner)
+        b.write(b"request\r\n")
+        assert b.sendable() == len(b"request\r\n")
+        assert createAsyncHookRunner._loop is None ## the runner's thread is only started when needed
+
+    def test_awaitableHook_offloaded(self, createHookExecutor, createAsyncHookRunner):
+        b = Buffer([b"\r\n"])
+        async def hook(buffer, request):
+            await asyncio.sleep(0.01)
+            return bytes(request)
+
+        b.setHook(hook, SerialHookQueue(createHookExecutor), asyncHookRunner=createAsyncHookRunner)
+        b.write(b"request\r\n")
+        _, future = b._pendingHooks[0]
+        assert future.result(timeout=5) == b"request\r\n"
+        assert b.sendable() == len(b"request\r\n")
+
+    def test_awaitableHook_missingRunner(self):
+        b = Buffer([b"\r\n"])
+        async def hook(buffer, request):
+            return None
+
+        b.setHook(hook)
+        with pytest.raises(MissingAsyncHookRunnerError) as excInfo:
+            b.write(b"request\r\n")
+        assert "no AsyncHookRunner was set" in str(excInfo.value)
+
+
+class Test_Buffer_RequestRewriting:
+    def test_replaceRequest_inHook(self):
+        b = Buffer([b"\r\n"], holdUndelimited=True)
+        def hook(buffer, request):
+            if request.startswith(b"PASV"):
+                buffer.replaceRequest(b"LONGER-EPSV\r\n")
+        b.setHook(hook)
+
+        b.write(b"NOOP\r\nPASV\r\nNOOP\r\npartial")
+        assert b.read(-1) == b"NOOP\r\nLONGER-EPSV\r\nNOOP\r\npartial"
+        ## The undelimited data is held back (it could still be rewritten)
+        assert b.sendable() == len(b"NOOP\r\nLONGER-EPSV\r\nNOOP\r\n")
+
+        b.pop(b.sendable())
+        b.write(b" request\r\n")
+        assert b.sendable() == len(b"partial request\r\n")
+
+    def test_replaceRequest_afterPop(self):
+        b = Buffer([b"\r\n"], holdUndelimited=True)
+        def hook(buffer, request):
+            buffer.replaceRequest(bytes(request).upper())
+        b.setHook(hook)
+
+        b.write(b"first\r\n")
+        b.pop(3)
+        b.write(b"second\r\n")
+        assert b.read(-1) == b"ST\r\nSECOND\r\n"
+        assert b.sendable() == len(b"ST\r\nSECOND\r\n")
+
+    def test_replaceRequest_outsideHook(self):
+        b = Buffer([b"\r\n"])
+        assert b.canReplaceRequest() is False
+        with pytest.raises(RequestRewriteUnavailableError):
+            b.replaceRequest(b"request\r\n")
+
+    def test_replaceRequest_offloadedHook(self, createHookExecutor):
+        b = Buffer([b"\r\n"])
+        def hook(buffer, request):
+            buffer.replaceRequest(b"rewritten\r\n")
+        b.setHook(hook, SerialHookQueue(createHookExecutor))
+
+        b.write(b"request\r\n")
+        _, future = b._pendingHooks[0]
+        with pytest.raises(RequestRewriteUnavailableError):
+            future.result(timeout=5)
+        assert b._data == bytearray(b"request\r\n")
+
+    def test_passThrough_notParsed(self):
+        b = Buffer([b"\r\n"], parseRequests=False)
+        calls = []
+        b.setHook(lambda buffer, request: calls.append(request))
+
+        b.write(b"request\r\nrequest\r\n")
+        assert calls == []
+        assert len(b._requests) == 0
+        assert b.sendable() == len(b"request\r\nrequest\r\n")
+
+
+class Test_Buffer_InspectionCutoff:
+    def test_stopInspection_inHook(self):
+        b = Buffer([b"\r\n"], holdUndelimited=True)
+        hooked = []
+        def hook(buffer, request):
+            hooked.append(bytes(request))
+            buffer.stopInspection()
+        b.setHook(hook)
+
+        b.write(b"first\r\nsecond\r\npartial")
+        ## The requests after the cutoff aren't hooked (or held back)
+        assert hooked == [b"first\r\n"]
+        assert len(b._requests) == 0 and b._prevEndBuffer == bytearray()
+        assert b.sendable() == len(b"first\r\nsecond\r\npartial")
+
+        b.write(b"\r\nthird\r\n")
+        assert hooked == [b"first\r\n"]
+        assert b.sendable() == len(b._data)
+
+    def test_stopInspection_offloadedHook(self, createHookExecutor):
+        b = Buffer([b"\r\n"], memoryBudget=MemoryBudget(1000, 2000))
+        def hook(buffer, request):
+            buffer.stopInspection()
+        b.setHook(hook, SerialHookQueue(createHookExecutor))
+
+        b.write(b"first\r\npartial")
+        _, future = b._pendingHooks[0]
+        future.result(timeout=5)
+        assert b.parseRequests is False
+
+        ## The partially parsed request is discarded (and unaccounted) by the next write
+        b.write(b" request\r\n")
+        assert len(b._requests) == 0
+        assert b.memoryBudget.usage == len(b._data)
+
+
+class Test_Buffer_Edits:
+    def test_edits_appliedOnRead(self):
+        b = Buffer([b"\r\n"], holdUndelimited=True)
+        def hook(buffer, request):
+            if request.startswith(b"Host"):
+                buffer.replaceRange(6, 9, b"example.com")
+                buffer.insertAt(0, b"Via: proxy\r\n")
+                buffer.deleteRange(0, 1)
+        b.setHook(hook)
+
+        b.write(b"GET / HTTP/1.1\r\nHost: abc\r\n\r\npartial")
+        ## The received data isn't moved - the edits are applied as it is read
+        assert b._data == bytearray(b"GET / HTTP/1.1\r\nHost: abc\r\n\r\npartial")
+        assert b.read(-1) == b"GET / HTTP/1.1\r\nVia: proxy\r\nost: example.com\r\n\r\npartial"
+        assert b.sendable() == len(b"GET / HTTP/1.1\r\nVia: proxy\r\nost: example.com\r\n\r\n")
+        ## The edited stream is sent as a list of segments (without being joined)
+        assert b.gather(len(b"GET / HTTP/1.1\r\nVia: proxy\r\n")) == [b"GET / HTTP/1.1\r\n", b"Via: proxy\r\n"]
+
+    @pytest.mark.parametrize("popSize", [1, 2, 3, 5, 64])
+    def test_edits_popped(self, popSize):
+        b = Buffer([b"\r\n"], holdUndelimited=True, memoryBudget=MemoryBudget(1000, 2000))
+        def hook(buffer, request):
+            buffer.replaceRange(0, 1, request[:1].upper() * 3)
+            buffer.deleteRange(len(request) - 2, len(request))
+            buffer.insertAt(len(request), b";\r\n")
+        b.setHook(hook)
+
+        b.write(b"first\r\nsecond\r\nthird")
+        popped = b""
+        while b.sendable():
+            popped += b.pop(min(popSize, b.sendable()))
+        assert popped == b"FFFirst;\r\nSSSecond;\r\n"
+        assert b._data == bytearray(b"third") and b._patches == []
+        assert b.memoryBudget.usage == b.memoryUsage()
+
+    def test_edits_heldByHook(self, createHookExecutor):
+        b = Buffer([b"\r\n"], holdUndelimited=True)
+        def hook(buffer, request):
+            buffer.replaceRange(0, 2, b"")
+        b.setHook(hook)
+
+        b.write(b"ab\r\nab\r\n")
+        ## Deleted ranges are skipped (even if nothing else is left to send)
+        assert b.sendable() == 4
+        assert b.pop(4) == b"\r\n\r\n"
+        assert b._data == bytearray() and b.sendable() == 0
+
+    def test_edits_consecutiveDeletions(self):
+        b = Buffer([b"\n"], holdUndelimited=True)
+        def hook(buffer, request):
+            buffer.replaceRange(0, len(request), b"")
+        b.setHook(hook)
+
+        ## Both requests are deleted, and the undelimited data after them is still held back
+        b.write(b"\n\naaa")
+        assert b.sendable() == 0
+        assert b.gather(b.sendable()) == [b""]
+        assert b._data == bytearray(b"aaa") and b._patches == []
+        b.write(b"\nbb")
+        assert b.sendable() == 0 and b._data == bytearray(b"bb")
+
+    @pytest.mark.parametrize("seed", range(20))
+    def test_edits_randomized(self, seed):
+        ## The edited stream that is sent must be the same however the stream is chunked, edited and popped
+        rng = random.Random(seed)
+        b = Buffer([b"\n"], holdUndelimited=True)
+        expected = []
+        def editingHook(buffer, request):
+            edit = rng.choice(("keep", "delete", "replace", "insert", "deletePart"))
+            if edit == "delete":
+                buffer.replaceRange(0, len(request), b"")
+                expected.append(b"")
+            elif edit == "replace":
+                replacement = b"R" * rng.randrange(0, 4)
+                buffer.replaceRange(0, len(request), replacement)
+                expected.append(replacement)
+            elif edit == "insert":
+                buffer.insertAt(0, b"I")
+                expected.append(b"I" + bytes(request))
+            elif edit == "deletePart" and len(request) > 1:
+                buffer.deleteRange(0, len(request) - 1)
+                expected.append(bytes(request[-1:]))
+            else:
+                expected.append(bytes(request))
+        b.setHook(editingHook)
+
+        stream = b"".join(rng.choice((b"\n", b"a\n", b"bb\n", b"ccc")) for _ in range(200))
+        sent, position = b"", 0
+        while position < len(stream):
+            chunkSize = rng.randrange(1, 8)
+            b.write(stream[position:position + chunkSize])
+            position += chunkSize
+            while rng.random() < 0.7:
+                sendable = b.sendable()
+                assert sendable >= 0
+                if not sendable:
+                    break
+                size = rng.randrange(1, sendable + 1)
+                sent += b"".join(b.gather(size))
+                b.pop(size)
+        while (sendable := b.sendable()):
+            sent += b"".join(b.gather(sendable))
+            b.pop(sendable)
+
+        ## Only the delimited requests are sent (with their edits), and the undelimited end is held back
+        assert sent == b"".join(expected)
+        assert bytes(b._data) == stream[stream.rindex(b"\n") + 1:]
+        assert b.sendable() == 0
+
+    @pytest.mark.parametrize("start, end", [(-1, 2), (2, 1), (0, 8), (1, 3), (2, 2)])
+    def test_edits_invalidRange(self, start, end):
+        b = Buffer([b"\r\n"], holdUndelimited=True)
+        errors = []
+        def hook(buffer, request):
+            buffer.replaceRange(0, 3, b"x")
+            try:
+                buffer.replaceRange(start, end, b"y")
+            except InvalidEditRangeError as e:
+                errors.append(e)
+        b.setHook(hook)
+
+        b.write(b"request\r\n")
+        assert len(errors) == 1
+        assert b.read(-1) == b"xuest\r\n"
+
+    def test_edits_outsideHook(self):
+        b = Buffer([b"\r\n"], holdUndelimited=True)
+        b.write(b"request\r\n")
+        with pytest.raises(RequestRewriteUnavailableError):
+            b.insertAt(0, b"x")
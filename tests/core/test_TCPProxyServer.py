@@ -1,3 +1,4 @@
+import copy
 import functools
 import time
 import os
@@ -18,29 +19,36 @@ import math
 
 from testhelper.TCPProxyServer import TPSTestResources
 from testhelper.DataTransferSimulator import DataTransferSimulator
+from testhelper.LoadGenerator import LoadGenerator
 from tests.testhelper.TestResources import PTTestResources
 
 
 sys.path.insert(0, os.path.join("..", "src"))
 sys.path.insert(0, "src")
-from tcp_proxyserver import ProxyConnections, TCPProxyServer, ProxyTunnel
+from tcp_proxyserver import ProxyConnections, TCPProxyServer, ProxyTunnel, EdgeTriggeredSelector
 from _exceptions import *
-from _proxyDS import StreamInterceptor, Buffer
+from _proxyDS import StreamInterceptor, Buffer, MemoryBudget
+from ftp_proxyinterceptor import FTPProxyInterceptor
+from _backendPool import Backend, BackendPool
+from _admissionControl import AdmissionControl
+from _accessList import AccessList
 
 
 
 
 @pytest.fixture()
-def createTCPProxyServer():
+def createTCPProxyServer(request):
     PROXY_HOST, PROXY_PORT = "127.0.0.1", 1337
     HOST, PORT = "127.0.0.1", 8080
-    streamInterceptor = PTTestResources.createMockStreamInterceptor()
+    ## NOTE: Tests can pass extra server options (e.g. edgeTriggered) with indirect parametrization
+    serverOptions = copy.deepcopy(getattr(request, "param", {}))
+    streamInterceptor = serverOptions.pop("streamInterceptor", None) or PTTestResources.createMockStreamInterceptor()
 
     ## first we need to kill any processes running on the (HOST, PORT)
     # TPSTestResources.freePort(PORT)
 
     ## we can then try to create the server (not execute it yet)
-    server = TCPProxyServer(HOST, PORT, PROXY_HOST, PROXY_PORT, streamInterceptor, addressReuse=True)
+    server = TCPProxyServer(HOST, PORT, PROXY_HOST, PROXY_PORT, streamInterceptor, addressReuse=True, **serverOptions)
     yield HOST, PORT, PROXY_HOST, PROXY_PORT, streamInterceptor, server
 
     ## we then want to shut down the server (at least the server socket)
@@ -123,10 +131,13 @@ class Test_ProxyServer_Init:
             ## selectors.EVENT_READ | selectors.EVENT_WRITE
             ## data = "serverSocket"
         assert isinstance(server.selector, selectors.DefaultSelector)
-        assert len(server.selector.get_map()) == 1
+        assert len(server.selector.get_map()) == 2
         selectorKey = server.selector.get_key(server.serverSocket)
         assert selectorKey.data == "ServerSocket"
         assert selectorKey.events == selectors.EVENT_READ
+        selectorKey = server.selector.get_key(server._wakeupReader)
+        assert selectorKey.data == "Wakeup"
+        assert selectorKey.events == selectors.EVENT_READ
 
         ## check that the selector has been created correctly
         assert server.selector == server.proxyConnections.selector
@@ -144,7 +155,7 @@ class Test_ProxyServer_Init:
         ## server 1 serverSocket should be bound and registered
         assert server1.serverSocket.getblocking() is False
         assert server1.serverSocket.getsockname() == (HOST, PORT)
-        assert len(server1.selector.get_map()) == 1
+        assert len(server1.selector.get_map()) == 2
         selectorKey = server1.selector.get_key(server1.serverSocket)
         assert selectorKey.data == "ServerSocket"
         assert selectorKey.events == selectors.EVENT_READ
@@ -153,6 +164,536 @@ class Test_ProxyServer_Init:
         TPSTestResources.assertConstantAttributes(server1, HOST, PORT, PROXY_HOST, PROXY_PORT, streamInterceptor)
 
 
+    @pytest.mark.parametrize("hookWorkers", [0, -1, 1.5])
+    def test_init_invalidHookWorkers(self, hookWorkers) -> None:
+        streamInterceptor = PTTestResources.createMockStreamInterceptor()
+        with pytest.raises(InvalidHookWorkersError) as excInfo:
+            TCPProxyServer("127.0.0.1", 8080, "127.0.0.1", 1337, streamInterceptor, hookWorkers=hookWorkers)
+        assert "hookWorkers must be a positive integer" in str(excInfo.value)
+
+    @pytest.mark.parametrize("createTCPProxyServer", [{"edgeTriggered": True}], indirect=True)
+    def test_init_edgeTriggered(self, createTCPProxyServer) -> None:
+        HOST, PORT, PROXY_HOST, PROXY_PORT, interceptor, server = createTCPProxyServer
+
+        ## The server should poll with the epoll (EPOLLET) selector
+        assert server.edgeTriggered is True
+        assert isinstance(server.selector, EdgeTriggeredSelector)
+        assert server.selector == server.proxyConnections.selector
+
+        selectorKey = server.selector.get_key(server.serverSocket)
+        assert selectorKey.data == "ServerSocket"
+        assert selectorKey.events == selectors.EVENT_READ
+        TPSTestResources.assertConstantAttributes(server, HOST, PORT, PROXY_HOST, PROXY_PORT, interceptor)
+
+
+
+
+class Test_ProxyServer_wakeup:
+    def test_idleLoop_blocksWithoutTimeout(self, createTCPProxyServer) -> None:
+        HOST, PORT, PROXY_HOST, PROXY_PORT, interceptor, server = createTCPProxyServer
+        assert server._selectTimeout() is None
+
+    def test_wakeup_readyUntilDrained(self, createTCPProxyServer) -> None:
+        HOST, PORT, PROXY_HOST, PROXY_PORT, interceptor, server = createTCPProxyServer
+        for _ in range(3):
+            server._wakeup()
+        events = server.selector.select(timeout=0)
+        assert [selectorKey.data for selectorKey, bitmask in events] == ["Wakeup"]
+
+        server._drainWakeupSocket()
+        assert server.selector.select(timeout=0) == []
+
+    def test_pausedSockets_polled(self, createTCPProxyServer) -> None:
+        HOST, PORT, PROXY_HOST, PROXY_PORT, interceptor, server = createTCPProxyServer
+        server._pausedSockets.add(server.serverSocket)
+        try:
+            assert server._selectTimeout() == server.PAUSED_POLL_INTERVAL
+        finally:
+            server._pausedSockets.clear()
+
+    def test_close_wakesBlockedLoop(self, createTCPProxyServer) -> None:
+        HOST, PORT, PROXY_HOST, PROXY_PORT, interceptor, server = createTCPProxyServer
+        timeouts = []
+        select = server.selector.select
+        def recordingSelect(timeout=None):
+            timeouts.append(timeout)
+            return select(timeout)
+        server.selector.select = recordingSelect
+
+        thread = threading.Thread(target=server.run, daemon=True)
+        thread.start()
+        while not timeouts:
+            time.sleep(0.01)
+        ## A reload request is handled straight away, even though the loop is blocked without a timeout
+        server._sigReloadHandler(signal.SIGHUP, None)
+        deadline = time.monotonic() + 5
+        while server._reloadFlag and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert server._reloadFlag is False
+
+        server.close()
+        thread.join(timeout=5)
+        assert not thread.is_alive()
+        assert set(timeouts) == {None}
+
+    def test_sigHandler_onLoopThread(self, createTCPProxyServer) -> None:
+        HOST, PORT, PROXY_HOST, PROXY_PORT, interceptor, server = createTCPProxyServer
+        select = server.selector.select
+        def interruptedSelect(timeout=None):
+            ## A SIGINT is handled on the loop's thread (as Python runs signal handlers on the main thread)
+            server._sigHandler(signal.SIGINT, None)
+            return select(timeout)
+        server.selector.select = interruptedSelect
+
+        thread = threading.Thread(target=server.run, daemon=True)
+        thread.start()
+        thread.join(timeout=5)
+        assert not thread.is_alive()
+        assert server._terminated.is_set()
+
+    def test_close_nonBlocking(self, createTCPProxyServer) -> None:
+        HOST, PORT, PROXY_HOST, PROXY_PORT, interceptor, server = createTCPProxyServer
+        ## The loop isn't running, so a blocking close() would wait forever
+        server.close(blocking=False)
+        assert server._exitFlag is True and not server._terminated.is_set()
+        server.run()
+        assert server._terminated.is_set()
+
+
+
+
+RELOADABLE_INTERCEPTOR_SOURCE = """
+from _proxyDS import StreamInterceptor
+
+class ReloadableStreamInterceptor(StreamInterceptor):
+    REQUEST_DELIMITERS = [b"\\r\\n"]
+    VERSION = {version}
+
+    def clientToServerHook(self, buffer, request: bytearray) -> None:
+        return None
+
+    def serverToClientHook(self, buffer, response: bytearray) -> None:
+        return None
+"""
+
+@pytest.fixture()
+def createReloadableInterceptorModule(tmp_path, monkeypatch):
+    ## NOTE: Bytecode caching is disabled, as the module is rewritten within the same second
+    monkeypatch.setattr(sys, "dont_write_bytecode", True)
+    monkeypatch.syspath_prepend(str(tmp_path))
+    modulePath = tmp_path / "reloadable_interceptor.py"
+
+    def writeVersion(version: int) -> None:
+        modulePath.write_text(RELOADABLE_INTERCEPTOR_SOURCE.format(version=version))
+
+    writeVersion(1)
+    import reloadable_interceptor
+    yield reloadable_interceptor.ReloadableStreamInterceptor, writeVersion
+    sys.modules.pop("reloadable_interceptor", None)
+
+
+class Test_ProxyServer_interceptorReload:
+    def test_reload_explicitClass(self, createTCPProxyServer) -> None:
+        HOST, PORT, PROXY_HOST, PROXY_PORT, interceptor, server = createTCPProxyServer
+        newInterceptor = PTTestResources.createMockStreamInterceptor()
+
+        ret = server.reloadStreamInterceptor(newInterceptor)
+        assert ret == newInterceptor
+        assert server.streamInterceptor == newInterceptor
+        assert server.proxyConnections.streamInterceptor == newInterceptor
+        TPSTestResources.assertConstantAttributes(server, HOST, PORT, PROXY_HOST, PROXY_PORT, newInterceptor)
+
+    def test_reload_abstractClass(self, createTCPProxyServer) -> None:
+        HOST, PORT, PROXY_HOST, PROXY_PORT, interceptor, server = createTCPProxyServer
+
+        ## An invalid interceptor is rejected, and the current version is kept
+        with pytest.raises(AbstractStreamInterceptorError):
+            server.reloadStreamInterceptor(StreamInterceptor)
+        TPSTestResources.assertConstantAttributes(server, HOST, PORT, PROXY_HOST, PROXY_PORT, interceptor)
+
+    def test_reload_localClass(self, createTCPProxyServer) -> None:
+        HOST, PORT, PROXY_HOST, PROXY_PORT, interceptor, server = createTCPProxyServer
+
+        ## The mock interceptor is defined inside a function, so it can't be re-imported
+        with pytest.raises(UnreloadableStreamInterceptorError) as excInfo:
+            server.reloadStreamInterceptor()
+        assert "Cannot reload" in str(excInfo.value)
+        TPSTestResources.assertConstantAttributes(server, HOST, PORT, PROXY_HOST, PROXY_PORT, interceptor)
+
+    def test_reload_moduleClass(self, createTCPProxyServer, createReloadableInterceptorModule) -> None:
+        HOST, PORT, PROXY_HOST, PROXY_PORT, interceptor, server = createTCPProxyServer
+        interceptorV1, writeVersion = createReloadableInterceptorModule
+        server.reloadStreamInterceptor(interceptorV1)
+
+        writeVersion(2)
+        interceptorV2 = server.reloadStreamInterceptor()
+        assert interceptorV2 is not interceptorV1
+        assert interceptorV2.__qualname__ == interceptorV1.__qualname__
+        assert interceptorV2.VERSION == 2
+        TPSTestResources.assertConstantAttributes(server, HOST, PORT, PROXY_HOST, PROXY_PORT, interceptorV2)
+
+    def test_reload_runtimeAttributes(self, createTCPProxyServer, tmp_path, monkeypatch) -> None:
+        HOST, PORT, PROXY_HOST, PROXY_PORT, interceptor, server = createTCPProxyServer
+        monkeypatch.setattr(sys, "dont_write_bytecode", True)
+        monkeypatch.syspath_prepend(str(tmp_path))
+        (tmp_path / "reloadable_ftp_interceptor.py").write_text(
+            "from ftp_proxyinterceptor import FTPProxyInterceptor\n\n"
+            "class ReloadableFTPInterceptor(FTPProxyInterceptor):\n"
+            "    pass\n")
+        import reloadable_ftp_interceptor
+        try:
+            interceptorV1 = reloadable_ftp_interceptor.ReloadableFTPInterceptor
+            baitCredentialIndex, loginAttemptTracker = object(), object()
+            interceptorV1.BAIT_CREDENTIAL_INDEX = baitCredentialIndex
+            interceptorV1.LOGIN_ATTEMPT_TRACKER = loginAttemptTracker
+            server.reloadStreamInterceptor(interceptorV1)
+
+            ## The module resets the attributes to None, but the configured values survive the reload
+            interceptorV2 = server.reloadStreamInterceptor()
+            assert interceptorV2 is not interceptorV1
+            assert interceptorV2.BAIT_CREDENTIAL_INDEX is baitCredentialIndex
+            assert interceptorV2.LOGIN_ATTEMPT_TRACKER is loginAttemptTracker
+        finally:
+            sys.modules.pop("reloadable_ftp_interceptor", None)
+
+    def test_reload_sighup_liveTunnels(self, createEchoProxyEnvironment, createReloadableInterceptorModule) -> None:
+        echoServer, proxyServerThreadWrapper, proxyServerArgs = createEchoProxyEnvironment
+        proxyServer = proxyServerThreadWrapper.proxyServer
+        interceptorV1, writeVersion = createReloadableInterceptorModule
+        proxyServer.reloadStreamInterceptor(interceptorV1)
+
+        ## A tunnel is created on the first version
+        connections = [TPSTestResources.setupConnection(proxyServer)]
+        echoServer.awaitConnectionCount(1)
+        proxyServerThreadWrapper.awaitConnectionCount(1)
+
+        try:
+            ## SIGHUP re-imports the interceptor module (performed by the event loop)
+            writeVersion(2)
+            os.kill(os.getpid(), signal.SIGHUP)
+            while proxyServer.streamInterceptor is interceptorV1:
+                time.sleep(0.01)
+
+            ## New tunnels use the new version, while the existing tunnel keeps the old version
+            connections.append(TPSTestResources.setupConnection(proxyServer))
+            echoServer.awaitConnectionCount(2)
+            proxyServerThreadWrapper.awaitConnectionCount(2)
+
+            versions = {}
+            for tunnel in set(proxyServer.proxyConnections._sock.values()):
+                versions[tunnel.clientToProxySocket.getpeername()] = tunnel.streamInterceptor.VERSION
+            assert versions[connections[0].getsockname()] == 1
+            assert versions[connections[1].getsockname()] == 2
+
+            ## Both tunnels still forward data
+            for conn in connections:
+                conn.sendall(b"data\r\n")
+            TPSTestResources.assertUserConnectionData(connections, [b"data\r\n", b"data\r\n"])
+        finally:
+            for sock in connections: sock.close()
+
+
+
+
+@pytest.fixture()
+def createMemoryBudgetTunnels(createTCPProxyServer):
+    HOST, PORT, PROXY_HOST, PROXY_PORT, interceptor, proxyServer = createTCPProxyServer
+    ## NOTE: The event loop isn't run - connections are accepted by hand and the buffers are filled directly
+    backendSocket = socket.create_server((PROXY_HOST, PROXY_PORT))
+    clientSockets = []
+
+    def acceptConnections(count: int) -> List[ProxyTunnel]:
+        tunnels = []
+        for _ in range(count):
+            existingTunnels = proxyServer.proxyConnections.tunnels()
+            clientSockets.append(TPSTestResources.setupConnection(proxyServer))
+            proxyServer._acceptConnection()
+            tunnels.extend(proxyServer.proxyConnections.tunnels() - existingTunnels)
+        return tunnels
+
+    yield proxyServer, acceptConnections, clientSockets
+
+    for sock in clientSockets:
+        sock.close()
+    backendSocket.close()
+
+
+MEMORY_BUDGET_OPTIONS = {"memoryBudget": MemoryBudget(softLimit=8000, hardLimit=20000, resumeLimit=4000)}
+
+class Test_ProxyServer_memoryBudget:
+    def _isReading(self, proxyServer: TCPProxyServer, sock: socket.socket) -> bool:
+        return bool(proxyServer.selector.get_key(sock).events & selectors.EVENT_READ)
+
+    @pytest.mark.parametrize("createTCPProxyServer", [MEMORY_BUDGET_OPTIONS], indirect=True)
+    def test_underSoftLimit(self, createMemoryBudgetTunnels) -> None:
+        proxyServer, acceptConnections, _ = createMemoryBudgetTunnels
+        tunnels = acceptConnections(2)
+        for tunnel in tunnels:
+            tunnel.clientToServerBuffer.write(b"a" * 1000)
+
+        proxyServer._enforceMemoryBudget()
+        assert proxyServer._pausedSockets == set()
+        assert all(self._isReading(proxyServer, tunnel.clientToProxySocket) for tunnel in tunnels)
+
+    @pytest.mark.parametrize("createTCPProxyServer", [MEMORY_BUDGET_OPTIONS], indirect=True)
+    def test_overSoftLimit_pausesLargestBuffers(self, createMemoryBudgetTunnels) -> None:
+        proxyServer, acceptConnections, _ = createMemoryBudgetTunnels
+        smallTunnel, largeTunnel = acceptConnections(2)
+        smallTunnel.clientToServerBuffer.write(b"a" * 1500)
+        largeTunnel.serverToClientBuffer.write(b"a" * 3000)
+
+        ## only the largest buffer needs to be paused to cover the excess
+        proxyServer._enforceMemoryBudget()
+        assert proxyServer._pausedSockets == {largeTunnel.proxyToServerSocket}
+        assert not self._isReading(proxyServer, largeTunnel.proxyToServerSocket)
+        assert self._isReading(proxyServer, largeTunnel.clientToProxySocket)
+        assert self._isReading(proxyServer, smallTunnel.clientToProxySocket)
+        assert self._isReading(proxyServer, smallTunnel.proxyToServerSocket)
+
+        ## the paused sockets are resumed once usage drops below the resume limit
+        ## NOTE: The undelimited request is still queued after the pop (so usage > resumeLimit)
+        largeTunnel.serverToClientBuffer.pop(3000)
+        proxyServer._enforceMemoryBudget()
+        assert proxyServer._pausedSockets == {largeTunnel.proxyToServerSocket}
+        proxyServer.proxyConnections.closeTunnel(smallTunnel)
+        proxyServer._enforceMemoryBudget()
+        assert proxyServer._pausedSockets == set()
+        assert self._isReading(proxyServer, largeTunnel.proxyToServerSocket)
+
+    @pytest.mark.parametrize("createTCPProxyServer", [MEMORY_BUDGET_OPTIONS], indirect=True)
+    def test_overHardLimit_refusesConnections(self, createMemoryBudgetTunnels) -> None:
+        proxyServer, acceptConnections, clientSockets = createMemoryBudgetTunnels
+        tunnel, = acceptConnections(1)
+        tunnel.clientToServerBuffer.write(b"a" * 21000)
+
+        acceptConnections(1)
+        assert len(proxyServer.proxyConnections._sock) == 2
+        assert clientSockets[-1].recv(1) == b"" ## the refused client is disconnected
+
+        ## closing the tunnel returns its bytes to the budget
+        proxyServer.proxyConnections.closeTunnel(tunnel)
+        assert proxyServer.memoryBudget.usage == 0
+        acceptConnections(1)
+        assert len(proxyServer.proxyConnections._sock) == 2
+
+    @pytest.mark.parametrize("createTCPProxyServer", [MEMORY_BUDGET_OPTIONS], indirect=True)
+    def test_memoryReport(self, createMemoryBudgetTunnels) -> None:
+        proxyServer, acceptConnections, clientSockets = createMemoryBudgetTunnels
+        tunnels = acceptConnections(2)
+        tunnels[0].clientToServerBuffer.write(b"a" * 100)
+
+        report = proxyServer.memoryReport()
+        assert report["budgetUsage"] == report["total"] == tunnels[0].memoryUsage()["total"]
+        assert report["softLimit"] == 8000 and report["hardLimit"] == 20000
+        assert report["tunnels"][tunnels[0].clientToProxySocket.getpeername()]["clientToServer"] == tunnels[0].clientToServerBuffer.memoryUsage()
+        assert report["tunnels"][tunnels[1].clientToProxySocket.getpeername()]["total"] == 0
+
+
+
+class ThrottlingStreamInterceptor(StreamInterceptor):
+    REQUEST_DELIMITERS = [b"\r\n"]
+    THROTTLED_HOSTS = {"127.0.0.1"}
+
+    @classmethod
+    def acceptsClient(cls, host: str) -> bool:
+        return host not in cls.THROTTLED_HOSTS
+
+    def clientToServerHook(self, buffer: Buffer, request: bytearray) -> None:
+        return None
+
+    def serverToClientHook(self, buffer: Buffer, response: bytearray) -> None:
+        return None
+
+
+class Test_ProxyServer_clientThrottling:
+    @pytest.mark.parametrize("createTCPProxyServer", [{"streamInterceptor": ThrottlingStreamInterceptor}], indirect=True)
+    def test_throttledClient_refused(self, createMemoryBudgetTunnels, monkeypatch) -> None:
+        proxyServer, acceptConnections, clientSockets = createMemoryBudgetTunnels
+        assert acceptConnections(1) == []
+        assert len(proxyServer.proxyConnections._sock) == 0
+        assert clientSockets[-1].recv(1) == b"" ## the throttled client is disconnected
+
+        monkeypatch.setattr(ThrottlingStreamInterceptor, "THROTTLED_HOSTS", set())
+        assert len(acceptConnections(1)) == 1
+
+
+    @pytest.mark.parametrize("createTCPProxyServer", [{"admissionControl": AdmissionControl(rate=0.001, burst=2)}], indirect=True)
+    def test_rateLimitedClient_dropped(self, createMemoryBudgetTunnels) -> None:
+        proxyServer, acceptConnections, clientSockets = createMemoryBudgetTunnels
+        assert len(acceptConnections(2)) == 2
+        ## The client's burst is spent, so it's dropped before a backend connection is made
+        assert acceptConnections(1) == []
+        assert len(proxyServer.proxyConnections._sock) == 4
+        assert clientSockets[-1].recv(1) == b""
+
+
+    def test_deniedClient_closed(self, createMemoryBudgetTunnels) -> None:
+        proxyServer, acceptConnections, clientSockets = createMemoryBudgetTunnels
+        ## NOTE: Set on the server, as the server options are deep copied (and the access list has a lock)
+        proxyServer.accessList = AccessList.fromRules([("deny", "127.0.0.0/8")])
+        assert acceptConnections(1) == []
+        assert len(proxyServer.proxyConnections._sock) == 0
+        assert clientSockets[-1].recv(1) == b""
+
+
+
+BACKEND_POOL_OPTIONS = {"backendPool": BackendPool([Backend("127.0.0.1", 1337), Backend("127.0.0.1", 1338, weight=2)])}
+
+class Test_ProxyServer_backendPool:
+    @pytest.mark.parametrize("createTCPProxyServer", [BACKEND_POOL_OPTIONS], indirect=True)
+    def test_tunnelsBalanced(self, createMemoryBudgetTunnels) -> None:
+        proxyServer, acceptConnections, clientSockets = createMemoryBudgetTunnels
+        with socket.create_server(("127.0.0.1", 1338)):
+            tunnels = acceptConnections(6)
+            ports = [tunnel.proxyToServerSocket.getpeername()[1] for tunnel in tunnels]
+            assert sorted(ports) == [1337, 1337, 1338, 1338, 1338, 1338]
+            assert [backend.activeTunnels for backend in proxyServer.proxyConnections.backendPool.backends] == [2, 4]
+
+            proxyServer.proxyConnections.closeTunnel(tunnels[0])
+            assert sum(backend.activeTunnels for backend in proxyServer.proxyConnections.backendPool.backends) == 5
+
+
+
+@pytest.fixture()
+def createFTPBackend(createTCPProxyServer):
+    HOST, PORT, PROXY_HOST, PROXY_PORT, interceptor, proxyServer = createTCPProxyServer
+    ## NOTE: A minimal FTP server that answers PASV/EPSV/PORT and sends PAYLOAD over the data connection
+    controlServer = socket.create_server((PROXY_HOST, PROXY_PORT))
+    dataAddresses = []
+
+    def serve() -> None:
+        try:
+            conn, _ = controlServer.accept()
+        except OSError:
+            return None
+        with conn:
+            conn.sendall(b"220 Ready\r\n")
+            command = conn.recv(1024)
+            if command.startswith(b"PORT"):
+                numbers = [int(n) for n in command[5:].strip().split(b",")]
+                conn.sendall(b"200 PORT command successful.\r\n")
+                dataAddresses.append((".".join(map(str, numbers[:4])), numbers[4] * 256 + numbers[5]))
+                dataConn = socket.create_connection(dataAddresses[-1])
+            else:
+                dataServer = socket.create_server((PROXY_HOST, 0))
+                port = dataServer.getsockname()[1]
+                dataAddresses.append((PROXY_HOST, port))
+                if command.startswith(b"EPSV"):
+                    conn.sendall(f"229 Entering Extended Passive Mode (|||{port}|)\r\n".encode())
+                else:
+                    conn.sendall(f"227 Entering Passive Mode (127,0,0,1,{port >> 8},{port & 0xFF}).\r\n".encode())
+                dataConn, _ = dataServer.accept()
+                dataServer.close()
+            with dataConn:
+                dataConn.sendall(Test_ProxyServer_ftpDataChannels.PAYLOAD)
+            conn.recv(1024) ## waits until the client disconnects
+
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+    yield dataAddresses
+    controlServer.close()
+    thread.join(timeout=5)
+
+
+class Test_ProxyServer_ftpDataChannels:
+    PAYLOAD = bytes(range(256)) * 4096
+
+    def _receiveAll(self, sock: socket.socket) -> bytes:
+        data = bytearray()
+        while chunk := sock.recv(65536):
+            data += chunk
+        return bytes(data)
+
+    def _awaitDataChannelsClosed(self, proxyServer: TCPProxyServer) -> None:
+        ## Only the control tunnel is left once the data tunnel has been torn down
+        deadline = time.time() + 5
+        while len(proxyServer.proxyConnections._sock) != 2 or proxyServer.proxyConnections._listeners:
+            assert time.time() < deadline
+            time.sleep(0.01)
+
+    @pytest.mark.parametrize("createTCPProxyServer", [
+        {"streamInterceptor": FTPProxyInterceptor},
+        {"streamInterceptor": FTPProxyInterceptor, "edgeTriggered": True},
+    ], indirect=True)
+    @pytest.mark.parametrize("command", [b"PASV\r\n", b"EPSV\r\n"])
+    def test_passiveDataChannel(self, createSingleThreadTCPProxyServer, createFTPBackend, command) -> None:
+        HOST, PORT, PROXY_HOST, PROXY_PORT, interceptor, proxyServerThreadWrapper = createSingleThreadTCPProxyServer
+        dataAddresses = createFTPBackend
+        proxyServerThreadWrapper.run()
+
+        with socket.create_connection((HOST, PORT)) as control:
+            assert control.recv(1024) == b"220 Ready\r\n"
+            control.sendall(command)
+            reply = control.recv(1024)
+            if command.startswith(b"PASV"):
+                assert reply.startswith(b"227 Entering Passive Mode (127,0,0,1,")
+                numbers = [int(n) for n in reply[reply.index(b"(") + 1:reply.index(b")")].split(b",")]
+                port = numbers[4] * 256 + numbers[5]
+            else:
+                assert reply.startswith(b"229 Entering Extended Passive Mode (|||")
+                port = int(reply.split(b"|")[3])
+
+            ## The client is pointed at a proxy-owned listener instead of the backend
+            assert port != dataAddresses[0][1]
+            with socket.create_connection((HOST, port)) as data:
+                assert self._receiveAll(data) == self.PAYLOAD
+            self._awaitDataChannelsClosed(proxyServerThreadWrapper.proxyServer)
+
+    @pytest.mark.parametrize("createTCPProxyServer", [{"streamInterceptor": FTPProxyInterceptor}], indirect=True)
+    def test_activeDataChannel(self, createSingleThreadTCPProxyServer, createFTPBackend) -> None:
+        HOST, PORT, PROXY_HOST, PROXY_PORT, interceptor, proxyServerThreadWrapper = createSingleThreadTCPProxyServer
+        dataAddresses = createFTPBackend
+        proxyServerThreadWrapper.run()
+
+        with socket.create_connection((HOST, PORT)) as control, socket.create_server(("127.0.0.1", 0)) as dataServer:
+            assert control.recv(1024) == b"220 Ready\r\n"
+            port = dataServer.getsockname()[1]
+            control.sendall(f"PORT 127,0,0,1,{port >> 8},{port & 0xFF}\r\n".encode())
+            assert control.recv(1024) == b"200 PORT command successful.\r\n"
+
+            ## The backend was pointed at a proxy-owned listener instead of the client
+            assert dataAddresses[0][1] != port
+            data, _ = dataServer.accept()
+            with data:
+                assert self._receiveAll(data) == self.PAYLOAD
+            self._awaitDataChannelsClosed(proxyServerThreadWrapper.proxyServer)
+
+
+
+class Test_ProxyServer_halfClose:
+    def _awaitTunnelsClosed(self, proxyServer: TCPProxyServer) -> None:
+        deadline = time.time() + 3
+        while len(proxyServer.proxyConnections._sock) != 0:
+            assert time.time() < deadline
+            time.sleep(0.01)
+
+    @pytest.mark.parametrize("createTCPProxyServer", [
+        {"streamInterceptor": FTPProxyInterceptor},
+        {"streamInterceptor": FTPProxyInterceptor, "edgeTriggered": True},
+    ], indirect=True)
+    def test_heldPartialRequest(self, createSingleThreadTCPProxyServer) -> None:
+        HOST, PORT, PROXY_HOST, PROXY_PORT, interceptor, proxyServerThreadWrapper = createSingleThreadTCPProxyServer
+        with socket.create_server((PROXY_HOST, PROXY_PORT)) as backendServer:
+            proxyServerThreadWrapper.run()
+            with socket.create_connection((HOST, PORT)) as client:
+                backend, _ = backendServer.accept()
+                with backend:
+                    backend.settimeout(3)
+                    ## The partial request is held back (it isn't delimited), so it's dropped once the client half-closes
+                    client.sendall(b"USER alice\r\nPASS partial")
+                    client.shutdown(socket.SHUT_WR)
+                    received = bytearray()
+                    while chunk := backend.recv(1024):
+                        received += chunk
+                    assert received == b"USER alice\r\n"
+
+                    ## The other direction keeps flowing until the backend closes as well
+                    backend.sendall(b"331 Please specify the password.\r\n")
+                    assert client.recv(1024) == b"331 Please specify the password.\r\n"
+                    backend.shutdown(socket.SHUT_WR)
+                    client.settimeout(3)
+                    assert client.recv(1024) == b""
+                self._awaitTunnelsClosed(proxyServerThreadWrapper.proxyServer)
 
 
 class Test_ProxyServer_connectionSetup:
@@ -609,6 +1150,142 @@ class Test_ProxyServer_connectionDataHandling:
         raise NotImplementedError()
 
 
+
+class Test_ProxyServer_concurrentLoad:
+    def _assertLoadHandling(self, echoServer, proxyServerThreadWrapper, connectionsToCreate, loadGeneratorArgs, dataTransferArgs):
+        ## Setting up
+        proxyServer = proxyServerThreadWrapper.proxyServer
+        loadGenerator = LoadGenerator(proxyServer.serverSocket.getsockname(), **dataTransferArgs, **loadGeneratorArgs)
+
+        ## Setup the client connections (they're opened by run(), on the arrival schedule)
+        connections = loadGenerator.createConnections(connectionsToCreate)
+
+        ## Assertions
+        try:
+            ## Every connection is driven concurrently (honoring the arrival and chunk timings)
+            latencies = loadGenerator.run(timeout=60)
+            echoServer.awaitConnectionCount(connectionsToCreate)
+            proxyServerThreadWrapper.awaitConnectionCount(connectionsToCreate)
+            assert loadGenerator.receivedData() == loadGenerator.connectionData()
+            connectSummary = loadGenerator.connectSummary()
+            assert connectSummary["count"] == connectionsToCreate
+            if loadGenerator.mode == "open":
+                ## The connections arrive on schedule (rather than all being opened up front)
+                assert connectSummary["arrivalRate"] <= loadGenerator.arrivalRate * 1.05
+
+            ## Every delimited message should have been echoed back (and timed) exactly once
+            expectedMessages = sum(len(connection.messageEnds) for connection in loadGenerator._connections)
+            assert len(latencies) == expectedMessages
+            assert all(latency >= 0 for latency in latencies.values())
+            assert loadGenerator.latencySummary()["count"] == expectedMessages
+
+            TPSTestResources.assertSelectorState(proxyServer, connections)
+            TPSTestResources.assertProxyConnectionsState(proxyServer, connections)
+        except Exception as e:
+            print(f"Assert LoadHandling - Exception raised: {e}")
+            raise e
+        finally:
+            loadGenerator.close()
+
+    def test_multiConnection_manyChunks_closedLoop(self, createEchoProxyEnvironment) -> None:
+        echoServer, proxyServerThreadWrapper, proxyServerArgs = createEchoProxyEnvironment
+        delimiterList = proxyServerThreadWrapper.proxyServer.streamInterceptor.REQUEST_DELIMITERS
+
+        ## PARAMETERS
+        connectionsToCreate = 100
+        testTimeRange = 1 ## the chunk timings are honored (scaled by timeScale)
+        dataSizeRange = (150, 200)
+        messageCountRange = (5, 10)
+        isEndDelimited = False
+        chunkCountRange = (2, 5)
+
+        completeConnSender = DataTransferSimulator.createRandomConnSender(dataSizeRange, messageCountRange, chunkCountRange, delimiterList, isEndDelimited, testTimeRange)
+        dataTransferArgs = {"completeConnSender": completeConnSender}
+        loadGeneratorArgs = {"mode": "closed", "timeScale": 0.5}
+
+        self._assertLoadHandling(echoServer, proxyServerThreadWrapper, connectionsToCreate, loadGeneratorArgs, dataTransferArgs)
+
+    def test_multiConnection_manyChunks_openLoop(self, createEchoProxyEnvironment) -> None:
+        echoServer, proxyServerThreadWrapper, proxyServerArgs = createEchoProxyEnvironment
+        delimiterList = proxyServerThreadWrapper.proxyServer.streamInterceptor.REQUEST_DELIMITERS
+
+        ## PARAMETERS
+        connectionsToCreate = 100
+        testTimeRange = 1
+        dataSizeRange = (150, 200)
+        messageCountRange = (5, 10)
+        isEndDelimited = True
+        chunkCountRange = (2, 5)
+
+        completeConnSender = DataTransferSimulator.createRandomConnSender(dataSizeRange, messageCountRange, chunkCountRange, delimiterList, isEndDelimited, testTimeRange)
+        dataTransferArgs = {"completeConnSender": completeConnSender}
+        loadGeneratorArgs = {"mode": "open", "arrivalRate": 200, "timeScale": 0.5}
+
+        self._assertLoadHandling(echoServer, proxyServerThreadWrapper, connectionsToCreate, loadGeneratorArgs, dataTransferArgs)
+
+    @pytest.mark.parametrize("createTCPProxyServer", [{"edgeTriggered": True}], indirect=True)
+    def test_multiConnection_manyChunks_closedLoop_edgeTriggered(self, createEchoProxyEnvironment) -> None:
+        echoServer, proxyServerThreadWrapper, proxyServerArgs = createEchoProxyEnvironment
+        delimiterList = proxyServerThreadWrapper.proxyServer.streamInterceptor.REQUEST_DELIMITERS
+
+        ## PARAMETERS
+        connectionsToCreate = 100
+        testTimeRange = 1
+        dataSizeRange = (2000, 5000) ## spans several CHUNK_SIZE reads per edge
+        messageCountRange = (5, 10)
+        isEndDelimited = False
+        chunkCountRange = (2, 5)
+
+        completeConnSender = DataTransferSimulator.createRandomConnSender(dataSizeRange, messageCountRange, chunkCountRange, delimiterList, isEndDelimited, testTimeRange)
+        dataTransferArgs = {"completeConnSender": completeConnSender}
+        loadGeneratorArgs = {"mode": "closed", "timeScale": 0.5}
+
+        self._assertLoadHandling(echoServer, proxyServerThreadWrapper, connectionsToCreate, loadGeneratorArgs, dataTransferArgs)
+
+    ## NOTE: The mock interceptor is "inline", so every delimited message is held until its hook has run
+    @pytest.mark.parametrize("createTCPProxyServer", [{"hookWorkers": 4}, {"hookWorkers": 4, "edgeTriggered": True}], indirect=True)
+    def test_multiConnection_manyChunks_closedLoop_hookWorkers(self, createEchoProxyEnvironment) -> None:
+        echoServer, proxyServerThreadWrapper, proxyServerArgs = createEchoProxyEnvironment
+        delimiterList = proxyServerThreadWrapper.proxyServer.streamInterceptor.REQUEST_DELIMITERS
+
+        ## PARAMETERS
+        connectionsToCreate = 50
+        testTimeRange = 1
+        dataSizeRange = (2000, 5000)
+        messageCountRange = (5, 10)
+        isEndDelimited = False
+        chunkCountRange = (2, 5)
+
+        completeConnSender = DataTransferSimulator.createRandomConnSender(dataSizeRange, messageCountRange, chunkCountRange, delimiterList, isEndDelimited, testTimeRange)
+        dataTransferArgs = {"completeConnSender": completeConnSender}
+        loadGeneratorArgs = {"mode": "closed", "timeScale": 0.5}
+
+        self._assertLoadHandling(echoServer, proxyServerThreadWrapper, connectionsToCreate, loadGeneratorArgs, dataTransferArgs)
+
+    ## NOTE: Every delimited message is held back (in its tunnel direction) until its hook has been awaited
+    @pytest.mark.parametrize("createTCPProxyServer", [
+        {"streamInterceptor": PTTestResources.createMockAsyncStreamInterceptor()},
+        {"streamInterceptor": PTTestResources.createMockAsyncStreamInterceptor(), "edgeTriggered": True},
+    ], indirect=True)
+    def test_multiConnection_manyChunks_closedLoop_awaitableHooks(self, createEchoProxyEnvironment) -> None:
+        echoServer, proxyServerThreadWrapper, proxyServerArgs = createEchoProxyEnvironment
+        delimiterList = proxyServerThreadWrapper.proxyServer.streamInterceptor.REQUEST_DELIMITERS
+
+        ## PARAMETERS
+        connectionsToCreate = 50
+        testTimeRange = 1
+        dataSizeRange = (2000, 5000)
+        messageCountRange = (5, 10)
+        isEndDelimited = False
+        chunkCountRange = (2, 5)
+
+        completeConnSender = DataTransferSimulator.createRandomConnSender(dataSizeRange, messageCountRange, chunkCountRange, delimiterList, isEndDelimited, testTimeRange)
+        dataTransferArgs = {"completeConnSender": completeConnSender}
+        loadGeneratorArgs = {"mode": "closed", "timeScale": 0.5}
+
+        self._assertLoadHandling(echoServer, proxyServerThreadWrapper, connectionsToCreate, loadGeneratorArgs, dataTransferArgs)
+
+
 #
 # class Test_ProxyServer_connectionTermination:
 #     ...
\ No newline at end of file
@@ -0,0 +1,95 @@
+import os
+import sys
+import ipaddress
+import random
+import pytest
+
+
+sys.path.insert(0, os.path.join("..", "src"))
+sys.path.insert(0, "src")
+from _accessList import AccessList, PrefixTree
+from _exceptions import *
+
+
+def writeRules(path, text):
+    path.write_text(text)
+    return str(path)
+
+
+class Test_AccessList_PrefixTree:
+    def test_longestMatch(self):
+        tree = PrefixTree(32)
+        for cidr, value in [("10.0.0.0/8", "a"), ("10.1.0.0/16", "b"), ("10.1.2.0/24", "c"), ("10.1.2.3/32", "d")]:
+            network = ipaddress.ip_network(cidr)
+            tree.insert(int(network.network_address), network.prefixlen, value)
+        lookup = lambda host: tree.lookup(int(ipaddress.ip_address(host)))
+        assert [lookup(host) for host in ("10.1.2.3", "10.1.2.4", "10.1.3.1", "10.2.0.1", "11.0.0.1")] == ["d", "c", "b", "a", None]
+        assert len(tree) == 4
+
+    def test_splitOrder(self):
+        ## A shorter prefix inserted after a longer one splits its node
+        tree = PrefixTree(32)
+        tree.insert(int(ipaddress.ip_address("192.168.1.0")), 24, "long")
+        tree.insert(int(ipaddress.ip_address("192.168.2.0")), 24, "sibling")
+        tree.insert(int(ipaddress.ip_address("192.168.0.0")), 16, "short")
+        tree.insert(0, 0, "default")
+        lookup = lambda host: tree.lookup(int(ipaddress.ip_address(host)))
+        assert [lookup(host) for host in ("192.168.1.9", "192.168.2.9", "192.168.3.9", "8.8.8.8")] == ["long", "sibling", "short", "default"]
+
+    def test_matchesBruteForce(self):
+        rng = random.Random(7)
+        networks = {ipaddress.ip_network((rng.getrandbits(32), rng.randint(0, 32)), strict=False) for _ in range(2000)}
+        tree = PrefixTree(32)
+        for network in networks:
+            tree.insert(int(network.network_address), network.prefixlen, str(network))
+        hosts = [ipaddress.ip_address(rng.getrandbits(32)) for _ in range(500)]
+        hosts += [network.network_address + rng.randrange(network.num_addresses) for network in list(networks)[:500]]
+        for host in hosts:
+            matches = [network for network in networks if host in network]
+            expected = str(max(matches, key=lambda network: network.prefixlen)) if matches else None
+            assert tree.lookup(int(host)) == expected
+
+
+class Test_AccessList_Rules:
+    def test_allowDeny(self):
+        accessList = AccessList.fromRules([("deny", "10.0.0.0/8"), ("allow", "10.1.0.0/16"), ("deny", "2001:db8::/32")])
+        assert not accessList.allows("10.0.0.1")
+        assert accessList.allows("10.1.0.1")
+        assert accessList.allows("192.0.2.1")
+        assert not accessList.allows("2001:db8::1")
+        assert accessList.allows("2001:db9::1")
+        assert accessList.allows("localhost")
+
+    def test_allowlist(self):
+        accessList = AccessList.fromRules([("deny", "0.0.0.0/0"), ("allow", "127.0.0.0/8")])
+        assert accessList.allows("127.0.0.1") and not accessList.allows("192.0.2.1")
+
+    def test_file(self, tmp_path):
+        path = writeRules(tmp_path / "blocklist", "# scanners\n198.51.100.0/24\ndeny 203.0.113.7  # one host\n\nallow 198.51.100.1\n")
+        accessList = AccessList(path)
+        assert len(accessList) == 3
+        assert not accessList.allows("198.51.100.2") and accessList.allows("198.51.100.1")
+        assert not accessList.allows("203.0.113.7")
+
+    def test_reload(self, tmp_path):
+        path = writeRules(tmp_path / "blocklist", "198.51.100.0/24\n")
+        accessList = AccessList(path)
+        assert accessList.reload() is False
+        ## The rules are replaced out of place
+        writeRules(tmp_path / "blocklist.new", "203.0.113.0/24\n")
+        os.replace(tmp_path / "blocklist.new", path)
+        assert accessList.reload() is True
+        assert accessList.allows("198.51.100.1") and not accessList.allows("203.0.113.1")
+
+    def test_invalidReload_keepsRules(self, tmp_path):
+        path = writeRules(tmp_path / "blocklist", "198.51.100.0/24\n")
+        accessList = AccessList(path)
+        writeRules(tmp_path / "blocklist", "198.51.100.0/24\nblock 203.0.113.0/24\n")
+        with pytest.raises(InvalidAccessListError):
+            accessList.reload()
+        assert not accessList.allows("198.51.100.1") and accessList.allows("203.0.113.1")
+
+    @pytest.mark.parametrize("text", ["300.0.0.0/8\n", "deny 10.0.0.0/8 extra\n"])
+    def test_invalid(self, tmp_path, text):
+        with pytest.raises(InvalidAccessListError):
+            AccessList(writeRules(tmp_path / "blocklist", text))
@@ -0,0 +1,69 @@
+import os
+import sys
+import pytest
+
+
+sys.path.insert(0, os.path.join("..", "src"))
+sys.path.insert(0, "src")
+from _admissionControl import AdmissionControl, TokenBucketTable
+from _exceptions import *
+
+
+class Test_AdmissionControl_TokenBuckets:
+    def test_burstThenRate(self):
+        admission = AdmissionControl(rate=2, burst=3)
+        assert [admission.admits("10.0.0.1", now=0.0) for _ in range(4)] == [True, True, True, False]
+        ## Refilled at `rate` tokens per second
+        assert admission.admits("10.0.0.1", now=0.25) is False
+        assert admission.admits("10.0.0.1", now=0.5) is True
+        assert admission.admits("10.0.0.1", now=0.5) is False
+        ## ... up to `burst` tokens
+        assert [admission.admits("10.0.0.1", now=100.0) for _ in range(4)] == [True, True, True, False]
+
+    def test_clientsSeparate(self):
+        admission = AdmissionControl(rate=1, burst=1)
+        assert admission.admits("10.0.0.1", now=0.0)
+        assert not admission.admits("10.0.0.1", now=0.0)
+        assert admission.admits("10.0.0.2", now=0.0)
+
+    def test_lruBounded(self):
+        table = TokenBucketTable(rate=1, burst=1, maxEntries=2)
+        table.bucket("a", 0.0)[0] -= 1
+        table.bucket("b", 0.0)
+        table.bucket("a", 0.0)
+        ## "b" is the least recently used, so it's the one evicted
+        table.bucket("c", 0.0)
+        assert len(table) == 2 and list(table._buckets) == ["a", "c"]
+        assert table.bucket("a", 0.0)[0] == 0
+
+
+class Test_AdmissionControl_Prefixes:
+    def test_prefixShared(self):
+        admission = AdmissionControl(rate=1, burst=2, prefixRate=1, prefixBurst=3)
+        clients = ["192.0.2.1", "192.0.2.2", "192.0.2.3", "192.0.2.4"]
+        assert [admission.admits(client, now=0.0) for client in clients] == [True, True, True, False]
+        ## A different /24 has its own bucket
+        assert admission.admits("192.0.3.1", now=0.0)
+
+    def test_droppedByPrefix_keepsHostToken(self):
+        admission = AdmissionControl(rate=1, burst=1, prefixRate=1, prefixBurst=1)
+        assert admission.admits("192.0.2.1", now=0.0)
+        assert not admission.admits("192.0.2.2", now=0.0)
+        assert admission._hosts.bucket("192.0.2.2", 0.0)[0] == 1
+
+    def test_ipv6Prefix(self):
+        admission = AdmissionControl(rate=1, burst=1, prefixRate=1, prefixBurst=1, prefixLength6=64)
+        assert admission.admits("2001:db8::1", now=0.0)
+        assert not admission.admits("2001:db8::2", now=0.0)
+        assert admission.admits("2001:db8:0:1::1", now=0.0)
+
+    @pytest.mark.parametrize("options", [
+        {"rate": 0, "burst": 1},
+        {"rate": 1, "burst": -1},
+        {"rate": 1, "burst": 1, "prefixRate": 0},
+        {"rate": 1, "burst": 1, "prefixLength": 33},
+        {"rate": 1, "burst": 1, "maxEntries": 0},
+    ])
+    def test_invalid(self, options):
+        with pytest.raises(InvalidAdmissionControlError):
+            AdmissionControl(**options)
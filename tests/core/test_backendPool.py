@@ -0,0 +1,260 @@
+import os
+import sys
+import collections
+import socket
+import pytest
+
+
+sys.path.insert(0, os.path.join("..", "src"))
+sys.path.insert(0, "src")
+from _backendPool import Backend, BackendPool, BackendProber, BREAKER_CLOSED, BREAKER_HALF_OPEN, BREAKER_OPEN
+from _exceptions import *
+
+
+def createBackends(*weights):
+    return [Backend("127.0.0.1", 9000 + index, weight) for index, weight in enumerate(weights)]
+
+
+class Test_BackendPool_Init:
+    def test_single(self):
+        pool = BackendPool.single("127.0.0.1", 80)
+        assert len(pool) == 1
+        assert pool.pick("10.0.0.1").address == ("127.0.0.1", 80)
+
+    @pytest.mark.parametrize("backends, strategy", [
+        ([], "round-robin"),
+        (createBackends(1), "random"),
+        (createBackends(1, 0), "round-robin"),
+        (createBackends(1, 1.5), "least-active"),
+    ])
+    def test_invalid(self, backends, strategy):
+        with pytest.raises(InvalidBackendPoolError):
+            BackendPool(backends, strategy)
+
+    def test_invalidAddress(self):
+        with pytest.raises(ValueError):
+            BackendPool([Backend("localhost", 80)])
+        with pytest.raises(InvalidProxyPortError):
+            BackendPool([Backend("127.0.0.1", -1)])
+
+    @pytest.mark.parametrize("options", [
+        {"failureThreshold": 0},
+        {"failureWindow": 0},
+        {"openSeconds": -1},
+        {"connectTimeout": "1"},
+    ])
+    def test_invalidBreaker(self, options):
+        with pytest.raises(InvalidBackendPoolError):
+            BackendPool(createBackends(1), **options)
+
+
+class Test_BackendPool_RoundRobin:
+    def test_unweighted(self):
+        backends = createBackends(1, 1, 1)
+        pool = BackendPool(backends)
+        assert [pool.pick() for _ in range(6)] == backends * 2
+
+    def test_weighted(self):
+        backends = createBackends(5, 1, 1)
+        pool = BackendPool(backends)
+        picks = [pool.pick() for _ in range(14)]
+        assert collections.Counter(picks) == {backends[0]: 10, backends[1]: 2, backends[2]: 2}
+        ## The heavier backend's turns are spread over the cycle
+        assert picks[:7] == [backends[0], backends[0], backends[1], backends[0], backends[2], backends[0], backends[0]]
+
+
+class Test_BackendPool_LeastActive:
+    def test_fewestTunnels(self):
+        backends = createBackends(1, 1, 1)
+        pool = BackendPool(backends, "least-active")
+        for _ in range(6):
+            pool.acquire(pool.pick())
+        assert [backend.activeTunnels for backend in backends] == [2, 2, 2]
+
+        pool.release(backends[1])
+        pool.release(backends[1])
+        assert pool.pick() is backends[1]
+        pool.acquire(backends[1])
+        assert pool.pick() is backends[1]
+
+    def test_weighted(self):
+        backends = createBackends(3, 1)
+        pool = BackendPool(backends, "least-active")
+        for _ in range(8):
+            pool.acquire(pool.pick())
+        assert [backend.activeTunnels for backend in backends] == [6, 2]
+
+    def test_manyBackends(self):
+        backends = createBackends(*[1] * 20)
+        pool = BackendPool(backends, "least-active")
+        for _ in range(100):
+            pool.acquire(pool.pick())
+        for backend in backends[5:15]:
+            pool.release(backend)
+        assert pool.pick() in backends[5:15]
+        assert pool.pick().activeTunnels == min(backend.activeTunnels for backend in backends)
+
+
+class Test_BackendPool_ConsistentHash:
+    def test_stickyClients(self):
+        pool = BackendPool(createBackends(1, 1, 1), "consistent-hash")
+        clients = [f"10.0.{i // 256}.{i % 256}" for i in range(300)]
+        picks = [pool.pick(client) for client in clients]
+        assert picks == [pool.pick(client) for client in clients]
+        ## Every backend gets a share of the clients
+        assert len(set(picks)) == 3
+
+    def test_addedBackend_movesFewClients(self):
+        backends = createBackends(1, 1, 1, 1)
+        before = BackendPool(backends[:3], "consistent-hash")
+        after = BackendPool(backends, "consistent-hash")
+        clients = [f"10.1.{i // 256}.{i % 256}" for i in range(1000)]
+        moved = [client for client in clients if before.pick(client).port != after.pick(client).port]
+        ## The clients that move, move to the new backend (about 1/4 of them)
+        assert all(after.pick(client) is backends[3] for client in moved)
+        assert 100 < len(moved) < 400
+
+    def test_noClientHost(self):
+        backends = createBackends(1, 1)
+        pool = BackendPool(backends, "consistent-hash")
+        assert [pool.pick() for _ in range(2)] == backends
+
+
+
+def tripBackend(pool, backend, now=0.0):
+    for _ in range(pool.failureThreshold):
+        pool.recordFailure(backend, now)
+
+
+class Test_BackendPool_CircuitBreaker:
+    def test_failuresTrip(self):
+        backends = createBackends(1, 1)
+        pool = BackendPool(backends, failureThreshold=3, failureWindow=10)
+        pool.recordFailure(backends[0], 0.0)
+        pool.recordFailure(backends[0], 5.0)
+        ## The first failure has left the window
+        pool.recordFailure(backends[0], 10.0)
+        assert backends[0].state == BREAKER_CLOSED
+        pool.recordFailure(backends[0], 11.0)
+        assert backends[0].state == BREAKER_OPEN
+        assert [pool.pick(now=12.0) for _ in range(3)] == [backends[1]] * 3
+
+    def test_allOpen_failFast(self):
+        pool = BackendPool.single("127.0.0.1", 80)
+        tripBackend(pool, pool.backends[0])
+        assert pool.pick(now=1.0) is None
+
+    def test_halfOpen_trialCloses(self):
+        backend = createBackends(1)[0]
+        pool = BackendPool([backend], openSeconds=5)
+        tripBackend(pool, backend)
+        assert pool.pick(now=4.0) is None
+        ## A single trial is let through once the circuit has been open for openSeconds
+        assert pool.pick(now=5.0) is backend and backend.state == BREAKER_HALF_OPEN
+        assert pool.pick(now=6.0) is None
+        pool.recordSuccess(backend)
+        assert backend.state == BREAKER_CLOSED
+        assert pool.pick(now=6.0) is backend
+
+    def test_halfOpen_trialReopens(self):
+        backend = createBackends(1)[0]
+        pool = BackendPool([backend], openSeconds=5)
+        tripBackend(pool, backend)
+        assert pool.pick(now=5.0) is backend
+        pool.recordFailure(backend, 5.0)
+        assert backend.state == BREAKER_OPEN
+        assert pool.pick(now=9.0) is None
+        assert pool.pick(now=10.0) is backend
+
+    def test_halfOpen_lostTrialRetried(self):
+        backend = createBackends(1)[0]
+        pool = BackendPool([backend], openSeconds=5)
+        tripBackend(pool, backend)
+        assert pool.pick(now=5.0) is backend
+        assert pool.pick(now=10.0) is backend
+
+    @pytest.mark.parametrize("strategy", BackendPool.STRATEGIES)
+    def test_strategiesSkipOpen(self, strategy):
+        backends = createBackends(1, 1, 1)
+        pool = BackendPool(backends, strategy)
+        tripBackend(pool, backends[1])
+        clients = [f"10.2.0.{i}" for i in range(60)]
+        picks = set()
+        for client in clients:
+            backend = pool.pick(client, now=1.0)
+            pool.acquire(backend)
+            picks.add(backend)
+        assert picks == {backends[0], backends[2]}
+
+        ## The closed circuit gets its tunnels again
+        pool.recordSuccess(backends[1])
+        if strategy == "least-active":
+            assert pool.pick(now=1.0) is backends[1]
+        else:
+            assert backends[1] in {pool.pick(client, now=1.0) for client in clients}
+
+
+class Test_BackendPool_Exclude:
+    @pytest.mark.parametrize("strategy", BackendPool.STRATEGIES)
+    def test_excludedSkipped(self, strategy):
+        backends = createBackends(1, 1, 1)
+        pool = BackendPool(backends, strategy)
+        ## Each retry gets a backend that hasn't been tried yet, until none are left
+        tried = set()
+        for _ in range(len(backends)):
+            backend = pool.pick("10.3.0.1", exclude=tried)
+            assert backend is not None and backend not in tried
+            tried.add(backend)
+        assert pool.pick("10.3.0.1", exclude=tried) is None
+        ## The backends aren't excluded from other picks
+        assert pool.pick("10.3.0.1") in backends
+
+    def test_leastActive_nextLeastLoaded(self):
+        backends = createBackends(1, 1, 1, 1)
+        pool = BackendPool(backends, "least-active")
+        for backend, tunnels in zip(backends, (3, 1, 0, 2)):
+            for _ in range(tunnels):
+                pool.acquire(backend)
+        ## The heap is unchanged by a failed connect, so the top is skipped
+        assert pool.pick() is backends[2]
+        assert pool.pick(exclude={backends[2]}) is backends[1]
+        assert pool.pick(exclude={backends[2], backends[1]}) is backends[3]
+
+    def test_consistentHash_nextRingNode(self):
+        backends = createBackends(1, 1, 1)
+        pool = BackendPool(backends, "consistent-hash")
+        client = "10.3.0.2"
+        first = pool.pick(client)
+        second = pool.pick(client, exclude={first})
+        assert second is not first
+        ## The client moves to the same backend as when the first one's circuit is open
+        tripBackend(pool, first)
+        assert pool.pick(client, now=1.0) is second
+
+    def test_singleBackend(self):
+        pool = BackendPool.single("127.0.0.1", 80)
+        assert pool.pick(exclude={pool.backends[0]}) is None
+
+
+class Test_BackendPool_Prober:
+    def test_probe(self):
+        with socket.create_server(("127.0.0.1", 0)) as server:
+            backends = [Backend("127.0.0.1", server.getsockname()[1]), Backend("127.0.0.1", 1)]
+            pool = BackendPool(backends, failureThreshold=1)
+            prober = BackendProber(pool, timeout=1)
+            assert prober.probe(backends[0]) and not prober.probe(backends[1])
+
+    def test_applyResults(self):
+        backends = createBackends(1, 1)
+        pool = BackendPool(backends, failureThreshold=1)
+        tripBackend(pool, backends[0])
+        prober = BackendProber(pool)
+        prober._results.extend([(backends[0], True), (backends[1], False)])
+        ## The results are only recorded once applied (by the event loop)
+        assert [backend.state for backend in backends] == [BREAKER_OPEN, BREAKER_CLOSED]
+        prober.applyResults()
+        assert [backend.state for backend in backends] == [BREAKER_CLOSED, BREAKER_OPEN]
+
+    def test_invalid(self):
+        with pytest.raises(InvalidBackendPoolError):
+            BackendProber(BackendPool(createBackends(1)), interval=0)
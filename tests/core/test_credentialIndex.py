@@ -0,0 +1,121 @@
+import os
+import sys
+import time
+import pytest
+
+
+sys.path.insert(0, os.path.join("..", "src"))
+sys.path.insert(0, "src")
+from _credentialIndex import BaitCredentialIndex, INDEX_HEADER, credentialDigest, _bloomBitIndexes
+from _exceptions import *
+
+
+## Fixtures
+@pytest.fixture(scope="function")
+def createBaitCredentials():
+    return [(f"user{i}", f"password{i}") for i in range(10000)]
+
+
+@pytest.fixture(scope="function")
+def createIndexPath(tmp_path):
+    return str(tmp_path / "bait.idx")
+
+
+class Test_BaitCredentialIndex_Build:
+    def test_build_emptyIndex(self, createIndexPath):
+        index = BaitCredentialIndex.build(createIndexPath, [])
+        assert len(index) == 0
+        assert index.contains("user", "password") is False
+
+    def test_build_duplicatedCredentials(self, createIndexPath):
+        index = BaitCredentialIndex.build(createIndexPath, [("user", "password")] * 3)
+        assert len(index) == 1
+
+    def test_build_noPlaintext(self, createIndexPath):
+        BaitCredentialIndex.build(createIndexPath, [("baituser", "baitpassword")])
+        with open(createIndexPath, "rb") as f:
+            data = f.read()
+        assert b"baituser" not in data and b"baitpassword" not in data
+
+    @pytest.mark.parametrize("falsePositiveRate", [0, 1, -0.5, 2])
+    def test_build_invalidFalsePositiveRate(self, createIndexPath, falsePositiveRate):
+        with pytest.raises(InvalidBloomFilterRateError) as excInfo:
+            BaitCredentialIndex.build(createIndexPath, [], falsePositiveRate=falsePositiveRate)
+        assert "false positive rate" in str(excInfo.value)
+
+    def test_open_invalidFile(self, createIndexPath):
+        with open(createIndexPath, "wb") as f:
+            f.write(b"\0" * INDEX_HEADER.size)
+        with pytest.raises(InvalidCredentialIndexError) as excInfo:
+            BaitCredentialIndex(createIndexPath)
+        assert "unknown format" in str(excInfo.value)
+
+    def test_open_truncatedFile(self, createIndexPath, createBaitCredentials):
+        BaitCredentialIndex.build(createIndexPath, createBaitCredentials)
+        with open(createIndexPath, "r+b") as f:
+            f.truncate(os.path.getsize(createIndexPath) - 1)
+        with pytest.raises(InvalidCredentialIndexError) as excInfo:
+            BaitCredentialIndex(createIndexPath)
+        assert "doesn't match the header" in str(excInfo.value)
+
+
+class Test_BaitCredentialIndex_Lookup:
+    def test_contains_baitCredentials(self, createIndexPath, createBaitCredentials):
+        index = BaitCredentialIndex.build(createIndexPath, createBaitCredentials)
+        assert len(index) == len(createBaitCredentials)
+        assert all(index.contains(username, password) for username, password in createBaitCredentials)
+
+    def test_contains_otherCredentials(self, createIndexPath, createBaitCredentials):
+        index = BaitCredentialIndex.build(createIndexPath, createBaitCredentials)
+        assert index.contains("user1", "password2") is False
+        assert index.contains("user1", "") is False
+        ## NOTE: The separator prevents ("ab", "c") and ("a", "bc") from sharing a digest
+        index = BaitCredentialIndex.build(createIndexPath, [("ab", "c")])
+        assert index.contains("a", "bc") is False
+
+    def test_contains_bloomFalsePositiveRate(self, createIndexPath, createBaitCredentials):
+        index = BaitCredentialIndex.build(createIndexPath, createBaitCredentials, falsePositiveRate=0.01)
+        state = index._state
+        ## Count the lookups that pass the bloom filter, despite not being bait credentials
+        bloomPasses = 0
+        for i in range(10000):
+            digest = credentialDigest(f"other{i}", "password", index.key)
+            bitIndexes = _bloomBitIndexes(digest, state.bloomBits, state.bloomHashes)
+            if all(state.mapping[state.bloomOffset + (bit >> 3)] & (1 << (bit & 7)) for bit in bitIndexes):
+                bloomPasses += 1
+        assert bloomPasses < 10000 * 0.03
+
+    def test_contains_keyedIndex(self, createIndexPath):
+        BaitCredentialIndex.build(createIndexPath, [("user", "password")], key=b"secret")
+        assert BaitCredentialIndex(createIndexPath, key=b"secret").contains("user", "password") is True
+        assert BaitCredentialIndex(createIndexPath, key=b"other").contains("user", "password") is False
+
+
+class Test_BaitCredentialIndex_Reload:
+    def test_reload_unchanged(self, createIndexPath, createBaitCredentials):
+        index = BaitCredentialIndex.build(createIndexPath, createBaitCredentials)
+        assert index.reload() is False
+
+    def test_reload_rebuiltIndex(self, createIndexPath):
+        index = BaitCredentialIndex.build(createIndexPath, [("user", "old")])
+        BaitCredentialIndex.build(createIndexPath, [("user", "new")])
+
+        ## the old mapping stays usable until the index is reloaded
+        assert index.contains("user", "old") is True
+        assert index.reload() is True
+        assert index.contains("user", "old") is False
+        assert index.contains("user", "new") is True
+
+    def test_reloadIfChanged_rateLimited(self, createIndexPath):
+        index = BaitCredentialIndex.build(createIndexPath, [("user", "old")])
+        index.RELOAD_CHECK_INTERVAL = 60
+        index._lastReloadCheck = time.monotonic()
+        BaitCredentialIndex.build(createIndexPath, [("user", "new")])
+
+        assert index.isReloadDue() is False
+        assert index.reloadIfChanged() is False
+        assert index.contains("user", "old") is True
+        index._lastReloadCheck -= 60
+        assert index.isReloadDue() is True
+        assert index.reloadIfChanged() is True
+        assert index.contains("user", "new") is True
@@ -0,0 +1,119 @@
+import os
+import sys
+import pytest
+
+
+sys.path.insert(0, os.path.join("..", "src"))
+sys.path.insert(0, "src")
+from _ftpParser import FTPReplyFramer, commandVerb, commandArgument, replyCode, isMultilineReplyStart
+from _ftpParser import parseHostPort, formatHostPort, parseExtendedPort, parseExtendedAddress, formatExtendedAddress
+
+
+class Test_FTPParser_Commands:
+    @pytest.mark.parametrize("message, verb", [
+        (b"USER anonymous\r\n", b"USER"),
+        (bytearray(b"pass secret\r\n"), b"PASS"),
+        (b"  Acct account\r\n", b"ACCT"),
+        (b"CWD /pub\r\n", b"CWD"),
+        (b"PWD\r\n", b"PWD"),
+        (b"PWD", b"PWD"),
+        (b"EPSV\r\n", b"EPSV"),
+        (memoryview(b"QUIT\r\n"), b"QUIT"),
+    ])
+    def test_commandVerb(self, message, verb):
+        assert commandVerb(message) == verb
+
+    @pytest.mark.parametrize("message", [b"", b"US", b"USERS x\r\n", b"CWDX /\r\n", b"XYZW\r\n", b"230 OK\r\n"])
+    def test_commandVerb_unknown(self, message):
+        assert commandVerb(message) is None
+
+    @pytest.mark.parametrize("message, argument", [
+        (b"USER anonymous\r\n", b"anonymous"),
+        (b"PASS two words \r\n", b"two words"),
+        (b" CWD /pub\r\n", b"/pub"),
+        (b"NOOP\r\n", b""),
+        (b"XYZW arg\r\n", b""),
+    ])
+    def test_commandArgument(self, message, argument):
+        assert commandArgument(message) == argument
+
+
+class Test_FTPParser_Replies:
+    @pytest.mark.parametrize("message, code", [
+        (b"230 Login successful.\r\n", 230),
+        (bytearray(b"331-Please\r\n"), 331),
+        (b"550\r\n", 550),
+        (b"125", 125),
+        (b"554 Custom.\r\n", 554),
+    ])
+    def test_replyCode(self, message, code):
+        assert replyCode(message) == code
+
+    @pytest.mark.parametrize("message", [b"", b"23", b"630 x\r\n", b"099 x\r\n", b"260 x\r\n", b"2300 x\r\n", b"abc\r\n", b" 230 x\r\n"])
+    def test_replyCode_invalid(self, message):
+        assert replyCode(message) is None
+
+    def test_isMultilineReplyStart(self):
+        assert isMultilineReplyStart(b"230-Welcome\r\n")
+        assert not isMultilineReplyStart(b"230 Welcome\r\n")
+        assert not isMultilineReplyStart(b"abc-Welcome\r\n")
+
+
+class Test_FTPParser_ReplyFramer:
+    def test_singleLine(self):
+        framer = FTPReplyFramer()
+        assert framer.feed(b"220 Ready\r\n") == (220, b"220 Ready\r\n")
+        assert not framer.inReply()
+
+    def test_multiLine(self):
+        framer = FTPReplyFramer()
+        lines = [b"211-Features:\r\n", b" EPSV\r\n", b"211-is not the end\r\n", b"230 other code\r\n", b"211 End\r\n"]
+        assert all(framer.feed(line) is None for line in lines[:-1])
+        assert framer.inReply()
+        assert framer.feed(lines[-1]) == (211, b"".join(lines))
+        assert not framer.inReply()
+
+        ## The framer is reset for the next reply
+        assert framer.feed(b"200 OK\r\n") == (200, b"200 OK\r\n")
+
+    def test_noReplyCode_ignored(self):
+        framer = FTPReplyFramer()
+        assert framer.feed(b"garbage\r\n") is None
+        assert not framer.inReply()
+
+
+class Test_FTPParser_DataChannels:
+    def test_parseHostPort(self):
+        reply = b"227 Entering Passive Mode (10,0,0,7,195,80).\r\n"
+        host, port, (start, end) = parseHostPort(reply)
+        assert (host, port) == ("10.0.0.7", 50000)
+        assert reply[start:end] == b"10,0,0,7,195,80"
+        assert parseHostPort(b"PORT 127,0,0,1,4,1\r\n")[:2] == ("127.0.0.1", 1025)
+
+    @pytest.mark.parametrize("message", [b"227 Entering Passive Mode.\r\n", b"PORT 127,0,0,1,4\r\n", b"PORT 256,0,0,1,4,1\r\n"])
+    def test_parseHostPort_invalid(self, message):
+        assert parseHostPort(message) is None
+
+    def test_formatHostPort(self):
+        assert formatHostPort("10.0.0.7", 50000) == b"10,0,0,7,195,80"
+        host, port, _ = parseHostPort(formatHostPort("192.168.1.20", 65535))
+        assert (host, port) == ("192.168.1.20", 65535)
+
+    def test_parseExtendedPort(self):
+        reply = b"229 Entering Extended Passive Mode (|||6446|)\r\n"
+        port, (start, end) = parseExtendedPort(reply)
+        assert port == 6446 and reply[start:end] == b"6446"
+        assert parseExtendedPort(b"229 Entering Extended Passive Mode (!!!21!)\r\n")[0] == 21
+        assert parseExtendedPort(b"229 Entering Extended Passive Mode (|1|6446|)\r\n") is None
+
+    def test_parseExtendedAddress(self):
+        command = b"EPRT |1|132.235.1.2|6275|\r\n"
+        host, port, (start, end) = parseExtendedAddress(command)
+        assert (host, port) == ("132.235.1.2", 6275) and command[start:end] == b"|1|132.235.1.2|6275|"
+        assert parseExtendedAddress(b"EPRT |2|1080::8:800:200C:417A|5282|\r\n")[:2] == ("1080::8:800:200C:417A", 5282)
+        assert parseExtendedAddress(b"EPRT |3|132.235.1.2|6275|\r\n") is None
+        assert parseExtendedAddress(b"EPRT |1|132.235.1.2|99999|\r\n") is None
+
+    def test_formatExtendedAddress(self):
+        assert formatExtendedAddress("10.0.0.7", 50000) == b"|1|10.0.0.7|50000|"
+        assert formatExtendedAddress("::1", 21) == b"|2|::1|21|"
@@ -0,0 +1,348 @@
+import asyncio
+import os
+import sys
+import threading
+import types
+import pytest
+
+
+sys.path.insert(0, os.path.join("..", "src"))
+sys.path.insert(0, "src")
+from ftp_proxyinterceptor import FTPProxyInterceptor, FTPLoginSession, FTP_LOGIN_TRANSITIONS
+from ftp_proxyinterceptor import LOGIN_IDLE, LOGIN_AWAIT_PASS, LOGIN_AWAIT_ACCT
+from _proxyDS import AsyncHookRunner, Buffer
+from _credentialIndex import BaitCredentialIndex
+from _loginTracker import LoginAttemptTracker
+from _exceptions import *
+
+
+## Fixtures
+@pytest.fixture(scope="function")
+def createInterceptorBuffers():
+    ## NOTE: The buffers are wired up the same way as in a ProxyTunnel
+    runner = AsyncHookRunner()
+    interceptor = FTPProxyInterceptor()
+    clientToServerBuffer = Buffer(interceptor.REQUEST_DELIMITERS)
+    serverToClientBuffer = Buffer(interceptor.REQUEST_DELIMITERS)
+    clientToServerBuffer.setHook(interceptor.clientToServerHook, asyncHookRunner=runner)
+    serverToClientBuffer.setHook(interceptor.serverToClientHook, asyncHookRunner=runner)
+    yield interceptor, clientToServerBuffer, serverToClientBuffer
+    runner.close()
+
+
+class Test_FTPProxyInterceptor_LoginHook:
+    def _login(self, clientToServerBuffer: Buffer, serverToClientBuffer: Buffer, password: bytes) -> None:
+        clientToServerBuffer.write(b"USER anonymous\r\n")
+        serverToClientBuffer.write(b"331 Please specify the password.\r\n")
+        clientToServerBuffer.write(b"PASS " + password + b"\r\n")
+        serverToClientBuffer.write(b"230 Login successful.\r\n")
+
+    def test_successfulLogin_awaitsCredentialCheck(self, createInterceptorBuffers):
+        interceptor, clientToServerBuffer, serverToClientBuffer = createInterceptorBuffers
+        release, checked = threading.Event(), []
+        async def isBaitCredential(username, password):
+            await asyncio.get_running_loop().run_in_executor(None, release.wait, 5)
+            checked.append((username, password))
+            return True
+        interceptor.isBaitCredential = isBaitCredential
+
+        self._login(clientToServerBuffer, serverToClientBuffer, b"secret")
+
+        ## Only the login reply (serverToClient) is held back while the credentials are checked
+        assert clientToServerBuffer.sendable() == len(clientToServerBuffer._data)
+        assert serverToClientBuffer.sendable() == len(b"331 Please specify the password.\r\n")
+        release.set()
+        assert serverToClientBuffer._lastAwaitedHook.result(timeout=5) is True
+        assert checked == [("anonymous", "secret")]
+        assert serverToClientBuffer.sendable() == len(serverToClientBuffer._data)
+
+    def test_successfulLogin_defaultCredentialCheck(self, createInterceptorBuffers):
+        interceptor, clientToServerBuffer, serverToClientBuffer = createInterceptorBuffers
+        self._login(clientToServerBuffer, serverToClientBuffer, b"secret")
+        assert serverToClientBuffer._lastAwaitedHook.result(timeout=5) is False
+
+    def test_successfulLogin_baitCredentialIndex(self, createInterceptorBuffers, tmp_path, monkeypatch):
+        interceptor, clientToServerBuffer, serverToClientBuffer = createInterceptorBuffers
+        index = BaitCredentialIndex.build(str(tmp_path / "bait.idx"), [("anonymous", "bait")])
+        monkeypatch.setattr(FTPProxyInterceptor, "BAIT_CREDENTIAL_INDEX", index)
+
+        self._login(clientToServerBuffer, serverToClientBuffer, b"bait")
+        assert serverToClientBuffer._lastAwaitedHook.result(timeout=5) is True
+        self._login(clientToServerBuffer, serverToClientBuffer, b"secret")
+        assert serverToClientBuffer._lastAwaitedHook.result(timeout=5) is False
+
+    def test_baitCredentialIndex_reloadedOffLoop(self, createInterceptorBuffers, tmp_path, monkeypatch):
+        interceptor, clientToServerBuffer, serverToClientBuffer = createInterceptorBuffers
+        index = BaitCredentialIndex.build(str(tmp_path / "bait.idx"), [("anonymous", "bait")])
+        reloadThreads = []
+        def reloadIfChanged():
+            reloadThreads.append(threading.current_thread())
+            return BaitCredentialIndex.reloadIfChanged(index)
+        monkeypatch.setattr(index, "reloadIfChanged", reloadIfChanged)
+        monkeypatch.setattr(FTPProxyInterceptor, "BAIT_CREDENTIAL_INDEX", index)
+
+        self._login(clientToServerBuffer, serverToClientBuffer, b"bait")
+        assert serverToClientBuffer._lastAwaitedHook.result(timeout=5) is True
+        ## The file is checked on an executor thread, not on the runner's loop thread
+        assert len(reloadThreads) == 1
+        assert reloadThreads[0] is not serverToClientBuffer._asyncHookRunner._thread
+
+        ## Within RELOAD_CHECK_INTERVAL, the lookup doesn't leave the loop at all
+        self._login(clientToServerBuffer, serverToClientBuffer, b"bait")
+        assert serverToClientBuffer._lastAwaitedHook.result(timeout=5) is True
+        assert len(reloadThreads) == 1
+
+    def test_failedLogin_notHeld(self, createInterceptorBuffers):
+        interceptor, clientToServerBuffer, serverToClientBuffer = createInterceptorBuffers
+        clientToServerBuffer.write(b"USER anonymous\r\n")
+        serverToClientBuffer.write(b"331 Please specify the password.\r\n")
+        clientToServerBuffer.write(b"PASS wrong\r\n")
+        serverToClientBuffer.write(b"530 Login incorrect.\r\n")
+
+        assert serverToClientBuffer._lastAwaitedHook is None
+        assert serverToClientBuffer.sendable() == len(serverToClientBuffer._data)
+
+    def test_greeting_notPaired(self, createInterceptorBuffers):
+        interceptor, clientToServerBuffer, serverToClientBuffer = createInterceptorBuffers
+        serverToClientBuffer.write(b"220 (vsFTPd 3.0.3)\r\n")
+        assert not interceptor._session.responses
+
+        self._login(clientToServerBuffer, serverToClientBuffer, b"secret")
+        assert interceptor._session.username is None
+        assert serverToClientBuffer._lastAwaitedHook.result(timeout=5) is False
+        assert not interceptor._session.requests and not interceptor._session.responses
+
+    def test_multilineReply_pairedOnce(self, createInterceptorBuffers):
+        interceptor, clientToServerBuffer, serverToClientBuffer = createInterceptorBuffers
+        clientToServerBuffer.write(b"USER anonymous\r\n")
+        serverToClientBuffer.write(b"331-Please specify\r\n230 is not the end\r\n331 the password.\r\n")
+        assert interceptor._session.username == "anonymous"
+
+        clientToServerBuffer.write(b"PASS secret\r\n")
+        serverToClientBuffer.write(b"230-Welcome\r\n 230 still welcome\r\n230 Login successful.\r\n")
+        assert serverToClientBuffer._lastAwaitedHook.result(timeout=5) is False
+        assert not interceptor._session.requests and not interceptor._session.responses
+
+
+class Test_FTPProxyInterceptor_LoginStateMachine:
+    def _transition(self, state: int, request: bytes, response: bytes, username: str = None):
+        interceptor, session = FTPProxyInterceptor(), FTPLoginSession()
+        session.state, session.username = state, username
+        session.USERmessages = ("USER anonymous\r\n", "331 Please specify the password.\r\n")
+        session.PASSmessages = ("PASS secret\r\n", "332 Need account for login.\r\n")
+        result = interceptor._advanceLoginState(session, request, response)
+        return session, result
+
+    def test_session_slots(self):
+        session = FTPLoginSession()
+        assert not hasattr(session, "__dict__")
+        assert (session.state, session.username, session.password) == (LOGIN_IDLE, None, None)
+
+    @pytest.mark.parametrize("state", [LOGIN_IDLE, LOGIN_AWAIT_PASS, LOGIN_AWAIT_ACCT])
+    def test_USER_intermediate(self, state):
+        session, result = self._transition(state, b"USER anonymous\r\n", b"331 Please specify the password.\r\n")
+        assert result is None
+        assert (session.state, session.username) == (LOGIN_AWAIT_PASS, "anonymous")
+
+    @pytest.mark.parametrize("response", [b"120 Wait.\r\n", b"230 Logged in.\r\n", b"421 Closing.\r\n", b"530 Not logged in.\r\n"])
+    def test_USER_final(self, response):
+        session, result = self._transition(LOGIN_AWAIT_PASS, b"USER anonymous\r\n", response, "previous")
+        assert result is None
+        assert (session.state, session.username, session.USERmessages) == (LOGIN_IDLE, None, None)
+
+    def test_PASS_success(self):
+        session, result = self._transition(LOGIN_AWAIT_PASS, b"PASS secret\r\n", b"230 Login successful.\r\n", "anonymous")
+        assert asyncio.iscoroutine(result)
+        assert asyncio.run(result) is False
+        assert session.state == LOGIN_IDLE
+
+    def test_PASS_intermediate(self):
+        session, result = self._transition(LOGIN_AWAIT_PASS, b"PASS secret\r\n", b"332 Need account.\r\n", "anonymous")
+        assert result is None
+        assert (session.state, session.password) == (LOGIN_AWAIT_ACCT, "secret")
+
+    @pytest.mark.parametrize("response", [b"150 Wait.\r\n", b"421 Closing.\r\n", b"530 Login incorrect.\r\n"])
+    def test_PASS_final(self, response):
+        session, result = self._transition(LOGIN_AWAIT_PASS, b"pass secret\r\n", response, "anonymous")
+        assert result is None
+        assert (session.state, session.username) == (LOGIN_IDLE, None)
+
+    @pytest.mark.parametrize("response", [b"150 Wait.\r\n", b"230 Logged in.\r\n", b"332 Again.\r\n", b"530 Not logged in.\r\n"])
+    def test_ACCT_final(self, response):
+        session, result = self._transition(LOGIN_AWAIT_ACCT, b"ACCT account\r\n", response, "anonymous")
+        assert result is None
+        assert session.state == LOGIN_IDLE
+
+    @pytest.mark.parametrize("state, ftpRequest", [
+        (LOGIN_IDLE, b"PASS secret\r\n"),
+        (LOGIN_IDLE, b"ACCT account\r\n"),
+        (LOGIN_AWAIT_PASS, b"NOOP\r\n"),
+        (LOGIN_AWAIT_PASS, b"ACCT account\r\n"),
+        (LOGIN_AWAIT_ACCT, b"PASS secret\r\n"),
+    ])
+    def test_noTransition_stateUnchanged(self, state, ftpRequest):
+        session, result = self._transition(state, ftpRequest, b"200 OK.\r\n", "anonymous")
+        assert result is None
+        assert (session.state, session.username) == (state, "anonymous")
+
+    def test_invalidReplyCode_stateUnchanged(self):
+        session, result = self._transition(LOGIN_AWAIT_PASS, b"PASS secret\r\n", b"abc\r\n", "anonymous")
+        assert result is None
+        assert session.state == LOGIN_AWAIT_PASS
+
+    def test_transitionTable_complete(self):
+        ## Every (state, verb) row of the login sequence handles all five reply classes
+        rows = {(state, verb) for state, verb, _ in FTP_LOGIN_TRANSITIONS}
+        assert len(rows) == 5
+        for state, verb in rows:
+            assert all((state, verb, replyClass) in FTP_LOGIN_TRANSITIONS for replyClass in range(1, 6))
+
+
+class Test_FTPProxyInterceptor_LoginAttemptTracker:
+    def _createInterceptor(self, host: str) -> FTPProxyInterceptor:
+        ## NOTE: Only the client's address is needed from the tunnel
+        interceptor = FTPProxyInterceptor()
+        interceptor.proxyTunnel = types.SimpleNamespace(clientToProxySocket=types.SimpleNamespace(getpeername=lambda: (host, 50000)))
+        return interceptor
+
+    def _login(self, interceptor: FTPProxyInterceptor, username: bytes, passwordReply: bytes):
+        interceptor.ftpMessageHook(request=b"USER " + username + b"\r\n")
+        interceptor.ftpMessageHook(response=b"331 Please specify the password.\r\n")
+        interceptor.ftpMessageHook(request=b"PASS secret\r\n")
+        return interceptor.ftpMessageHook(response=passwordReply)
+
+    def test_failuresTrackedAcrossSessions(self, monkeypatch):
+        tracker = LoginAttemptTracker(throttleThreshold=3)
+        monkeypatch.setattr(FTPProxyInterceptor, "LOGIN_ATTEMPT_TRACKER", tracker)
+
+        for username in (b"root", b"admin"):
+            self._login(self._createInterceptor("10.0.0.1"), username, b"530 Login incorrect.\r\n")
+        interceptor = self._createInterceptor("10.0.0.1")
+        interceptor.ftpMessageHook(request=b"USER nobody\r\n")
+        interceptor.ftpMessageHook(response=b"530 Not allowed.\r\n")
+
+        assert tracker.failures("10.0.0.1") == 3
+        assert tracker.failures("10.0.0.1", "root") == 1
+        assert tracker.failures("10.0.0.1", "nobody") == 1
+        assert FTPProxyInterceptor.acceptsClient("10.0.0.1") is False
+        assert FTPProxyInterceptor.acceptsClient("10.0.0.2") is True
+
+    def test_successTracked(self, monkeypatch):
+        tracker = LoginAttemptTracker()
+        monkeypatch.setattr(FTPProxyInterceptor, "LOGIN_ATTEMPT_TRACKER", tracker)
+
+        self._login(self._createInterceptor("10.0.0.1"), b"anonymous", b"230 Login successful.\r\n").close()
+        assert tracker.successes("10.0.0.1", "anonymous") == 1
+        assert tracker.failures("10.0.0.1") == 0
+
+    def test_noTracker_acceptsClients(self):
+        assert FTPProxyInterceptor.LOGIN_ATTEMPT_TRACKER is None
+        assert FTPProxyInterceptor.acceptsClient("10.0.0.1") is True
+
+
+class Test_FTPProxyInterceptor_InspectionCutoff:
+    class _RecordingTunnel:
+        def __init__(self) -> None:
+            self.stopped = 0
+            self.dataChannels = []
+            self.clientToProxySocket = types.SimpleNamespace(getpeername=lambda: ("10.0.0.1", 50000))
+        def stopInspection(self, direction=None) -> None:
+            self.stopped += 1
+        def hasOpenDataChannels(self) -> bool:
+            return bool(self.dataChannels)
+        def openDataChannel(self, targetAddress, acceptFrom="client"):
+            self.dataChannels.append((targetAddress, acceptFrom))
+            return ("10.0.0.9", 2000)
+
+    class NoDataChannelsInterceptor(FTPProxyInterceptor):
+        REWRITES_REQUESTS = False
+
+    def _login(self, interceptor: FTPProxyInterceptor, passwordReply: bytes):
+        interceptor.ftpMessageHook(request=b"USER anonymous\r\n")
+        interceptor.ftpMessageHook(response=b"331 Please specify the password.\r\n")
+        interceptor.ftpMessageHook(request=b"PASS secret\r\n")
+        return interceptor.ftpMessageHook(response=passwordReply)
+
+    def test_success_dataChannelsStillInspected(self):
+        interceptor = FTPProxyInterceptor()
+        interceptor.proxyTunnel = tunnel = self._RecordingTunnel()
+        self._login(interceptor, b"230 Login successful.\r\n").close()
+        assert tunnel.stopped == 0
+
+    def test_success_withoutDataChannels(self):
+        interceptor = self.NoDataChannelsInterceptor()
+        interceptor.proxyTunnel = tunnel = self._RecordingTunnel()
+        self._login(interceptor, b"230 Login successful.\r\n").close()
+        assert tunnel.stopped == 1
+
+    def test_success_openDataChannel(self):
+        interceptor = self.NoDataChannelsInterceptor()
+        interceptor.proxyTunnel = tunnel = self._RecordingTunnel()
+        tunnel.dataChannels.append((("10.0.0.2", 2000), "client"))
+        self._login(interceptor, b"230 Login successful.\r\n").close()
+        assert tunnel.stopped == 0
+
+    def test_maxLoginFailures(self):
+        interceptor = self.NoDataChannelsInterceptor()
+        interceptor.proxyTunnel = tunnel = self._RecordingTunnel()
+        for _ in range(FTPProxyInterceptor.MAX_LOGIN_FAILURES - 1):
+            self._login(interceptor, b"530 Login incorrect.\r\n")
+        assert tunnel.stopped == 0
+        self._login(interceptor, b"530 Login incorrect.\r\n")
+        assert tunnel.stopped == 1
+
+    def test_maxLoginFailures_PORTStillRewritten(self):
+        interceptor = FTPProxyInterceptor()
+        interceptor.proxyTunnel = tunnel = self._RecordingTunnel()
+        clientToServerBuffer = Buffer(interceptor.REQUEST_DELIMITERS, holdUndelimited=True)
+        serverToClientBuffer = Buffer(interceptor.REQUEST_DELIMITERS, holdUndelimited=True)
+        clientToServerBuffer.setHook(interceptor.clientToServerHook)
+        serverToClientBuffer.setHook(interceptor.serverToClientHook)
+        for _ in range(FTPProxyInterceptor.MAX_LOGIN_FAILURES):
+            clientToServerBuffer.write(b"USER anonymous\r\n")
+            serverToClientBuffer.write(b"331 Please specify the password.\r\n")
+            clientToServerBuffer.write(b"PASS wrong\r\n")
+            serverToClientBuffer.write(b"530 Login incorrect.\r\n")
+        clientToServerBuffer.pop(clientToServerBuffer.sendable())
+
+        clientToServerBuffer.write(b"PORT 10,0,0,1,4,1\r\n")
+        assert tunnel.stopped == 0
+        assert tunnel.dataChannels == [(("10.0.0.1", 1025), "server")]
+        sendable = clientToServerBuffer.sendable()
+        assert b"".join(clientToServerBuffer.gather(sendable)) == b"PORT 10,0,0,9,7,208\r\n"
+
+    def _createDataChannelBuffer(self, interceptor: FTPProxyInterceptor) -> Buffer:
+        clientToServerBuffer = Buffer(interceptor.REQUEST_DELIMITERS, holdUndelimited=True)
+        clientToServerBuffer.setHook(interceptor.clientToServerHook)
+        return clientToServerBuffer
+
+    @pytest.mark.parametrize("request_", [b"PORT 10,0,0,7,4,1\r\n", b"EPRT |1|10.0.0.7|1025|\r\n"])
+    def test_activeDataChannel_bounceRefused(self, request_):
+        interceptor = FTPProxyInterceptor()
+        interceptor.proxyTunnel = tunnel = self._RecordingTunnel()
+        clientToServerBuffer = self._createDataChannelBuffer(interceptor)
+
+        ## The address isn't the client's, so the proxy doesn't connect to it, and the server refuses the command
+        clientToServerBuffer.write(request_)
+        assert tunnel.dataChannels == []
+        sendable = clientToServerBuffer.sendable()
+        assert b"".join(clientToServerBuffer.gather(sendable)) == request_[:4] + b"\r\n"
+
+    def test_activeDataChannel_EPRT(self):
+        interceptor = FTPProxyInterceptor()
+        interceptor.proxyTunnel = tunnel = self._RecordingTunnel()
+        clientToServerBuffer = self._createDataChannelBuffer(interceptor)
+
+        clientToServerBuffer.write(b"EPRT |1|10.0.0.1|1025|\r\n")
+        assert tunnel.dataChannels == [(("10.0.0.1", 1025), "server")]
+        sendable = clientToServerBuffer.sendable()
+        assert b"".join(clientToServerBuffer.gather(sendable)) == b"EPRT |1|10.0.0.9|2000|\r\n"
+
+    def test_activeDataChannel_IPv4MappedClient(self):
+        interceptor = FTPProxyInterceptor()
+        interceptor.proxyTunnel = tunnel = self._RecordingTunnel()
+        tunnel.clientToProxySocket = types.SimpleNamespace(getpeername=lambda: ("::ffff:10.0.0.1", 50000, 0, 0))
+        clientToServerBuffer = self._createDataChannelBuffer(interceptor)
+
+        clientToServerBuffer.write(b"PORT 10,0,0,1,4,1\r\n")
+        assert tunnel.dataChannels == [(("10.0.0.1", 1025), "server")]
@@ -0,0 +1,188 @@
+import os
+import sys
+import pytest
+
+
+sys.path.insert(0, os.path.join("..", "src"))
+sys.path.insert(0, "src")
+from _httpFramer import HTTPMessageFramer, HTTPMessageHead
+from _proxyDS import Buffer
+from tcp_proxyinterceptors import HTTPProxyInterceptor
+
+
+def feedAll(framer, stream, chunkSize):
+    ## Returns the hooked heads, and the total of the relayed bytes
+    heads, relayed = [], 0
+    for start in range(0, len(stream), chunkSize):
+        for frame in framer.feed(stream[start:start + chunkSize]):
+            if type(frame) is int:
+                relayed += frame
+            else:
+                heads.append(frame)
+    return heads, relayed
+
+
+class Test_HTTPFramer_MessageHead:
+    def test_request(self):
+        head = HTTPMessageHead(b"GET /index.html HTTP/1.1\r\nHost: example.com\r\nAccept:  */*\r\n\r\n")
+        assert head.isValid and head.isRequest
+        assert (head.method, head.target, head.version) == (b"GET", b"/index.html", b"HTTP/1.1")
+        assert head.fields == [(b"Host", b"example.com"), (b"Accept", b"*/*")]
+        assert head.header(b"HOST") == b"example.com"
+        assert head.header(b"Content-Length") is None
+        assert head == b"GET /index.html HTTP/1.1\r\nHost: example.com\r\nAccept:  */*\r\n\r\n"
+
+    def test_response(self):
+        head = HTTPMessageHead(b"HTTP/1.1 404 Not Found\r\nVia: a\r\nvia: b\r\n\r\n")
+        assert head.isValid and not head.isRequest
+        assert (head.version, head.status, head.reason) == (b"HTTP/1.1", 404, b"Not Found")
+        assert head.header(b"Via") == b"a, b"
+        assert head.headers(b"Via") == [b"a", b"b"]
+
+    @pytest.mark.parametrize("head", [
+        b"GET /\r\n\r\n",
+        b"HTTP/1.1 OK\r\n\r\n",
+        b"GET / HTTP/1.1\r\nHost : example.com\r\n\r\n",
+        b"GET / HTTP/1.1\r\nHost: example.com\r\n folded\r\n\r\n",
+        b"GET / HTTP/1.1\r\nNoColon\r\n\r\n",
+    ])
+    def test_invalid(self, head):
+        assert not HTTPMessageHead(head).isValid
+
+
+class Test_HTTPFramer_Requests:
+    STREAM = (b"POST /upload HTTP/1.1\r\nContent-Length: 11\r\n\r\nhello world"
+              b"POST /chunked HTTP/1.1\r\nTransfer-Encoding: gzip, chunked\r\n\r\n"
+              b"5;ext=1\r\nhello\r\n6\r\n world\r\n0\r\nTrailer: x\r\n\r\n"
+              b"\r\nGET / HTTP/1.1\r\nHost: example.com\r\n\r\n")
+
+    @pytest.mark.parametrize("chunkSize", [1, 2, 3, 7, 64, 1024])
+    def test_framing(self, chunkSize):
+        framer, _ = HTTPMessageFramer.forConnection()
+        heads, relayed = feedAll(framer, self.STREAM, chunkSize)
+        assert [head.target for head in heads] == [b"/upload", b"/chunked", b"/"]
+        ## Everything but the heads is relayed (bodies, chunk lines, trailers and empty lines)
+        assert relayed == len(self.STREAM) - sum(len(head) for head in heads)
+        assert framer.pendingBytes() == 0 and not framer.isRelaying()
+
+    def test_bodyNotScanned(self):
+        framer, _ = HTTPMessageFramer.forConnection()
+        framer.feed(b"PUT /file HTTP/1.1\r\nContent-Length: 1000000\r\n\r\n")
+        ## A body that looks like a head isn't hooked
+        assert framer.feed(b"GET / HTTP/1.1\r\n\r\n" * 10) == [180]
+        assert framer.pendingBytes() == 0
+
+    def test_partialHead(self):
+        framer, _ = HTTPMessageFramer.forConnection()
+        assert framer.feed(b"GET / HTTP/1.1\r\nHost: a\r\n\r") == []
+        assert framer.pendingBytes() == len(b"GET / HTTP/1.1\r\nHost: a\r\n\r")
+        assert framer.feed(b"\nrest") == [b"GET / HTTP/1.1\r\nHost: a\r\n\r\n"]
+        assert framer.pendingBytes() == len(b"rest")
+
+    def test_connect(self):
+        framer, _ = HTTPMessageFramer.forConnection()
+        frames = framer.feed(b"CONNECT example.com:443 HTTP/1.1\r\n\r\n\x16\x03\x01")
+        assert frames == [b"CONNECT example.com:443 HTTP/1.1\r\n\r\n", 3]
+        assert framer.isRelaying()
+
+    @pytest.mark.parametrize("stream", [
+        b"POST / HTTP/1.1\r\nContent-Length: 5\r\nContent-Length: 6\r\n\r\nhello",
+        b"POST / HTTP/1.1\r\nContent-Length: -5\r\n\r\nhello",
+        b"POST / HTTP/1.1\r\nTransfer-Encoding: gzip\r\n\r\nhello",
+        b"POST / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\nzz\r\nhello",
+        b"POST / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n0x5\r\nhello",
+        b"POST / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n2\r\nhello\r\n",
+        b"HTTP/1.1 200 OK\r\n\r\n",
+    ])
+    def test_unframeable_relayed(self, stream):
+        framer, _ = HTTPMessageFramer.forConnection()
+        heads, relayed = feedAll(framer, stream, 1024)
+        assert framer.isRelaying()
+        assert relayed + sum(len(head) for head in heads) == len(stream)
+        assert framer.feed(b"anything") == [8]
+
+    def test_oversizedHead_relayed(self):
+        framer, _ = HTTPMessageFramer.forConnection()
+        stream = b"GET / HTTP/1.1\r\n" + b"X: y\r\n" * (HTTPMessageFramer.MAX_HEAD_SIZE // 6)
+        heads, relayed = feedAll(framer, stream, 1024)
+        assert heads == [] and relayed == len(stream)
+        assert framer.isRelaying() and framer.pendingBytes() == 0
+
+
+class Test_HTTPFramer_Responses:
+    def test_responseBodies(self):
+        requestFramer, responseFramer = HTTPMessageFramer.forConnection()
+        requestFramer.feed(b"HEAD / HTTP/1.1\r\n\r\nGET / HTTP/1.1\r\n\r\nGET /a HTTP/1.1\r\n\r\nGET /b HTTP/1.1\r\n\r\n")
+        stream = (b"HTTP/1.1 200 OK\r\nContent-Length: 100\r\n\r\n"          ## HEAD - no body
+                  b"HTTP/1.1 100 Continue\r\n\r\n"                            ## interim
+                  b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n3\r\nabc\r\n0\r\n\r\n"
+                  b"HTTP/1.1 304 Not Modified\r\nContent-Length: 100\r\n\r\n"  ## no body
+                  b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok")
+        heads, relayed = feedAll(responseFramer, stream, 5)
+        assert [head.status for head in heads] == [200, 100, 200, 304, 200]
+        assert relayed == len(b"3\r\nabc\r\n0\r\n\r\nok")
+        assert not responseFramer.isRelaying()
+
+    def test_untilClose(self):
+        requestFramer, responseFramer = HTTPMessageFramer.forConnection()
+        requestFramer.feed(b"GET / HTTP/1.0\r\n\r\n")
+        assert responseFramer.feed(b"HTTP/1.0 200 OK\r\n\r\nbody") == [b"HTTP/1.0 200 OK\r\n\r\n", 4]
+        assert responseFramer.isRelaying()
+
+    @pytest.mark.parametrize("request_, response", [
+        (b"GET /chat HTTP/1.1\r\nUpgrade: websocket\r\n\r\n", b"HTTP/1.1 101 Switching Protocols\r\n\r\n"),
+        (b"CONNECT example.com:443 HTTP/1.1\r\n\r\n", b"HTTP/1.1 200 Connection Established\r\n\r\n"),
+    ])
+    def test_protocolSwitch(self, request_, response):
+        requestFramer, responseFramer = HTTPMessageFramer.forConnection()
+        requestFramer.feed(request_)
+        assert responseFramer.feed(response + b"\x00\x01") == [response, 2]
+        ## Neither direction is HTTP any more
+        assert responseFramer.isRelaying() and requestFramer.isRelaying()
+
+
+class Test_HTTPFramer_Buffer:
+    def test_headsHooked(self):
+        clientToServerFramer, _ = HTTPMessageFramer.forConnection()
+        b = Buffer([b"\r\n\r\n"], framer=clientToServerFramer, holdUndelimited=True)
+        hooked = []
+        b.setHook(lambda buffer, head: hooked.append(head))
+
+        b.write(b"POST / HTTP/1.1\r\nContent-Length: 10\r\n\r\n01234")
+        b.write(b"56789GET / HTTP/1.1\r\n")
+        assert hooked == [b"POST / HTTP/1.1\r\nContent-Length: 10\r\n\r\n"]
+        ## The body streams through, while the partial head is held back
+        assert b.sendable() == len(b._data) - len(b"GET / HTTP/1.1\r\n")
+        assert b.memoryUsage() == len(b._data) + len(b"GET / HTTP/1.1\r\n")
+        assert len(b._requests) == 0
+
+        b.write(b"\r\n")
+        assert [head.method for head in hooked] == [b"POST", b"GET"]
+        assert b.sendable() == len(b._data)
+
+    def test_interceptorRewritesHeadsOnly(self):
+        interceptor = HTTPProxyInterceptor()
+        clientToServerFramer, _ = interceptor.createFramers()
+        b = Buffer(interceptor.REQUEST_DELIMITERS, framer=clientToServerFramer, holdUndelimited=interceptor.REWRITES_REQUESTS)
+        b.setHook(interceptor.clientToServerHook)
+
+        b.write(b"POST / HTTP/1.1\r\nHost: 0.0.0.0:8080\r\nContent-Length: 12\r\n\r\n0.0.0.0:8080"
+                b"GET / HTTP/1.1\r\nHost: 0.0.0.0:8080\r\n\r\n")
+        rewritten = (b"POST / HTTP/1.1\r\nHost: 127.0.0.1:80\r\nContent-Length: 12\r\n\r\n0.0.0.0:8080"
+                     b"GET / HTTP/1.1\r\nHost: 127.0.0.1:80\r\n\r\n")
+        assert b.read(-1) == rewritten
+        assert b.sendable() == len(rewritten)
+
+    def test_stopInspection(self):
+        clientToServerFramer, _ = HTTPMessageFramer.forConnection()
+        b = Buffer([b"\r\n\r\n"], framer=clientToServerFramer, holdUndelimited=True)
+        hooked = []
+        def hook(buffer, head):
+            hooked.append(head)
+            buffer.stopInspection()
+        b.setHook(hook)
+
+        b.write(b"GET /a HTTP/1.1\r\n\r\nGET /b HTTP/1.1\r\n\r\nGET /c")
+        assert [head.target for head in hooked] == [b"/a"]
+        assert b.sendable() == len(b._data)
+        assert b.memoryUsage() == len(b._data)
@@ -0,0 +1,254 @@
+import os
+import sys
+import asyncio
+import threading
+import pytest
+
+
+sys.path.insert(0, os.path.join("..", "src"))
+sys.path.insert(0, "src")
+from _proxyDS import AsyncHookRunner, Buffer, PassThroughInterceptor, StreamInterceptor
+from _interceptorPipeline import InterceptorPipeline, _noHook
+from _sessionCapture import CaptureRecord
+from session_replay import replaySession
+from tcp_proxyinterceptors import HTTPProxyInterceptor
+from _exceptions import *
+
+
+CALLS = []
+
+
+class ClientStage(StreamInterceptor):
+    REQUEST_DELIMITERS = [b"\r\n"]
+    def clientToServerHook(self, buffer, request) -> None:
+        CALLS.append(("ClientStage", bytes(request)))
+
+
+class BothStage(StreamInterceptor):
+    REQUEST_DELIMITERS = [b"\r\n"]
+    HOOK_MODE = "async"
+    SOCKET_PROFILE = "interactive"
+    def clientToServerHook(self, buffer, request) -> None:
+        CALLS.append(("BothStage", bytes(request)))
+    def serverToClientHook(self, buffer, response) -> None:
+        CALLS.append(("BothStage", bytes(response)))
+    @classmethod
+    def acceptsClient(cls, host: str) -> bool:
+        return host != "10.0.0.1"
+
+
+class BulkClientStage(ClientStage):
+    SOCKET_PROFILE = "bulk"
+
+
+class AwaitingStage(StreamInterceptor):
+    REQUEST_DELIMITERS = [b"\r\n"]
+    def clientToServerHook(self, buffer, request):
+        async def check():
+            await asyncio.sleep(0)
+            CALLS.append(("AwaitingStage", bytes(request)))
+        return check()
+
+
+class SlowFirstStage(StreamInterceptor):
+    REQUEST_DELIMITERS = [b"\n"]
+    def clientToServerHook(self, buffer, message):
+        if not message.startswith(b"A"):
+            return None
+        async def check():
+            await asyncio.sleep(0.05)
+        return check()
+
+
+class RecordingStage(StreamInterceptor):
+    REQUEST_DELIMITERS = [b"\n"]
+    def clientToServerHook(self, buffer, message) -> None:
+        CALLS.append((threading.current_thread(), bytes(message)))
+
+
+class LowerCaseStage(StreamInterceptor):
+    REQUEST_DELIMITERS = [b"\n"]
+    REWRITES_REQUESTS = True
+    def clientToServerHook(self, buffer, message) -> None:
+        buffer.replaceRequest(bytes(message).lower())
+
+
+class SlowFirstPipeline(InterceptorPipeline):
+    STAGES = (SlowFirstStage, RecordingStage, LowerCaseStage)
+
+
+class LineBytesPipeline(InterceptorPipeline):
+    STAGES = (ClientStage, PassThroughInterceptor, BothStage)
+
+
+class HostRecordingStage(HTTPProxyInterceptor):
+    REWRITES_REQUESTS = False
+    def clientToServerHook(self, buffer, head) -> None:
+        CALLS.append(("HostRecordingStage", bytes(head)))
+    def serverToClientHook(self, buffer, head) -> None:
+        return None
+
+
+class BackendHostStage(HTTPProxyInterceptor):
+    SERVER_ADDRESS = b"backend:80"
+
+
+class HTTPPipeline(InterceptorPipeline):
+    STAGES = (BackendHostStage, HostRecordingStage)
+
+
+@pytest.fixture(autouse=True)
+def clearCalls():
+    CALLS.clear()
+    yield
+    CALLS.clear()
+
+
+@pytest.fixture()
+def createAsyncHookRunner():
+    runner = AsyncHookRunner()
+    yield runner
+    runner.close()
+
+
+class Test_InterceptorPipeline_Construction:
+    def test_stagesResolved(self):
+        assert LineBytesPipeline.STAGES == (ClientStage, PassThroughInterceptor, BothStage)
+        ## The pass-through stage has no hooks, so it's dropped
+        assert LineBytesPipeline._stages == (ClientStage, BothStage)
+        assert LineBytesPipeline._clientToServerStages == (0, 1)
+        assert LineBytesPipeline._serverToClientStages == (1,)
+        assert LineBytesPipeline.REQUEST_DELIMITERS == [b"\r\n"]
+        assert LineBytesPipeline.PASS_THROUGH is False
+        assert LineBytesPipeline.HOOK_MODE == "inline"
+        assert LineBytesPipeline.REWRITES_REQUESTS is False
+        assert LineBytesPipeline.SOCKET_PROFILE == "interactive"
+        assert HTTPPipeline.REWRITES_REQUESTS is True
+
+    def test_singleStageDirection_callsHookDirectly(self):
+        pipeline = LineBytesPipeline()
+        assert pipeline.serverToClientHook == pipeline.stages[1].serverToClientHook
+
+        class ClientOnlyPipeline(InterceptorPipeline):
+            STAGES = (ClientStage,)
+        assert ClientOnlyPipeline().serverToClientHook is _noHook
+
+    def test_nestedPipeline_flattened(self):
+        class NestedPipeline(InterceptorPipeline):
+            STAGES = (LineBytesPipeline, ClientStage)
+        assert NestedPipeline.STAGES == (ClientStage, PassThroughInterceptor, BothStage, ClientStage)
+        assert NestedPipeline._clientToServerStages == (0, 1, 2)
+
+    def test_passThroughStages_passThroughPipeline(self):
+        class BulkPipeline(InterceptorPipeline):
+            STAGES = (PassThroughInterceptor,)
+        assert BulkPipeline.PASS_THROUGH is True
+        assert BulkPipeline.SOCKET_PROFILE == "bulk"
+
+    @pytest.mark.parametrize("stages, reason", [
+        ((), "STAGES is empty"),
+        ((object,), "is not a StreamInterceptor subclass"),
+        ((StreamInterceptor,), "is not a StreamInterceptor subclass"),
+        ((ClientStage, HostRecordingStage), "different REQUEST_DELIMITERS"),
+        ((BothStage, BulkClientStage), "different socket profiles"),
+    ])
+    def test_invalidStages(self, stages, reason):
+        with pytest.raises(InvalidInterceptorPipelineError) as excInfo:
+            type("InvalidPipeline", (InterceptorPipeline,), {"STAGES": stages})
+        assert reason in str(excInfo.value)
+
+    def test_differentFramers(self):
+        class LineHeadStage(ClientStage):
+            REQUEST_DELIMITERS = HTTPProxyInterceptor.REQUEST_DELIMITERS
+        with pytest.raises(InvalidInterceptorPipelineError) as excInfo:
+            type("InvalidPipeline", (InterceptorPipeline,), {"STAGES": (HostRecordingStage, LineHeadStage)})
+        assert "different createFramers()" in str(excInfo.value)
+
+
+class Test_InterceptorPipeline_Hooks:
+    def test_stagesCalledInOrder(self):
+        records = [CaptureRecord(1, "clientToServer", 0.0, b"USER a"), CaptureRecord(1, "clientToServer", 0.0, b"non\r\n"),
+                   CaptureRecord(1, "serverToClient", 0.0, b"331 ok\r\n")]
+        stats = replaySession(records, LineBytesPipeline)
+        assert CALLS == [("ClientStage", b"USER anon\r\n"), ("BothStage", b"USER anon\r\n"), ("BothStage", b"331 ok\r\n")]
+        assert stats.bytesOut == stats.bytesIn
+
+    def test_sharedFraming_editsApplied(self):
+        head = b"GET / HTTP/1.1\r\nHost: 0.0.0.0:8080\r\n\r\n"
+        records = [CaptureRecord(1, "clientToServer", 0.0, head[:10]), CaptureRecord(1, "clientToServer", 0.0, head[10:])]
+        stats = replaySession(records, HTTPPipeline)
+        ## The later stage sees the head as it was received (the edit is applied as it's sent)
+        assert CALLS == [("HostRecordingStage", head)]
+        assert stats.bytesOut == len(head) - len(b"0.0.0.0:8080") + len(b"backend:80")
+
+    def test_awaitedStage_laterStagesAwaited(self):
+        class AwaitingPipeline(InterceptorPipeline):
+            STAGES = (ClientStage, AwaitingStage, BothStage)
+        message = bytearray(b"NOOP\r\n")
+        result = AwaitingPipeline().clientToServerHook(None, message)
+        assert CALLS == [("ClientStage", b"NOOP\r\n")]
+        ## The awaitable resolves to the rest of the chain (which the buffer calls on the loop thread)
+        resume = asyncio.run(result)
+        assert CALLS == [("ClientStage", b"NOOP\r\n"), ("AwaitingStage", b"NOOP\r\n")]
+        assert resume(None, message) is None
+        assert CALLS == [("ClientStage", b"NOOP\r\n"), ("AwaitingStage", b"NOOP\r\n"), ("BothStage", b"NOOP\r\n")]
+
+    def test_awaitedStage_laterMessagesQueued(self, createAsyncHookRunner):
+        pipeline = SlowFirstPipeline()
+        buffer = Buffer(pipeline.REQUEST_DELIMITERS, holdUndelimited=True)
+        buffer.setHook(pipeline.clientToServerHook, asyncHookRunner=createAsyncHookRunner)
+        buffer.write(b"A1\nB2\n")
+        ## B2's stages wait behind A1's awaited stage (even though its own first stage wouldn't await)
+        assert CALLS == [] and buffer.sendable() == 0
+
+        buffer.waitForHooks(timeout=5)
+        assert [message for _, message in CALLS] == [b"A1\n", b"B2\n"]
+        ## The deferred stages run on the thread that drives the buffer, so they can still rewrite the messages
+        assert {thread for thread, _ in CALLS} == {threading.current_thread()}
+        sendable = buffer.sendable()
+        assert b"".join(buffer.gather(sendable)) == b"a1\nb2\n"
+
+    def test_awaitedStage_failureSkipsLaterStages(self, createAsyncHookRunner):
+        class FailingStage(SlowFirstStage):
+            def clientToServerHook(self, buffer, message):
+                async def check():
+                    raise ValueError(bytes(message))
+                return check() if message.startswith(b"A") else None
+        class FailingPipeline(InterceptorPipeline):
+            STAGES = (FailingStage, RecordingStage)
+        pipeline = FailingPipeline()
+        buffer = Buffer(pipeline.REQUEST_DELIMITERS)
+        buffer.setHook(pipeline.clientToServerHook, asyncHookRunner=createAsyncHookRunner)
+        buffer.write(b"A1\nB2\n")
+        buffer.waitForHooks(timeout=5)
+        ## Only the failed message's later stages are skipped
+        assert [message for _, message in CALLS] == [b"B2\n"]
+        assert buffer.sendable() == len(b"A1\nB2\n")
+
+    def test_awaitedStage_replayed(self):
+        records = [CaptureRecord(1, "clientToServer", 0.0, b"A1\nB"), CaptureRecord(1, "clientToServer", 0.0, b"2\nC3\n")]
+        stats = replaySession(records, SlowFirstPipeline)
+        assert [message for _, message in CALLS] == [b"A1\n", b"B2\n", b"C3\n"]
+        assert stats.bytesOut == stats.bytesIn
+
+    def test_proxyTunnel_setOnStages(self):
+        pipeline = LineBytesPipeline()
+        tunnel = object()
+        pipeline.proxyTunnel = tunnel
+        assert pipeline.proxyTunnel is tunnel
+        assert all(stage.proxyTunnel is tunnel for stage in pipeline.stages)
+
+    def test_isTransparent(self):
+        class FilterStage(StreamInterceptor):
+            @classmethod
+            def acceptsClient(cls, host: str) -> bool:
+                return False
+        class FilterPipeline(InterceptorPipeline):
+            STAGES = (FilterStage, PassThroughInterceptor)
+        ## Neither stage hooks the stream, so the pipeline's tunnels are only relayed
+        assert FilterPipeline.isTransparent() is True
+        assert LineBytesPipeline.isTransparent() is False
+
+    def test_acceptsClient_allStages(self):
+        assert LineBytesPipeline.acceptsClient("10.0.0.2") is True
+        assert LineBytesPipeline.acceptsClient("10.0.0.1") is False
@@ -0,0 +1,98 @@
+import os
+import sys
+import pytest
+
+
+sys.path.insert(0, os.path.join("..", "src"))
+sys.path.insert(0, "src")
+from _loginTracker import SlidingWindowSketch, LoginAttemptTracker
+from _exceptions import *
+
+
+class Test_SlidingWindowSketch:
+    def test_counts(self):
+        sketch = SlidingWindowSketch(window=60, buckets=6, width=256, depth=4)
+        for _ in range(5):
+            sketch.add("a", now=0)
+        assert sketch.add("b", count=3, now=0) == 3
+        assert sketch.estimate("a", now=0) == 5
+        assert sketch.estimate("missing", now=0) == 0
+
+    def test_slidingWindow_expiresBuckets(self):
+        sketch = SlidingWindowSketch(window=60, buckets=6, width=256, depth=4)
+        sketch.add("a", now=0)
+        sketch.add("a", count=2, now=30)
+        assert sketch.estimate("a", now=59) == 3
+        ## The first bucket [0, 10) leaves the window first
+        assert sketch.estimate("a", now=65) == 2
+        assert sketch.estimate("a", now=95) == 0
+
+    def test_slidingWindow_longIdle(self):
+        sketch = SlidingWindowSketch(window=60, buckets=6, width=256, depth=4)
+        sketch.add("a", count=10, now=0)
+        assert sketch.estimate("a", now=10_000) == 0
+        assert sketch.add("a", now=10_000) == 1
+
+    def test_neverUnderestimates(self):
+        ## NOTE: Collisions can only add to a count (the sketch is far smaller than the key count)
+        sketch = SlidingWindowSketch(window=60, buckets=1, width=32, depth=2)
+        for key in range(500):
+            sketch.add(key, count=key % 7, now=0)
+        assert all(sketch.estimate(key, now=0) >= key % 7 for key in range(500))
+
+    @pytest.mark.parametrize("options", [{"window": 0}, {"buckets": 0}, {"width": 0}, {"depth": -1}])
+    def test_invalidOptions(self, options):
+        with pytest.raises(InvalidSlidingWindowError):
+            SlidingWindowSketch(**options)
+
+
+class Test_LoginAttemptTracker:
+    def test_failures_perKey(self):
+        tracker = LoginAttemptTracker()
+        for username in ("root", "admin", "root"):
+            tracker.recordFailure("10.0.0.1", username, now=0)
+        tracker.recordFailure("10.0.0.2", "root", now=0)
+
+        assert tracker.failures("10.0.0.1", now=0) == 3
+        assert tracker.failures("10.0.0.1", "root", now=0) == 2
+        assert tracker.failures(username="root", now=0) == 3
+        assert tracker.failures("10.0.0.3", now=0) == 0
+
+    def test_isThrottled(self):
+        tracker = LoginAttemptTracker(window=60, throttleThreshold=3)
+        for _ in range(3):
+            assert not tracker.isThrottled("10.0.0.1", now=0)
+            tracker.recordFailure("10.0.0.1", "root", now=0)
+        assert tracker.isThrottled("10.0.0.1", now=0)
+        assert not tracker.isThrottled("10.0.0.2", now=0)
+        ## The failures leave the window
+        assert not tracker.isThrottled("10.0.0.1", now=120)
+
+    def test_successes(self, caplog):
+        tracker = LoginAttemptTracker(throttleThreshold=2)
+        tracker.recordSuccess("10.0.0.1", "anonymous", now=0)
+        assert tracker.successes("10.0.0.1", now=0) == 1
+        assert "CRITICAL" not in caplog.text
+
+        tracker.recordFailure("10.0.0.1", "root", now=0)
+        tracker.recordFailure("10.0.0.1", "root", now=0)
+        tracker.recordSuccess("10.0.0.1", "root", now=0)
+        assert "logged in after 2 failed attempts" in caplog.text
+
+    def test_topOffenders(self):
+        tracker = LoginAttemptTracker(window=60, maxOffenders=4)
+        for host, failures in (("10.0.0.1", 5), ("10.0.0.2", 1), ("10.0.0.3", 3)):
+            for _ in range(failures):
+                tracker.recordFailure(host, now=0)
+
+        assert tracker.topOffenders(2, now=0) == [(("10.0.0.1", None), 5), (("10.0.0.3", None), 3)]
+        ## Offenders with the fewest failures are replaced once the list is full
+        for _ in range(2):
+            tracker.recordFailure("10.0.0.4", now=0)
+            tracker.recordFailure("10.0.0.5", now=0)
+        assert ("10.0.0.2", None) not in dict(tracker.topOffenders(10, now=0))
+        assert tracker.topOffenders(10, now=120) == []
+
+    def test_invalidThrottleThreshold(self):
+        with pytest.raises(InvalidThrottleThresholdError):
+            LoginAttemptTracker(throttleThreshold=0)
@@ -1,14 +1,17 @@
 import os
+import select
 import selectors
 import sys
 import socket
 import pytest
+import struct
 import collections
 from typing import List
 sys.path.insert(0, os.path.join("..", "src"))
 sys.path.insert(0, "src")
 from tcp_proxyserver import ProxyConnections, ProxyTunnel
 from _proxyDS import StreamInterceptor
+from _backendPool import Backend, BackendPool
 from _exceptions import *
 
 
@@ -53,7 +56,10 @@ class PCTestResources:
         expectedSelectorEvent = selectors.EVENT_READ | selectors.EVENT_WRITE
         for sock in registeredSocks:
             selectorKey = pc.selector.get_key(sock)
-            assert selectorKey.data == "connection"
+            ## NOTE: The socket's tunnel endpoint is stored as the key data (so events don't require a pc.get() lookup)
+            assert selectorKey.data is pc.get(sock).getEndpoint(sock)
+            assert selectorKey.data.tunnel == pc.get(sock)
+            assert selectorKey.data.sock == sock
             assert selectorKey.events == expectedSelectorEvent
 
     @classmethod
@@ -174,6 +180,17 @@ class Test_ProxyConnections_Init:
             ProxyConnections(PROXY_HOST, PROXY_PORT, interceptor, selector)
         assert "A subclass of StreamInterceptor is required" in str(excInfo.value)
 
+    def test_streamInterceptor_invalidHookMode(self):
+        PROXY_HOST, PROXY_PORT = "127.0.0.1", 80
+        selector = selectors.DefaultSelector()
+
+        class StreamInterceptor_invalidHookMode(MockStreamInterceptor):
+            HOOK_MODE = "deferred"
+
+        with pytest.raises(InvalidHookModeError) as excInfo:
+            ProxyConnections(PROXY_HOST, PROXY_PORT, StreamInterceptor_invalidHookMode, selector)
+        assert "Invalid HOOK_MODE" in str(excInfo.value)
+
     def test_streamInterceptor_abstractSubclass_clientToServerHook(self):
         ## NOTE: There are still incomplete methods that haven't been overriden
         PROXY_HOST, PROXY_PORT = "127.0.0.1", 80
@@ -474,3 +491,262 @@ class Test_ProxyConnections_operations:
         except Exception as e:
             PCTestResources._closeSockets(*socks)
             raise e
+
+
+class Test_ProxyConnections_DataChannels:
+    def test_openDataChannel_registersListener(self, createPC):
+        pc, PROXY_HOST, PROXY_PORT, streamInterceptor, selector = createPC
+        s1, s2, s3, s4 = PCTestResources._createTunnel()
+        try:
+            controlTunnel = pc.createTunnel(s2, s3)
+            host, port = controlTunnel.openDataChannel(("127.0.0.1", 9999), "client")
+
+            assert host == s2.getsockname()[0]
+            assert len(pc._listeners) == 1
+            listener, = pc._listeners.values()
+            assert selector.get_key(listener.sock).data is listener
+            assert listener.address == (host, port)
+            assert listener.controlTunnel is controlTunnel
+            assert pc.dataChannels(controlTunnel) == [listener]
+            assert controlTunnel.hasOpenDataChannels() is True
+        finally:
+            pc.closeAllTunnels()
+            PCTestResources._closeSockets(s1, s4)
+        PCTestResources._assertClosedProxyConnections(pc)
+        assert len(pc._listeners) == 0
+
+    def test_openDataChannel_withoutProxyConnections(self):
+        s1, s2, s3, s4 = PCTestResources._createTunnel()
+        try:
+            pt = ProxyTunnel(s2, s3, MockStreamInterceptor)
+            with pytest.raises(DataChannelUnavailableError):
+                pt.openDataChannel(("127.0.0.1", 9999))
+        finally:
+            PCTestResources._closeSockets(s1, s2, s3, s4)
+
+    def test_connectDataChannel_passThroughTunnel(self, createPC):
+        pc, PROXY_HOST, PROXY_PORT, streamInterceptor, selector = createPC
+        s1, s2, s3, s4 = PCTestResources._createTunnel()
+        target = socket.create_server(("127.0.0.1", 0))
+        dataClient = socket.socket()
+        try:
+            controlTunnel = pc.createTunnel(s2, s3)
+            listener = pc.openDataChannel(controlTunnel, target.getsockname(), "client")
+            dataClient.connect(listener.address)
+            acceptedSocket, _ = listener.sock.accept()
+
+            pending = pc.connectDataChannel(listener, acceptedSocket)
+            assert len(pc._listeners) == 0 and listener.sock.fileno() == -1
+            ## The connect is polled by the selector, instead of blocking the event loop
+            assert selector.get_key(pending.targetSocket).data is pending
+            assert pending.targetSocket.getblocking() is False
+            select.select([], [pending.targetSocket], [], 5)
+
+            dataTunnel = pc.completeDataChannel(pending)
+            assert len(pc._pendingDataChannels) == 0
+            assert dataTunnel.clientToProxySocket is acceptedSocket
+            assert dataTunnel.CHUNK_SIZE == pc.BULK_CHUNK_SIZE
+            assert dataTunnel.clientToServerBuffer.parseRequests is False
+            assert dataTunnel.serverToClientBuffer.parseRequests is False
+
+            ## The data tunnel outlives its control tunnel
+            pc.closeTunnel(controlTunnel)
+            assert pc.get(acceptedSocket) is dataTunnel
+        finally:
+            pc.closeAllTunnels()
+            PCTestResources._closeSockets(s1, s4, target, dataClient)
+        PCTestResources._assertClosedProxyConnections(pc)
+
+    def test_completeDataChannel_connectFailure(self, createPC):
+        pc, PROXY_HOST, PROXY_PORT, streamInterceptor, selector = createPC
+        s1, s2, s3, s4 = PCTestResources._createTunnel()
+        ## Nothing listens on the target's port once it's closed
+        target = socket.create_server(("127.0.0.1", 0))
+        targetAddress = target.getsockname()
+        target.close()
+        dataClient = socket.socket()
+        try:
+            controlTunnel = pc.createTunnel(s2, s3)
+            listener = pc.openDataChannel(controlTunnel, targetAddress, "client")
+            dataClient.connect(listener.address)
+            acceptedSocket, _ = listener.sock.accept()
+
+            pending = pc.connectDataChannel(listener, acceptedSocket)
+            select.select([], [pending.targetSocket], [], 5)
+            with pytest.raises(ConnectionRefusedError):
+                pc.completeDataChannel(pending)
+            assert len(pc._pendingDataChannels) == 0
+            assert acceptedSocket.fileno() == -1 and pending.targetSocket.fileno() == -1
+        finally:
+            pc.closeAllTunnels()
+            PCTestResources._closeSockets(s1, s4, dataClient)
+        PCTestResources._assertClosedProxyConnections(pc)
+
+    def test_closeExpiredPendingDataChannels(self, createPC):
+        pc, PROXY_HOST, PROXY_PORT, streamInterceptor, selector = createPC
+        s1, s2, s3, s4 = PCTestResources._createTunnel()
+        dataClient = socket.socket()
+        try:
+            controlTunnel = pc.createTunnel(s2, s3)
+            ## NOTE: A non-routable address, so that the connect stays in progress
+            listener = pc.openDataChannel(controlTunnel, ("10.255.255.1", 9999), "client")
+            dataClient.connect(listener.address)
+            acceptedSocket, _ = listener.sock.accept()
+            pc.DATA_CHANNEL_CONNECT_TIMEOUT = 0
+            try:
+                pending = pc.connectDataChannel(listener, acceptedSocket)
+            except OSError:
+                pytest.skip("The host has no route to a non-routable address")
+            assert pc.nextDataChannelExpiry() == pending.expiresAt
+
+            pc.closeExpiredDataChannels()
+            assert len(pc._pendingDataChannels) == 0
+            assert acceptedSocket.fileno() == -1 and pending.targetSocket.fileno() == -1
+        finally:
+            pc.closeAllTunnels()
+            PCTestResources._closeSockets(s1, s4, dataClient)
+        PCTestResources._assertClosedProxyConnections(pc)
+
+    def test_closeTunnel_closesUnconnectedDataChannels(self, createPC):
+        pc, PROXY_HOST, PROXY_PORT, streamInterceptor, selector = createPC
+        s1, s2, s3, s4 = PCTestResources._createTunnel()
+        try:
+            controlTunnel = pc.createTunnel(s2, s3)
+            listener = pc.openDataChannel(controlTunnel, ("127.0.0.1", 9999), "server")
+            assert listener.address[0] == s3.getsockname()[0]
+
+            pc.closeTunnel(controlTunnel)
+            assert len(pc._listeners) == 0 and listener.sock.fileno() == -1
+            assert controlTunnel.hasOpenDataChannels() is False
+            PCTestResources._assertClosedProxyConnections(pc)
+        finally:
+            PCTestResources._closeSockets(s1, s4)
+
+    def test_closeExpiredDataChannels(self, createPC):
+        pc, PROXY_HOST, PROXY_PORT, streamInterceptor, selector = createPC
+        s1, s2, s3, s4 = PCTestResources._createTunnel()
+        try:
+            controlTunnel = pc.createTunnel(s2, s3)
+            pc.DATA_CHANNEL_TIMEOUT = 0
+            expired = pc.openDataChannel(controlTunnel, ("127.0.0.1", 9999), "client")
+            pc.DATA_CHANNEL_TIMEOUT = 60
+            pending = pc.openDataChannel(controlTunnel, ("127.0.0.1", 9999), "client")
+
+            pc.closeExpiredDataChannels()
+            assert list(pc._listeners.values()) == [pending]
+            assert expired.sock.fileno() == -1
+        finally:
+            pc.closeAllTunnels()
+            PCTestResources._closeSockets(s1, s4)
+
+    def test_nextDataChannelExpiry(self, createPC):
+        pc, PROXY_HOST, PROXY_PORT, streamInterceptor, selector = createPC
+        assert pc.nextDataChannelExpiry() is None
+        s1, s2, s3, s4 = PCTestResources._createTunnel()
+        try:
+            controlTunnel = pc.createTunnel(s2, s3)
+            pc.DATA_CHANNEL_TIMEOUT = 60
+            later = pc.openDataChannel(controlTunnel, ("127.0.0.1", 9999), "client")
+            pc.DATA_CHANNEL_TIMEOUT = 10
+            sooner = pc.openDataChannel(controlTunnel, ("127.0.0.1", 9999), "client")
+            assert pc.nextDataChannelExpiry() == sooner.expiresAt < later.expiresAt
+
+            pc.closeDataChannel(sooner)
+            assert pc.nextDataChannelExpiry() == later.expiresAt
+        finally:
+            pc.closeAllTunnels()
+            PCTestResources._closeSockets(s1, s4)
+
+
+class Test_ProxyConnections_Backends:
+    def test_defaultPool(self, createPC):
+        pc, PROXY_HOST, PROXY_PORT, streamInterceptor, selector = createPC
+        assert len(pc.backendPool) == 1
+        assert pc.pickBackend("10.0.0.1").address == (PROXY_HOST, PROXY_PORT)
+
+    def test_tunnelCounts(self):
+        backends = [Backend("127.0.0.1", 81), Backend("127.0.0.1", 82)]
+        pc = ProxyConnections("127.0.0.1", 80, MockStreamInterceptor, selectors.DefaultSelector(),
+                                backendPool=BackendPool(backends, "least-active"))
+        socks, tunnels = [], []
+        try:
+            for _ in range(3):
+                s1, s2, s3, s4 = PCTestResources._createTunnel()
+                socks.extend([s1, s4])
+                backend = pc.pickBackend()
+                tunnels.append(pc.createTunnel(s2, s3, backend=backend))
+                assert tunnels[-1].backend is backend
+            assert sorted(backend.activeTunnels for backend in backends) == [1, 2]
+
+            ## Closing a tunnel returns it to its backend's count
+            busiest = max(backends, key=lambda backend: backend.activeTunnels)
+            pc.closeTunnel(next(tunnel for tunnel in tunnels if tunnel.backend is busiest))
+            assert [backend.activeTunnels for backend in backends] == [1, 1]
+
+            ## Tunnels without a backend (e.g. data channels) aren't counted
+            s1, s2, s3, s4 = PCTestResources._createTunnel()
+            socks.extend([s1, s4])
+            pc.createTunnel(s2, s3)
+            assert [backend.activeTunnels for backend in backends] == [1, 1]
+        finally:
+            pc.closeAllTunnels()
+            PCTestResources._closeSockets(*socks)
+        assert [backend.activeTunnels for backend in backends] == [0, 0]
+
+    def test_setupProxyToServerSocket_unreachableBackend(self, createPC):
+        pc, PROXY_HOST, PROXY_PORT, streamInterceptor, selector = createPC
+        with pytest.raises(socket.error):
+            pc.setupProxyToServerSocket(Backend("127.0.0.1", 1))
+
+    def test_connectBackend_failover(self):
+        with socket.create_server(("127.0.0.1", 0)) as server:
+            backends = [Backend("127.0.0.1", 1), Backend("127.0.0.1", server.getsockname()[1])]
+            pc = ProxyConnections("127.0.0.1", 80, MockStreamInterceptor, selectors.DefaultSelector(),
+                                    backendPool=BackendPool(backends, failureThreshold=2))
+            ## A failed connect is retried on the next backend
+            for _ in range(2):
+                sock, backend = pc.connectBackend("10.0.0.1")
+                assert backend is backends[1]
+                sock.close()
+            assert backends[0].state == "open"
+
+    @pytest.mark.parametrize("strategy", BackendPool.STRATEGIES)
+    def test_connectBackend_failoverExcludesTried(self, strategy):
+        with socket.create_server(("127.0.0.1", 0)) as server:
+            backends = [Backend("127.0.0.1", 1), Backend("127.0.0.1", server.getsockname()[1])]
+            pool = BackendPool(backends, strategy=strategy, failureThreshold=10)
+            pc = ProxyConnections("127.0.0.1", 80, MockStreamInterceptor, selectors.DefaultSelector(), backendPool=pool)
+            ## The client is hashed onto the dead backend (which is also the least active one)
+            clientHost = next(f"10.0.0.{i}" for i in range(256) if pool._pickConsistentHash(f"10.0.0.{i}") is backends[0])
+            ## The dead backend's circuit stays closed, but it isn't picked again for the same tunnel
+            for _ in range(2):
+                sock, backend = pc.connectBackend(clientHost)
+                assert backend is backends[1]
+                sock.close()
+            assert backends[0].state == "closed"
+
+    def test_connectBackend_failFast(self):
+        pc = ProxyConnections("127.0.0.1", 1, MockStreamInterceptor, selectors.DefaultSelector(),
+                                backendPool=BackendPool([Backend("127.0.0.1", 1)], failureThreshold=1))
+        with pytest.raises(ConnectionRefusedError):
+            pc.connectBackend()
+        ## The open circuit isn't dialled again
+        with pytest.raises(BackendUnavailableError):
+            pc.connectBackend()
+
+    def test_resetCountsAsFailure(self):
+        backend = Backend("127.0.0.1", 8889)
+        pc = ProxyConnections("127.0.0.1", 80, MockStreamInterceptor, selectors.DefaultSelector(),
+                                backendPool=BackendPool([backend], failureThreshold=1))
+        s1, s2, s3, s4 = PCTestResources._createTunnel()
+        try:
+            tunnel = pc.createTunnel(s2, s3, backend=backend)
+            ## The backend aborts the connection (RST)
+            s4.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+            s4.close()
+            assert tunnel.serverEndpoint.readFrom() is None
+            assert tunnel.serverEndpoint.reset
+            pc.closeTunnel(tunnel)
+            assert backend.state == "open" and backend.activeTunnels == 0
+        finally:
+            PCTestResources._closeSockets(s1, s4)
@@ -8,8 +8,10 @@ import socket
 
 sys.path.insert(0, os.path.join("..", "src"))
 sys.path.insert(0, "src")
-from tcp_proxyserver import ProxyTunnel
-from _proxyDS import Buffer
+from tcp_proxyserver import ProxyTunnel, BULK_CHUNK_SIZE
+from _proxyDS import Buffer, MemoryBudget, PassThroughInterceptor, RelayBuffer, StreamInterceptor
+from tcp_proxyinterceptors import HTTPProxyInterceptor
+from _sessionCapture import CaptureReader, SessionCapture
 from _exceptions import *
 from tests.testhelper.TestResources import PTTestResources
 
@@ -138,12 +140,12 @@ class Test_ProxyTunnel_Init:
         assert isinstance(pt.clientToServerBuffer, Buffer)
         
         request = bytearray(b"completeRequest\r\n")
-        pt.streamInterceptor.clientToServerHook(request)
+        pt.streamInterceptor.clientToServerHook(pt.clientToServerBuffer, request)
         assert len(pt.streamInterceptor.clientToServerDeque) == 1
         assert pt.streamInterceptor.clientToServerDeque[-1] == request
 
         response = bytearray(b"completeResponse\r\n")
-        pt.streamInterceptor.serverToClientHook(response)
+        pt.streamInterceptor.serverToClientHook(pt.serverToClientBuffer, response)
         assert len(pt.streamInterceptor.serverToClientDeque) == 1
         assert pt.streamInterceptor.serverToClientDeque[-1] == response
 
@@ -514,6 +516,102 @@ class Test_ProxyTunnel_ByteOperations:
         assert buffer._requests[-1] == [testdata, False]
 
 
+class Test_ProxyTunnel_DrainingOperations:
+    ## ProxyTunnel().readAllFrom()
+    ## ProxyTunnel().writeAllTo()
+    ## NOTE: These are used with the edge-triggered selector (sockets are non-blocking)
+
+    def test_readAllFrom_noData_clientToProxy(self, createProxyTunnel):
+        pt, socketList = createProxyTunnel
+        socketList[1].setblocking(False)
+        buffer = pt._selectBufferForRead(socketList[1])
+
+        ret = pt.readAllFrom(socketList[1])
+        assert ret == 0
+        assert buffer._data == bytearray(b"")
+        assert len(buffer._requests) == 0
+
+
+    def test_readAllFrom_manyChunks_clientToProxy(self, createProxyTunnel):
+        pt, socketList = createProxyTunnel
+        socketList[1].setblocking(False)
+        buffer = pt._selectBufferForRead(socketList[1])
+        testdata = b"A" * (pt.CHUNK_SIZE * 3 + 10) + b"\r\n"
+        socketList[0].sendall(testdata)
+
+        ## The socket should be drained past a single CHUNK_SIZE
+        ret = pt.readAllFrom(socketList[1])
+        while len(buffer._data) < len(testdata):
+            ret += pt.readAllFrom(socketList[1])
+
+        assert ret == len(testdata)
+        assert buffer._data == bytearray(testdata)
+        assert len(buffer._requests) == 0 ## the delimited request is passed to the request hook
+
+
+    def test_readAllFrom_OneRead_OneEmptyRead_proxyToServer(self, createProxyTunnel):
+        pt, socketList = createProxyTunnel
+        socketList[2].setblocking(False)
+        buffer = pt._selectBufferForRead(socketList[2])
+        testdata = b"testdata"
+
+        socketList[3].sendall(testdata)
+        socketList[3].close()
+
+        ## The data is read into the buffer, but the closed connection takes precedence
+        ret = pt.readAllFrom(socketList[2])
+        assert ret == None
+        assert buffer._data == bytearray(testdata)
+
+
+    def test_readAllFrom_SocketError_clientToProxy(self, createProxyTunnel_mockedErrorSockets):
+        pt, socketList = createProxyTunnel_mockedErrorSockets
+        buffer = pt._selectBufferForRead(socketList[1])
+
+        ret = pt.readAllFrom(socketList[1])
+        assert ret == None
+        assert buffer._data == bytearray(b"")
+
+
+    def test_writeAllTo_noDataInBuffer_proxyToServer(self, createProxyTunnel):
+        pt, socketList = createProxyTunnel
+        socketList[2].setblocking(False)
+        buffer = pt._selectBufferForWrite(socketList[2])
+
+        ret = pt.writeAllTo(socketList[2])
+        assert ret == 0
+        assert buffer._data == bytearray(b"")
+
+
+    def test_writeAllTo_manyChunks_clientToProxy(self, createProxyTunnel):
+        pt, socketList = createProxyTunnel
+        socketList[1].setblocking(False)
+        buffer = pt._selectBufferForWrite(socketList[1])
+        testdata = bytearray(b"B" * (pt.CHUNK_SIZE * 3 + 10))
+        buffer.write(testdata)
+
+        ## The buffer should be flushed past a single CHUNK_SIZE
+        ret = pt.writeAllTo(socketList[1])
+        assert ret == len(testdata)
+        assert buffer._data == bytearray(b"")
+
+        received = bytearray()
+        while len(received) < len(testdata):
+            received += socketList[0].recv(len(testdata))
+        assert received == testdata
+
+
+    def test_writeAllTo_SocketError_proxyToServer(self, createProxyTunnel_mockedErrorSockets):
+        pt, socketList = createProxyTunnel_mockedErrorSockets
+        testdata = bytearray(b"testdata")
+        buffer = pt._selectBufferForWrite(socketList[2])
+        buffer.write(testdata)
+
+        ret = pt.writeAllTo(socketList[2])
+        assert ret == None
+        assert buffer._data == testdata
+
+
 class Test_ProxyTunnel_HelperMethods:
 
 
@@ -559,3 +657,182 @@ class Test_ProxyTunnel_HelperMethods:
         with pytest.raises(UnassociatedTunnelSocket) as excInfo:
             pt._selectBufferForRead(nonparticipatingSocket)
         assert "not associated with the ProxyTunnel" in str(excInfo.value)
+
+
+
+class Test_ProxyTunnel_Endpoints:
+    ## NOTE: The endpoints are registered as the selector key data of the tunnel's sockets
+
+    def test_endpoints_boundBuffers(self, createProxyTunnel):
+        pt, socketList = createProxyTunnel
+        clientEndpoint, serverEndpoint = pt.clientEndpoint, pt.serverEndpoint
+
+        assert clientEndpoint.tunnel is pt and serverEndpoint.tunnel is pt
+        assert clientEndpoint.sock is pt.clientToProxySocket
+        assert clientEndpoint.readBuffer is pt._selectBufferForRead(pt.clientToProxySocket)
+        assert clientEndpoint.writeBuffer is pt._selectBufferForWrite(pt.clientToProxySocket)
+        assert serverEndpoint.sock is pt.proxyToServerSocket
+        assert serverEndpoint.readBuffer is pt._selectBufferForRead(pt.proxyToServerSocket)
+        assert serverEndpoint.writeBuffer is pt._selectBufferForWrite(pt.proxyToServerSocket)
+        assert clientEndpoint.peer is serverEndpoint and serverEndpoint.peer is clientEndpoint
+        assert (clientEndpoint.direction, serverEndpoint.direction) == ("clientToServer", "serverToClient")
+
+
+    def test_getEndpoint(self, createProxyTunnel):
+        pt, socketList = createProxyTunnel
+        assert pt.getEndpoint(socketList[1]) is pt.clientEndpoint
+        assert pt.getEndpoint(socketList[2]) is pt.serverEndpoint
+
+        nonparticipatingSocket = PTTestResources.createClientSocket()
+        with pytest.raises(UnassociatedTunnelSocket) as excInfo:
+            pt.getEndpoint(nonparticipatingSocket)
+        assert "not associated with the ProxyTunnel" in str(excInfo.value)
+
+
+    def test_readFrom_writeTo_clientToServer(self, createProxyTunnel):
+        pt, socketList = createProxyTunnel
+        testdata = b"testdata\r\n"
+        socketList[0].sendall(testdata)
+
+        assert pt.clientEndpoint.readFrom() == len(testdata)
+        assert pt.clientToServerBuffer._data == bytearray(testdata)
+        assert pt.serverEndpoint.writeTo() == len(testdata)
+        assert pt.clientToServerBuffer._data == bytearray(b"")
+        assert socketList[3].recv(1024) == testdata
+
+
+    def test_readFrom_closedSocket_serverToClient(self, createProxyTunnel):
+        pt, socketList = createProxyTunnel
+        socketList[3].close()
+        assert pt.serverEndpoint.readFrom() == None
+
+
+    def test_readAll_writeAll_serverToClient(self, createProxyTunnel):
+        pt, socketList = createProxyTunnel
+        socketList[2].setblocking(False)
+        testdata = b"B" * (pt.CHUNK_SIZE * 3 + 10)
+        socketList[3].sendall(testdata)
+
+        bytesRead = 0
+        while bytesRead < len(testdata):
+            bytesRead += pt.serverEndpoint.readAll()
+        assert pt.serverToClientBuffer._data == bytearray(testdata)
+
+        assert pt.serverEndpoint.peer.writeAll() == len(testdata)
+        received = bytearray()
+        while len(received) < len(testdata):
+            received += socketList[0].recv(len(testdata))
+        assert received == testdata
+
+
+class Test_ProxyTunnel_InspectionCutoff:
+    def test_stopInspection_direction(self, createProxyTunnel):
+        pt, socketList = createProxyTunnel
+        pt.stopInspection("serverToClient")
+
+        assert pt.serverToClientBuffer.parseRequests is False
+        assert pt.clientToServerBuffer.parseRequests is True
+        ## The endpoint that reads the direction, and the one that writes it, relay in bulk chunks
+        assert pt.serverEndpoint.CHUNK_SIZE == pt.clientEndpoint.CHUNK_SIZE == BULK_CHUNK_SIZE
+
+
+    def test_stopInspection_bothDirections(self, createProxyTunnel):
+        pt, socketList = createProxyTunnel
+        pt.stopInspection()
+        assert pt.serverToClientBuffer.parseRequests is False
+        assert pt.clientToServerBuffer.parseRequests is False
+
+        ## The stream is still relayed
+        socketList[0].sendall(b"request\r\n")
+        assert pt.clientEndpoint.readFrom() == len(b"request\r\n")
+        assert pt.serverEndpoint.writeTo() == len(b"request\r\n")
+        assert socketList[3].recv(1024) == b"request\r\n"
+
+
+    def test_stopInspection_invalidDirection(self, createProxyTunnel):
+        pt, socketList = createProxyTunnel
+        with pytest.raises(ValueError):
+            pt.stopInspection("sideways")
+
+
+class Test_ProxyTunnel_Framing:
+    def test_default_noFramers(self, createProxyTunnel):
+        pt, socketList = createProxyTunnel
+        assert pt.clientToServerBuffer.framer is None and pt.serverToClientBuffer.framer is None
+
+
+    def test_interceptorFramers(self, createProxyTunnel):
+        _, socketList = createProxyTunnel
+        pt = ProxyTunnel(socketList[1], socketList[2], HTTPProxyInterceptor)
+        ## The response framer of the tunnel follows its request framer (e.g. for HEAD requests)
+        assert pt.clientToServerBuffer.framer.isRequest
+        assert pt.serverToClientBuffer.framer.requestFramer is pt.clientToServerBuffer.framer
+
+        socketList[0].sendall(b"GET / HTTP/1.1\r\nHost: 0.0.0.0:8080\r\n\r\nGET /partial")
+        pt.clientEndpoint.readFrom()
+        pt.serverEndpoint.writeTo()
+        assert socketList[3].recv(1024) == b"GET / HTTP/1.1\r\nHost: 127.0.0.1:80\r\n\r\n"
+
+
+
+class Test_ProxyTunnel_Capture:
+    def test_default_noCapture(self, createProxyTunnel):
+        pt, socketList = createProxyTunnel
+        assert pt.clientEndpoint.capture is None and pt.serverEndpoint.capture is None
+
+
+    def test_chunksCaptured(self, createProxyTunnel, tmp_path):
+        pt, socketList = createProxyTunnel
+        capture = SessionCapture(str(tmp_path))
+        pt = ProxyTunnel(socketList[1], socketList[2], pt.streamInterceptor.__class__, capture=capture)
+
+        socketList[0].sendall(b"request\r\n")
+        pt.clientEndpoint.readFrom()
+        socketList[3].sendall(b"response\r\n")
+        socketList[2].setblocking(False)
+        pt.serverEndpoint.readAll()
+        capture.close()
+
+        ## The chunks are recorded as read, with the direction they were read in
+        records = list(CaptureReader(str(tmp_path)).records(pt.captureId))
+        assert [(record.direction, record.payload) for record in records] == [
+            ("clientToServer", b"request\r\n"), ("serverToClient", b"response\r\n")]
+
+
+class Test_ProxyTunnel_Transparent:
+    class CountingInterceptor(StreamInterceptor):
+        ## NOTE: Neither hook is overridden (and there are no delimiters), so its tunnels are only relayed
+        tunnels = 0
+        def __init__(self) -> None:
+            Test_ProxyTunnel_Transparent.CountingInterceptor.tunnels += 1
+
+    def test_isTransparent(self, createProxyTunnel):
+        pt, socketList = createProxyTunnel
+        assert PassThroughInterceptor.isTransparent() is True
+        assert self.CountingInterceptor.isTransparent() is True
+        assert pt.streamInterceptor.isTransparent() is False
+        assert pt.transparent is False and isinstance(pt.clientToServerBuffer, Buffer)
+
+    def test_relayBuffers(self, createProxyTunnel):
+        pt, socketList = createProxyTunnel
+        pt = ProxyTunnel(socketList[1], socketList[2], self.CountingInterceptor)
+        assert pt.transparent is True
+        assert isinstance(pt.clientToServerBuffer, RelayBuffer) and isinstance(pt.serverToClientBuffer, RelayBuffer)
+        assert pt.hookQueue is None
+
+        socketList[0].sendall(b"no delimiters here")
+        assert pt.clientEndpoint.readFrom() == 18
+        assert pt.serverEndpoint.writeTo() == 18
+        assert socketList[3].recv(1024) == b"no delimiters here"
+        assert pt.clientToServerBuffer.sendable() == 0
+
+    def test_relayBuffers_memoryBudget(self):
+        memoryBudget = MemoryBudget(softLimit=100, hardLimit=200)
+        buffer = RelayBuffer(memoryBudget)
+        buffer.write(b"x" * 50)
+        assert memoryBudget.usage == buffer.memoryUsage() == 50
+        assert buffer.pop(20) == b"x" * 20
+        assert memoryBudget.usage == 30
+        buffer.releaseMemory()
+        assert memoryBudget.usage == 0
+
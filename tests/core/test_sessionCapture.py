@@ -0,0 +1,154 @@
+import os
+import sys
+import glob
+import threading
+import pytest
+
+
+sys.path.insert(0, os.path.join("..", "src"))
+sys.path.insert(0, "src")
+from _sessionCapture import CaptureReader, SessionCapture, RECORD_HEADER, SEGMENT_HEADER
+from _exceptions import *
+
+
+@pytest.fixture()
+def captureDirectory(tmp_path):
+    return str(tmp_path / "capture")
+
+
+class Test_SessionCapture_Append:
+    def test_records(self, captureDirectory):
+        capture = SessionCapture(captureDirectory)
+        first, second = capture.newTunnelId(), capture.newTunnelId()
+        capture.append(first, 0, b"USER anonymous\r\n")
+        capture.append(second, 0, b"GET / HTTP/1.1\r\n\r\n")
+        capture.append(first, 1, b"331 Password required\r\n")
+        capture.close()
+
+        records = list(CaptureReader(captureDirectory).records())
+        assert [(record.tunnelId, record.direction, record.payload) for record in records] == [
+            (first, "clientToServer", b"USER anonymous\r\n"),
+            (second, "clientToServer", b"GET / HTTP/1.1\r\n\r\n"),
+            (first, "serverToClient", b"331 Password required\r\n"),
+        ]
+        assert records[0].timestamp <= records[1].timestamp <= records[2].timestamp
+
+    def test_openSegmentScanned(self, captureDirectory):
+        capture = SessionCapture(captureDirectory)
+        capture._nextSegment.result(timeout=5)
+        capture.append(capture.newTunnelId(), 0, b"abc")
+        capture.append(capture.newTunnelId(), 1, b"")
+        ## The segment hasn't been closed (so it has no index, and its zeroed end isn't a record)
+        capture._submit(lambda: None).result(timeout=5)
+        reader = CaptureReader(captureDirectory)
+        assert [record.payload for record in reader.records()] == [b"abc", b""]
+        assert reader.tunnelIds() == [1, 2]
+        capture.close()
+
+    def test_rotation(self, captureDirectory):
+        payload = b"x" * 100
+        segmentSize = SEGMENT_HEADER.size + 3 * (RECORD_HEADER.size + len(payload))
+        capture = SessionCapture(captureDirectory, segmentSize=segmentSize)
+        tunnelIds = [capture.newTunnelId() for _ in range(2)]
+        for i in range(10):
+            capture.append(tunnelIds[i % 2], 0, payload)
+        ## A record that is larger than a segment gets a segment of its own
+        capture.append(tunnelIds[0], 1, b"y" * segmentSize)
+        capture.close()
+
+        reader = CaptureReader(captureDirectory)
+        assert len(reader.segments()) == 5
+        ## Closed segments are truncated to their records
+        assert os.path.getsize(reader.segments()[0]) == segmentSize
+        assert len(list(reader.records())) == 11
+        assert [len(record.payload) for record in reader.records(tunnelIds[0])] == [100] * 5 + [segmentSize]
+        assert len(list(reader.records(tunnelIds[1]))) == 5
+        ## The preallocated segment that wasn't used is removed
+        assert sorted(os.listdir(captureDirectory)) == sorted(os.path.basename(path) for path in
+                                                                reader.segments() + glob.glob(f"{captureDirectory}/*.idx"))
+
+    def test_rotation_offLoop(self, captureDirectory, monkeypatch):
+        payload = b"x" * 100
+        segmentSize = SEGMENT_HEADER.size + RECORD_HEADER.size + len(payload)
+        capture = SessionCapture(captureDirectory, segmentSize=segmentSize)
+        calledBy = {"_closeSegment": [], "_publishSegment": []}
+        for name in calledBy:
+            def recordingMethod(self, segment, method=getattr(SessionCapture, name), name=name):
+                calledBy[name].append(threading.current_thread())
+                method(self, segment)
+            monkeypatch.setattr(SessionCapture, name, recordingMethod)
+
+        tunnelId = capture.newTunnelId()
+        ## The first segment is preallocated too, but it's hidden from readers until it's used
+        capture._nextSegment.result(timeout=5)
+        assert len(CaptureReader(captureDirectory).segments()) == 0
+        capture.append(tunnelId, 0, payload)
+        capture._nextSegment.result(timeout=5)
+        capture.append(tunnelId, 0, payload)
+        capture.close()
+
+        ## The segments are renamed into place and closed by the writer
+        for threads in calledBy.values():
+            assert len(threads) == 2 and threading.current_thread() not in threads
+        assert [record.payload for record in CaptureReader(captureDirectory).records(tunnelId)] == [payload, payload]
+
+    def test_rotation_segmentNotReady(self, captureDirectory):
+        payload = b"x" * 100
+        segmentSize = SEGMENT_HEADER.size + RECORD_HEADER.size + len(payload)
+        capture = SessionCapture(captureDirectory, segmentSize=segmentSize)
+        ## The writer is held up, so none of the segments are ready
+        release = threading.Event()
+        capture._submit(release.wait, 5)
+
+        tunnelId = capture.newTunnelId()
+        for i in range(5):
+            capture.append(tunnelId, i % 2, payload + bytes([i]))
+        ## The records wait in memory (rather than the event loop blocking on the writer)
+        assert len(capture._backlog) == 5 and capture._segment is None
+        release.set()
+        capture.close()
+
+        reader = CaptureReader(captureDirectory)
+        assert len(reader.segments()) == 5
+        assert [record.payload for record in reader.records(tunnelId)] == [payload + bytes([i]) for i in range(5)]
+
+    def test_newCapture_appendsSegments(self, captureDirectory):
+        for payload in (b"first", b"second"):
+            capture = SessionCapture(captureDirectory)
+            capture.append(capture.newTunnelId(), 0, payload)
+            capture.close()
+        assert [record.payload for record in CaptureReader(captureDirectory).records()] == [b"first", b"second"]
+
+    def test_invalidSegmentSize(self, captureDirectory):
+        with pytest.raises(InvalidSessionCaptureError):
+            SessionCapture(captureDirectory, segmentSize=16)
+
+    def test_invalidSegment(self, captureDirectory):
+        os.makedirs(captureDirectory)
+        with open(os.path.join(captureDirectory, "capture-000001.seg"), "wb") as file:
+            file.write(b"not a capture segment")
+        with pytest.raises(InvalidCaptureFileError):
+            list(CaptureReader(captureDirectory).records())
+
+    def test_sessions_readOnce(self, captureDirectory, monkeypatch):
+        payload = b"x" * 100
+        capture = SessionCapture(captureDirectory, segmentSize=SEGMENT_HEADER.size + 2 * (RECORD_HEADER.size + len(payload)))
+        tunnelIds = [capture.newTunnelId() for _ in range(3)]
+        for i in range(9):
+            capture.append(tunnelIds[i % 3], i % 2, payload + bytes([i]))
+        capture.close()
+
+        reader = CaptureReader(captureDirectory)
+        readPaths, readSegment = [], CaptureReader._readSegment
+        def recordingReadSegment(self, path, tunnelId=None):
+            readPaths.append(path)
+            return readSegment(self, path, tunnelId)
+        monkeypatch.setattr(CaptureReader, "_readSegment", recordingReadSegment)
+
+        ## The records are dispatched by tunnel, with every segment read only once
+        sessions = reader.sessions()
+        assert sorted(readPaths) == sorted(reader.segments())
+        assert list(sessions) == tunnelIds
+        for offset, tunnelId in enumerate(tunnelIds):
+            assert [record.payload for record in sessions[tunnelId]] == [payload + bytes([i]) for i in range(offset, 9, 3)]
+        assert list(reader.sessions([tunnelIds[2], 99])) == [tunnelIds[2]]
@@ -0,0 +1,107 @@
+import os
+import sys
+import pytest
+
+
+sys.path.insert(0, os.path.join("..", "src"))
+sys.path.insert(0, "src")
+from _proxyDS import PassThroughInterceptor, StreamInterceptor
+from _sessionCapture import CaptureRecord, SessionCapture
+from session_replay import ReplayStats, replayCapture, replaySession
+from tcp_proxyinterceptors import HTTPProxyInterceptor
+from ftp_proxyinterceptor import FTPProxyInterceptor
+from _credentialIndex import BaitCredentialIndex
+
+
+class RecordingInterceptor(StreamInterceptor):
+    REQUEST_DELIMITERS = [b"\r\n"]
+    def __init__(self) -> None:
+        self.requests = []
+        RecordingInterceptor.instances.append(self)
+    def clientToServerHook(self, buffer, request) -> None:
+        self.requests.append(("clientToServer", bytes(request)))
+    def serverToClientHook(self, buffer, response) -> None:
+        self.requests.append(("serverToClient", bytes(response)))
+RecordingInterceptor.instances = []
+
+
+class BackendHostInterceptor(HTTPProxyInterceptor):
+    SERVER_ADDRESS = b"backend:80"
+
+
+def createCapture(directory, sessions):
+    capture = SessionCapture(directory)
+    for chunks in sessions:
+        tunnelId = capture.newTunnelId()
+        for direction, payload in chunks:
+            capture.append(tunnelId, direction, payload)
+    capture.close()
+
+
+class Test_SessionReplay_Session:
+    def test_hooksSeeCapturedStream(self):
+        RecordingInterceptor.instances.clear()
+        records = [CaptureRecord(1, "clientToServer", 0.0, b"USER a"), CaptureRecord(1, "clientToServer", 0.0, b"non\r\nPASS"),
+                   CaptureRecord(1, "serverToClient", 0.0, b"331 ok\r\n"), CaptureRecord(1, "clientToServer", 0.0, b" x\r\n")]
+        stats = replaySession(records, RecordingInterceptor)
+        assert RecordingInterceptor.instances[0].requests == [
+            ("clientToServer", b"USER anon\r\n"), ("serverToClient", b"331 ok\r\n"), ("clientToServer", b"PASS x\r\n")]
+        assert (stats.sessions, stats.chunks, stats.bytesIn, stats.bytesOut) == (1, 4, 27, 27)
+
+    def test_editsApplied(self):
+        head = b"GET / HTTP/1.1\r\nHost: 0.0.0.0:8080\r\n\r\n"
+        ## The head is split across chunks (as it was read)
+        records = [CaptureRecord(1, "clientToServer", 0.0, head[:10]), CaptureRecord(1, "clientToServer", 0.0, head[10:])]
+        stats = replaySession(records, BackendHostInterceptor)
+        assert stats.bytesIn == len(head)
+        assert stats.bytesOut == len(head) - len(b"0.0.0.0:8080") + len(b"backend:80")
+
+    def test_passThrough(self):
+        ## A transparent interceptor's tunnel is replayed with RelayBuffers (there are no hooks to wait for)
+        records = [CaptureRecord(1, "clientToServer", 0.0, b"GET / HTTP/1.1\r\n"), CaptureRecord(1, "serverToClient", 0.0, b"HTTP/1.1 200")]
+        stats = replaySession(records, PassThroughInterceptor)
+        assert (stats.chunks, stats.bytesIn, stats.bytesOut) == (2, 28, 28)
+
+    def test_awaitedHooks(self, tmp_path, monkeypatch):
+        index = BaitCredentialIndex.build(str(tmp_path / "bait.idx"), [("anonymous", "bait")])
+        monkeypatch.setattr(FTPProxyInterceptor, "BAIT_CREDENTIAL_INDEX", index)
+        checked = []
+        async def isBaitCredential(self, username, password):
+            checked.append((username, password))
+            return index.contains(username, password)
+        monkeypatch.setattr(FTPProxyInterceptor, "isBaitCredential", isBaitCredential)
+        chunks = [("serverToClient", b"220 (vsFTPd 3.0.3)\r\n"), ("clientToServer", b"USER anonymous\r\n"),
+                  ("serverToClient", b"331 Please specify the password.\r\n"), ("clientToServer", b"PASS bait\r\n"),
+                  ("serverToClient", b"230 Login successful.\r\n"), ("clientToServer", b"PORT 127,0,0,1,4,1\r\n")]
+        records = [CaptureRecord(1, direction, 0.0, payload) for direction, payload in chunks]
+
+        ## The login reply is held back by an awaited hook, and is sent on once the check is done
+        stats = replaySession(records, FTPProxyInterceptor)
+        assert checked == [("anonymous", "bait")]
+        assert (stats.chunks, stats.bytesOut) == (6, stats.bytesIn)
+
+
+class Test_SessionReplay_Capture:
+    SESSIONS = [
+        [(0, b"GET /a HTTP/1.1\r\nHost: 0.0.0.0:8080\r\n\r\n"), (1, b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok")],
+        [(0, b"GET /b HTTP/1.1\r\n"), (0, b"\r\n"), (1, b"HTTP/1.1 204 No Content\r\n\r\n")],
+        [(0, b"POST /c HTTP/1.1\r\nContent-Length: 3\r\n\r\nabc")],
+    ]
+
+    @pytest.mark.parametrize("workers", [None, 2])
+    def test_replayCapture(self, tmp_path, workers):
+        createCapture(str(tmp_path), self.SESSIONS)
+        stats = replayCapture(str(tmp_path), BackendHostInterceptor, workers=workers)
+        assert (stats.sessions, stats.chunks) == (3, 6)
+        assert stats.bytesIn == sum(len(payload) for chunks in self.SESSIONS for _, payload in chunks)
+        assert stats.bytesOut == stats.bytesIn - len(b"0.0.0.0:8080") + len(b"backend:80")
+
+    def test_selectedTunnels(self, tmp_path):
+        createCapture(str(tmp_path), self.SESSIONS)
+        assert replayCapture(str(tmp_path), HTTPProxyInterceptor, tunnelIds=[2, 3]).chunks == 4
+
+    def test_stats(self):
+        stats = ReplayStats(1, 2, 100, 100, 0.5) + ReplayStats(1, 1, 300, 300, 0.5)
+        assert (stats.sessions, stats.chunks, stats.bytesIn) == (2, 3, 400)
+        assert stats.throughput == 400
+        assert ReplayStats().throughput == 0
@@ -0,0 +1,97 @@
+import os
+import sys
+import socket
+import selectors
+import pytest
+
+
+sys.path.insert(0, os.path.join("..", "src"))
+sys.path.insert(0, "src")
+from _socketOptions import SOCKET_PROFILES, SocketProfile, TCP_QUICKACK, getSocketProfile
+from _proxyDS import PassThroughInterceptor, StreamInterceptor
+from tcp_proxyserver import ProxyConnections, ProxyTunnel
+from _exceptions import *
+
+
+@pytest.fixture()
+def connectedSockets():
+    with socket.create_server(("127.0.0.1", 0)) as server:
+        client = socket.create_connection(server.getsockname())
+        accepted, _ = server.accept()
+    yield client, accepted
+    client.close()
+    accepted.close()
+
+
+class Test_SocketOptions_Profiles:
+    def test_interactive(self, connectedSockets):
+        sock, _ = connectedSockets
+        SOCKET_PROFILES["interactive"].apply(sock)
+        assert sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY)
+        assert sock.getsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE)
+        if hasattr(socket, "TCP_KEEPIDLE"):
+            assert sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE) == 60
+
+    def test_bulk(self, connectedSockets):
+        sock, _ = connectedSockets
+        defaultReceiveBuffer = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+        SOCKET_PROFILES["bulk"].apply(sock)
+        ## The buffers are left to the kernel (setting them would turn off its automatic sizing)
+        assert SOCKET_PROFILES["bulk"].receiveBuffer is None and SOCKET_PROFILES["bulk"].autotuneLimit is None
+        assert sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF) == defaultReceiveBuffer
+        assert not sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY)
+
+    def test_closedSocket_ignored(self):
+        sock = socket.socket()
+        sock.close()
+        SOCKET_PROFILES["interactive"].apply(sock)
+
+    def test_getSocketProfile(self):
+        assert getSocketProfile(None) is None
+        assert getSocketProfile("bulk") is SOCKET_PROFILES["bulk"]
+        with pytest.raises(UnknownSocketProfileError):
+            getSocketProfile("fast")
+
+
+class Test_SocketOptions_Tunnels:
+    def test_unknownProfile_rejected(self):
+        class UnknownProfileInterceptor(PassThroughInterceptor):
+            SOCKET_PROFILE = "fast"
+        with pytest.raises(UnknownSocketProfileError):
+            ProxyConnections("127.0.0.1", 80, UnknownProfileInterceptor, selectors.DefaultSelector())
+
+    def test_tunnelProfile(self, connectedSockets):
+        clientSocket, serverSocket = connectedSockets
+        tunnel = ProxyTunnel(clientSocket, serverSocket, PassThroughInterceptor)
+        tunnel.applySocketProfile(SocketProfile(noDelay=True, quickAck=True))
+        assert clientSocket.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY)
+        assert serverSocket.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY)
+        assert tunnel.clientEndpoint.quickAck == (TCP_QUICKACK is not None)
+
+    def test_autotune(self, connectedSockets):
+        clientSocket, serverSocket = connectedSockets
+        tunnel = ProxyTunnel(serverSocket, clientSocket, PassThroughInterceptor)
+        tunnel.applySocketProfile(SocketProfile(receiveBuffer=4096, sendBuffer=4096, autotuneLimit=16384))
+        endpoint = tunnel.clientEndpoint
+        ## The buffers are doubled every AUTOTUNE_FACTOR buffers' worth of data, up to the limit
+        endpoint._tune(4096 * SocketProfile.AUTOTUNE_FACTOR - 1)
+        assert endpoint._bufferSize == 4096
+        endpoint._tune(1)
+        assert endpoint._bufferSize == 8192
+        assert serverSocket.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF) >= 8192
+        assert clientSocket.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF) >= 8192
+        endpoint._tune(8192 * SocketProfile.AUTOTUNE_FACTOR)
+        assert endpoint._bufferSize == 16384 and endpoint._autotuneLimit is None
+
+    def test_autotune_cappedByKernel(self, connectedSockets):
+        clientSocket, serverSocket = connectedSockets
+        tunnel = ProxyTunnel(serverSocket, clientSocket, PassThroughInterceptor)
+        tunnel.applySocketProfile(SocketProfile(receiveBuffer=4096, sendBuffer=4096, autotuneLimit=1 << 40))
+        endpoint = tunnel.clientEndpoint
+        ## NOTE: The kernel caps the size well below the limit (e.g. at rmem_max), so the tuning stops there
+        for _ in range(40):
+            endpoint._tune(endpoint._bufferSize * SocketProfile.AUTOTUNE_FACTOR)
+            if endpoint._autotuneLimit is None:
+                break
+        assert endpoint._autotuneLimit is None
+        assert endpoint._bufferSize < 1 << 40
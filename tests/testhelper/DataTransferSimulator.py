@@ -43,7 +43,8 @@ class DataTransferSimulator:
             dataChunks = cls._convertMessagesIntoChunks(dataMessages, chunkCount)
 
             ## the datetimes array must be in sorted in ascending order
-            ## TODO: We are not waiting for datetime Timestamp before sending (we only respect the orderings)
+            ## NOTE: We are not waiting for datetime Timestamp before sending (we only respect the orderings)
+            ## --> Use testhelper.LoadGenerator to honor the timings across many concurrent connections
             dt = datetimes[0] - datetime.timedelta(seconds=1)
             for index, chunk in enumerate(dataChunks):
                 ## we finally select the datetime for each index (  datetime_i <= datetime_i+1)
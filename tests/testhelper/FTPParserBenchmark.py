@@ -0,0 +1,70 @@
+import os
+import re
+import sys
+import time
+from typing import Callable, List, Optional
+
+sys.path.insert(0, os.path.join("..", "src"))
+sys.path.insert(0, "src")
+from _ftpParser import commandVerb, commandArgument, replyCode
+
+
+## Microbenchmark (messages/s) of the bytes parser against the str helpers it replaced
+## Usage: python tests/testhelper/FTPParserBenchmark.py [iterations]
+
+COMMANDS = [bytearray(b"USER anonymous\r\n"), bytearray(b"PASS secret\r\n"), bytearray(b"CWD /pub\r\n"),
+            bytearray(b"TYPE I\r\n"), bytearray(b"PASV\r\n"), bytearray(b"RETR file.bin\r\n")]
+REPLIES = [bytearray(b"331 Please specify the password.\r\n"), bytearray(b"230 Login successful.\r\n"),
+           bytearray(b"250 Directory successfully changed.\r\n"), bytearray(b"200 Switching to Binary mode.\r\n"),
+           bytearray(b"227 Entering Passive Mode (127,0,0,1,195,80).\r\n"), bytearray(b"226 Transfer complete.\r\n")]
+
+
+## The str helpers (as they were in FTPProxyInterceptor) - each message is decoded first
+def _legacyIsUSERRequest(request: str) -> bool:
+    return re.search(r'^\s*USER', request) is not None
+
+def _legacyGetArgument(request: str) -> str:
+    request = request.strip(" \r\n")
+    entities = [entity.strip(" ") for entity in request.split(" ")]
+    return entities[1] if len(entities) == 2 else ""
+
+def _legacyGetResponseCode(response: str) -> Optional[int]:
+    ret = re.search(r'^\s*([1-5][0-5][0-9])', response)
+    if ret is None:
+        return None
+    return int(ret.group(1))
+
+
+def legacyParse(command: bytearray, reply: bytearray) -> None:
+    request, response = command.decode("latin-1"), reply.decode("latin-1")
+    _legacyIsUSERRequest(request)
+    _legacyGetArgument(request)
+    _legacyGetResponseCode(response)
+
+def bytesParse(command: bytearray, reply: bytearray) -> None:
+    commandVerb(command)
+    commandArgument(command)
+    replyCode(reply)
+
+
+def messagesPerSecond(parse: Callable[[bytearray, bytearray], None], iterations: int) -> float:
+    pairs = list(zip(COMMANDS, REPLIES))
+    start = time.perf_counter()
+    for _ in range(iterations):
+        for command, reply in pairs:
+            parse(command, reply)
+    elapsed = time.perf_counter() - start
+    ## NOTE: Each pair is two messages (a command and its reply)
+    return 2 * len(pairs) * iterations / elapsed
+
+
+def main(argv: List[str]) -> None:
+    iterations = int(argv[1]) if len(argv) > 1 else 100_000
+    legacy = messagesPerSecond(legacyParse, iterations)
+    parser = messagesPerSecond(bytesParse, iterations)
+    print(f"str/regex helpers: {legacy:,.0f} messages/s")
+    print(f"bytes parser:      {parser:,.0f} messages/s ({parser / legacy:.2f}x)")
+
+
+if __name__ == "__main__":
+    main(sys.argv)
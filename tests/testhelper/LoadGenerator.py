@@ -0,0 +1,357 @@
+import os
+import sys
+import errno
+import heapq
+import math
+import time
+import random
+import socket
+import selectors
+import datetime
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+sys.path.insert(0, os.path.join("..", "src"))
+sys.path.insert(0, "src")
+from _proxyDS import Buffer
+from testhelper.DataTransferSimulator import DataTransferSimulator
+
+
+## NOTE: Each delimited message starts with a fixed width (hex) sequence id
+## --> The echoed message is matched back to its send timestamp using this id
+SEQUENCE_ID_LENGTH = 8
+
+
+@dataclass
+class LoadConnection:
+    sock: socket.socket
+    chunks: List[bytes]
+    offsets: List[float]                    ## seconds relative to the first chunk
+    messageEnds: List[Tuple[int, int]]      ## (stream offset after delimiter, sequenceId)
+    sentData: bytes
+
+    startTime: float = field(default=0.0)
+    connectStart: Optional[float] = field(default=None)     ## set once the connection attempt is made
+    connectTime: Optional[float] = field(default=None)      ## seconds until the connection was established
+    nextChunk: int = field(default=0)
+    sentBytes: int = field(default=0)
+    outstanding: int = field(default=0)
+    receivedData: bytearray = field(default_factory=bytearray)
+    _outbound: bytearray = field(default_factory=bytearray)
+    _nextMessageEnd: int = field(default=0)
+    _responseBuffer: Buffer = field(init=False, repr=False)
+
+    def isComplete(self) -> bool:
+        return len(self.receivedData) >= len(self.sentData)
+
+
+class LoadGenerator:
+    """Drives many connections concurrently from a single selector loop
+
+    Each connection replays a stream built from a DataTransferSimulator
+    connSender (data size, message count, chunk count, delimiters and
+    datetimes). Unlike DataTransferSimulator.sendMultiConnMultiMessage() the
+    gaps between the datetimes are honored, and every delimited message
+    carries a sequence id so that the per-message roundtrip latency can be
+    recorded once the echo comes back.
+
+    The connections are opened by run() (non-blocking), on the arrival
+    schedule. The messages of a connection's first chunk are timed from its
+    connection attempt, so their latency includes the connection setup.
+
+    - "open" mode:   connections arrive at a fixed `arrivalRate` (connections/s),
+                     and chunks are sent on schedule regardless of responses
+    - "closed" mode: every connection arrives immediately, but a chunk is only
+                     sent once all messages completed by previous chunks have
+                     been echoed back (the gap is measured from that point)
+    """
+    MODES = ("open", "closed")
+
+    def __init__(self, address: Tuple[str, int], completeConnSender: Callable,
+                        mode: str = "closed", arrivalRate: Optional[float] = None,
+                        timeScale: float = 1.0, recvSize: int = 4096) -> None:
+        if mode not in self.MODES:
+            raise ValueError(f"Invalid load generator mode - {mode} (expected one of {self.MODES})")
+        if mode == "open" and not (arrivalRate and arrivalRate > 0):
+            raise ValueError(f"An open-loop load generator requires a positive arrivalRate - {arrivalRate}")
+        if timeScale < 0:
+            raise ValueError(f"timeScale must be non-negative - {timeScale}")
+
+        self.address = address
+        self.completeConnSender = completeConnSender
+        self.mode = mode
+        self.arrivalRate = arrivalRate
+        self.timeScale = timeScale
+        self.recvSize = recvSize
+
+        self._selector = selectors.DefaultSelector()
+        self._connections: List[LoadConnection] = []
+        self._timers: List[Tuple[float, int, int]] = []  ## heap of (dueTime, tiebreaker, connectionIndex)
+        self._timerCounter = 0
+        self._nextSequenceId = 0
+        self._sendTimes: Dict[int, float] = {}
+        self.latencies: Dict[int, float] = {}
+
+
+    ############### Setup #######################
+    def createConnections(self, connectionCount: int) -> List[socket.socket]:
+        """Prepares the sockets and send schedules of `connectionCount`
+        connections (they're only connected once run() reaches their arrival)"""
+        for _ in range(connectionCount):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setblocking(False)
+            self._connections.append(self._createConnection(sock))
+        return [connection.sock for connection in self._connections]
+
+
+    def _createConnection(self, sock: socket.socket) -> LoadConnection:
+        dataSize, messageCount, chunkCount, delimiters, datetimes, isEndDelimited = self.completeConnSender()
+        stream, messageEnds = self._createSequencedStream(dataSize, messageCount, delimiters, isEndDelimited)
+
+        ## NOTE: The chunker requires at least one split point per additional chunk
+        chunkCount = max(1, min(chunkCount, len(stream) - 1))
+        chunks = DataTransferSimulator._convertMessagesIntoChunks(stream, chunkCount)
+        offsets = self._convertDatetimesIntoOffsets(datetimes[:len(chunks)], len(chunks))
+
+        connection = LoadConnection(sock, chunks, offsets, messageEnds, bytes(stream))
+        connection._responseBuffer = Buffer(list(dict.fromkeys(delimiters)) or [b"\r\n"])
+        return connection
+
+
+    def _createSequencedStream(self, dataSize: int, messageCount: int, delimiters: List[bytes],
+                                    isEndDelimited: bool) -> Tuple[bytearray, List[Tuple[int, int]]]:
+        ## NOTE: Mirrors DataTransferSimulator._convertStreamIntoMessages() - there are `messageCount`
+        ## delimited messages, followed by an undelimited tail if `isEndDelimited` is False
+        segmentCount = messageCount + int(not isEndDelimited)
+        data = DataTransferSimulator._generateData(max(dataSize, segmentCount))
+        splits = [0] + sorted(random.sample(range(1, len(data)), segmentCount - 1)) + [len(data)]
+
+        delimiters = iter(delimiters)
+        stream, messageEnds = bytearray(), []
+        for index in range(segmentCount):
+            segment = data[splits[index]:splits[index+1]]
+            if index == messageCount:
+                ## undelimited tail (no sequence id, as it is never echoed as a complete message)
+                stream += segment
+                break
+
+            sequenceId = self._nextSequenceId
+            self._nextSequenceId += 1
+            stream += b"%0*x" % (SEQUENCE_ID_LENGTH, sequenceId) + segment + next(delimiters)
+            messageEnds.append((len(stream), sequenceId))
+
+        return stream, messageEnds
+
+
+    def _convertDatetimesIntoOffsets(self, datetimes: List[datetime.datetime], chunkCount: int) -> List[float]:
+        if not datetimes:
+            return [0.0] * chunkCount
+        offsets = [(dt - datetimes[0]).total_seconds() * self.timeScale for dt in datetimes]
+        ## If fewer datetimes than chunks were provided (e.g. chunkCount was clamped), the rest are sent immediately
+        return offsets + [offsets[-1]] * (chunkCount - len(offsets))
+
+
+    ############### Event Loop #######################
+    def run(self, timeout: Optional[float] = None) -> Dict[int, float]:
+        """Runs until every connection has received its echoed stream (or
+        the timeout expires) and returns {sequenceId: latency (seconds)}"""
+        startTime = time.monotonic()
+        deadline = math.inf if timeout is None else startTime + timeout
+
+        ## NOTE: The first timer of a connection opens it (see _fireTimers())
+        for index, connection in enumerate(self._connections):
+            if self.mode == "open":
+                connection.startTime = startTime + index / self.arrivalRate
+            else:
+                connection.startTime = startTime
+            self._scheduleNextChunk(index, connection.startTime)
+
+        remaining = sum(1 for connection in self._connections if not connection.isComplete())
+        while remaining:
+            now = time.monotonic()
+            if now >= deadline:
+                raise TimeoutError(f"LoadGenerator timed out with {remaining} incomplete connections")
+
+            self._fireTimers(now)
+            selectTimeout = min(self._timers[0][0] - now if self._timers else 0.1, deadline - now)
+            for selectorKey, bitmask in self._selector.select(timeout=max(selectTimeout, 0)):
+                index = selectorKey.data
+                if self._connections[index].connectTime is None:
+                    self._completeConnect(index)
+                    continue
+                if bitmask & selectors.EVENT_WRITE:
+                    self._sendOutbound(index)
+                if bitmask & selectors.EVENT_READ:
+                    if self._receive(index) and self._connections[index].isComplete():
+                        remaining -= 1
+
+        return self.latencies
+
+
+    def _scheduleNextChunk(self, index: int, dueTime: float) -> None:
+        self._timerCounter += 1
+        heapq.heappush(self._timers, (dueTime, self._timerCounter, index))
+
+
+    def _fireTimers(self, now: float) -> None:
+        while self._timers and self._timers[0][0] <= now:
+            _, _, index = heapq.heappop(self._timers)
+            if self._connections[index].connectStart is None:
+                self._startConnect(index)
+            else:
+                self._queueChunk(index)
+
+
+    def _startConnect(self, index: int) -> None:
+        connection = self._connections[index]
+        connection.connectStart = time.monotonic()
+        error = connection.sock.connect_ex(self.address)
+        if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN):
+            raise ConnectionError(f"Connection {index} failed to connect - {os.strerror(error)}")
+        ## NOTE: The socket is writable once the handshake is done
+        self._selector.register(connection.sock, selectors.EVENT_WRITE, data=index)
+
+
+    def _completeConnect(self, index: int) -> None:
+        connection = self._connections[index]
+        error = connection.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error:
+            raise ConnectionError(f"Connection {index} failed to connect - {os.strerror(error)}")
+        connection.connectTime = time.monotonic() - connection.connectStart
+        self._selector.modify(connection.sock, selectors.EVENT_READ, data=index)
+        self._queueChunk(index)
+
+
+    def _queueChunk(self, index: int) -> None:
+        connection = self._connections[index]
+        connection._outbound += connection.chunks[connection.nextChunk]
+        connection.nextChunk += 1
+        self._sendOutbound(index)
+
+
+    def _sendOutbound(self, index: int) -> None:
+        connection = self._connections[index]
+        try:
+            bytesSent = connection.sock.send(connection._outbound)
+        except BlockingIOError:
+            bytesSent = 0
+        del connection._outbound[:bytesSent]
+        connection.sentBytes += bytesSent
+
+        ## record the send time of each message that has been fully handed over to the kernel
+        ## NOTE: The first chunk's messages are timed from the connection attempt (so the setup is measured)
+        now = time.monotonic()
+        sendTime = connection.connectStart if connection.nextChunk == 1 else now
+        while (connection._nextMessageEnd < len(connection.messageEnds)
+                and connection.messageEnds[connection._nextMessageEnd][0] <= connection.sentBytes):
+            self._sendTimes[connection.messageEnds[connection._nextMessageEnd][1]] = sendTime
+            connection._nextMessageEnd += 1
+            connection.outstanding += 1
+
+        ## only poll for EVENT_WRITE while there is a backlog to flush
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if connection._outbound else 0)
+        if self._selector.get_key(connection.sock).events != events:
+            self._selector.modify(connection.sock, events, data=index)
+
+        if connection._outbound or connection.nextChunk >= len(connection.chunks):
+            return None
+
+        ## schedule the next chunk once the current one has been flushed
+        ## closed-loop: wait for the outstanding messages to be echoed (see _receive())
+        if self.mode == "open":
+            self._scheduleNextChunk(index, connection.startTime + connection.offsets[connection.nextChunk])
+        elif connection.outstanding == 0:
+            self._scheduleNextChunk(index, now + self._chunkGap(connection))
+
+
+    def _chunkGap(self, connection: LoadConnection) -> float:
+        return connection.offsets[connection.nextChunk] - connection.offsets[connection.nextChunk - 1]
+
+
+    def _receive(self, index: int) -> bool:
+        connection = self._connections[index]
+        try:
+            data = connection.sock.recv(self.recvSize)
+        except BlockingIOError:
+            return False
+        if not data:
+            raise ConnectionError(f"Connection {index} was closed before its stream was echoed back")
+
+        connection.receivedData += data
+        now = time.monotonic()
+        responses = self._parseResponses(connection, data)
+        for response in responses:
+            sequenceId = int(response[:SEQUENCE_ID_LENGTH], 16)
+            self.latencies[sequenceId] = now - self._sendTimes[sequenceId]
+            connection.outstanding -= 1
+
+        ## closed-loop: the next chunk can be sent once all messages have been echoed back
+        if (self.mode == "closed" and responses and connection.outstanding == 0
+                and not connection._outbound and connection.nextChunk < len(connection.chunks)):
+            self._scheduleNextChunk(index, now + self._chunkGap(connection))
+
+        return True
+
+
+    def _parseResponses(self, connection: LoadConnection, data: bytes) -> Deque[bytearray]:
+        responses = deque()
+        connection._responseBuffer._requestHook = responses.append
+        connection._responseBuffer.write(data)
+        connection._responseBuffer.pop(-1)
+        return responses
+
+
+    ############### Results #######################
+    def latencySummary(self) -> Dict[str, float]:
+        """Returns count/mean/p50/p90/p99/max of the recorded latencies (seconds)"""
+        latencies = sorted(self.latencies.values())
+        if not latencies:
+            return {"count": 0}
+
+        def percentile(p: float) -> float:
+            return latencies[min(len(latencies) - 1, int(math.ceil(p * len(latencies))) - 1)]
+
+        return {
+            "count": len(latencies),
+            "mean": sum(latencies) / len(latencies),
+            "p50": percentile(0.50),
+            "p90": percentile(0.90),
+            "p99": percentile(0.99),
+            "max": latencies[-1],
+        }
+
+
+    def connectSummary(self) -> Dict[str, float]:
+        """Returns count/mean/max of the connection setup times (seconds), and
+        the arrival rate that was achieved (connections/s)"""
+        connected = [connection for connection in self._connections if connection.connectTime is not None]
+        if not connected:
+            return {"count": 0}
+        connectTimes = [connection.connectTime for connection in connected]
+        starts = sorted(connection.connectStart for connection in connected)
+        span = starts[-1] - starts[0]
+        return {
+            "count": len(connected),
+            "mean": sum(connectTimes) / len(connectTimes),
+            "max": max(connectTimes),
+            "arrivalRate": (len(starts) - 1) / span if span > 0 else math.inf,
+        }
+
+
+    def connectionData(self) -> List[bytes]:
+        """Returns the streams sent by each connection (same format as
+        DataTransferSimulator.sendMultiConnMultiMessage())"""
+        return [connection.sentData for connection in self._connections]
+
+
+    def receivedData(self) -> List[bytes]:
+        return [bytes(connection.receivedData) for connection in self._connections]
+
+
+    def close(self) -> None:
+        for connection in self._connections:
+            if connection.connectStart is not None:
+                self._selector.unregister(connection.sock)
+            connection.sock.close()
+        self._selector.close()
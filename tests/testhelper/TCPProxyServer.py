@@ -85,7 +85,7 @@ class TPSTestResources:
         registeredConnections = {}
         for _, key in proxyServer.selector.get_map().items():
             sock = key.fileobj
-            if proxyServer.serverSocket != sock:
+            if sock not in (proxyServer.serverSocket, proxyServer._wakeupReader):
                 registeredConnections[(sock.getsockname(), sock.getpeername())] = sock
         return registeredConnections
 
@@ -95,7 +95,7 @@ class TPSTestResources:
         ## it should be added to the selector (correct  key, no duplicates)
         ## There should be two fd's socket server, and new connection and proxy
         ## We check that the selector has the correct number of fd being polled
-        assert len(proxyServer.selector.get_map()) == 1 + len(connections)*2 ## serverSock + 2 endpoints for each connection
+        assert len(proxyServer.selector.get_map()) == 2 + len(connections)*2 ## serverSock + wakeup socket + 2 endpoints for each connection
 
         ## checking server socket is logged
         serverSocketKey = proxyServer.selector.get_key(proxyServer.serverSocket)
@@ -108,7 +108,7 @@ class TPSTestResources:
 
         ## for each user connection, there should be two sockets managed by server 
         ## (this ensure equal number of types of sockets (clientTOProxy, and ProxyToServer))
-        assert len(proxyServer.selector.get_map()) == 1 + len(connections)*2 ## serverSock + 2 endpoints for each connection
+        assert len(proxyServer.selector.get_map()) == 2 + len(connections)*2 ## serverSock + wakeup socket + 2 endpoints for each connection
         assert len(registeredSockNames) == len(connections) * 2
 
         ## Here we perform assertions on the client <--> proxy connections
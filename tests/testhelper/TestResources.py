@@ -1,5 +1,6 @@
 import os
 import sys
+import asyncio
 import socket
 import collections
 from typing import Tuple, List
@@ -23,14 +24,28 @@ class PTTestResources:
                 self.clientToServerDeque = collections.deque([])
                 self.serverToClientDeque = collections.deque([])
 
-            def clientToServerHook(self, request: bytearray) -> None:
+            def clientToServerHook(self, buffer: Buffer, request: bytearray) -> None:
                 self.clientToServerDeque.append(request)
 
-            def serverToClientHook(self, response: bytearray) -> None:
+            def serverToClientHook(self, buffer: Buffer, response: bytearray) -> None:
                 self.serverToClientDeque.append(response)
 
         return mockStreamInterceptor
 
+    @staticmethod
+    def createMockAsyncStreamInterceptor():
+        ## NOTE: The hooks are awaited off the event loop thread (and hold back each message until they return)
+        class mockAsyncStreamInterceptor(PTTestResources.createMockStreamInterceptor()):
+            async def clientToServerHook(self, buffer: Buffer, request: bytearray) -> None:
+                await asyncio.sleep(0.001)
+                self.clientToServerDeque.append(request)
+
+            async def serverToClientHook(self, buffer: Buffer, response: bytearray) -> None:
+                await asyncio.sleep(0.001)
+                self.serverToClientDeque.append(response)
+
+        return mockAsyncStreamInterceptor
+
     @staticmethod
     def createClientSocket() -> socket.socket:
         clientSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
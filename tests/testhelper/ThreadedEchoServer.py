@@ -11,6 +11,7 @@ class EchoServer:
         self._exitFlag = False
         self._mainThread = threading.Thread(target=self._run, args=(HOST, PORT,))
         self._selector = selectors.DefaultSelector()
+        self._listeningEvent = threading.Event()
         self._counterEvent = threading.Event()
         self._counterLock = threading.Lock()
         self._counterTarget = 0
@@ -21,19 +22,23 @@ class EchoServer:
         with socket.socket() as serverSock:
             try:
                 serverSock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-                serverSock.setblocking(False)
+                ## NOTE: Timeouts (rather than non-blocking sockets) so the threads don't spin while idle
+                ## --> Otherwise the accept loop is starved (GIL) once many connections are serviced
+                serverSock.settimeout(0.1)
                 serverSock.bind((HOST, PORT))
                 serverSock.listen()
             except Exception as e:
                 print(f"EchoServer server Exception: {e}")
                 raise e
+            finally:
+                self._listeningEvent.set()
             print(f"Running Echo Server @ {HOST}:{PORT}")
 
             try:
                 while self._exitFlag is False:
                     try:
                         conn, addr = serverSock.accept()
-                    except BlockingIOError:
+                    except socket.timeout:
                         continue
 
                     self._instantiateNewThread(conn)
@@ -45,7 +50,7 @@ class EchoServer:
     def _serviceConnection(self, conn: socket.socket, index: int) -> None:
         with conn:
             try:
-                conn.setblocking(False)
+                conn.settimeout(0.1)
                 while self._exitFlag is False and self._threadExit[index] is False:
                     try:
                         data = conn.recv(1024)
@@ -62,7 +67,9 @@ class EchoServer:
                 self._updateCounterEvent(-1)
 
     def run(self) -> None:
-        return self._mainThread.start()
+        self._mainThread.start()
+        ## NOTE: Returns once the server is listening, so the proxy's backend connects aren't refused
+        self._listeningEvent.wait()
 
     def close(self) -> None:
         ## set exitFlag to exit eventLoop in self._run